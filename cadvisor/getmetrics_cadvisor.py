@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import ConfigParser
+import array
 import collections
 import json
 import logging
@@ -243,6 +244,8 @@ def get_if_config_vars():
             if_url = config_parser.get('insightfinder', 'if_url')
             if_http_proxy = config_parser.get('insightfinder', 'if_http_proxy')
             if_https_proxy = config_parser.get('insightfinder', 'if_https_proxy')
+            metric_aggregation = config_parser.get('insightfinder', 'metric_aggregation') if config_parser.has_option(
+                'insightfinder', 'metric_aggregation') else ''
         except ConfigParser.NoOptionError:
             logger.error('Agent not correctly configured ([insightfinder]). Check config file.')
             sys.exit(1)
@@ -294,6 +297,10 @@ def get_if_config_vars():
             chunk_size_kb = 2048  # 2MB chunks by default
         if len(if_url) == 0:
             if_url = 'https://app.insightfinder.com'
+        metric_aggregation = metric_aggregation.lower() or 'median'
+        if metric_aggregation not in METRIC_AGGREGATIONS:
+            logger.warning('Agent not correctly configured (metric_aggregation). Check config file.')
+            sys.exit(1)
 
         # set IF proxies
         if_proxies = dict()
@@ -311,7 +318,8 @@ def get_if_config_vars():
             'sampling_interval': int(sampling_interval),     # as seconds
             'chunk_size': int(chunk_size_kb) * 1024,         # as bytes
             'if_url': if_url,
-            'if_proxies': if_proxies
+            'if_proxies': if_proxies,
+            'metric_aggregation': metric_aggregation
         }
 
         return config_vars
@@ -495,6 +503,11 @@ def get_json_size_bytes(json_data):
     return len(bytearray(json.dumps(json_data)))
 
 
+def get_json_separator_size(json_data):
+    """ size of the ', ' that json.dumps puts before every item but the first """
+    return 2 if len(json_data) > 1 else 0
+
+
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for index in xrange(0, len(l), n):
@@ -887,6 +900,8 @@ def reset_track():
     track['line_count'] = 0
     track['current_row'] = []
     track['current_dict'] = dict()
+    track['current_dict_size'] = 2  # '{}'
+    track['metric_samples'] = []
 
 
 #########################################
@@ -934,10 +949,10 @@ def prepare_log_entry(timestamp, data, instance, device=''):
 def metric_handoff(timestamp, field_name, data, instance, device=''):
     append_metric_data_to_entry(timestamp, field_name, data, instance, device)
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_dict']) >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
+    if track['current_dict_size'] >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 500 == 0:
-        logger.debug('Current data object size: ' + str(get_json_size_bytes(track['current_dict'])) + ' bytes')
+        logger.debug('Current data object size: ' + str(track['current_dict_size']) + ' bytes')
 
 
 def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''):
@@ -946,30 +961,53 @@ def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''
     ts_str = str(timestamp)
     if ts_str not in track['current_dict']:
         track['current_dict'][ts_str] = dict()
+        # '"<ts>": {}'
+        track['current_dict_size'] += get_json_size_bytes(ts_str) + 4 + get_json_separator_size(track['current_dict'])
     current_obj = track['current_dict'][ts_str]
 
-    # use the next non-null value to overwrite the prev value
-    # for the same metric in the same timestamp
-    if key in current_obj.keys():
+    # keep each non-null value for the same metric in the same timestamp,
+    # to be aggregated when the chunk is sent
+    if key in current_obj:
         if data is not None and len(str(data)) > 0:
-            current_obj[key] += '|' + str(data)
+            add_metric_sample(current_obj, key, data)
     else:
         current_obj[key] = str(data)
+        # '"<key>": "<value>"'
+        track['current_dict_size'] += get_json_size_bytes(key) + 2 + get_json_size_bytes(current_obj[key]) + \
+            get_json_separator_size(current_obj)
     track['current_dict'][ts_str] = current_obj
 
 
+def add_metric_sample(current_obj, key, data):
+    """ add another value to a metric at a timestamp, keeping them as doubles until they're aggregated """
+    samples = current_obj[key]
+    if not isinstance(samples, array.array):
+        # the aggregate can be as long as any float
+        track['current_dict_size'] += max(METRIC_VALUE_SIZE - len(samples), 0)
+        samples = current_obj[key] = array.array('d', [float(samples)])
+        track['metric_samples'].append((current_obj, key))
+    samples.append(float(data))
+
+
 def transpose_metrics():
     """ flatten data up to the timestamp"""
-    for timestamp in track['current_dict'].keys():
+    # aggregate every metric with more than one value in one pass
+    aggregate = METRIC_AGGREGATIONS[if_config_vars['metric_aggregation']]
+    for current_obj, key in track['metric_samples']:
+        current_obj[key] = str(aggregate(current_obj[key]))
+    for timestamp, kvs in track['current_dict'].items():
         track['line_count'] += 1
-        new_row = dict()
-        new_row['timestamp'] = timestamp
-        for key in track['current_dict'][timestamp]:
-            value = track['current_dict'][timestamp][key]
-            if '|' in value:
-                value = statistics.median(map(lambda v: float(v), value.split('|')))
-            new_row[key] = str(value)
-        track['current_row'].append(new_row)
+        kvs['timestamp'] = timestamp
+        track['current_row'].append(kvs)
+
+
+def get_median(values):
+    """ median of a list of numbers, as statistics.median """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
 
 
 ################################
@@ -1140,6 +1178,14 @@ if __name__ == "__main__":
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = ','
     ATTEMPTS = 3
+    METRIC_AGGREGATIONS = {
+        'median': get_median,
+        'mean': lambda values: sum(values) / len(values),
+        'min': min,
+        'max': max,
+        'last': lambda values: values[-1]
+    }
+    METRIC_VALUE_SIZE = 19  # longest str() of a float
     track = dict()
 
     # get config
@@ -1,6 +1,7 @@
 import collections
 import csv
 import datetime
+import heapq
 import itertools
 import json
 import logging
@@ -18,7 +19,11 @@ home_path = ''
 server_url = ''
 data_dir = ''
 logger = None
+csv_offsets = None
 previous_results_filename = "previous_results.json"
+csv_offsets_filename = "csv_offsets.json"
+cpu_average_files = ['aggregation-cpu-average/cpu-system-', 'aggregation-cpu-average/cpu-user-',
+                     'aggregation-cpu-average/cpu-idle-']
 
 
 def get_input_from_user():
@@ -137,12 +142,14 @@ def set_from_reporting_config_json():
     return reporting_interval_l, hostname_l, hostname_short_l, prev_endtime_l, csvpath_l, date_l
 
 
+def is_cleanup_time():
+    # time between which each day the deletion is done
+    return datetime.time(06, 30) <= datetime.datetime.now().time() <= datetime.time(20, 35)
+
+
 # deletes old csv files from a directory
 def remove_old_files(directory, filetype):
-    now = datetime.datetime.now()
-    now_time = now.time()
-    # time between which each day the deletion is done
-    if datetime.time(06, 30) <= now_time <= datetime.time(20, 35):
+    if is_cleanup_time():
         # data directory path
         data_file_path = directory
         # data_file_path = os.path.join(homepath,datadir)
@@ -191,6 +198,19 @@ def get_previous_results():
         return json.load(f)
 
 
+def get_csv_offsets():
+    """ where each collectd csv file was read up to, and the day old files were last removed """
+    if not os.path.isfile(os.path.join(home_path, data_dir + csv_offsets_filename)):
+        return {'offsets': {}, 'cleanup_date': ''}
+    with open(os.path.join(home_path, data_dir + csv_offsets_filename), 'r') as f:
+        return json.load(f)
+
+
+def update_csv_offsets(csv_offsets_l):
+    with open(os.path.join(home_path, data_dir + csv_offsets_filename), 'w') as f:
+        json.dump(csv_offsets_l, f)
+
+
 def set_epoch_time(reporting_interval_l, prev_endtime_l):
     if prev_endtime_l != "0":
         start_time = prev_endtime_l
@@ -249,7 +269,6 @@ def send_data(metric_data_l, reporting_interval_l, hostname_l):
 
 
 def aggregate_results_into_raw_data(start_time_epoch_l, new_prev_endtime_epoch_l, date_l):
-    raw_data_l = collections.OrderedDict()
     filenames = {'cpu/percent-active-': ['CPU'], 'memory/memory-used-': ['MemUsed'],
                  'load/load-': ['LoadAvg1', 'LoadAvg5', 'LoadAvg15'], 'df-root/percent_bytes-used-': ['DiskUsed'],
                  'processes/ps_state-blocked-': ['BlockedProcess'], 'processes/ps_state-paging-': ['PagingProcess'],
@@ -257,133 +276,110 @@ def aggregate_results_into_raw_data(start_time_epoch_l, new_prev_endtime_epoch_l
                  'processes/ps_state-sleeping-': ['SleepingProcess'], 'processes/ps_state-stopped-': ['StoppedProcess'],
                  'processes/ps_state-zombies-': ['ZombieProcess']}
 
-    all_latest_timestamps = []
     # Calculate average CPU
-    aggregate_cpu = remove_old_files_and_update_filesnames(filenames)
+    aggregate_cpu = remove_old_files_and_update_filesnames(filenames, date_l)
+    series = [each_file for each_file in filenames if not (aggregate_cpu and "cpu/percent-active" in each_file)]
+    if aggregate_cpu:
+        series.extend(cpu_average_files)
     # Collect info from /var/lib/collectd/
-    set_raw_data_from_collectd_dir(aggregate_cpu, all_latest_timestamps, date_l, filenames, new_prev_endtime_epoch_l,
-                                   raw_data_l, start_time_epoch_l)
-    # update endtime_epoch from recent data load
-    new_prev_endtime_epoch_l = max(all_latest_timestamps)
+    new_prev_endtime_epoch_l, raw_data_l = merge_collectd_series(series, filenames, new_prev_endtime_epoch_l,
+                                                                 start_time_epoch_l, date_l)
     return new_prev_endtime_epoch_l, raw_data_l
 
 
-def remove_old_files_and_update_filesnames(filenames):
+def remove_old_files_and_update_filesnames(filenames, date_l):
     all_directories = os.listdir(csvpath)
     # aggregate cou for collectd version < 5.5
     aggregate_cpu = False
-    # remove old csv files in datadir
-    remove_old_files(os.path.join(home_path, data_dir), 'csv')
+    # remove old files once a day, rather than listing every collectd directory on every run
+    if csv_offsets['cleanup_date'] != date_l and is_cleanup_time():
+        # remove old csv files in datadir
+        remove_old_files(os.path.join(home_path, data_dir), 'csv')
+        for each_dir in all_directories:
+            # remove old collectd log files
+            remove_old_files(os.path.join(csvpath, each_dir), None)
+        csv_offsets['cleanup_date'] = date_l
 
     for each_dir in all_directories:
-        # remove old collectd log files
-        remove_old_files(os.path.join(csvpath, each_dir), None)
-
         if "disk" in each_dir:
             filenames[each_dir + "/disk_octets-"] = [each_dir +
                                                      '_DiskWrite', each_dir + '_DiskRead']
         if "interface" in each_dir:
             filenames[each_dir + "/if_octets-"] = [each_dir +
                                                    '_NetworkIn', each_dir + '_NetworkOut']
-
-    for fEntry in os.walk(os.path.join(csvpath)):
-        if "cpu-" in fEntry[0]:
+        if "cpu-" in each_dir:
             aggregate_cpu = True
-            filenames['aggregation-cpu-average/cpu-system-'] = ['CPU']
 
     return aggregate_cpu
 
 
-def set_raw_data_from_collectd_dir(aggregate_cpu, all_latest_timestamps, date_l, filenames, new_prev_endtime_epoch_l,
-                                   raw_data_l, start_time_epoch_l):
-    for each_file in filenames:
-        if "cpu/percent-active" in each_file and aggregate_cpu:
-            continue
-        if "aggregation-cpu-average/cpu-system" in each_file and aggregate_cpu:
-            new_prev_endtime_epoch_l = calculate_avg_cpu_values(all_latest_timestamps, each_file, filenames,
-                                                                new_prev_endtime_epoch_l, raw_data_l,
-                                                                start_time_epoch_l, date_l)
-            aggregate_cpu = False
-        else:
-            new_prev_endtime_epoch_l = calculate_disk_load_values(all_latest_timestamps, each_file, filenames,
-                                                                  new_prev_endtime_epoch_l, raw_data_l,
-                                                                  start_time_epoch_l, date_l)
-
-
-def calculate_avg_cpu_values(all_latest_timestamps, each_file, filenames, new_prev_endtime_epoch_l, raw_data_l,
-                             start_time_epoch_l, date_l):
+def read_new_csv_rows(index, each_file, start_time_epoch_l, date_l, new_offsets):
+    """ yield (timestamp, index, row) for each complete row added to a collectd csv file since the last run """
+    csv_path = os.path.join(csvpath, each_file + date_l)
     try:
-        csv_file_1 = open(os.path.join(csvpath, each_file + date_l))
-        csv_file_2 = open(os.path.join(
-            csvpath, 'aggregation-cpu-average/cpu-user-' + date_l))
-        csv_file_3 = open(os.path.join(
-            csvpath, 'aggregation-cpu-average/cpu-idle-' + date_l))
-        reader1 = csv.reader(csv_file_1)
-        reader2 = csv.reader(csv_file_2)
-        reader3 = csv.reader(csv_file_3)
-
-        for row, row1, row2 in itertools.izip(reader1, reader2, reader3):
-            if reader1.line_num > 1:
-                if long(int(float(row[0]))) < long(start_time_epoch_l):
-                    continue
-                timestamp_str = str(int(float(row[0])))
-                new_prev_endtime_epoch_l = long(timestamp_str) * 1000.0
-                if timestamp_str in raw_data_l:
-                    value_list = raw_data_l[timestamp_str]
-                    total = float(row[1]) + float(row1[1]) + float(row2[1])
-                    idle = float(row2[1])
-                    # result = 1 - round(float(idle / total), 4)
-                    value_list[filenames[each_file][0]] = str(
-                        round((1 - float(idle / total)) * 100, 4))
-                    raw_data_l[timestamp_str] = value_list
-                else:
-                    value_list = {}
-                    total = float(row[1]) + float(row1[1]) + float(row2[1])
-                    idle = float(row2[1])
-                    # result = 1 - round(float(idle / total), 4)
-                    value_list[filenames[each_file][0]] = str(
-                        round((1 - float(idle / total)) * 100, 4))
-                    raw_data_l[timestamp_str] = value_list
-        all_latest_timestamps.append(new_prev_endtime_epoch_l)
-
+        csv_file = open(csv_path, 'rb')
     except IOError:
-        print ""
-    return new_prev_endtime_epoch_l
+        return
+    with csv_file:
+        offset = csv_offsets['offsets'].get(csv_path, 0)
+        if offset > os.fstat(csv_file.fileno()).st_size:
+            offset = 0
+        csv_file.seek(offset)
+        for line in csv_file:
+            # collectd is still writing the last line
+            if not line.endswith('\n'):
+                break
+            offset += len(line)
+            new_offsets[csv_path] = offset
+            # header
+            if offset == len(line):
+                continue
+            row = next(csv.reader([line]))
+            if long(int(float(row[0]))) < long(start_time_epoch_l):
+                continue
+            yield int(float(row[0])), index, row
+    new_offsets[csv_path] = offset
+
+
+def merge_collectd_series(series, filenames, new_prev_endtime_epoch_l, start_time_epoch_l, date_l):
+    """ merge-join the new rows of every series by timestamp """
+    raw_data_l = collections.OrderedDict()
+    new_offsets = {}
+    merged_rows = heapq.merge(*[read_new_csv_rows(index, each_file, start_time_epoch_l, date_l, new_offsets)
+                                for index, each_file in enumerate(series)])
+    for timestamp, rows in itertools.groupby(merged_rows, key=lambda merged_row: merged_row[0]):
+        value_list = {}
+        cpu_rows = {}
+        for _, index, row in rows:
+            each_file = series[index]
+            if each_file in cpu_average_files:
+                cpu_rows[each_file] = row
+            else:
+                set_values_from_row(value_list, each_file, filenames[each_file], row)
+        if len(cpu_rows) == len(cpu_average_files):
+            value_list['CPU'] = calculate_avg_cpu_value(*[cpu_rows[each_file] for each_file in cpu_average_files])
+        if value_list:
+            raw_data_l[str(timestamp)] = value_list
+        new_prev_endtime_epoch_l = max(new_prev_endtime_epoch_l, long(timestamp) * 1000.0)
+    # only files still being written are kept
+    csv_offsets['offsets'] = new_offsets
+    return new_prev_endtime_epoch_l, raw_data_l
 
 
-def calculate_disk_load_values(all_latest_timestamps, each_file, filenames, new_prev_endtime_epoch_l, raw_data_l,
-                               start_time_epoch_l, date_l):
-    try:
-        csvfile = open(os.path.join(csvpath, each_file + date_l))
-        reader = csv.reader(csvfile)
-
-        for row in reader:
-            if reader.line_num > 1:
-                if long(int(float(row[0]))) < long(start_time_epoch_l):
-                    continue
-                timestamp_str = str(int(float(row[0])))
-                new_prev_endtime_epoch_l = long(timestamp_str) * 1000.0
-                if timestamp_str in raw_data_l:
-                    value_list = raw_data_l[timestamp_str]
-                    value_list[filenames[each_file][0]] = row[1]
-                    if ("disk" in each_file) or ("interface" in each_file):
-                        value_list[filenames[each_file][1]] = row[2]
-                    elif "load" in each_file:
-                        value_list[filenames[each_file][1]] = row[2]
-                        value_list[filenames[each_file][2]] = row[3]
-                    raw_data_l[timestamp_str] = value_list
-                else:
-                    value_list = {filenames[each_file][0]: row[1]}
-                    if ("disk" in each_file) or ("interface" in each_file):
-                        value_list[filenames[each_file][1]] = row[2]
-                    elif "load" in each_file:
-                        value_list[filenames[each_file][1]] = row[2]
-                        value_list[filenames[each_file][2]] = row[3]
-                    raw_data_l[timestamp_str] = value_list
-        all_latest_timestamps.append(new_prev_endtime_epoch_l)
-    except IOError:
-        pass
-    return new_prev_endtime_epoch_l
+def calculate_avg_cpu_value(system_row, user_row, idle_row):
+    total = float(system_row[1]) + float(user_row[1]) + float(idle_row[1])
+    idle = float(idle_row[1])
+    # result = 1 - round(float(idle / total), 4)
+    return str(round((1 - float(idle / total)) * 100, 4))
+
+
+def set_values_from_row(value_list, each_file, names, row):
+    value_list[names[0]] = row[1]
+    if ("disk" in each_file) or ("interface" in each_file):
+        value_list[names[1]] = row[2]
+    elif "load" in each_file:
+        value_list[names[1]] = row[2]
+        value_list[names[2]] = row[3]
 
 
 def is_str_in_keys(my_dict, my_str):
@@ -487,6 +483,7 @@ def update_endtime_in_config(metric_data_l, reporting_interval_l, new_prev_endti
         new_prev_endtime = time.strftime(
             "%Y%m%d%H%M%S", time.localtime(long(new_prev_endtimeinsec)))
         update_timestamp(new_prev_endtime)
+        update_csv_offsets(csv_offsets)
         send_data(metric_data_l, reporting_interval_l, hostname_l)
     return
 
@@ -508,6 +505,8 @@ if __name__ == "__main__":
 
     reporting_interval, start_time_epoch, prev_endtime = set_epoch_time(reporting_interval, prev_endtime)
 
+    csv_offsets = get_csv_offsets()
+
     new_prev_endtime_epoch, raw_data = aggregate_results_into_raw_data(start_time_epoch, new_prev_endtime_epoch, date)
 
     metric_data, previous_result = fill_metric_data_to_send(raw_data, hostname_short)
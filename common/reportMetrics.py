@@ -396,20 +396,13 @@ def process_replay(file_path):
                 replay_network_log(file_path)
             else:
                 # default
+                line_count = 0
+                entry_count = 0
+                chunk_count = 0
+                current_row = []
+                start_time = time.time()
                 try:
-                    output = subprocess.check_output(
-                        'cat ' + file_path + ' | jq -c ".[]" > ' + file_path + ".mod",
-                        shell=True)
-                except subprocess.CalledProcessError as e:
-                    logger.error("Not a correctly formatted json file. Please contact support.")
-                    sys.exit(1)
-                with open(file_path + ".mod") as logfile:
-                    line_count = 0
-                    entry_count = 0
-                    chunk_count = 0
-                    current_row = []
-                    start_time = time.time()
-                    for line in logfile:
+                    for json_message in iter_json_array(file_path):
                         if line_count >= parameters['chunkLines']:
                             logger.debug("--- Chunk creation time: %s seconds ---" % (time.time() - start_time))
                             send_data(current_row, file_path, None)
@@ -418,7 +411,6 @@ def process_replay(file_path):
                             line_count = 0
                             start_time = time.time()
 
-                        json_message = json.loads(line.rstrip())
                         if agent_config_vars['selected_fields'] == "All":
                             current_row.append(json_message)
                         else:
@@ -429,21 +421,18 @@ def process_replay(file_path):
                             current_row.append(json.loads(json.dumps(current_log_msg)))
                         line_count += 1
                         entry_count += 1
+                except ValueError as e:
+                    logger.error("Not a correctly formatted json file. Please contact support.")
+                    logger.error(e)
+                    sys.exit(1)
 
-                    if len(current_row) != 0:
-                        logger.debug("--- Chunk creation time: %s seconds ---" % (time.time() - start_time))
-                        send_data(current_row, file_path, None)
-                        chunk_count += 1
-
-                    logger.debug("Total chunks created: " + str(chunk_count))
-                    logger.debug("Total log entries: " + str(entry_count))
+                if len(current_row) != 0:
+                    logger.debug("--- Chunk creation time: %s seconds ---" % (time.time() - start_time))
+                    send_data(current_row, file_path, None)
+                    chunk_count += 1
 
-                try:
-                    subprocess.check_output(
-                        "rm -f " + file_path + ".mod",
-                        shell=True)
-                except subprocess.CalledProcessError:
-                    logger.error('Could not clean up file. Please run "rm ' + file_path + '.mod"')
+                logger.debug("Total chunks created: " + str(chunk_count))
+                logger.debug("Total log entries: " + str(entry_count))
 
         else:  # metric file replay processing
             # handle different metric agents
@@ -512,6 +501,50 @@ def process_replay(file_path):
 
 
 
+def iter_json_array(file_path, read_size=1 << 20):
+    """
+    Yield each element of the top-level JSON array(s) in a file, like `jq -c ".[]"`,
+    reading it in blocks instead of loading it whole.
+    """
+    decoder = json.JSONDecoder()
+    with open(file_path, 'rb') as json_file:
+        buf = ''
+        pos = 0
+        eof = False
+        in_array = False
+        while True:
+            pos = JSON_WHITESPACE.match(buf, pos).end()
+            if pos < len(buf):
+                char = buf[pos]
+                if (not in_array and char == '[') or (in_array and char in ',]'):
+                    in_array = char != ']'
+                    pos += 1
+                    continue
+                if not in_array:
+                    raise ValueError('Expected a JSON array at byte {}'.format(json_file.tell() - len(buf) + pos))
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # the element may continue in the next block
+                    if eof:
+                        raise
+                else:
+                    # as may a number at the end of this one
+                    if eof or (end < len(buf) and buf[end] not in '0123456789.eE+-'):
+                        pos = end
+                        yield value
+                        continue
+            elif eof:
+                if in_array:
+                    raise ValueError('Unterminated JSON array')
+                return
+            # read more at once while a single element doesn't fit
+            more = json_file.read(max(read_size, len(buf) - pos))
+            eof = not more
+            buf = buf[pos:] + more
+            pos = 0
+
+
 def replay_sar(metric_file_path, command):
     logger.info('Replaying sar file')
     translated_file_path = metric_file_path + '.sar'
@@ -964,6 +997,7 @@ def get_file_list_for_directory(root_path):
 if __name__ == '__main__':
     GROUPING_START = 31000
     GROUPING_END = 33000
+    JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
     prog_start_time = time.time()
     normalization_ids_map = dict()
     data_directory = 'data/'
@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 import configparser
 import json
+import zlib
 import logging
 import os
 import regex
 import socket
 import sys
+import threading
 import time
 import pytz
+import queue
 import arrow
 import urllib.parse
 import http.client
@@ -30,111 +33,202 @@ def start_data_processing():
     # get conn
     es_conn = get_es_connection()
 
-    # time query
-    timestamp_field = agent_config_vars['timestamp_field']
-
     # parse sql string by params
     logger.debug('history range config: {}'.format(agent_config_vars['his_time_range']))
-    if agent_config_vars['his_time_range']:
+    if agent_config_vars['his_time_range'] and agent_config_vars['scan_mode'] != 'PAGE':
+        logger.debug('Using time range for replay data')
+        # a scan streams the whole range, so there is no need to split it by sampling interval
+        query_body = build_query_body(agent_config_vars['his_time_range'][0], agent_config_vars['his_time_range'][1])
+        scan_messages_elasticsearch(es_conn, query_body)
+
+    elif agent_config_vars['his_time_range']:
         logger.debug('Using time range for replay data')
         for timestamp in range(agent_config_vars['his_time_range'][0],
                                agent_config_vars['his_time_range'][1],
                                if_config_vars['sampling_interval']):
-            start_time = timestamp
-            end_time = timestamp + if_config_vars['sampling_interval']
-
-            # build query
-            query_body = {
-                "query": {
-                    "range": {
-                        timestamp_field: {
-                            "format": "epoch_second",
-                            'gte': start_time,
-                            'lte': end_time
-                        }
-                    }
-                }
-            }
-            # add user-defined query
-            if isinstance(agent_config_vars['query_json'], dict):
-                query_body.update(agent_config_vars['query_json'])
-
-            # get total number of messages
-            response = es_conn.search(
-                body=query_body,
-                index=agent_config_vars['indeces'],
-                ignore_unavailable=False,
-                size=0
-            )
-            total = response.get('hits', {}).get('total', 0)
-            if not isinstance(total, int):
-                total = total.get('value', 0)
-
-            # validate successs
-            if 'error' in response:
-                logger.error('Query es error: ' + str(response))
-                sys.exit(1)
-
-            # build query with chunk
-            start_index = 0
-            while start_index < total:
-                query = dict({'from': start_index, "size": agent_config_vars['query_chunk_size']}, **query_body)
-                start_index += agent_config_vars['query_chunk_size']
-
-                data = query_messages_elasticsearch(es_conn, query)
-                parse_messages_elasticsearch(data)
-
-                # clear log buffer when piece of chunk range end
-                clear_log_buffer()
+            query_body = build_query_body(timestamp, timestamp + if_config_vars['sampling_interval'])
+            page_messages_elasticsearch(es_conn, query_body)
 
     else:
         logger.debug('Using current time for streaming data')
         time_now = int(arrow.utcnow().float_timestamp)
-        start_time = time_now - if_config_vars['sampling_interval']
-        end_time = time_now
-
-        # build query
-        query_body = {
-            "query": {
-                "range": {
-                    timestamp_field: {
-                        "format": "epoch_second",
-                        'gte': start_time,
-                        'lte': end_time
-                    }
-                }
-            }
-        }
-        # add user-defined query
-        if isinstance(agent_config_vars['query_json'], dict):
-            query_body.update(agent_config_vars['query_json'])
+        query_body = build_query_body(time_now - if_config_vars['sampling_interval'], time_now)
+        if agent_config_vars['scan_mode'] != 'PAGE':
+            scan_messages_elasticsearch(es_conn, query_body)
+        else:
+            page_messages_elasticsearch(es_conn, query_body)
 
-        # get total number of messages
-        response = es_conn.search(
-            body=query_body,
-            index=agent_config_vars['indeces'],
-            ignore_unavailable=False,
-            size=0)
-        total = response.get('hits').get('total', 0)
+    logger.info('Closed......')
 
-        # validate successs
-        if 'error' in response:
-            logger.error('Query es error: ' + str(response))
-            sys.exit(1)
 
-        # build query with chunk
-        start_index = 0
-        while start_index < total:
-            query = dict({'from': start_index, "size": agent_config_vars['query_chunk_size']}, **query_body)
-            start_index += agent_config_vars['query_chunk_size']
+def build_query_body(start_time, end_time):
+    # build query
+    query_body = {
+        "query": {
+            "range": {
+                agent_config_vars['timestamp_field']: {
+                    "format": "epoch_second",
+                    'gte': start_time,
+                    'lte': end_time
+                }
+            }
+        }
+    }
+    # add user-defined query
+    if isinstance(agent_config_vars['query_json'], dict):
+        query_body.update(agent_config_vars['query_json'])
+    return query_body
+
+
+def page_messages_elasticsearch(es_conn, query_body):
+    """ page through the query with from/size, limited by index.max_result_window """
+    # get total number of messages
+    response = es_conn.search(
+        body=query_body,
+        index=agent_config_vars['indeces'],
+        ignore_unavailable=False,
+        size=0
+    )
+    total = response.get('hits', {}).get('total', 0)
+    if not isinstance(total, int):
+        total = total.get('value', 0)
+
+    # validate successs
+    if 'error' in response:
+        logger.error('Query es error: ' + str(response))
+        sys.exit(1)
 
-            data = query_messages_elasticsearch(es_conn, query)
+    # build query with chunk
+    start_index = 0
+    while start_index < total:
+        query = dict({'from': start_index, "size": agent_config_vars['query_chunk_size']}, **query_body)
+        start_index += agent_config_vars['query_chunk_size']
+
+        data = query_messages_elasticsearch(es_conn, query)
+        parse_messages_elasticsearch(data)
+
+        # clear log buffer when piece of chunk range end
+        clear_log_buffer()
+
+
+def scan_messages_elasticsearch(es_conn, query_body):
+    """ stream every hit of the query, split into slices scanned by parallel workers """
+    workers = agent_config_vars['scan_workers']
+    scan = scan_slice_scroll
+    pit_id = None
+    if agent_config_vars['scan_mode'] == 'PIT':
+        # one point in time, shared by all the slices
+        scan = scan_slice_pit
+        response = retry_es_request(es_conn.open_point_in_time, index=agent_config_vars['indeces'],
+                                    keep_alive=agent_config_vars['scan_keep_alive'])
+        pit_id = response['id']
+        query_body = dict(query_body, pit={'id': pit_id, 'keep_alive': agent_config_vars['scan_keep_alive']})
+    hits_queue = queue.Queue(maxsize=workers * 2)
+    failed_slices = []
+    threads = []
+    try:
+        for slice_id in range(workers):
+            thread = threading.Thread(target=scan_slice_worker,
+                                      args=(scan, es_conn, query_body, slice_id, hits_queue, failed_slices))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # parse pages as they arrive; each worker sends None when its slice is done
+        running = workers
+        while running > 0:
+            data = hits_queue.get()
+            if data is None:
+                running -= 1
+                continue
             parse_messages_elasticsearch(data)
 
             # clear log buffer when piece of chunk range end
             clear_log_buffer()
 
-    logger.info('Closed......')
+        for thread in threads:
+            thread.join()
+    finally:
+        if pit_id:
+            es_conn.close_point_in_time(body={'id': pit_id}, ignore=(404,))
+
+    # the hits of a failed slice are missing, so don't let the run pass as complete
+    if failed_slices:
+        clear_log_buffer()
+        logger.error('Query log error: {} of {} slices could not be read'.format(len(failed_slices), workers))
+        sys.exit(1)
+
+
+def scan_slice_worker(scan, es_conn, query_body, slice_id, hits_queue, failed_slices):
+    try:
+        for data in scan(es_conn, get_slice_query_body(query_body, slice_id)):
+            hits_queue.put(data)
+    except Exception as e:
+        logger.error(e)
+        logger.error('Query log error in slice {}.'.format(slice_id))
+        failed_slices.append(slice_id)
+    finally:
+        hits_queue.put(None)
+
+
+def retry_es_request(request, **kwargs):
+    """ make a request to es, trying again after an error. only for requests that can safely be repeated """
+    for attempt in range(ATTEMPTS):
+        try:
+            return request(**kwargs)
+        except Exception as e:
+            if attempt == ATTEMPTS - 1:
+                raise
+            logger.warning('Request to es failed, trying again: {}'.format(e))
+            time.sleep(2 ** attempt)
+
+
+def get_slice_query_body(query_body, slice_id):
+    query = dict({'size': agent_config_vars['query_chunk_size']}, **query_body)
+    # es rejects a slice max of 1
+    if agent_config_vars['scan_workers'] > 1:
+        query['slice'] = {'id': slice_id, 'max': agent_config_vars['scan_workers']}
+    return query
+
+
+def scan_slice_scroll(es_conn, query):
+    """ yield pages of hits from a scroll """
+    logger.info('Starting scroll server es')
+    query = dict(query, sort=['_doc'])
+    response = retry_es_request(
+        es_conn.search,
+        body=query,
+        index=agent_config_vars['indeces'],
+        ignore_unavailable=False,
+        scroll=agent_config_vars['scan_keep_alive'])
+    scroll_id = response.get('_scroll_id')
+    try:
+        while True:
+            data = response.get('hits', {}).get('hits', [])
+            if len(data) == 0:
+                break
+            yield data
+            # not retried: a scroll request that failed may still have moved the scroll on
+            response = es_conn.scroll(scroll_id=scroll_id, scroll=agent_config_vars['scan_keep_alive'])
+            scroll_id = response.get('_scroll_id', scroll_id)
+    finally:
+        if scroll_id:
+            es_conn.clear_scroll(scroll_id=scroll_id, ignore=(404,))
+
+
+def scan_slice_pit(es_conn, query):
+    """ yield pages of hits from the shared point in time, using search_after """
+    logger.info('Starting point in time search server es')
+    query = dict(query, sort=['_shard_doc'], pit=dict(query['pit']))
+    while True:
+        # search_after picks up after the last page, so a failed request can be made again
+        response = retry_es_request(es_conn.search, body=query)
+        query['pit']['id'] = response.get('pit_id', query['pit']['id'])
+        data = response.get('hits', {}).get('hits', [])
+        if len(data) == 0:
+            break
+        yield data
+        query['search_after'] = data[-1]['sort']
 
 
 def get_es_connection():
@@ -267,6 +361,8 @@ def get_agent_config_vars():
         query_chunk_size = None
         indeces = None
         his_time_range = None
+        scan_mode = None
+        scan_workers = None
 
         instance_whitelist_regex = None
         try:
@@ -308,6 +404,12 @@ def get_agent_config_vars():
             query_json = config_parser.get('elasticsearch', 'query_json')
             query_chunk_size = config_parser.get('elasticsearch', 'query_chunk_size')
             indeces = config_parser.get('elasticsearch', 'indeces')
+            scan_mode = config_parser.get('elasticsearch', 'scan_mode').upper() if config_parser.has_option(
+                'elasticsearch', 'scan_mode') else ''
+            scan_workers = config_parser.get('elasticsearch', 'scan_workers') if config_parser.has_option(
+                'elasticsearch', 'scan_workers') else ''
+            scan_keep_alive = config_parser.get('elasticsearch', 'scan_keep_alive') if config_parser.has_option(
+                'elasticsearch', 'scan_keep_alive') else ''
 
             # time range
             his_time_range = config_parser.get('elasticsearch', 'his_time_range')
@@ -352,6 +454,15 @@ def get_agent_config_vars():
                 logger.error('Agent not correctly configured (query_chunk_size). Use 5000 by default.')
                 query_chunk_size = 5000
 
+        scan_mode = scan_mode or 'SCROLL'
+        if scan_mode not in {'SCROLL', 'PIT', 'PAGE'}:
+            config_error('scan_mode')
+        scan_keep_alive = scan_keep_alive or '5m'
+        if len(scan_workers) != 0:
+            scan_workers = int(scan_workers)
+        else:
+            scan_workers = 1
+
         if len(instance_whitelist) != 0:
             try:
                 instance_whitelist_regex = regex.compile(instance_whitelist)
@@ -410,6 +521,9 @@ def get_agent_config_vars():
             'query_json': query_json,
             'query_chunk_size': query_chunk_size,
             'indeces': indeces,
+            'scan_mode': scan_mode,
+            'scan_workers': scan_workers,
+            'scan_keep_alive': scan_keep_alive,
             'his_time_range': his_time_range,
 
             'proxies': agent_proxies,
@@ -451,6 +565,14 @@ def get_if_config_vars():
             if_url = config_parser.get('insightfinder', 'if_url')
             if_http_proxy = config_parser.get('insightfinder', 'if_http_proxy')
             if_https_proxy = config_parser.get('insightfinder', 'if_https_proxy')
+            if_pool_size = config_parser.get('insightfinder', 'if_pool_size') if config_parser.has_option(
+                'insightfinder', 'if_pool_size') else ''
+            if_compress = config_parser.get('insightfinder', 'if_compress') if config_parser.has_option(
+                'insightfinder', 'if_compress') else ''
+            spool_dir = config_parser.get('insightfinder', 'spool_dir') if config_parser.has_option(
+                'insightfinder', 'spool_dir') else ''
+            spool_size_mb = config_parser.get('insightfinder', 'spool_size_mb') if config_parser.has_option(
+                'insightfinder', 'spool_size_mb') else ''
         except configparser.NoOptionError as cp_noe:
             logger.error(cp_noe)
             config_error()
@@ -524,6 +646,10 @@ def get_if_config_vars():
             'chunk_size': int(chunk_size_kb) * 1024,  # as bytes
             'if_url': if_url,
             'if_proxies': if_proxies,
+            'if_pool_size': int(if_pool_size or 10),
+            'if_compress': if_compress.upper() == 'TRUE',
+            'spool_dir': abs_path_from_cur(spool_dir or 'spool'),
+            'spool_size': int(spool_size_mb or 100) * 1024 * 1024,  # as bytes
             'is_replay': is_replay
         }
 
@@ -729,11 +855,15 @@ def initialize_data_gathering():
     track['chunk_count'] = 0
     track['entry_count'] = 0
 
+    start_spool_replayer()
+
     start_data_processing()
 
     # clear log buffer when data processing end
     clear_log_buffer()
 
+    stop_spool_replayer()
+
     logger.info('Total chunks created: ' + str(track['chunk_count']))
     logger.info('Total {} entries: {}'.format(
         if_config_vars['project_type'].lower(), track['entry_count']))
@@ -809,24 +939,236 @@ def send_data_to_if(chunk_metric_data):
 
     # send the data
     post_url = urllib.parse.urljoin(if_config_vars['if_url'], get_api_from_project_type())
-    send_request(post_url, 'POST', 'Could not send request to IF',
-                 str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
-                 data=data_to_post, verify=False, proxies=if_config_vars['if_proxies'])
+    post_data, post_headers = get_post_body(data_to_post)
+    response = send_request(post_url, 'POST', 'Could not send request to IF',
+                            str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
+                            data=post_data, headers=post_headers, verify=False, proxies=if_config_vars['if_proxies'])
+    if response == -1:
+        spool_chunk(post_url, data_to_post)
     logger.info('--- Send data time: %s seconds ---' % round(time.time() - send_data_time, 2))
 
 
+def start_spool_replayer():
+    """ start the thread that re-sends spooled chunks once IF is reachable again """
+    spool['lock'] = threading.Lock()
+    spool['stop'] = threading.Event()
+    spool['segment'] = None
+    spool['thread'] = None
+    if if_config_vars['spool_size'] == 0 or cli_config_vars['testing']:
+        return
+    if not os.path.isdir(if_config_vars['spool_dir']):
+        os.makedirs(if_config_vars['spool_dir'])
+    recover_spool_segments()
+    spool['thread'] = threading.Thread(target=replay_spool, name='spool-replay')
+    spool['thread'].daemon = True
+    spool['thread'].start()
+
+
+def stop_spool_replayer():
+    """ stop replaying. anything left in the spool is replayed on the next run """
+    if not spool['thread']:
+        return
+    spool['stop'].set()
+    spool['thread'].join()
+    with spool['lock']:
+        close_spool_segment()
+
+
+def recover_spool_segments():
+    """ release segments left open or half-replayed by agent runs that have exited """
+    for name in os.listdir(if_config_vars['spool_dir']):
+        if name.endswith('.open'):
+            # <ts>-<writer pid>.open
+            owner = name[:-len('.open')].split('-')[-1]
+            closed = name[:-len('.open')] + '.spool'
+        elif name.endswith('.replay'):
+            # <ts>-<writer pid>.spool.<replayer pid>.replay
+            closed, owner, _ = name.rsplit('.', 2)
+        elif name.endswith('.replay.tmp'):
+            # left over from writing back a half-replayed segment
+            owner = name.rsplit('.', 3)[1]
+            if not is_pid_running(int(owner)):
+                os.remove(os.path.join(if_config_vars['spool_dir'], name))
+            continue
+        else:
+            continue
+        if not is_pid_running(int(owner)):
+            os.rename(os.path.join(if_config_vars['spool_dir'], name),
+                      os.path.join(if_config_vars['spool_dir'], closed))
+
+
+def is_pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def get_spool_segments(suffix='.spool'):
+    """ spool segment files, oldest first """
+    return [os.path.join(if_config_vars['spool_dir'], name)
+            for name in sorted(os.listdir(if_config_vars['spool_dir']))
+            if name.endswith(suffix)]
+
+
+def close_spool_segment():
+    """ close the segment this process appends to, making it available for replay """
+    if spool['segment'] and os.path.exists(spool['segment']):
+        os.rename(spool['segment'], spool['segment'][:-len('.open')] + '.spool')
+    spool['segment'] = None
+
+
+def spool_chunk(post_url, data_to_post):
+    """ append a chunk that could not be sent to the spool, dropping the oldest segments over the size cap """
+    if not spool['thread']:
+        return
+    with spool['lock']:
+        if spool['segment'] and os.path.getsize(spool['segment']) >= SPOOL_SEGMENT_SIZE:
+            close_spool_segment()
+        if not spool['segment']:
+            spool['segment'] = os.path.join(if_config_vars['spool_dir'], '{:015d}-{}.open'.format(
+                int(time.time() * 1000), os.getpid()))
+        # only the payload is spooled, the account fields are filled in again on replay
+        account_fields = initialize_api_post_data()
+        payload = dict((key, value) for key, value in data_to_post.items() if key not in account_fields)
+        with open(spool['segment'], 'a') as spool_file:
+            spool_file.write(json.dumps({'url': post_url, 'data': payload}) + '\n')
+        logger.warning('Spooled chunk to {}'.format(spool['segment']))
+
+        # evict oldest first
+        segments = get_spool_segments()
+        spool_size = sum(os.path.getsize(segment) for segment in segments + get_spool_segments('.open'))
+        while spool_size > if_config_vars['spool_size'] and segments:
+            segment = segments.pop(0)
+            spool_size -= os.path.getsize(segment)
+            os.remove(segment)
+            logger.warning('Spool is full, dropped {}'.format(segment))
+
+
+def replay_spool():
+    """ re-send spooled chunks oldest first, backing off exponentially while IF is unreachable """
+    backoff = SPOOL_MIN_BACKOFF
+    while not spool['stop'].is_set():
+        if replay_spool_segment():
+            backoff = SPOOL_MIN_BACKOFF
+        else:
+            spool['stop'].wait(backoff)
+            backoff = min(backoff * 2, SPOOL_MAX_BACKOFF)
+
+
+def replay_spool_segment():
+    """ claim and re-send the oldest spooled segment. returns True if all of it was sent """
+    with spool['lock']:
+        segments = get_spool_segments()
+        if not segments and spool['segment']:
+            close_spool_segment()
+            segments = get_spool_segments()
+        if not segments:
+            return False
+        segment = segments[0]
+        # renaming is atomic, so only one process can claim a segment
+        claimed = '{}.{}.replay'.format(segment, os.getpid())
+        try:
+            os.rename(segment, claimed)
+        except OSError:
+            return False
+
+    with open(claimed) as spool_file:
+        lines = spool_file.readlines()
+    for i, line in enumerate(lines):
+        try:
+            chunk = json.loads(line)
+        except ValueError:
+            logger.warning('Skipping corrupt line in {}'.format(segment))
+            continue
+        if spool['stop'].is_set() or not send_spooled_chunk(chunk):
+            # put back what wasn't sent
+            try:
+                with open(claimed + '.tmp', 'w') as spool_file:
+                    spool_file.writelines(lines[i:])
+                os.rename(claimed + '.tmp', segment)
+            except (IOError, OSError) as e:
+                logger.warning('Could not write back {}, it is replayed in full on the next run'.format(segment))
+                logger.warning(e)
+                if os.path.exists(claimed + '.tmp'):
+                    os.remove(claimed + '.tmp')
+                return False
+            os.remove(claimed)
+            return False
+    os.remove(claimed)
+    logger.info('Replayed {} spooled chunks from {}'.format(len(lines), segment))
+    return True
+
+
+def send_spooled_chunk(chunk):
+    """ re-send a spooled chunk. returns False if it should be tried again later """
+    data_to_post = initialize_api_post_data()
+    data_to_post.update(chunk['data'])
+    post_data, post_headers = get_post_body(data_to_post)
+    # the replayer backs off between attempts, so post once rather than through send_request
+    try:
+        response = get_request_session().post(chunk['url'], data=post_data, headers=post_headers, verify=False,
+                                              proxies=if_config_vars['if_proxies'])
+    except requests.exceptions.RequestException as e:
+        logger.warning('Could not re-send spooled chunk to IF')
+        logger.warning(e)
+        return False
+    if response.status_code == http.client.OK:
+        logger.info('Re-sent a spooled chunk.')
+        return True
+    if 400 <= response.status_code < 500 and response.status_code not in SPOOL_RETRYABLE_STATUS:
+        # IF will never accept this chunk, so drop it rather than hold up the rest of the spool
+        logger.warning('IF rejected a spooled chunk, dropping it. Response Code: {}\nTEXT: {}'.format(
+            response.status_code, response.text))
+        return True
+    logger.warning('Could not re-send spooled chunk to IF. Response Code: {}'.format(response.status_code))
+    return False
+
+
+def get_post_body(data_to_post):
+    """ get the body and headers to post data_to_post with, gzipped if configured """
+    if not if_config_vars['if_compress']:
+        return data_to_post, None
+    return gzip_compress(urllib.parse.urlencode(data_to_post).encode('utf-8')), {'Content-Type': 'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'}
+
+
+def get_request_session():
+    """ get this thread's pooled session, so connections are reused between requests """
+    # requests.Session is not thread-safe, so each thread gets its own
+    pid = (os.getpid(), threading.current_thread().ident)
+    if pid not in SESSIONS:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=if_config_vars['if_pool_size'],
+                                                pool_maxsize=if_config_vars['if_pool_size'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        SESSIONS[pid] = session
+    return SESSIONS[pid]
+
+
+def gzip_compress(data):
+    """ gzip a request body """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
 def send_request(url, mode='GET', failure_message='Failure!', success_message='Success!', **request_passthrough):
     """ sends a request to the given url """
     # determine if post or get (default)
     requests.packages.urllib3.disable_warnings()
-    req = requests.get
+    session = get_request_session()
+    req = session.get
     if mode.upper() == 'POST':
-        req = requests.post
+        req = session.post
 
     req_num = 0
     for req_num in range(ATTEMPTS):
         try:
+            request_time = time.time()
             response = req(url, **request_passthrough)
+            logger.debug('Request took {} seconds, {} bytes sent, {} bytes received'.format(
+                round(time.time() - request_time, 3), len(response.request.body or ''), len(response.content)))
             if response.status_code == http.client.OK:
                 return response
             else:
@@ -948,8 +1290,14 @@ if __name__ == "__main__":
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = r",|\t"
     ATTEMPTS = 3
+    SESSIONS = dict()
+    SPOOL_SEGMENT_SIZE = 8 * 1024 * 1024
+    SPOOL_MIN_BACKOFF = 1
+    SPOOL_MAX_BACKOFF = 300
+    SPOOL_RETRYABLE_STATUS = (408, 429)
     CACHE_NAME = 'cache.db'
     track = dict()
+    spool = dict()
     log_buffer = dict()
 
     # get config
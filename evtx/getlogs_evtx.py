@@ -2,24 +2,32 @@
 import ConfigParser
 import collections
 import json
+import zlib
 import logging
 import os
 import re
 import socket
 import sys
+import threading
 import time
+import base64
+import heapq
+import math
+import mmap
+import struct
 import pytz
 from optparse import OptionParser
-from multiprocessing import Process
+from multiprocessing import Process, Pool
 from itertools import islice
 from datetime import datetime
 import dateutil
+import urllib
 import urlparse
 import httplib
 import requests
 import statistics
-from Evtx import Evtx as evtx
-import xmltodict
+from Evtx import Nodes as evtx_nodes
+from Evtx.BinaryParser import parse_filetime
 
 
 '''
@@ -28,13 +36,283 @@ This script gathers data to send to Insightfinder
 
 
 def start_data_processing(thread_number):
-    # get list of file(s)
-    files = agent_config_vars['files']
-    for evtx_file in files:
-        with evtx.Evtx(evtx_file) as log:
-            for record in log.records():
-                if record.timestamp():
-                    parse_json_message(json.loads(json.dumps(xmltodict.parse(record.xml()))))
+    """ decode the chunks of each file, split between cli_config_vars['threads'] processes, and send its records in timestamp order """
+    processes = cli_config_vars['threads']
+    pool = Pool(processes) if processes > 1 else None
+    for evtx_file in agent_config_vars['files']:
+        start_time = time.time()
+        tasks = get_evtx_tasks(evtx_file, processes)
+        if pool:
+            results = pool.map(decode_evtx_chunks, tasks)
+        else:
+            results = map(decode_evtx_chunks, tasks)
+        # each task's handoffs are already sorted
+        handoff_count = 0
+        for timestamp, record_num, seq, handoff, args in heapq.merge(*results):
+            handoff(*args)
+            handoff_count += 1
+        logger.info('Decoded {} from {} tasks with {} processes in {} seconds: {} handoffs'.format(
+            evtx_file, len(tasks), processes, round(time.time() - start_time, 1), handoff_count))
+    if pool:
+        pool.close()
+        pool.join()
+
+
+def get_evtx_tasks(evtx_file, processes):
+    """ split the chunks of an evtx file into (filename, start, end) ranges, a few for each process """
+    try:
+        with open(evtx_file, 'rb') as f:
+            header = f.read(EVTX_FILE_HEADER_SIZE)
+        size = os.path.getsize(evtx_file)
+    except (IOError, OSError) as e:
+        logger.warning('Could not read {}'.format(evtx_file))
+        logger.warning(e)
+        return []
+    if not header.startswith(EVTX_FILE_MAGIC):
+        logger.warning('{} is not an evtx file'.format(evtx_file))
+        return []
+
+    first_chunk = struct.unpack_from('<H', header, 0x28)[0]
+    chunk_count = max(size - first_chunk, 0) // EVTX_CHUNK_SIZE
+    per_task = max(int(math.ceil(chunk_count / float(processes * EVTX_TASKS_PER_PROCESS))), 1)
+    return [(evtx_file,
+             first_chunk + i * EVTX_CHUNK_SIZE,
+             first_chunk + min(i + per_task, chunk_count) * EVTX_CHUNK_SIZE)
+            for i in range(0, chunk_count, per_task)]
+
+
+def decode_evtx_chunks(task):
+    """ parse the records of the chunks in [start, end) of a file. returns their handoffs, sorted by timestamp """
+    evtx_file, start, end = task
+    track['handoffs'] = []
+    with open(evtx_file, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in range(start, end, EVTX_CHUNK_SIZE):
+                for record_num, message in read_evtx_chunk(buf, offset):
+                    track['record_num'] = record_num
+                    parse_json_message(message)
+        finally:
+            buf.close()
+    handoffs = track['handoffs']
+    track['handoffs'] = None
+    handoffs.sort()
+    return handoffs
+
+
+def buffer_handoff(handoff, timestamp, *args):
+    """ keep a handoff made while decoding, for start_data_processing to make in timestamp order """
+    handoffs = track['handoffs']
+    handoffs.append((timestamp, track['record_num'], len(handoffs), handoff, (timestamp, ) + args))
+
+
+def read_evtx_chunk(buf, offset):
+    """ yield (record number, message) for the records of the chunk at offset, as xmltodict would parse their xml """
+    if buf[offset:offset + len(EVTX_CHUNK_MAGIC)] != EVTX_CHUNK_MAGIC:
+        return
+    # compiled templates, by their offset in this chunk
+    templates = dict()
+    end = offset + min(struct.unpack_from('<I', buf, offset + 0x30)[0], EVTX_CHUNK_SIZE)
+    record = offset + EVTX_CHUNK_HEADER_SIZE
+    while record < end:
+        magic, size, record_num = struct.unpack_from('<IIQ', buf, record)
+        if magic != EVTX_RECORD_MAGIC or size == 0 or size > EVTX_CHUNK_SIZE:
+            break
+        try:
+            message = dict()
+            fill_evtx_content(message, [], *decode_evtx_root(buf, offset, templates, record + EVTX_RECORD_HEADER_SIZE))
+            yield record_num, message
+        except Exception as e:
+            logger.warning('Could not decode record {} at {}'.format(record_num, record))
+            logger.warning(e)
+        record += size
+
+
+def decode_evtx_root(buf, chunk_offset, templates, offset):
+    """ returns the compiled template of the binary xml at offset, and its substitutions """
+    # skip the start of stream token
+    if ord(buf[offset]) & 0x0F == 0x0F:
+        offset += 4
+    # template instance: token, unknown, template id, template offset in the chunk
+    template_offset = struct.unpack_from('<I', buf, offset + 6)[0]
+    if template_offset > offset - chunk_offset:
+        # the template is defined here, the first time it's used in the chunk
+        offset += struct.unpack_from('<I', buf, chunk_offset + template_offset + 0x14)[0] + 0x18
+    offset += 10
+    if template_offset not in templates:
+        # skip the template header: next template offset, guid and data size
+        templates[template_offset] = compile_evtx_nodes(buf, chunk_offset, chunk_offset + template_offset + 0x18)[0]
+
+    count = struct.unpack_from('<I', buf, offset)[0]
+    offset += 4
+    declarations = struct.unpack_from('<' + 'HBx' * count, buf, offset)
+    offset += 4 * count
+    subs = []
+    for i in range(count):
+        size, value_type = declarations[2 * i], declarations[2 * i + 1]
+        subs.append(decode_evtx_value(buf, chunk_offset, templates, offset, size, value_type))
+        offset += size
+    return templates[template_offset], subs
+
+
+def decode_evtx_value(buf, chunk_offset, templates, offset, size, value_type):
+    """ the text python-evtx renders for a substitution value, or (content, subs) for nested binary xml """
+    if value_type == 0x01:
+        value = buf[offset:offset + (size & ~1)].decode('utf16').rstrip(u'\x00')
+    elif value_type in EVTX_INT_FORMATS:
+        value = str(struct.unpack_from(EVTX_INT_FORMATS[value_type], buf, offset)[0])
+    elif value_type == 0x14:
+        value = '0x{:08x}'.format(struct.unpack_from('<I', buf, offset)[0])
+    elif value_type == 0x15:
+        value = '0x{:016x}'.format(struct.unpack_from('<Q', buf, offset)[0])
+    elif value_type == 0x11:
+        value = parse_filetime(struct.unpack_from('<Q', buf, offset)[0]).isoformat(' ')
+    elif value_type == 0x0F:
+        value = '{{{:08x}-{:04x}-{:04x}-{:02x}{:02x}-{:02x}{:02x}{:02x}{:02x}{:02x}{:02x}}}'.format(
+            *struct.unpack_from('<IHH8B', buf, offset))
+    elif value_type == 0x13:
+        version, count = struct.unpack_from('<BB', buf, offset)
+        id_high, id_low = struct.unpack_from('>IH', buf, offset + 2)
+        value = 'S-{}-{}'.format(version, (id_high << 16) ^ id_low) + ''.join(
+            '-{}'.format(i) for i in struct.unpack_from('<{}I'.format(count), buf, offset + 8))
+    elif value_type == 0x0E:
+        value = base64.b64encode(buf[offset:offset + size])
+    elif value_type == 0x21:
+        return decode_evtx_root(buf, chunk_offset, templates, offset)
+    elif value_type == 0x00:
+        value = u''
+    else:
+        value = evtx_nodes.get_variant_value(buf, offset, None, None, value_type, length=size).string()
+    return clean_evtx_text(value)
+
+
+def clean_evtx_text(value):
+    """ drop the characters the xml view drops, and normalize line ends as an xml parser does """
+    value = EVTX_RESTRICTED_CHARS.sub(u'', value)
+    if '\r' in value:
+        value = value.replace('\r\n', '\n').replace('\r', '\n')
+    return value
+
+
+def compile_evtx_nodes(buf, chunk_offset, offset):
+    """ returns the content of the binary xml at offset, up to its close element or end of stream, and the offset after that """
+    content = []
+    while ord(buf[offset]) & 0x0F not in (0x00, 0x04):
+        node, offset = compile_evtx_node(buf, chunk_offset, offset)
+        if node:
+            content.append(node)
+    return content, offset + 1
+
+
+def compile_evtx_node(buf, chunk_offset, offset):
+    """ returns the (kind, value) of the template node at offset, or None if the xml view renders nothing for it, and the offset after it """
+    token = ord(buf[offset])
+    if token & 0x0F == 0x01:
+        # open start element: token, dependency id, data size, name offset
+        name, end = read_evtx_name(buf, chunk_offset, offset, offset + 7)
+        if token & 0x40:
+            # attribute list size
+            end += 4
+        attributes = []
+        while ord(buf[end]) & 0x0F == 0x06:
+            attribute_name, end = read_evtx_name(buf, chunk_offset, end, end + 1)
+            value, end = compile_evtx_node(buf, chunk_offset, end)
+            attributes.append(('@' + attribute_name, value or (EVTX_TEXT, u'')))
+        if ord(buf[end]) & 0x0F == 0x03:
+            # close empty element
+            return (EVTX_ELEMENT, (name, attributes, [])), end + 1
+        content, end = compile_evtx_nodes(buf, chunk_offset, end + 1)
+        return (EVTX_ELEMENT, (name, attributes, content)), end
+    elif token & 0x0F == 0x05:
+        # value: token, type, value
+        value_type = ord(buf[offset + 1])
+        if value_type == 0x01:
+            length = struct.unpack_from('<H', buf, offset + 2)[0]
+            value = buf[offset + 4:offset + 4 + 2 * length].decode('utf16').rstrip(u'\x00')
+            end = offset + 4 + 2 * length
+        else:
+            node = evtx_nodes.get_variant_value(buf, offset + 2, None, None, value_type)
+            value = node.string()
+            end = offset + 2 + node.length()
+        return (EVTX_TEXT, clean_evtx_text(value)), end
+    elif token & 0x0F in (0x0D, 0x0E):
+        # normal or conditional substitution: token, index, type
+        return (EVTX_SUBSTITUTION, struct.unpack_from('<H', buf, offset + 1)[0]), offset + 4
+    elif token & 0x0F == 0x0F:
+        # start of stream
+        return None, offset + 4
+    elif token & 0x0F == 0x07:
+        # cdata section, read as python-evtx does
+        length = struct.unpack_from('<H', buf, offset + 1)[0]
+        value = buf[offset + 3:offset + 3 + 2 * (length - 2)].decode('utf16')
+        return (EVTX_TEXT, clean_evtx_text(value)), offset + 3 + length
+    elif token & 0x0F == 0x08:
+        # character references aren't rendered by the xml view
+        return None, offset + 3
+    elif token & 0x0F in (0x09, 0x0A):
+        # entity reference or processing instruction target
+        name, end = read_evtx_name(buf, chunk_offset, offset, offset + 1)
+        return (EVTX_TEXT, ('&{};' if token & 0x0F == 0x09 else '<?{}').format(name)), end
+    elif token & 0x0F == 0x0B:
+        # processing instruction data
+        length = struct.unpack_from('<H', buf, offset + 1)[0]
+        value = buf[offset + 3:offset + 3 + 2 * length].decode('utf16')
+        return (EVTX_TEXT, u' {}?>'.format(value) if length else u'?>'), offset + 3 + 2 * length
+    raise ValueError('Unexpected binary xml token {:02x} at {}'.format(token, offset))
+
+
+def read_evtx_name(buf, chunk_offset, offset, name_field):
+    """ returns the name the node at offset refers to from name_field, and where the node continues """
+    name_offset = struct.unpack_from('<I', buf, name_field)[0]
+    length = struct.unpack_from('<H', buf, chunk_offset + name_offset + 6)[0]
+    name = buf[chunk_offset + name_offset + 8:chunk_offset + name_offset + 8 + 2 * length].decode('utf16')
+    end = name_field + 4
+    if name_offset > offset - chunk_offset:
+        # the name is defined here: next offset, hash, length, characters and a null
+        end += 10 + 2 * length
+    return name, end
+
+
+def fill_evtx_content(item, text, content, subs):
+    """ add the elements of content to item, and its text to text, the way xmltodict does """
+    for kind, value in content:
+        if kind == EVTX_ELEMENT:
+            name, attributes, children = value
+            element = dict()
+            for key, (attribute_kind, attribute_value) in attributes:
+                if attribute_kind == EVTX_SUBSTITUTION:
+                    attribute_value = subs[attribute_value]
+                    if isinstance(attribute_value, tuple):
+                        attribute_value = u''
+                # xml attribute value normalization
+                if '\n' in attribute_value or '\t' in attribute_value:
+                    attribute_value = attribute_value.replace('\n', ' ').replace('\t', ' ')
+                element[key] = attribute_value
+            element_text = []
+            fill_evtx_content(element, element_text, children, subs)
+            data = u''.join(element_text).strip()
+            if element:
+                if data:
+                    element['#text'] = data
+            else:
+                element = data or None
+            if name not in item:
+                item[name] = element
+            elif isinstance(item[name], list):
+                item[name].append(element)
+            else:
+                item[name] = [item[name], element]
+            # the xml view ends each element with a newline
+            text.append(u'\n')
+        elif kind == EVTX_TEXT:
+            text.append(value)
+        else:
+            sub = subs[value]
+            if isinstance(sub, tuple):
+                # nested binary xml
+                fill_evtx_content(item, text, *sub)
+            else:
+                text.append(sub)
 
 
 def get_agent_config_vars():
@@ -137,6 +415,10 @@ def get_if_config_vars():
             if_url = config_parser.get('insightfinder', 'if_url')
             if_http_proxy = config_parser.get('insightfinder', 'if_http_proxy')
             if_https_proxy = config_parser.get('insightfinder', 'if_https_proxy')
+            if_pool_size = config_parser.get('insightfinder', 'if_pool_size') if config_parser.has_option(
+                'insightfinder', 'if_pool_size') else ''
+            if_compress = config_parser.get('insightfinder', 'if_compress') if config_parser.has_option(
+                'insightfinder', 'if_compress') else ''
         except ConfigParser.NoOptionError:
             logger.error('Agent not correctly configured. Check config file.')
             sys.exit(1)
@@ -205,7 +487,9 @@ def get_if_config_vars():
             'sampling_interval': int(sampling_interval),     # as seconds
             'chunk_size': int(chunk_size_kb) * 1024,         # as bytes
             'if_url': if_url,
-            'if_proxies': if_proxies
+            'if_proxies': if_proxies,
+            'if_pool_size': int(if_pool_size or 10),
+            'if_compress': if_compress.upper() == 'TRUE'
         }
 
         return config_vars
@@ -218,11 +502,8 @@ def get_cli_config_vars():
     """ get CLI options. use of these options should be rare """
     usage = 'Usage: %prog [options]'
     parser = OptionParser(usage=usage)
-    """
-    ## not ready.
     parser.add_option('--threads', default=1,
-                      action='store', dest='threads', help='Number of threads to run')
-    """
+                      action='store', dest='threads', help='Number of processes to decode files with')
     parser.add_option('--tz', default='UTC', action='store', dest='time_zone', 
                       help='Timezone of the data. See pytz.all_timezones')
     parser.add_option('-q', '--quiet', action='store_true', dest='quiet', 
@@ -234,16 +515,13 @@ def get_cli_config_vars():
                            ' Automatically turns on verbose logging')
     (options, args) = parser.parse_args()
 
-    """
-    # not ready
     try:
-        threads = int(options.threads)
+        threads = max(int(options.threads), 1)
     except ValueError:
         threads = 1
-    """
 
     config_vars = {
-        'threads': 1,
+        'threads': threads,
         'testing': False,
         'log_level': logging.INFO,
         'time_zone': pytz.utc
@@ -390,6 +668,17 @@ def get_json_size_bytes(json_data):
     return len(bytearray(json.dumps(json_data)))
 
 
+def get_json_separator_size(json_data):
+    """ size of the ', ' that json.dumps puts before every item but the first """
+    return 2 if len(json_data) > 1 else 0
+
+
+def append_to_current_row(entry):
+    """ add an entry to the current chunk, keeping a running count of its size in bytes """
+    track['current_row'].append(entry)
+    track['current_row_size'] += get_json_size_bytes(entry) + get_json_separator_size(track['current_row'])
+
+
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for index in xrange(0, len(l), n):
@@ -630,7 +919,7 @@ def parse_json_message_single(message):
                             instance, 
                             device)
         else:
-            log_data = json.loads(json.dumps(message))
+            log_data = message
 
     # hand off to log
     if 'METRIC' not in if_config_vars['project_type']:
@@ -843,6 +1132,7 @@ def initialize_data_gathering(thread_number):
     reset_track()
     track['chunk_count'] = 0
     track['entry_count'] = 0
+    track['handoffs'] = None
 
     start_data_processing(thread_number)
 
@@ -861,7 +1151,9 @@ def reset_track():
     track['start_time'] = time.time()
     track['line_count'] = 0
     track['current_row'] = []
+    track['current_row_size'] = 2  # '[]'
     track['current_dict'] = dict()
+    track['current_dict_size'] = 2  # '{}'
 
 
 #########################################
@@ -880,14 +1172,17 @@ def alert_handoff(timestamp, data, instance, device=''):
 
 
 def log_handoff(timestamp, data, instance, device=''):
+    if track['handoffs'] is not None:
+        buffer_handoff(log_handoff, timestamp, data, instance, device)
+        return
     entry = prepare_log_entry(str(int(timestamp)), data, instance, device)
-    track['current_row'].append(entry)
+    append_to_current_row(entry)
     track['line_count'] += 1
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
+    if track['current_row_size'] >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 100 == 0:
-        logger.debug('Current data object size: {} bytes'.format(get_json_size_bytes(track['current_row'])))
+        logger.debug('Current data object size: {} bytes'.format(track['current_row_size']))
 
 
 def prepare_log_entry(timestamp, data, instance, device=''):
@@ -907,12 +1202,15 @@ def prepare_log_entry(timestamp, data, instance, device=''):
 # Functions to handle Metric data #
 ###################################
 def metric_handoff(timestamp, field_name, data, instance, device=''):
+    if track['handoffs'] is not None:
+        buffer_handoff(metric_handoff, timestamp, field_name, data, instance, device)
+        return
     append_metric_data_to_entry(timestamp, field_name, data, instance, device)
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_dict']) >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
+    if track['current_dict_size'] >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 500 == 0:
-        logger.debug('Current data object size: {} bytes'.format(get_json_size_bytes(track['current_dict'])))
+        logger.debug('Current data object size: {} bytes'.format(track['current_dict_size']))
 
 
 def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''):
@@ -921,15 +1219,22 @@ def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''
     ts_str = str(timestamp)
     if ts_str not in track['current_dict']:
         track['current_dict'][ts_str] = dict()
+        # '"<ts>": {}'
+        track['current_dict_size'] += get_json_size_bytes(ts_str) + 4 + get_json_separator_size(track['current_dict'])
     current_obj = track['current_dict'][ts_str]
 
     # use the next non-null value to overwrite the prev value
     # for the same metric in the same timestamp
-    if key in current_obj.keys():
+    if key in current_obj:
         if data is not None and len(str(data)) > 0:
+            prev_size = get_json_size_bytes(current_obj[key])
             current_obj[key] += '|' + str(data)
+            track['current_dict_size'] += get_json_size_bytes(current_obj[key]) - prev_size
     else:
         current_obj[key] = str(data)
+        # '"<key>": "<value>"'
+        track['current_dict_size'] += get_json_size_bytes(key) + 2 + get_json_size_bytes(current_obj[key]) + \
+            get_json_separator_size(current_obj)
     track['current_dict'][ts_str] = current_obj
 
 
@@ -944,7 +1249,7 @@ def transpose_metrics():
             if '|' in value:
                 value = statistics.median(map(lambda v: float(v), value.split('|')))
             new_row[key] = str(value)
-        track['current_row'].append(new_row)
+        append_to_current_row(new_row)
 
 
 def build_metric_name_map():
@@ -1073,22 +1378,51 @@ def send_data_to_if(chunk_metric_data):
 
     # send the data
     post_url = urlparse.urljoin(if_config_vars['if_url'], get_api_from_project_type())
+    post_data = data_to_post
+    post_headers = None
+    if if_config_vars['if_compress']:
+        post_data = gzip_compress(urllib.urlencode(data_to_post))
+        post_headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'}
     send_request(post_url, 'POST', 'Could not send request to IF',
                  str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
-                 data=data_to_post, proxies=if_config_vars['if_proxies'])
+                 data=post_data, headers=post_headers, proxies=if_config_vars['if_proxies'])
     logger.debug('--- Send data time: %s seconds ---' % round(time.time() - send_data_time, 2))
 
 
+def get_request_session():
+    """ get this thread's pooled session, so connections are reused between requests """
+    # requests.Session is not thread-safe, so each thread gets its own
+    pid = (os.getpid(), threading.current_thread().ident)
+    if pid not in SESSIONS:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=if_config_vars['if_pool_size'],
+                                                pool_maxsize=if_config_vars['if_pool_size'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        SESSIONS[pid] = session
+    return SESSIONS[pid]
+
+
+def gzip_compress(data):
+    """ gzip a request body """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
 def send_request(url, mode='GET', failure_message='Failure!', success_message='Success!', **request_passthrough):
     """ sends a request to the given url """
     # determine if post or get (default)
-    req = requests.get
+    session = get_request_session()
+    req = session.get
     if mode.upper() == 'POST':
-        req = requests.post
+        req = session.post
 
     for i in xrange(ATTEMPTS):
         try:
+            request_time = time.time()
             response = req(url, **request_passthrough)
+            logger.debug('Request took {} seconds, {} bytes sent, {} bytes received'.format(
+                round(time.time() - request_time, 3), len(response.request.body or ''), len(response.content)))
             if response.status_code == httplib.OK:
                 logger.info(success_message)
                 return response
@@ -1208,6 +1542,23 @@ if __name__ == "__main__":
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = ','
     ATTEMPTS = 3
+    SESSIONS = dict()
+    EVTX_FILE_MAGIC = 'ElfFile\x00'
+    EVTX_FILE_HEADER_SIZE = 0x80
+    EVTX_CHUNK_MAGIC = 'ElfChnk\x00'
+    EVTX_CHUNK_SIZE = 0x10000
+    EVTX_CHUNK_HEADER_SIZE = 0x200
+    EVTX_RECORD_MAGIC = 0x2a2a
+    EVTX_RECORD_HEADER_SIZE = 0x18
+    EVTX_TASKS_PER_PROCESS = 4
+    # signed and unsigned byte, word, dword and qword substitutions
+    EVTX_INT_FORMATS = {0x03: '<b', 0x04: '<B', 0x05: '<h', 0x06: '<H', 0x07: '<i', 0x08: '<I', 0x09: '<q', 0x0A: '<Q'}
+    # control characters the xml view removes after escaping
+    EVTX_RESTRICTED_CHARS = re.compile(u'[\x01-\x08\x0b\x0c\x0e-\x1f\x7f]')
+    # kinds of compiled template content
+    EVTX_ELEMENT = 0
+    EVTX_TEXT = 1
+    EVTX_SUBSTITUTION = 2
     track = dict()
 
     # get config
@@ -1217,8 +1568,7 @@ if __name__ == "__main__":
     agent_config_vars = get_agent_config_vars()
     print_summary_info()
 
-    # start data processing
-    for i in range(0, cli_config_vars['threads']):
-        Process(target=initialize_data_gathering,
-                args=(i,)
-                ).start()
+    # start data processing. files are split between cli_config_vars['threads'] processes from there
+    Process(target=initialize_data_gathering,
+            args=(0,)
+            ).start()
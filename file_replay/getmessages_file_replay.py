@@ -1,27 +1,45 @@
 #!/usr/bin/env python
 import ConfigParser
+import Queue
+import array
+import calendar
+import cStringIO
+import ctypes
+import ctypes.util
+import itertools
 import json
+import zlib
 import logging
 import os
 import regex
+import select
 import socket
+import sqlite3
+import struct
 import sys
+import threading
 import time
 import pytz
 from optparse import OptionParser
-from multiprocessing import Process
+from multiprocessing import Pool, Process
 from datetime import datetime
+from collections import OrderedDict
 import dateutil
+import urllib
 import urlparse
 import httplib
 import requests
-import statistics
 import subprocess
 import shlex
 import xlrd
 import xml2dict
 import avro.datafile
 import avro.io
+try:
+    import numpy
+    import pandas
+except ImportError:
+    pandas = None
 
 
 '''
@@ -31,75 +49,88 @@ This script gathers data to send to Insightfinder
 
 def start_data_processing(thread_number):
     data_format = agent_config_vars['data_format']
-    # treat file_list as a queue
-    file_list = get_all_files(
-            agent_config_vars['file_path'],
-            agent_config_vars['file_name_regex'])
-    # sort by update time, reading oldest first
-    file_list.sort(key=lambda x: os.path.getmtime(x))
-    # create list of [{st_ino: filename}, {st_ino: filename}, ...]
-    file_list = [{str(os.stat(i).st_ino): i} for i in file_list]
-    # track st_ino of filenames
-    completed_files_st_ino = agent_config_vars['state']['completed_files_st_ino']
-    # start with current file or first in queue
-    current_file = agent_config_vars['state']['current_file']
-    if current_file:
-        _file = json.loads(current_file)
-        _file_st_ino, _file_name = _file.items()[0]
-        if str(os.stat(_file_name).st_ino) != _file_st_ino:
-            # between the last read and now, this file has rotated
-            update_state('current_file', '')
-            update_state('current_file_offset', 0)
-            _file = file_list.pop(0)
-        else:
-            file_list.pop(file_list.index(_file))
-    else:
-        _file = file_list.pop(0)
+    state = agent_config_vars['state']
+    # treat file_list as a queue of (st_ino, filename), oldest first
+    file_list = get_file_queue()
+    if 'TAIL' in data_format:
+        forget_missing_files(set(st_ino for st_ino, file_name in file_list))
+    if 'TAILF' in data_format:
+        logger.debug('tailing files')
+        process_lines(data_format, follow_files(data_format))
+        return
+    # track st_ino of filenames. only TAILF saves these, so keep the others out of the checkpoint
+    completed_files_st_ino = set(state['completed_files_st_ino'])
+    queued_files_st_ino = set(st_ino for st_ino, file_name in file_list)
     # while there's a file to read
-    while _file:
-        logger.debug(_file)
-        # get file info
-        st_ino_orig, file_name = _file.items()[0]
-        if st_ino_orig in completed_files_st_ino:
+    while file_list:
+        st_ino, file_name = file_list.pop(0)
+        logger.debug(file_name)
+        if st_ino in completed_files_st_ino:
             logger.debug('already streamed file {}'.format(file_name))
-            _file = file_list.pop(0) if len(file_list) != 0 else None
             continue
         # read from the file
-        message = ''
-        for line in reader(data_format, file_name, st_ino_orig):
-            if line:
-                logger.debug(line)
-                try:
-                    if 'IFEXPORT' in data_format:
-                        track['current_row'].append(line)
-                        send_metric()
-                    elif 'RAW' in data_format:
-                        message = parse_raw_line(message, line)
-                    else:  # everything else gets converted to a dict
-                        parse_json_message(line)
-                except Exception as e:
-                    logger.debug('Error when processing line {}'.format(line))
-                    logger.debug(e)
-        # get last message
-        if 'RAW' in data_format:
-            try:
-                parse_raw_message(message)
-            except Exception as e:
-                logger.debug('Error when processing line {}'.format(message))
-                logger.debug(e)
+        replay_file(data_format, file_name, st_ino)
         # mark as done
-        completed_files_st_ino.append(st_ino_orig)
-        # update file_list
-        cur_files = get_all_files(
-                agent_config_vars['file_path'],
-                agent_config_vars['file_name_regex'])
+        completed_files_st_ino.add(st_ino)
         # queue add'l files
-        new_files = [{str(os.stat(i).st_ino): i} for i in cur_files if ({str(os.stat(i).st_ino): i} not in file_list and str(os.stat(i).st_ino) not in completed_files_st_ino)]
-        file_list += new_files
-        file_list.sort(key=lambda x: os.path.getmtime(x.values()[0]))
+        file_list += get_file_queue(queued_files_st_ino)
+        queued_files_st_ino.update(st_ino for st_ino, file_name in file_list)
         logger.debug(file_list)
-        # dequeue next file
-        _file = file_list.pop(0) if len(file_list) != 0 else None
+
+
+def process_lines(data_format, lines):
+    message = ''
+    for line in lines:
+        if line:
+            logger.debug(line)
+            try:
+                if 'IFEXPORT' in data_format:
+                    append_to_current_row(line)
+                    send_metric()
+                elif 'RAW' in data_format:
+                    message = parse_raw_line(message, line)
+                else:  # everything else gets converted to a dict
+                    parse_json_message(line)
+            except Exception as e:
+                logger.debug('Error when processing line {}'.format(line))
+                logger.debug(e)
+    # get last message
+    if 'RAW' in data_format:
+        try:
+            parse_raw_message(message)
+        except Exception as e:
+            logger.debug('Error when processing line {}'.format(message))
+            logger.debug(e)
+
+
+def get_file_queue(skip_st_ino=frozenset()):
+    """ list (st_ino, filename) of files to read, oldest first """
+    files = []
+    for file_name in get_all_files(agent_config_vars['file_path'], agent_config_vars['file_name_regex']):
+        try:
+            stat = os.stat(file_name)
+        except OSError:
+            # removed since it was listed
+            continue
+        if str(stat.st_ino) not in skip_st_ino:
+            files.append((stat.st_mtime, str(stat.st_ino), file_name))
+    files.sort()
+    return [(st_ino, file_name) for mtime, st_ino, file_name in files]
+
+
+def forget_missing_files(st_inos):
+    """ drop saved positions and completed files that no longer exist, so state doesn't grow forever """
+    state = agent_config_vars['state']
+    state['completed_files_st_ino'] &= st_inos
+    for st_ino in set(state['tail_offsets']) - st_inos:
+        del state['tail_offsets'][st_ino]
+    if state['current_file']:
+        st_ino = json.loads(state['current_file']).keys()[0]
+        if st_ino in st_inos:
+            # resume it with the others
+            state['tail_offsets'][st_ino] = state['current_file_offset']
+        state['current_file'] = ''
+        state['current_file_offset'] = 0
 
 
 def read_xls(_file):
@@ -113,24 +144,27 @@ def read_xls(_file):
             for row in sheet.get_rows():
                 # build dict of <field name: value>
                 d = label_message(list(map(lambda x: x.value, row)))
-                # turn datetime into epoch
-                timestamp = ''
-                while timestamp == '' and len(agent_config_vars['timestamp_field']) != 0:
-                    timestamp_field = agent_config_vars['timestamp_field'].pop(0)
-                    try:
-                        timestamp_xlrd = d[timestamp_field]
-                    except KeyError:
-                        continue
-                    timestamp = get_timestamp_from_datetime(datetime(
-                        *xlrd.xldate_as_tuple(
-                            timestamp_xlrd,
-                            sheet.book.datemode)))
-                d[timestamp_field] = timestamp
-                agent_config_vars['timestamp_field'] = [timestamp_field]
+                # turn datetime in the first timestamp field that's set into epoch
+                for timestamp_field in agent_config_vars['timestamp_field']:
+                    if d.get(timestamp_field, '') != '':
+                        d[timestamp_field] = get_xls_timestamp(d[timestamp_field], wb.datemode)
+                        break
                 yield d
 
 
-def reader_next_line(_format, data, line):
+def get_xls_timestamp(value, datemode):
+    """ unix epoch (ms) of an excel date """
+    return get_timestamp_from_datetime(datetime(*xlrd.xldate_as_tuple(value, datemode)))
+
+
+def reader_next_line(_format, line):
+    if 'TAIL' in _format:
+        # only move the position past lines that have been handed off. for multiline
+        # messages, stay at the start of the message until the next one starts
+        if 'RAW' not in _format or not agent_config_vars['raw_start_regex'] or agent_config_vars['raw_start_regex'].match(line):
+            agent_config_vars['state']['current_file_offset'] = checkpoint['offset']
+        checkpoint['offset'] += len(line)
+        checkpoint_tick()
     # preformatting on each line
     if 'RAW' not in _format:
         try:
@@ -141,14 +175,10 @@ def reader_next_line(_format, data, line):
         line = label_message(agent_config_vars['csv_field_delimiter'].split(line))
     elif 'JSON' in _format:
         line = json.loads(line)
-    if 'TAIL' in _format:
-        pos = data.tell()
-        # write to state
-        update_state('current_file_offset', pos)
     return line
 
 
-def reader(_format, _file, st_ino):
+def reader(_format, _file, st_ino, start=0, end=None):
     if _format in {'XLS', 'XLSX'}:
         for line in read_xls(_file):
             yield line
@@ -160,8 +190,9 @@ def reader(_format, _file, st_ino):
                 agent_config_vars['csv_field_names'] = data.readline().strip().split(',')
             # preformatting on all data
             if 'TAIL' in _format:
-                update_state('current_file', json.dumps({st_ino: _file}))
-                data.seek(int(agent_config_vars['state']['current_file_offset'])) # read from state
+                switch_file(st_ino, _file)
+                checkpoint['offset'] = int(agent_config_vars['state']['current_file_offset'])
+                data.seek(checkpoint['offset']) # read from state
             elif _format == 'AVRO':
                 data = avro.datafile.DataFileReader(data, avro.io.DatumReader())
             # read data
@@ -171,58 +202,477 @@ def reader(_format, _file, st_ino):
             else:
                 # read each line
                 logger.debug('reading each line')
-                for line in data:
-                    yield reader_next_line(_format, data, line)
+                for line in (data if end is None else read_range(data, start, end)):
+                    yield reader_next_line(_format, line)
                 if 'TAIL' in _format:
-                    if 'TAILF' in _format:
-                        logger.debug('tailing file')
-                        # keep reading file
-                        for line2 in tail_file(_file, data):
-                            yield reader_next_line(_format, data, line2)
-                        # move from current file to completed, reset position
-                        update_state('completed_files_st_ino', st_ino, append=True)
-                        update_state('current_file', '')
-                        update_state('current_file_offset', 0)
-
-
-def tail_file(_file, data):
-    # start at end of file
-    data.seek(0,2)
-    # start reading in new lines
-    while os.path.getmtime(_file) > (get_timestamp_from_datetime(datetime.now())/1000 - if_config_vars['run_interval']):
-        line = ''
-        # build the line while it doesn't end in a newline
-        while not line.endswith(('\r', '\n', '\r\n')):
-            tail = data.readline()
-            if not tail:
-                time.sleep(0.1)
-                continue
-            line += tail
+                    update_state('current_file_offset', checkpoint['offset'])
+
+
+def read_range(data, start, end):
+    """ read the lines that start between the start and end byte offsets """
+    pos = start
+    if start > 0:
+        # the line running into start belongs to the range before
+        data.seek(start - 1)
+        pos += len(data.readline()) - 1
+    for line in data:
+        if pos >= end:
+            break
+        pos += len(line)
         yield line
 
 
+def replay_file(data_format, file_name, st_ino, start=0, end=None):
+    """ hand off the rows of a file, or of the range of it between start and end """
+    if columnar_plan and data_format == 'CSV':
+        read_csv_columns(file_name, start, end)
+    elif columnar_plan and data_format in {'XLS', 'XLSX'}:
+        read_xls_columns(file_name)
+    else:
+        process_lines(data_format, reader(data_format, file_name, st_ino, start, end))
+
+
+def read_csv_columns(_file, start=0, end=None):
+    """ parse a CSV a block of lines at a time, converting each column of the block at once """
+    field_names = agent_config_vars['csv_field_names']
+    with open(_file, 'r') as data:
+        lines = data if end is None else read_range(data, start, end)
+        while True:
+            block = list(itertools.islice(lines, CSV_BLOCK_LINES))
+            if not block:
+                break
+            block_data = ''.join(block)
+            # pandas only splits the same as the delimiter regex if one delimiter is used, every line
+            # has all the fields and there are no bare carriage returns. otherwise go line by line
+            delimiters = [x for x in columnar_plan['delimiters'] if x in block_data] or columnar_plan['delimiters'][:1]
+            if len(delimiters) != 1 \
+                    or block_data.count(delimiters[0]) != len(block) * (len(field_names) - 1) \
+                    or block_data.count('\r') != block_data.count('\r\n'):
+                logger.debug('reading block of {} lines line by line'.format(len(block)))
+                process_lines('CSV', (reader_next_line('CSV', line) for line in block))
+                continue
+            frame = pandas.read_csv(cStringIO.StringIO(block_data),
+                                    sep=delimiters[0],
+                                    header=None,
+                                    names=field_names,
+                                    index_col=False,
+                                    dtype=columnar_plan['dtype'],
+                                    quoting=3,  # csv.QUOTE_NONE
+                                    keep_default_na=False,
+                                    float_precision='round_trip')
+            metric_frame_handoff(frame, get_csv_timestamps(frame[columnar_plan['timestamp_field']]))
+
+
+def read_xls_columns(_file):
+    """ read each sheet of a workbook a column at a time """
+    field_names = agent_config_vars['csv_field_names']
+    with xlrd.open_workbook(_file) as wb:
+        for sheet in wb.sheets():
+            # fields past the last column aren't set
+            frame = pandas.DataFrame(OrderedDict(
+                (field, sheet.col_values(i) if i < sheet.ncols else [None] * sheet.nrows)
+                for i, field in enumerate(field_names)))
+            timestamps = convert_column(frame[columnar_plan['timestamp_field']].tolist(),
+                                        lambda x: get_xls_timestamp(x, wb.datemode))
+            valid = numpy.array([x is not None for x in timestamps], dtype=bool)
+            metric_frame_handoff(frame, (numpy.array([x or 0 for x in timestamps], dtype=numpy.int64), valid))
+
+
+def get_csv_timestamps(column):
+    """ unix epoch (ms) for each row of a timestamp column, and which rows have one """
+    epochs = numpy.zeros(len(column), dtype=numpy.int64)
+    slow = numpy.ones(len(column), dtype=bool)
+    if agent_config_vars['timestamp_format'][0] == 'epoch' \
+            and agent_config_vars['timezone'] is pytz.utc \
+            and not agent_config_vars.get('strip_tz'):
+        # get_timestamp_from_epoch_string for the whole column
+        digits = column.str.isdigit().fillna(False).values.astype(bool)
+        numbers = pandas.to_numeric(column.where(digits), errors='coerce').fillna(0).values
+        ms = (numbers >= 10 ** 12) & (numbers < 10 ** 14)
+        seconds = (numbers >= 10 ** 8) & (numbers < 10 ** 12)
+        epochs[ms] = numbers[ms] // 1000 * 1000
+        epochs[seconds] = numbers[seconds] * 1000
+        slow = ~(ms | seconds)
+    # everything else is parsed the same as on the row path
+    timestamps = convert_column(column.values[slow].tolist(),
+                                lambda x: get_timestamp_from_date_string(get_csv_value(x)))
+    epochs[slow] = [x or 0 for x in timestamps]
+    valid = numpy.ones(len(column), dtype=bool)
+    valid[slow] = [x is not None for x in timestamps]
+    return epochs, valid
+
+
+def metric_frame_handoff(frame, timestamps):
+    """ hand off a block of rows as parse_json_message_single would each row """
+    epochs, valid = timestamps
+    # filter
+    if columnar_plan['filters_include']:
+        valid &= numpy.any([numpy.array(get_filter_column(frame[filter_field], filter_vals), dtype=object) == True
+                            for filter_field, filter_vals in columnar_plan['filters_include']], axis=0)
+    for filter_field, filter_vals in columnar_plan['filters_exclude']:
+        valid &= numpy.array(get_filter_column(frame[filter_field], filter_vals), dtype=object) == False
+
+    # get instance & device
+    if columnar_plan['instance_field']:
+        instances = convert_column(frame[columnar_plan['instance_field']].tolist(),
+                                   lambda x: get_csv_value(x) or HOSTNAME)
+    else:
+        instances = [HOSTNAME] * len(frame)
+    if columnar_plan['device_field']:
+        devices = convert_column(frame[columnar_plan['device_field']].tolist(), get_csv_value)
+    else:
+        devices = [''] * len(frame)
+    instances = convert_column(zip(instances, devices), lambda x: make_safe_instance_string(*x))
+    valid &= numpy.array([x is not None for x in instances], dtype=bool)
+
+    if not valid.all():
+        logger.debug('skipping {} of {} rows'.format(len(valid) - valid.sum(), len(valid)))
+        frame = frame[valid]
+        epochs = epochs[valid]
+        instances = list(itertools.compress(instances, valid))
+    append_metric_block(epochs.astype(str).tolist(),
+                        instances,
+                        [(field, get_metric_column(frame[field])) for field in columnar_plan['data_fields']])
+
+
+def get_filter_column(column, filter_vals):
+    """ if each row's value contains one of the filter values, or None if it can't be checked """
+    return convert_column(column.tolist(),
+                          lambda x: any(filter_val in get_csv_value(x).upper() for filter_val in filter_vals))
+
+
+def get_metric_column(column):
+    """ each row's value of a data field as a string, or None if it isn't a number """
+    if column.dtype.kind in 'iuf':
+        return [str(x) for x in column.astype(float).tolist()]
+    values = []
+    for value, number in itertools.izip(column.tolist(), pandas.to_numeric(column, errors='coerce').astype(float).tolist()):
+        if number == number:
+            values.append(str(number))
+        elif value is None or value == '':
+            values.append(None)
+        else:
+            # nan, or something only the row path can read
+            try:
+                values.append(str(float(get_csv_value(value))))
+            except Exception:
+                values.append(None)
+    return values
+
+
+def get_csv_value(value):
+    """ read a single field's value the same way as the row path """
+    return get_json_path({0: value}, [0])
+
+
+def convert_column(values, convert):
+    """ convert each distinct value of a column once. None where the value isn't set or can't be converted """
+    converted = dict()
+    for value in set(values):
+        if value is None:
+            converted[value] = None
+            continue
+        try:
+            converted[value] = convert(value)
+        except Exception as e:
+            logger.debug('Error when converting {}'.format(value))
+            logger.debug(e)
+            converted[value] = None
+    return [converted[value] for value in values]
+
+
+def switch_file(st_ino, file_name):
+    """ make file_name the current file, keeping the position in the file read before it """
+    state = agent_config_vars['state']
+    current_file = json.dumps({st_ino: file_name})
+    if current_file == state['current_file']:
+        return
+    if state['current_file']:
+        last_st_ino = json.loads(state['current_file']).keys()[0]
+        if last_st_ino not in state['completed_files_st_ino']:
+            state['tail_offsets'][last_st_ino] = state['current_file_offset']
+    state['current_file'] = current_file
+    state['current_file_offset'] = state['tail_offsets'].pop(st_ino, 0)
+
+
+def complete_file(st_ino):
+    """ mark a tailed file as done, so it isn't read again """
+    state = agent_config_vars['state']
+    state['completed_files_st_ino'].add(st_ino)
+    state['tail_offsets'].pop(st_ino, None)
+    if state['current_file'] and st_ino in json.loads(state['current_file']):
+        state['current_file'] = ''
+        state['current_file_offset'] = 0
+
+
+def follow_files(_format):
+    """
+    read the files to tail, then keep reading what's written to them and to new files in the same
+    directories, until nothing has been written for run_interval.
+    files that are moved away or deleted (ie rotated) are read to the end and marked as completed.
+    """
+    completed_files_st_ino = agent_config_vars['state']['completed_files_st_ino']
+    # watch before listing, so no file is missed in between
+    watch = inotify_open()
+    for root in agent_config_vars['file_path']:
+        root = os.path.expanduser(root)
+        watch_dirs(watch, root if os.path.isdir(root) else os.path.dirname(root))
+    followed = dict()   # st_ino: open file
+    paths = dict()      # filename: st_ino
+    # open everything before reading, so files rotated in the meantime are still read to the end
+    to_read = [follow_file(followed, paths, file_name) for st_ino, file_name in get_file_queue(completed_files_st_ino)]
+    last_read = time.time()
+    while True:
+        for st_ino in to_read:
+            if st_ino in followed:
+                for line in read_followed(_format, st_ino, followed[st_ino]):
+                    last_read = time.time()
+                    yield line
+        to_read = set()
+        timeout = if_config_vars['run_interval'] - (time.time() - last_read)
+        if timeout <= 0:
+            break
+        for directory, mask, name in inotify_events(watch, timeout):
+            if name is None:
+                # no inotify, or events were dropped: check everything
+                for st_ino, file_name in get_file_queue(set(followed) | completed_files_st_ino):
+                    follow_file(followed, paths, file_name)
+                to_read = set(followed)
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    watch_dirs(watch, path)
+                    for file_name in get_all_files([path], agent_config_vars['file_name_regex']):
+                        to_read.add(follow_file(followed, paths, file_name))
+            elif mask & IN_MODIFY:
+                if path in paths:
+                    to_read.add(paths[path])
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                if is_followed_path(path):
+                    to_read.add(follow_file(followed, paths, path))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                if path in paths:
+                    st_ino = paths.pop(path)
+                    logger.debug('{} was rotated'.format(path))
+                    for line in read_followed(_format, st_ino, followed[st_ino]):
+                        yield line
+                    followed.pop(st_ino).close()
+                    complete_file(st_ino)
+    for data in followed.values():
+        data.close()
+    if watch['fd'] is not None:
+        os.close(watch['fd'])
+
+
+def follow_file(followed, paths, file_name):
+    """ start following a file. returns its st_ino, or None if it's not to be read """
+    try:
+        data = open(file_name, 'r')
+    except IOError as e:
+        logger.warning('Could not open {}: {}'.format(file_name, e))
+        return None
+    st_ino = str(os.fstat(data.fileno()).st_ino)
+    if st_ino in followed or st_ino in agent_config_vars['state']['completed_files_st_ino']:
+        # ie a rotated file moved under another matching name
+        data.close()
+        return None
+    followed[st_ino] = data
+    paths[file_name] = st_ino
+    logger.debug('following {}'.format(file_name))
+    return st_ino
+
+
+def is_followed_path(path):
+    """ whether a new file would have been picked up by get_all_files """
+    for root in agent_config_vars['file_path']:
+        root = os.path.expanduser(root)
+        if os.path.isdir(root):
+            if path.startswith(os.path.join(root, '')) and check_regex(agent_config_vars['file_name_regex'], os.path.basename(path)):
+                return True
+        elif path == root and check_regex(agent_config_vars['file_name_regex'], root):
+            return True
+    return False
+
+
+def read_followed(_format, st_ino, data):
+    """ read the complete lines written to a followed file since it was last read """
+    switch_file(st_ino, data.name)
+    checkpoint['offset'] = agent_config_vars['state']['current_file_offset']
+    if os.fstat(data.fileno()).st_size < checkpoint['offset']:
+        # truncated in place (ie copytruncate), start over
+        logger.debug('{} was truncated'.format(data.name))
+        checkpoint['offset'] = agent_config_vars['state']['current_file_offset'] = 0
+    data.seek(checkpoint['offset'])
+    while True:
+        line = data.readline()
+        if not line.endswith('\n'):
+            # nothing new, or the rest of the line hasn't been written yet
+            break
+        yield reader_next_line(_format, line)
+    # a multiline message may continue in the next write
+    if 'RAW' not in _format or not agent_config_vars['raw_start_regex']:
+        agent_config_vars['state']['current_file_offset'] = checkpoint['offset']
+
+
+def inotify_open():
+    """ returns a watch for inotify_events. without inotify (ie not on linux), events are polled for """
+    watch = {'fd': None, 'wds': dict()}
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init()
+    except (OSError, AttributeError) as e:
+        logger.warning('inotify is not available, polling files instead: {}'.format(e))
+        return watch
+    if fd < 0:
+        logger.warning('inotify_init failed, polling files instead: {}'.format(os.strerror(ctypes.get_errno())))
+        return watch
+    watch['libc'] = libc
+    watch['fd'] = fd
+    return watch
+
+
+def watch_dirs(watch, root):
+    """ watch root and every directory under it """
+    if watch['fd'] is None:
+        return
+    for path, subdirs, files in os.walk(root):
+        wd = watch['libc'].inotify_add_watch(watch['fd'], path, INOTIFY_MASK)
+        if wd < 0:
+            logger.warning('Could not watch {}: {}'.format(path, os.strerror(ctypes.get_errno())))
+        else:
+            watch['wds'][wd] = path
+
+
+def inotify_events(watch, timeout):
+    """ wait up to timeout seconds for events, as (directory, mask, filename) """
+    if watch['fd'] is None:
+        time.sleep(min(timeout, POLL_INTERVAL))
+        return [(None, 0, None)]
+    ready, _, _ = select.select([watch['fd']], [], [], timeout)
+    if not ready:
+        return []
+    buf = os.read(watch['fd'], 65536)
+    events = []
+    i = 0
+    while i < len(buf):
+        wd, mask, cookie, length = struct.unpack_from('iIII', buf, i)
+        name = buf[i + 16:i + 16 + length].rstrip('\0')
+        i += 16 + length
+        if mask & IN_Q_OVERFLOW:
+            events.append((None, mask, None))
+        elif mask & IN_IGNORED:
+            watch['wds'].pop(wd, None)
+        elif wd in watch['wds'] and name:
+            events.append((watch['wds'][wd], mask, name))
+    return events
+
+
 def update_state(setting, value, append=False):
     # update in-mem
     if append:
-        current = ','.join(agent_config_vars['state'][setting])
-        value = '{},{}'.format(current, value) if current else value
-        agent_config_vars['state'][setting] = value.split(',')
+        agent_config_vars['state'][setting].add(value)
     else:
         agent_config_vars['state'][setting] = value
     logger.debug('setting {} to {}'.format(setting, value))
-    # update config file
-    if 'TAIL' in agent_config_vars['data_format']:
-        config_ini = config_ini_path()
-        if os.path.exists(config_ini):
-            config_parser = ConfigParser.SafeConfigParser()
-            config_parser.read(config_ini)
-            config_parser.set('state', setting, str(value))
-            with open(config_ini, 'w') as config_file:
-                config_parser.write(config_file)
     # return new value (if append)
     return value
 
 
+def open_checkpoint_store():
+    """ open the checkpoint store for *TAIL formats, seeding it from [state] the first time """
+    checkpoint['lock'] = threading.Lock()
+    checkpoint['seq'] = 0       # last chunk sealed
+    checkpoint['acked'] = 0     # every chunk up to and including this one was sent
+    checkpoint['pending'] = dict()
+    checkpoint['sent'] = set()
+    checkpoint['stalled'] = False
+    checkpoint['failed'] = 0
+    checkpoint['offset'] = 0
+    checkpoint['lines'] = 0
+    checkpoint['time'] = time.time()
+    checkpoint['conn'] = None
+    if 'TAIL' not in agent_config_vars['data_format']:
+        return
+    conn = sqlite3.connect(agent_config_vars['checkpoint_file'], check_same_thread=False)
+    conn.execute('CREATE TABLE IF NOT EXISTS state (setting TEXT PRIMARY KEY, value TEXT)')
+    stored = dict(conn.execute('SELECT setting, value FROM state').fetchall())
+    if stored:
+        for setting, value in stored.items():
+            agent_config_vars['state'][setting] = json.loads(value)
+        agent_config_vars['state']['completed_files_st_ino'] = set(agent_config_vars['state']['completed_files_st_ino'])
+        logger.debug('Loaded checkpoint {}'.format(agent_config_vars['state']))
+    else:
+        write_checkpoint(conn, get_state_snapshot())
+    checkpoint['conn'] = conn
+
+
+def write_checkpoint(conn, state):
+    # one transaction, so a crash leaves either the old or the new position
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO state (setting, value) VALUES (?, ?)',
+                         [(setting, json.dumps(value)) for setting, value in state.items()])
+
+
+def checkpoint_seal():
+    """ snapshot the read position for the chunk about to be sent. returns the chunk's sequence number """
+    checkpoint['lines'] = 0
+    checkpoint['time'] = time.time()
+    if not checkpoint['conn'] or checkpoint['stalled']:
+        return None
+    with checkpoint['lock']:
+        checkpoint['seq'] += 1
+        checkpoint['pending'][checkpoint['seq']] = get_state_snapshot()
+        return checkpoint['seq']
+
+
+def get_state_snapshot():
+    state = agent_config_vars['state']
+    return {
+        'current_file': state['current_file'],
+        'current_file_offset': state['current_file_offset'],
+        'completed_files_st_ino': list(state['completed_files_st_ino']),
+        'tail_offsets': dict(state['tail_offsets'])
+    }
+
+
+def checkpoint_ack(seq, sent):
+    """ save the position of the newest chunk that was sent after every chunk before it """
+    if not sent:
+        with checkpoint['lock']:
+            checkpoint['failed'] += 1
+    if seq is None:
+        return
+    with checkpoint['lock']:
+        if not sent:
+            # keep the last saved position, so everything from here is read again after a restart
+            logger.warning('Chunk {} was not sent, checkpoint stays at chunk {}'.format(seq, checkpoint['acked']))
+            checkpoint['stalled'] = True
+            checkpoint['pending'].clear()
+        if checkpoint['stalled']:
+            return
+        checkpoint['sent'].add(seq)
+        state = None
+        while checkpoint['acked'] + 1 in checkpoint['sent']:
+            checkpoint['acked'] += 1
+            checkpoint['sent'].remove(checkpoint['acked'])
+            state = checkpoint['pending'].pop(checkpoint['acked'])
+        if state:
+            write_checkpoint(checkpoint['conn'], state)
+
+
+def checkpoint_tick():
+    """ seal the current chunk if too many lines or seconds have gone by without one """
+    checkpoint['lines'] += 1
+    if checkpoint['lines'] >= agent_config_vars['checkpoint_lines'] or \
+            time.time() - checkpoint['time'] >= agent_config_vars['checkpoint_seconds']:
+        if len(track['current_row']) > 0 or len(track['current_dict']) > 0:
+            send_data_wrapper()
+        else:
+            # nothing to send (ie all lines were filtered out), only the position moves
+            checkpoint_ack(checkpoint_seal(), True)
+
+
 def get_agent_config_vars():
     """ Read and parse config.ini """
     config_ini = config_ini_path()
@@ -235,6 +685,14 @@ def get_agent_config_vars():
             current_file = config_parser.get('state', 'current_file')
             current_file_offset = config_parser.get('state', 'current_file_offset') or 0
             completed_files_st_ino = config_parser.get('state', 'completed_files_st_ino')
+            checkpoint_file = config_parser.get('agent', 'checkpoint_file') if config_parser.has_option(
+                'agent', 'checkpoint_file') else ''
+            checkpoint_lines = config_parser.get('agent', 'checkpoint_lines') if config_parser.has_option(
+                'agent', 'checkpoint_lines') else ''
+            checkpoint_seconds = config_parser.get('agent', 'checkpoint_seconds') if config_parser.has_option(
+                'agent', 'checkpoint_seconds') else ''
+            replay_split_size_mb = config_parser.get('agent', 'replay_split_size_mb') if config_parser.has_option(
+                'agent', 'replay_split_size_mb') else ''
 
             # files
             file_path = config_parser.get('agent', 'file_path')
@@ -364,8 +822,13 @@ def get_agent_config_vars():
             'state': {
                 'current_file': current_file if 'TAIL' in data_format else '',
                 'current_file_offset': int(current_file_offset) if 'TAIL' in data_format else 0,
-                'completed_files_st_ino': completed_files_st_ino.split(',') if 'TAIL' in data_format else []
+                'completed_files_st_ino': set(completed_files_st_ino.split(',')) if 'TAIL' in data_format and completed_files_st_ino else set(),
+                'tail_offsets': dict()
                 },
+            'checkpoint_file': abs_path_from_cur(checkpoint_file or 'checkpoint.db'),
+            'checkpoint_lines': int(checkpoint_lines or 10000),
+            'checkpoint_seconds': int(checkpoint_seconds or 10),
+            'replay_split_size': int(replay_split_size_mb or 64) * 1024 * 1024,
             'file_path': file_path,
             'file_name_regex': file_name_regex,
             'filters_include': filters_include,
@@ -413,6 +876,16 @@ def get_if_config_vars():
             if_url = config_parser.get('insightfinder', 'if_url')
             if_http_proxy = config_parser.get('insightfinder', 'if_http_proxy')
             if_https_proxy = config_parser.get('insightfinder', 'if_https_proxy')
+            if_pool_size = config_parser.get('insightfinder', 'if_pool_size') if config_parser.has_option(
+                'insightfinder', 'if_pool_size') else ''
+            if_compress = config_parser.get('insightfinder', 'if_compress') if config_parser.has_option(
+                'insightfinder', 'if_compress') else ''
+            upload_workers = config_parser.get('insightfinder', 'upload_workers') if config_parser.has_option(
+                'insightfinder', 'upload_workers') else ''
+            upload_queue_size = config_parser.get('insightfinder', 'upload_queue_size') if config_parser.has_option(
+                'insightfinder', 'upload_queue_size') else ''
+            metric_aggregation = config_parser.get('insightfinder', 'metric_aggregation') if config_parser.has_option(
+                'insightfinder', 'metric_aggregation') else ''
         except ConfigParser.NoOptionError as cp_noe:
             logger.error(cp_noe)
             config_error()
@@ -466,6 +939,9 @@ def get_if_config_vars():
             chunk_size_kb = 2048  # 2MB chunks by default
         if len(if_url) == 0:
             if_url = 'https://app.insightfinder.com'
+        metric_aggregation = metric_aggregation.lower() or 'median'
+        if metric_aggregation not in METRIC_AGGREGATIONS:
+            config_error('metric_aggregation')
 
         # set IF proxies
         if_proxies = dict()
@@ -484,7 +960,12 @@ def get_if_config_vars():
             'run_interval': int(run_interval),              # as seconds
             'chunk_size': int(chunk_size_kb) * 1024,        # as bytes
             'if_url': if_url,
-            'if_proxies': if_proxies
+            'if_proxies': if_proxies,
+            'if_pool_size': int(if_pool_size or 10),
+            'if_compress': if_compress.upper() == 'TRUE',
+            'upload_workers': int(upload_workers or 1),
+            'upload_queue_size': int(upload_queue_size or 4),
+            'metric_aggregation': metric_aggregation
         }
 
         return config_vars
@@ -504,11 +985,8 @@ def get_cli_config_vars():
     """ get CLI options. use of these options should be rare """
     usage = 'Usage: %prog [options]'
     parser = OptionParser(usage=usage)
-    """
-    ## not ready.
     parser.add_option('--threads', default=1, action='store', dest='threads',
-                      help='Number of threads to run')
-    """
+                      help='Number of processes to replay files with. *TAIL formats always use one')
     parser.add_option('-c', '--config', action='store', dest='config', default=abs_path_from_cur('config.ini'),
                       help='Path to the config file to use. Defaults to {}'.format(abs_path_from_cur('config.ini')))
     parser.add_option('-q', '--quiet', action='store_true', dest='quiet', default=False,
@@ -520,17 +998,14 @@ def get_cli_config_vars():
                            ' Automatically turns on verbose logging')
     (options, args) = parser.parse_args()
 
-    """
-    # not ready
     try:
-        threads = int(options.threads)
+        threads = max(int(options.threads), 1)
     except ValueError:
         threads = 1
-    """
 
     config_vars = {
         'config': options.config if os.path.isfile(options.config) else abs_path_from_cur('config.ini'),
-        'threads': 1,
+        'threads': threads,
         'testing': False,
         'log_level': logging.INFO
         }
@@ -718,6 +1193,17 @@ def get_json_size_bytes(json_data):
     return len(bytearray(json.dumps(json_data)))
 
 
+def get_json_separator_size(json_data):
+    """ size of the ', ' that json.dumps puts before every item but the first """
+    return 2 if len(json_data) > 1 else 0
+
+
+def append_to_current_row(entry):
+    """ add an entry to the current chunk, keeping a running count of its size in bytes """
+    track['current_row'].append(entry)
+    track['current_row_size'] += get_json_size_bytes(entry) + get_json_separator_size(track['current_row'])
+
+
 def get_all_files(files, file_regex_c):
     return [ i for j in
                 map(lambda k:
@@ -810,13 +1296,118 @@ def parse_formatted(message, setting_value, default='', allow_list=False, remove
     return setting_value.format(**fields)
 
 
+def build_extraction_plan():
+    """ pre-split the field settings once, so each message only has to be walked """
+    return {
+        'json_top_level': agent_config_vars['json_top_level'].split(JSON_LEVEL_DELIM),
+        'filters_include': [compile_filter(x) for x in agent_config_vars['filters_include']],
+        'filters_exclude': [compile_filter(x) for x in agent_config_vars['filters_exclude']],
+        'instance_field': compile_setting(agent_config_vars['instance_field']),
+        'device_field': compile_setting(agent_config_vars['device_field']),
+        'timestamp_field': compile_setting(agent_config_vars['timestamp_field']),
+        # reverse list so it's in priority order, as shared fields names will get overwritten
+        'data_fields': [compile_data_field(x) for x in reversed(agent_config_vars['data_fields'] or [])],
+    }
+
+
+def build_columnar_plan():
+    """ the columns to read each setting from, if metric rows can be read a block at a time """
+    if pandas is None or 'METRIC' not in if_config_vars['project_type'] \
+            or agent_config_vars['data_format'] not in {'CSV', 'XLS', 'XLSX'} \
+            or agent_config_vars['json_top_level']:
+        return None
+    field_names = agent_config_vars['csv_field_names']
+    if len(set(field_names)) != len(field_names):
+        return None
+    plan = {'dtype': dict()}
+    # only plain field names, each read from a single column
+    for setting in ('instance_field', 'device_field', 'timestamp_field'):
+        setting_plan = extraction_plan[setting]
+        if setting_plan['formatted'] or len(setting_plan['paths']) > 1 \
+                or any(len(path) != 1 or path[0] not in field_names for path in setting_plan['paths']):
+            return None
+        plan[setting] = setting_plan['paths'][0][0] if setting_plan['paths'] else None
+        if plan[setting] and setting != 'timestamp_field':
+            plan['dtype'][plan[setting]] = str
+    if not plan['timestamp_field']:
+        return None
+    # read as text, as the row path does. a float epoch would otherwise make the whole column float
+    plan['dtype'][plan['timestamp_field']] = str
+    for setting in ('filters_include', 'filters_exclude'):
+        if any(len(path) != 1 or path[0] not in field_names for path, filter_vals in extraction_plan[setting]):
+            return None
+        plan[setting] = [(path[0], filter_vals) for path, filter_vals in extraction_plan[setting]]
+        for path, filter_vals in extraction_plan[setting]:
+            plan['dtype'][path[0]] = str
+    if extraction_plan['data_fields']:
+        if any(path is None or len(path) != 1 for setting_value, path in extraction_plan['data_fields']):
+            return None
+        plan['data_fields'] = [path[0] for setting_value, path in extraction_plan['data_fields'] if path[0] in field_names]
+    else:
+        used = {plan['instance_field'], plan['device_field'], plan['timestamp_field']}
+        if any(JSON_LEVEL_DELIM in field for field in field_names if field not in used):
+            return None
+        plan['data_fields'] = [field for field in field_names if field not in used]
+    # a regex alternating between single characters can be read as any one of them
+    plan['delimiters'] = []
+    for delimiter in agent_config_vars['csv_field_delimiter'].pattern.split('|'):
+        if delimiter == r'\t':
+            delimiter = '\t'
+        elif len(delimiter) == 2 and delimiter[0] == '\\' and not delimiter[1].isalnum():
+            delimiter = delimiter[1]
+        elif len(delimiter) != 1 or delimiter in '.^$*+?{}[]()\\':
+            return None
+        plan['delimiters'].append(delimiter)
+    logger.debug('reading {} a block at a time'.format(agent_config_vars['data_format']))
+    return plan
+
+
+def compile_filter(_filter):
+    filter_field = _filter.split(':')[0]
+    filter_vals = _filter.split(':')[1].split(',')
+    return filter_field.split(JSON_LEVEL_DELIM), [x.upper() for x in filter_vals]
+
+
+def compile_setting(setting_value):
+    if is_formatted(setting_value[0]):
+        return {'formatted': setting_value[0], 'paths': []}
+    return {'formatted': None, 'paths': [x.split(JSON_LEVEL_DELIM) for x in setting_value if x]}
+
+
+def compile_data_field(setting_value):
+    if is_named_data_field(setting_value):
+        return setting_value, None
+    return setting_value, setting_value.split(JSON_LEVEL_DELIM)
+
+
+def get_plan_value(message, setting_plan, default='', allow_list=False, remove=False):
+    if setting_plan['formatted']:
+        return parse_formatted(message,
+                               setting_plan['formatted'],
+                               default=default,
+                               allow_list=False,
+                               remove=remove)
+    value = ''
+    for path in setting_plan['paths']:
+        value = get_json_path(message,
+                              path,
+                              allow_list=allow_list,
+                              remove=remove)
+        if value != '':
+            break
+    return value or default
+
+
 def get_data_values(timestamp, message):
-    setting_values = agent_config_vars['data_fields'] or message.keys()
-    # reverse list so it's in priority order, as shared fields names will get overwritten
-    setting_values.reverse()
-    data = { x: dict() for x in timestamp }
-    for setting_value in setting_values:
-        name, value = get_data_value(message, setting_value)
+    data = {x: dict() for x in timestamp}
+    # plan is in priority order, as shared fields names will get overwritten
+    data_fields = extraction_plan['data_fields'] or [(x, None) for x in reversed(message.keys())]
+    for setting_value, path in data_fields:
+        if path is None:
+            name, value = get_data_value(message, setting_value)
+        else:
+            name = setting_value
+            value = get_json_path(message, path, allow_list=True)
         if isinstance(value, (set, tuple, list)):
             for i in range(minlen(timestamp, value)):
                 merge_data(name, value[i], data[timestamp[i]])
@@ -891,12 +1482,20 @@ def get_json_field_by_pri(message, pri_list, default='', allow_list=False, remov
 
 
 def get_json_field(message, setting_value, default='', allow_list=False, remove=False):
+    return get_json_path(message,
+                         setting_value.split(JSON_LEVEL_DELIM),
+                         default=default,
+                         allow_list=allow_list,
+                         remove=remove)
+
+
+def get_json_path(message, path, default='', allow_list=False, remove=False):
     field_val = json_format_field_value(
-                    _get_json_field_helper(
-                        message,
-                        setting_value.split(JSON_LEVEL_DELIM),
-                        allow_list=allow_list,
-                        remove=remove))
+        _get_json_field_helper(
+            message,
+            list(path),
+            allow_list=allow_list,
+            remove=remove))
     if len(field_val) == 0:
         field_val = default
     return field_val
@@ -921,7 +1520,7 @@ def _get_json_field_helper(nested_value, next_fields, allow_list=False, remove=F
 
     # get the next value
     next_field = next_fields.pop(0)
-    next_value = json.loads(json.dumps(nested_value.get(next_field)))
+    next_value = nested_value.get(next_field)
     if len(next_fields) == 0 and remove:
         # last field to grab, so remove it
         nested_value.pop(next_field)
@@ -935,14 +1534,15 @@ def _get_json_field_helper(nested_value, next_fields, allow_list=False, remove=F
         return ''
 
     # sometimes payloads come in formatted
-    try:
-        next_value = json.loads(next_value)
-    except Exception as ex:
-        next_value = json.loads(json.dumps(next_value))
+    if isinstance(next_value, basestring):
+        try:
+            next_value = json.loads(next_value)
+        except Exception as ex:
+            pass
 
     # handle simple lists
     while isinstance(next_value, (list, set, tuple)) and len(next_value) == 1:
-        next_value = next_value.pop()
+        next_value = list(next_value)[0]
 
     # continue traversing?
     if next_fields is None:
@@ -956,17 +1556,15 @@ def _get_json_field_helper(nested_value, next_fields, allow_list=False, remove=F
         if allow_list:
             return json_gather_list_values(
                 next_value,
-                next_fields,
-                remove=remove)
+                next_fields)
         else:
             raise ListNotAllowedError('encountered list or set in json when not allowed')
     elif isinstance(next_value, dict):
-        # there's more tree to walk down
+        # there's more tree to walk down; only top-level fields are removed
         return _get_json_field_helper(
-                json.loads(json.dumps(next_value)),
+                next_value,
                 next_fields,
-                allow_list=allow_list,
-                remove=remove)
+                allow_list=allow_list)
     else:
         # catch-all
         return ''
@@ -1010,7 +1608,7 @@ def parse_json_message(messages):
         else:
             top_level = _get_json_field_helper(
                     messages,
-                    agent_config_vars['json_top_level'].split(JSON_LEVEL_DELIM),
+                    list(extraction_plan['json_top_level']),
                     allow_list=True)
             if isinstance(top_level, (list, set, tuple)):
                 for message in top_level:
@@ -1025,21 +1623,19 @@ def parse_json_message(messages):
 
 
 def parse_json_message_single(message):
-    message = json.loads(json.dumps(message))
     # filter
-    if len(agent_config_vars['filters_include']) != 0:
+    if len(extraction_plan['filters_include']) != 0:
         # for each provided filter
         is_valid = False
-        for _filter in agent_config_vars['filters_include']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = get_json_field(
+        for filter_path, filter_vals in extraction_plan['filters_include']:
+            filter_check = get_json_path(
                 message,
-                filter_field,
+                filter_path,
                 allow_list=True)
             # check if a valid value
+            filter_check_upper = filter_check.upper()
             for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
+                if filter_val in filter_check_upper:
                     is_valid = True
                     break
             if is_valid:
@@ -1051,18 +1647,17 @@ def parse_json_message_single(message):
         else:
             logger.debug('passed filter (inclusion)')
 
-    if len(agent_config_vars['filters_exclude']) != 0:
+    if len(extraction_plan['filters_exclude']) != 0:
         # for each provided filter
-        for _filter in agent_config_vars['filters_exclude']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = get_json_field(
+        for filter_path, filter_vals in extraction_plan['filters_exclude']:
+            filter_check = get_json_path(
                 message,
-                filter_field,
+                filter_path,
                 allow_list=True)
             # check if a valid value
+            filter_check_upper = filter_check.upper()
             for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
+                if filter_val in filter_check_upper:
                     logger.debug('filtered message (exclusion): {} in {}'.format(
                         filter_val, filter_check))
                     return
@@ -1073,24 +1668,24 @@ def parse_json_message_single(message):
     #                                'project_field',
     #                                default=if_config_vars['project_name']),
     #                                remove=True)
-    instance = get_single_value(message,
-                                'instance_field',
-                                default=HOSTNAME,
-                                remove=True)
-    device = get_single_value(message,
-                              'device_field',
+    instance = get_plan_value(message,
+                              extraction_plan['instance_field'],
+                              default=HOSTNAME,
                               remove=True)
+    device = get_plan_value(message,
+                            extraction_plan['device_field'],
+                            remove=True)
     # get timestamp
     try:
-        timestamp = get_single_value(message,
-                                     'timestamp_field',
-                                     remove=True)
+        timestamp = get_plan_value(message,
+                                   extraction_plan['timestamp_field'],
+                                   remove=True)
         timestamp = [timestamp]
     except ListNotAllowedError as lnae:
-        timestamp = get_single_value(message,
-                                     'timestamp_field',
-                                     remove=True,
-                                     allow_list=True)
+        timestamp = get_plan_value(message,
+                                   extraction_plan['timestamp_field'],
+                                   remove=True,
+                                   allow_list=True)
     except Exception as e:
         logger.warn(e)
         sys.exit(1)
@@ -1217,8 +1812,36 @@ def parse_csv_row(row, field_names, instance, device=''):
 
 def get_timestamp_from_date_string(date_string):
     """ parse a date string into unix epoch (ms) """
-    timestamp_datetime = get_datetime_from_date_string(date_string.partition('.')[0])
-    return get_timestamp_from_datetime(timestamp_datetime)
+    date_string = date_string.partition('.')[0]
+    epoch = get_timestamp_from_epoch_string(date_string)
+    if epoch is not None:
+        return epoch
+
+    # most lines share their second with a line seen shortly before
+    epoch = timestamp_cache.pop(date_string, None)
+    if epoch is None:
+        timestamp_datetime = get_datetime_from_date_string(date_string)
+        epoch = get_timestamp_from_datetime(timestamp_datetime)
+    if len(timestamp_cache) >= TIMESTAMP_CACHE_SIZE:
+        timestamp_cache.popitem(last=False)
+    timestamp_cache[date_string] = epoch
+    return epoch
+
+
+def get_timestamp_from_epoch_string(date_string):
+    """ fast path for epoch timestamps in UTC, returns None to fall back to the full parse """
+    if agent_config_vars['timestamp_format'][0] != 'epoch' \
+            or agent_config_vars['timezone'] is not pytz.utc \
+            or agent_config_vars.get('strip_tz'):
+        return None
+    epoch = date_string.lstrip(' 0')
+    if not epoch.isdigit():
+        return None
+    if 13 <= len(epoch) < 15:
+        return long(epoch) / 1000 * 1000
+    elif 9 <= len(epoch) < 13:
+        return long(epoch) * 1000
+    return None
 
 
 def get_datetime_from_date_string(date_string):
@@ -1226,19 +1849,24 @@ def get_datetime_from_date_string(date_string):
     if 'strip_tz' in agent_config_vars and agent_config_vars['strip_tz']:
         date_string = ''.join(agent_config_vars['strip_tz_fmt'].split(date_string))
     if 'timestamp_format' in agent_config_vars:
-        for timestamp_format in agent_config_vars['timestamp_format']:
+        timestamp_formats = agent_config_vars['timestamp_format']
+        for i, timestamp_format in enumerate(timestamp_formats):
             try:
                 if timestamp_format == 'epoch':
                     timestamp_datetime = get_datetime_from_unix_epoch(date_string)
                 else:
-                    timestamp_datetime = datetime.strptime(date_string,
-                                                           timestamp_format)
-                break
+                    timestamp_datetime = get_datetime_from_format(date_string,
+                                                                  timestamp_format)
             except Exception as e:
-                logger.info('timestamp {} does not match {}'.format(
+                logger.debug('timestamp {} does not match {}'.format(
                     date_string,
                     timestamp_format))
                 continue
+            # try the format that matched first from now on. epoch stays in place,
+            # as it exits on anything that isn't a number
+            if i != 0 and timestamp_format != 'epoch':
+                timestamp_formats.insert(0, timestamp_formats.pop(i))
+            break
     else:
         try:
             timestamp_datetime = dateutil.parse.parse(date_string)
@@ -1249,7 +1877,22 @@ def get_datetime_from_date_string(date_string):
     return timestamp_datetime
 
 
+def get_datetime_from_format(date_string, timestamp_format):
+    # strptime is slow, so read the common ISO8601 layouts directly
+    if timestamp_format in ISO8601_FAST_FORMATS and len(date_string) == 19 \
+            and date_string[4] == '-' and date_string[7] == '-' and date_string[10] == timestamp_format[8] \
+            and date_string[13] == ':' and date_string[16] == ':':
+        fields = (date_string[0:4], date_string[5:7], date_string[8:10],
+                  date_string[11:13], date_string[14:16], date_string[17:19])
+        if all(x.isdigit() for x in fields):
+            return datetime(*[int(x) for x in fields])
+    return datetime.strptime(date_string, timestamp_format)
+
+
 def get_timestamp_from_datetime(timestamp_datetime):
+    if agent_config_vars['timezone'] is pytz.utc:
+        return long(calendar.timegm(timestamp_datetime.timetuple())) * 1000
+
     timestamp_localize = agent_config_vars['timezone'].localize(timestamp_datetime)
 
     epoch = long((timestamp_localize - datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()) * 1000
@@ -1391,24 +2034,132 @@ def initialize_data_gathering(thread_number):
     track['chunk_count'] = 0
     track['entry_count'] = 0
 
-    start_data_processing(thread_number)
+    open_checkpoint_store()
+    start_upload_workers()
 
-    # last chunk
-    if len(track['current_row']) > 0 or len(track['current_dict']) > 0:
-        logger.debug('Sending last chunk')
-        send_data_wrapper()
+    try:
+        start_data_processing(thread_number)
+
+        # last chunk
+        if len(track['current_row']) > 0 or len(track['current_dict']) > 0:
+            logger.debug('Sending last chunk')
+            send_data_wrapper()
+    finally:
+        # send what was already queued, even if reading stopped on an error
+        stop_upload_workers()
+    # save where reading stopped, now that everything before it was sent
+    checkpoint_ack(checkpoint_seal(), True)
 
     logger.debug('Total chunks created: ' + str(track['chunk_count']))
     logger.debug('Total {} entries: {}'.format(
         if_config_vars['project_type'].lower(), track['entry_count']))
 
 
+def replay_in_parallel(processes):
+    """ split the files to replay between worker processes, each with its own chunk buffer and senders """
+    start_time = time.time()
+    conn = sqlite3.connect(agent_config_vars['checkpoint_file'])
+    conn.execute('CREATE TABLE IF NOT EXISTS replayed (st_ino TEXT PRIMARY KEY, file_name TEXT, size INTEGER, mtime REAL)')
+    replayed = dict((row[0], tuple(row[1:])) for row in conn.execute('SELECT st_ino, file_name, size, mtime FROM replayed'))
+    tasks = get_replay_tasks(replayed)
+    # ranges left to send per file
+    remaining = dict()
+    failed_files = set()
+    for task in tasks:
+        remaining[task[0]] = remaining.get(task[0], 0) + 1
+    logger.info('Replaying {} files as {} tasks with {} processes ({} files already replayed)'.format(
+        len(remaining), len(tasks), processes, len(replayed)))
+
+    totals = {'bytes': 0, 'entries': 0, 'chunks': 0, 'failed': 0}
+    pool = Pool(processes, initializer=open_checkpoint_store)
+    for task, stats in pool.imap_unordered(replay_task, tasks):
+        st_ino, file_name, size, mtime, start, end, data_format = task
+        for stat in totals:
+            totals[stat] += stats[stat]
+        if stats['failed']:
+            failed_files.add(st_ino)
+        remaining[st_ino] -= 1
+        if remaining[st_ino] == 0 and st_ino not in failed_files:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO replayed (st_ino, file_name, size, mtime) VALUES (?, ?, ?, ?)',
+                             (st_ino, file_name, size, mtime))
+            logger.debug('Replayed {}'.format(file_name))
+    pool.close()
+    pool.join()
+    conn.close()
+
+    elapsed = max(time.time() - start_time, 0.001)
+    logger.info('Replayed {} MB, {} entries in {} chunks in {} seconds: {} MB/s, {} entries/s'.format(
+        round(totals['bytes'] / 1048576.0, 1), totals['entries'], totals['chunks'], round(elapsed, 1),
+        round(totals['bytes'] / 1048576.0 / elapsed, 1), int(totals['entries'] / elapsed)))
+    if failed_files:
+        logger.warning('{} chunks failed to send. {} files will be replayed again on the next run'.format(
+            totals['failed'], len(failed_files)))
+
+
+def get_replay_tasks(replayed):
+    """
+    list (st_ino, filename, size, mtime, start, end, data_format) for each file, or each range of a large line-based file.
+    the format goes with the task, as reading XLS(X) switches the worker's data_format to CSV
+    """
+    data_format = agent_config_vars['data_format']
+    # each line is a message on its own
+    splittable = data_format in {'CSV', 'JSON'} or (data_format == 'RAW' and not agent_config_vars['raw_start_regex'])
+    split_size = agent_config_vars['replay_split_size']
+    tasks = []
+    for st_ino, file_name in get_file_queue():
+        try:
+            stat = os.stat(file_name)
+        except OSError:
+            continue
+        if replayed.get(st_ino) == (file_name, stat.st_size, stat.st_mtime):
+            logger.debug('already replayed file {}'.format(file_name))
+            continue
+        if not splittable or stat.st_size <= split_size:
+            tasks.append((st_ino, file_name, stat.st_size, stat.st_mtime, 0, None, data_format))
+            continue
+        for start in range(0, stat.st_size, split_size):
+            tasks.append((st_ino, file_name, stat.st_size, stat.st_mtime, start, min(start + split_size, stat.st_size),
+                          data_format))
+    return tasks
+
+
+def replay_task(task):
+    """ send one file or range of a file from a worker process. returns the task and what was sent """
+    st_ino, file_name, size, mtime, start, end, data_format = task
+    reset_track()
+    track['chunk_count'] = 0
+    track['entry_count'] = 0
+    checkpoint['failed'] = 0
+    start_upload_workers()
+    try:
+        replay_file(data_format, file_name, st_ino, start, end)
+        # last chunk
+        if len(track['current_row']) > 0 or len(track['current_dict']) > 0:
+            send_data_wrapper()
+    except Exception as e:
+        logger.warning('Error when replaying {}'.format(file_name))
+        logger.warning(e)
+        checkpoint['failed'] += 1
+    finally:
+        stop_upload_workers()
+    return task, {
+        'bytes': (end if end is not None else size) - start,
+        'entries': track['entry_count'],
+        'chunks': track['chunk_count'],
+        'failed': checkpoint['failed']
+    }
+
+
 def reset_track():
     """ reset the track global for the next chunk """
     track['start_time'] = time.time()
     track['line_count'] = 0
     track['current_row'] = []
+    track['current_row_size'] = 2  # '[]'
     track['current_dict'] = dict()
+    track['current_dict_size'] = 2  # '{}'
+    track['metric_samples'] = []
 
 
 #########################################
@@ -1432,14 +2183,14 @@ def log_handoff(timestamp, data, instance, device=''):
 
 def send_log(timestamp, data, instance, device=''):
     entry = prepare_log_entry(str(int(timestamp)), data, instance, device)
-    track['current_row'].append(entry)
+    append_to_current_row(entry)
     track['line_count'] += 1
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
+    if track['current_row_size'] >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 100 == 0:
         logger.debug('Current data object size: {} bytes'.format(
-            get_json_size_bytes(track['current_row'])))
+            track['current_row_size']))
 
 
 def prepare_log_entry(timestamp, data, instance, device=''):
@@ -1478,11 +2229,11 @@ def add_and_send_metric(timestamp, field_name, data, instance, device=''):
 
 def send_metric():
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_dict']) >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
+    if track['current_dict_size'] >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 500 == 0:
         logger.debug('Current data object size: {} bytes'.format(
-            get_json_size_bytes(track['current_dict'])))
+            track['current_dict_size']))
 
 
 def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''):
@@ -1492,30 +2243,85 @@ def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''
     ts_str = str(timestamp)
     if ts_str not in track['current_dict']:
         track['current_dict'][ts_str] = dict()
+        # '"<ts>": {}'
+        track['current_dict_size'] += get_json_size_bytes(ts_str) + 4 + get_json_separator_size(track['current_dict'])
     current_obj = track['current_dict'][ts_str]
 
-    # use the next non-null value to overwrite the prev value
-    # for the same metric in the same timestamp
-    if key in current_obj.keys():
+    # keep each non-null value for the same metric in the same timestamp,
+    # to be aggregated when the chunk is sent
+    if key in current_obj:
         if data is not None and len(str(data)) > 0:
-            current_obj[key] += '|' + str(data)
+            add_metric_sample(current_obj, key, data)
     else:
         current_obj[key] = str(data)
+        # '"<key>": "<value>"'
+        track['current_dict_size'] += get_json_size_bytes(key) + 2 + get_json_size_bytes(current_obj[key]) + \
+            get_json_separator_size(current_obj)
     track['current_dict'][ts_str] = current_obj
 
 
+def add_metric_sample(current_obj, key, data):
+    """ add another value to a metric at a timestamp, keeping them as doubles until they're aggregated """
+    samples = current_obj[key]
+    if not isinstance(samples, array.array):
+        # the aggregate can be as long as any float
+        track['current_dict_size'] += max(METRIC_VALUE_SIZE - len(samples), 0)
+        samples = current_obj[key] = array.array('d', [float(samples)])
+        track['metric_samples'].append((current_obj, key))
+    samples.append(float(data))
+
+
+def append_metric_block(timestamps, instances, columns):
+    """ add a block of rows to the metric buffer, as append_metric_data_to_entry would each value,
+        sending it whenever it fills up. columns are (field name, value of each row or None) """
+    field_names = [make_safe_metric_key(field_name) for field_name, values in columns]
+    row_keys = dict()
+    for ts_str, instance, row in itertools.izip(timestamps, instances, itertools.izip(*[values for field_name, values in columns])):
+        keys = row_keys.get(instance)
+        if keys is None:
+            # (key, size of '"<key>": ""') for each field
+            keys = row_keys[instance] = [(key, get_json_size_bytes(key) + 4)
+                                         for key in ('{}[{}]'.format(x, instance) for x in field_names)]
+        current_obj = track['current_dict'].get(ts_str)
+        size = 0
+        for (key, key_size), value in itertools.izip(keys, row):
+            if value is None:
+                continue
+            if current_obj is None:
+                current_obj = track['current_dict'][ts_str] = dict()
+                # '"<ts>": {}'
+                size += len(ts_str) + 6 + get_json_separator_size(track['current_dict'])
+            if key in current_obj:
+                add_metric_sample(current_obj, key, value)
+            else:
+                # ', ' before all but the first
+                size += key_size + len(value) + (2 if current_obj else 0)
+                current_obj[key] = value
+            track['entry_count'] += 1
+        track['current_dict_size'] += size
+        if track['current_dict_size'] >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
+            send_data_wrapper()
+
+
 def transpose_metrics():
     """ flatten data up to the timestamp"""
+    # aggregate every metric with more than one value in one pass
+    aggregate = METRIC_AGGREGATIONS[if_config_vars['metric_aggregation']]
+    for current_obj, key in track['metric_samples']:
+        current_obj[key] = str(aggregate(current_obj[key]))
     for timestamp, kvs in track['current_dict'].items():
         track['line_count'] += 1
-        new_row = dict()
-        new_row['timestamp'] = timestamp
-        for key, value in kvs.items():
-            if '|' in value:
-                value = statistics.median(
-                    map(lambda v: float(v), value.split('|')))
-            new_row[key] = str(value)
-        track['current_row'].append(new_row)
+        kvs['timestamp'] = timestamp
+        track['current_row'].append(kvs)
+
+
+def get_median(values):
+    """ median of a list of numbers, as statistics.median """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
 
 
 def build_metric_name_map():
@@ -1630,12 +2436,66 @@ def send_data_wrapper():
         transpose_metrics()
     logger.debug('--- Chunk creation time: {} seconds ---'.format(
         round(time.time() - track['start_time'], 2)))
-    send_data_to_if(track['current_row'])
+    seq = checkpoint_seal()
+    if upload['workers']:
+        # blocks while the queue is full, so parsing can't run too far ahead of sending
+        upload['queue'].put((track['current_row'], track['line_count'], seq))
+        upload['max_depth'] = max(upload['max_depth'], upload['queue'].qsize())
+        logger.debug('Upload queue depth: {}, in flight: {}'.format(
+            upload['queue'].qsize(), upload['in_flight']))
+    else:
+        checkpoint_ack(seq, send_data_to_if(track['current_row'], track['line_count']))
     track['chunk_count'] += 1
     reset_track()
 
 
-def send_data_to_if(chunk_metric_data):
+def start_upload_workers():
+    """ start the threads that send chunks to IF in the background """
+    upload['queue'] = Queue.Queue(maxsize=if_config_vars['upload_queue_size'])
+    upload['lock'] = threading.Lock()
+    upload['in_flight'] = 0
+    upload['max_depth'] = 0
+    upload['workers'] = []
+    for i in range(if_config_vars['upload_workers']):
+        worker = threading.Thread(target=upload_worker, name='upload-{}'.format(i))
+        worker.daemon = True
+        worker.start()
+        upload['workers'].append(worker)
+
+
+def stop_upload_workers():
+    """ wait for all queued chunks to be sent, then stop the upload threads """
+    logger.debug('Draining upload queue: {} queued, {} in flight'.format(
+        upload['queue'].qsize(), upload['in_flight']))
+    for _ in upload['workers']:
+        upload['queue'].put(None)
+    for worker in upload['workers']:
+        worker.join()
+    upload['workers'] = []
+    logger.debug('Max upload queue depth: {}'.format(upload['max_depth']))
+
+
+def upload_worker():
+    while True:
+        chunk = upload['queue'].get()
+        if chunk is None:
+            return
+        chunk_metric_data, line_count, seq = chunk
+        with upload['lock']:
+            upload['in_flight'] += 1
+        sent = False
+        try:
+            sent = send_data_to_if(chunk_metric_data, line_count)
+        except Exception as e:
+            logger.warning('Error when sending chunk')
+            logger.warning(e)
+        finally:
+            checkpoint_ack(seq, sent)
+            with upload['lock']:
+                upload['in_flight'] -= 1
+
+
+def send_data_to_if(chunk_metric_data, line_count):
     send_data_time = time.time()
 
     # prepare data for metric streaming agent
@@ -1648,30 +2508,60 @@ def send_data_to_if(chunk_metric_data):
     logger.debug('First:\n' + str(chunk_metric_data[0]))
     logger.debug('Last:\n' + str(chunk_metric_data[-1]))
     logger.debug('Total Data (bytes): ' + str(get_json_size_bytes(data_to_post)))
-    logger.debug('Total Lines: ' + str(track['line_count']))
+    logger.debug('Total Lines: ' + str(line_count))
 
     # do not send if only testing
     if cli_config_vars['testing']:
-        return
+        return True
 
     # send the data
     post_url = urlparse.urljoin(if_config_vars['if_url'], get_api_from_project_type())
-    send_request(post_url, 'POST', 'Could not send request to IF',
-                 str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
-                 data=data_to_post, proxies=if_config_vars['if_proxies'])
+    post_data = data_to_post
+    post_headers = None
+    if if_config_vars['if_compress']:
+        post_data = gzip_compress(urllib.urlencode(data_to_post))
+        post_headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'}
+    response = send_request(post_url, 'POST', 'Could not send request to IF',
+                            str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
+                            data=post_data, headers=post_headers, proxies=if_config_vars['if_proxies'])
     logger.debug('--- Send data time: %s seconds ---' % round(time.time() - send_data_time, 2))
+    return response != -1
+
+
+def get_request_session():
+    """ get this thread's pooled session, so connections are reused between requests """
+    # requests.Session is not thread-safe, so each upload thread gets its own
+    pid = (os.getpid(), threading.current_thread().ident)
+    if pid not in SESSIONS:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=if_config_vars['if_pool_size'],
+                                                pool_maxsize=if_config_vars['if_pool_size'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        SESSIONS[pid] = session
+    return SESSIONS[pid]
+
+
+def gzip_compress(data):
+    """ gzip a request body """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
 
 
 def send_request(url, mode='GET', failure_message='Failure!', success_message='Success!', **request_passthrough):
     """ sends a request to the given url """
     # determine if post or get (default)
-    req = requests.get
+    session = get_request_session()
+    req = session.get
     if mode.upper() == 'POST':
-        req = requests.post
+        req = session.post
 
     for i in range(ATTEMPTS):
         try:
+            request_time = time.time()
             response = req(url, **request_passthrough)
+            logger.debug('Request took {} seconds, {} bytes sent, {} bytes received'.format(
+                round(time.time() - request_time, 3), len(response.request.body or ''), len(response.content)))
             if response.status_code == httplib.OK:
                 logger.info(success_message)
                 return response
@@ -1797,10 +2687,35 @@ if __name__ == "__main__":
     FORMAT_STR = regex.compile(r"{(.*?)}")
     HOSTNAME = socket.gethostname().partition('.')[0]
     ISO8601 = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y%m%dT%H%M%SZ', 'epoch']
+    ISO8601_FAST_FORMATS = {'%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S'}
+    TIMESTAMP_CACHE_SIZE = 4096
+    CSV_BLOCK_LINES = 100000
+    METRIC_AGGREGATIONS = {
+        'median': get_median,
+        'mean': lambda values: sum(values) / len(values),
+        'min': min,
+        'max': max,
+        'last': lambda values: values[-1]
+    }
+    METRIC_VALUE_SIZE = 19  # longest str() of a float
+    IN_MODIFY = 0x2
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    INOTIFY_MASK = IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    POLL_INTERVAL = 1
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = r",|\t"
     ATTEMPTS = 3
+    SESSIONS = dict()
     track = dict()
+    timestamp_cache = OrderedDict()
+    upload = dict()
+    checkpoint = dict()
 
     # get config
     cli_config_vars = get_cli_config_vars()
@@ -1808,10 +2723,14 @@ if __name__ == "__main__":
     logger.debug(cli_config_vars)
     if_config_vars = get_if_config_vars()
     agent_config_vars = get_agent_config_vars()
+    extraction_plan = build_extraction_plan()
+    columnar_plan = build_columnar_plan()
     print_summary_info()
 
     # start data processing
-    for i in range(0, cli_config_vars['threads']):
+    if cli_config_vars['threads'] > 1 and 'TAIL' not in agent_config_vars['data_format']:
+        replay_in_parallel(cli_config_vars['threads'])
+    else:
         Process(target=initialize_data_gathering,
-                args=(i,)
+                args=(0,)
                 ).start()
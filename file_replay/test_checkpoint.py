@@ -0,0 +1,147 @@
+"""
+Tests for the *TAIL checkpoint in getmessages_file_replay.py: the agent is killed part-way through a file
+and restarted, against a local HTTP server standing in for InsightFinder.
+
+    python test_checkpoint.py
+"""
+
+import ConfigParser
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+AGENT_DIR = os.path.dirname(os.path.abspath(__file__))
+LINES = 20000
+CHECKPOINT_LINES = 100
+UPLOAD_WORKERS = 2
+UPLOAD_QUEUE_SIZE = 4
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ records the seq of each entry posted, taking a little while to answer like a real server """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        post = dict(urlparse.parse_qsl(body))
+        time.sleep(0.02)
+        with self.server.lock:
+            for entry in json.loads(post['metricData']):
+                data = entry['data'] if isinstance(entry['data'], dict) else json.loads(entry['data'])
+                self.server.received.append(int(data['seq']))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.server.lock = threading.Lock()
+        self.server.received = []
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        self.work_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.work_dir, 'logs'))
+        with open(os.path.join(self.work_dir, 'logs', 'app.log'), 'w') as log_file:
+            for seq in range(LINES):
+                log_file.write(json.dumps({'timestamp': 1600000000000 + seq, 'host': 'host-1', 'seq': seq,
+                                           'message': 'x' * (seq % 40)}) + '\n')
+        self.config = self.write_config()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def write_config(self):
+        config_parser = ConfigParser.RawConfigParser()
+        config_parser.read(os.path.join(AGENT_DIR, 'config.ini.template'))
+        settings = {
+            'agent': {
+                'file_path': os.path.join(self.work_dir, 'logs'),
+                'file_name_regex': r'^.*\.log$',
+                'data_format': 'jsontail',
+                'checkpoint_file': os.path.join(self.work_dir, 'checkpoint.db'),
+                'checkpoint_lines': str(CHECKPOINT_LINES),
+                'data_fields': 'seq,message',
+            },
+            'insightfinder': {
+                'user_name': 'user',
+                'license_key': 'key',
+                'project_name': 'project',
+                'project_type': 'log',
+                'if_url': 'http://127.0.0.1:{}'.format(self.server.server_port),
+                'upload_workers': str(UPLOAD_WORKERS),
+                'upload_queue_size': str(UPLOAD_QUEUE_SIZE),
+            },
+        }
+        for section, options in settings.items():
+            for option, value in options.items():
+                config_parser.set(section, option, value)
+        # left to their defaults
+        config_parser.remove_option('agent', 'checkpoint_seconds')
+        config_path = os.path.join(self.work_dir, 'config.ini')
+        with open(config_path, 'w') as config_file:
+            config_parser.write(config_file)
+        return config_path
+
+    def start_agent(self):
+        with open(os.devnull, 'w') as devnull:
+            # in its own process group, so the worker process it starts can be killed along with it
+            return subprocess.Popen([sys.executable, os.path.join(AGENT_DIR, 'getmessages_file_replay.py'),
+                                     '-c', self.config, '-q'], cwd=self.work_dir, stdout=devnull, stderr=devnull,
+                                    preexec_fn=os.setsid)
+
+    def received(self):
+        with self.server.lock:
+            return list(self.server.received)
+
+    def test_restart_after_kill_loses_nothing(self):
+        agent = self.start_agent()
+        # kill it once part of the file was sent
+        deadline = time.time() + 60
+        while len(self.received()) < LINES / 4 and agent.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(agent.poll(), 'the agent finished before it could be killed')
+        os.killpg(agent.pid, signal.SIGKILL)
+        agent.wait()
+        received_before_kill = len(self.received())
+        self.assertLess(received_before_kill, LINES)
+
+        agent = self.start_agent()
+        self.assertEqual(agent.wait(), 0)
+
+        received = self.received()
+        self.assertEqual(set(received), set(range(LINES)))
+        # only the chunks that were read, queued or being sent when it was killed are sent again
+        resent = len(received) - LINES
+        self.assertLessEqual(resent, (UPLOAD_WORKERS + UPLOAD_QUEUE_SIZE + 1) * CHECKPOINT_LINES)
+
+        # a finished file is not read again
+        agent = self.start_agent()
+        self.assertEqual(agent.wait(), 0)
+        self.assertEqual(len(self.received()), len(received))
+
+
+if __name__ == '__main__':
+    unittest.main()
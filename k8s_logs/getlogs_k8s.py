@@ -1,20 +1,26 @@
 #!/usr/bin/env python
 import ConfigParser
+import Queue
+import calendar
 import collections
 import json
+import zlib
 import logging
 import os
 import re
 import socket
 import sys
+import threading
 import time
 import pytz
 from optparse import OptionParser
 from multiprocessing import Process
+from multiprocessing.pool import ThreadPool
 from itertools import islice
 from datetime import datetime
 import dateutil
 from dateutil.tz import tzlocal
+import urllib
 import urlparse
 import httplib
 import requests
@@ -63,75 +69,144 @@ def raw_parse_log(instance, device, log):
     
 
 def get_logs_for_pods():
+    """ read every container's new log lines with a pool of threads, handing them off as they arrive """
+    positions = load_log_positions()
+    tasks = []
     for pod_namespace in agent_config_vars['pods']:
-        logger.debug(pod_namespace)
         for pod_name in agent_config_vars['pods'][pod_namespace]:
-            logger.debug(pod_name)
-            if 'containers' in agent_config_vars['pods'][pod_namespace][pod_name]:
-                for container in agent_config_vars['pods'][pod_namespace][pod_name]['containers']:
-                    logger.debug(container)
-                    get_logs_for_pod(pod_namespace, pod_name, container)
-            else:
-                get_logs_for_pod(pod_namespace, pod_name)
+            for container in agent_config_vars['pods'][pod_namespace][pod_name].get('containers') or ['']:
+                position = positions.get(get_log_position_key(pod_namespace, pod_name, container))
+                tasks.append((pod_namespace, pod_name, container, position, get_log_since_seconds(position)))
+    if not tasks:
+        return
+    logger.info('Reading logs of {} containers with {} threads'.format(len(tasks), agent_config_vars['thread_pool']))
+
+    # threads only read from k8s, the lines are handed off here so track is only used by this thread
+    queue = Queue.Queue(LOG_QUEUE_SIZE)
+    pool = ThreadPool(min(agent_config_vars['thread_pool'], len(tasks)))
+    pool.map_async(lambda task: stream_logs_for_pod(queue, *task), tasks)
+    pool.close()
+    done = 0
+    while done < len(tasks):
+        (pod_namespace, pod_name, container), lines, position = queue.get()
+        if lines is None:
+            done += 1
+            continue
+        pod = agent_config_vars['pods'][pod_namespace][pod_name]
+        device = extract_device(pod['group'], pod_name, container)
+        for log in lines:
+            raw_parse_log(pod['instance'], device, log)
+        positions[get_log_position_key(pod_namespace, pod_name, container)] = position
+    pool.join()
+
+    if cli_config_vars['testing']:
+        return
+    # send what is left first, so the saved positions only cover lines that were sent
+    if len(track['current_row']) > 0:
+        send_data_wrapper()
+    # forget containers that are gone
+    save_log_positions(dict((key, positions[key]) for key in
+                            (get_log_position_key(*task[:3]) for task in tasks) if key in positions))
+
+
+def get_log_since_seconds(position):
+    """ how far back to read a container's log. the client has no since_time, so this may include lines already read """
+    if not position:
+        return if_config_vars['sampling_interval']
+    since = calendar.timegm(time.strptime(position[:19], '%Y-%m-%dT%H:%M:%S'))
+    return max(int(time.time()) - since + 1, 1)
+
+
+def stream_logs_for_pod(queue, pod_namespace, pod_name, container, position, since_seconds):
+    """ stream one container's log, putting the lines after position on the queue a block at a time """
+    key = (pod_namespace, pod_name, container)
+    try:
+        api_request_vars = { 'timestamps': True,
+                             'namespace': pod_namespace,
+                             'name': pod_name,
+                             'since_seconds': since_seconds,
+                             '_preload_content': False }
+        if container:
+            api_request_vars['container'] = container
+
+        response = call_k8s_api('read_namespaced_pod_log', **api_request_vars)
+        if response is None:
+            return
+        rest = ''
+        for block in response.stream(LOG_READ_SIZE):
+            lines = (rest + block).split('\n')
+            rest = lines.pop()
+            position = put_new_log_lines(queue, key, lines, position)
+        put_new_log_lines(queue, key, [rest], position)
+        response.release_conn()
+    except Exception as e:
+        logger.warning('Could not read logs of {}: {}'.format('/'.join(key), e))
+    finally:
+        queue.put((key, None, None))
+
+
+def put_new_log_lines(queue, key, lines, position):
+    """ queue the lines after position. lines are in time order, so only the first ones can be old """
+    start = 0
+    for log in lines:
+        if log and (not position or get_log_position(log) > position):
+            break
+        start += 1
+    lines = [log for log in lines[start:] if log]
+    if not lines:
+        return position
+    position = get_log_position(lines[-1])
+    queue.put((key, lines, position))
+    return position
+
+
+def get_log_position(log):
+    """ sortable form of a log line's timestamp. k8s may drop trailing zeros of the fraction """
+    timestamp = log.split(' ', 1)[0].rstrip('Z')
+    seconds, _, fraction = timestamp.partition('.')
+    return seconds + '.' + fraction.ljust(9, '0')
+
+
+def get_log_position_key(pod_namespace, pod_name, container):
+    return '/'.join((pod_namespace, pod_name, container))
 
 
-def get_logs_for_pod(pod_namespace, pod_name, container=''):
-    instance = agent_config_vars['pods'][pod_namespace][pod_name]['instance']
-    group = agent_config_vars['pods'][pod_namespace][pod_name]['group']
-    api_request_vars = { 'timestamps': True,
-                         'namespace': pod_namespace,
-                         'name': pod_name,
-                         'since_seconds': if_config_vars['sampling_interval'] }
-    if container:
-        api_request_vars['container'] = container
+def load_log_positions():
+    """ last timestamp read for each container, from the state file """
+    try:
+        with open(agent_config_vars['state_file']) as state_file:
+            return json.load(state_file)
+    except IOError:
+        return dict()
+    except ValueError as ve:
+        logger.warning('Could not read {}: {}'.format(agent_config_vars['state_file'], ve))
+        return dict()
+
 
-    device = extract_device(group, pod_name, container)
-    logs = call_k8s_api('read_namespaced_pod_log', **api_request_vars)
-    logs = logs.split('\n')
-    for log in logs:
-        if log: raw_parse_log(instance, device, log)
+def save_log_positions(positions):
+    # write then rename, so a crash leaves either the old or the new positions
+    tmp_file = agent_config_vars['state_file'] + '.tmp'
+    with open(tmp_file, 'w') as state_file:
+        json.dump(positions, state_file)
+    os.rename(tmp_file, agent_config_vars['state_file'])
+    logger.debug('Saved positions of {} containers'.format(len(positions)))
 
 
 def get_pods():
-    api_request_vars = { 'pretty': 'false' }
+    api_request_vars = { '_preload_content': False }
     if len(agent_config_vars['pod_field_selector']) != 0:
         api_request_vars['field_selector'] = agent_config_vars['pod_field_selector']
     if len(agent_config_vars['pod_label_selector']) != 0:
         api_request_vars['label_selector'] = agent_config_vars['pod_label_selector']
-    pods_raw = call_k8s_api('list_pod_for_all_namespaces', **api_request_vars)
-    # the 'pretty' kwarg doesn't seem to work
-    pods_raw = pods_raw.replace('\n', '')
-    pods_raw = pods_raw.replace('\'', '\"')
-    pods_raw = SPACES.sub('', pods_raw)
-    # nested json that is a string, formatted with escapes and unicode indicator
-    pods_raw = pods_raw.replace('u\"', '\"')
-    pods_raw = pods_raw.replace('\"{\"', '{\"')
-    pods_raw = pods_raw.replace('\"}\"', '\"}')
-    pods_raw = pods_raw.replace('\\n\"', '')
-    # json.loads will not recognize the python representation of some things
-    pods_raw = pods_raw.replace('None', 'null')
-    pods_raw = pods_raw.replace('True', 'true')
-    pods_raw = pods_raw.replace('False', 'false')
-    # replace datetime in place
-    dt_re = re.compile(r"(datetime\.)(?P<dt>datetime\([0-9]{4}\,[\s]*[0-9]{1,2}\,[\s]*[0-9]{1,2}\,[\s]*[0-9]{1,2}\,[\s]*[0-9]{1,2}\,([\s]*[0-9]{1,2}\,)?[\s]*tzinfo\=tzlocal\(\)\))")
-    matches = dt_re.finditer(pods_raw)
-    pods = ''
-    last_end = 0
-    for match in matches:
-         pods += pods_raw[last_end:match.start()]
-         dt = match.group('dt')
-         dt_fmt = str(eval(dt))
-         dt_fmt = dt_fmt.replace(' ', 'T')
-         pods += '\"' + dt_fmt + '\"'
-         last_end = match.end()
-    pods += pods_raw[last_end:]
-    # ready to load as json
+    response = call_k8s_api('list_pod_for_all_namespaces', **api_request_vars)
+    if not response:
+        return
+    # read the API's own JSON, rather than the client's objects
     try:
-        pods_json = json.loads(pods)['items']
+        pods_json = json.loads(response.data)['items']
         logger.debug('json loaded')
     except ValueError as ve:
         logger.warning(str(ve))
-	logger.warning(pods)
         return
     # for each pod
     for pod in pods_json:
@@ -159,11 +234,11 @@ def get_pods():
 
 
 def extract_host(pod):
-    host_value = get_json_field_by_pri(pod, ['spec.node_name', 
-                                             'spec.hostname', 
-                                             'spec.host_aliases', 
-                                             'spec.host_ipc', 
-                                             'status.host_ip'])
+    host_value = get_json_field_by_pri(pod, ['spec.nodeName',
+                                             'spec.hostname',
+                                             'spec.hostAliases',
+                                             'spec.hostIPC',
+                                             'status.hostIP'])
     parsed = urlparse.urlparse(host_value)
     host = parsed.hostname or parsed.path.split(':')[0]
     return host
@@ -174,9 +249,9 @@ def extract_group(pod):
                                         'metadata.labels.app',
                                         'metadata.labels.k8s-app',
                                         'metadata.labels.component',
-                                        'metadata.owner_references.name', 
-                                        'spec.service_account_name', 
-                                        'spec.service_account', 
+                                        'metadata.ownerReferences.name',
+                                        'spec.serviceAccountName',
+                                        'spec.serviceAccount',
                                         'metadata.namespace'])
     return group
 
@@ -198,10 +273,10 @@ def extract_device(group, pod_name, container=''):
 
 def call_k8s_api(api_endpoint, **api_request_vars):
     try:
-        return str(getattr(agent_config_vars['k8s_api'], api_endpoint)(**api_request_vars))
+        return getattr(agent_config_vars['k8s_api'], api_endpoint)(**api_request_vars)
     except ApiException as ae:
-        logger.warning(str(ae))    
-        return ''
+        logger.warning(str(ae))
+        return None
 
 
 def get_agent_config_vars():
@@ -219,13 +294,25 @@ def get_agent_config_vars():
             filters_exclude = config_parser.get('agent', 'filters_exclude')
 
             # namespaces & pods
-            namespaces = config_parser.get('agent', 'namespaces')
+            # older configs name this option namespaces
+            if config_parser.has_option('agent', 'namespace'):
+                namespaces = config_parser.get('agent', 'namespace')
+            elif config_parser.has_option('agent', 'namespaces'):
+                namespaces = config_parser.get('agent', 'namespaces')
+            else:
+                namespaces = ''
             names = config_parser.get('agent', 'pod_names')
 
             # pod selector
             pod_field_selector = config_parser.get('agent', 'pod_field_selector')
             pod_label_selector = config_parser.get('agent', 'pod_label_selector')
 
+            # log collection
+            thread_pool = config_parser.get('agent', 'thread_pool') if config_parser.has_option(
+                'agent', 'thread_pool') else ''
+            state_file = config_parser.get('agent', 'state_file') if config_parser.has_option(
+                'agent', 'state_file') else ''
+
         except ConfigParser.NoOptionError:
             logger.error('Agent not correctly configured. Check config file.')
             sys.exit(1)
@@ -249,14 +336,28 @@ def get_agent_config_vars():
         if len(namespaces) != 0:
             namespaces = namespaces.split(',')
         
+        # log collection
+        try:
+            thread_pool = max(int(thread_pool), 1)
+        except ValueError:
+            thread_pool = 10
+        state_file = state_file or os.path.abspath(os.path.join(__file__, os.pardir, 'state.json'))
+
+        # one connection to k8s per thread
+        k8s_config = kubernetes.client.Configuration()
+        kubernetes.config.load_kube_config(client_configuration=k8s_config)
+        k8s_config.connection_pool_maxsize = thread_pool
+
         # timestamp format
         ts_format_info = {'strip_tz': False, 'strip_tz_fmt': '', 'timestamp_format': '%Y-%m-%dT%H:%M:%S'}
         
         # add parsed variables to a global
         config_vars = {
             'proxies': agent_proxies,
-            'k8s_api': kubernetes.client.CoreV1Api(kubernetes.config.load_kube_config()),
+            'k8s_api': kubernetes.client.CoreV1Api(kubernetes.client.ApiClient(k8s_config)),
             'pods': dict(),
+            'thread_pool': thread_pool,
+            'state_file': state_file,
             'names': names,
             'namespaces': namespaces,
             'pod_field_selector': pod_field_selector,
@@ -293,6 +394,10 @@ def get_if_config_vars():
             if_url = config_parser.get('insightfinder', 'if_url')
             if_http_proxy = config_parser.get('insightfinder', 'if_http_proxy')
             if_https_proxy = config_parser.get('insightfinder', 'if_https_proxy')
+            if_pool_size = config_parser.get('insightfinder', 'if_pool_size') if config_parser.has_option(
+                'insightfinder', 'if_pool_size') else ''
+            if_compress = config_parser.get('insightfinder', 'if_compress') if config_parser.has_option(
+                'insightfinder', 'if_compress') else ''
         except ConfigParser.NoOptionError:
             logger.error('Agent not correctly configured. Check config file.')
             sys.exit(1)
@@ -361,7 +466,9 @@ def get_if_config_vars():
             'sampling_interval': int(sampling_interval),     # as seconds
             'chunk_size': int(chunk_size_kb) * 1024,         # as bytes
             'if_url': if_url,
-            'if_proxies': if_proxies
+            'if_proxies': if_proxies,
+            'if_pool_size': int(if_pool_size or 10),
+            'if_compress': if_compress.upper() == 'TRUE'
         }
 
         return config_vars
@@ -545,6 +652,17 @@ def get_json_size_bytes(json_data):
     return len(bytearray(json.dumps(json_data)))
 
 
+def get_json_separator_size(json_data):
+    """ size of the ', ' that json.dumps puts before every item but the first """
+    return 2 if len(json_data) > 1 else 0
+
+
+def append_to_current_row(entry):
+    """ add an entry to the current chunk, keeping a running count of its size in bytes """
+    track['current_row'].append(entry)
+    track['current_row_size'] += get_json_size_bytes(entry) + get_json_separator_size(track['current_row'])
+
+
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for index in xrange(0, len(l), n):
@@ -944,7 +1062,9 @@ def reset_track():
     track['start_time'] = time.time()
     track['line_count'] = 0
     track['current_row'] = []
+    track['current_row_size'] = 2  # '[]'
     track['current_dict'] = dict()
+    track['current_dict_size'] = 2  # '{}'
 
 
 #########################################
@@ -964,13 +1084,13 @@ def alert_handoff(timestamp, data, instance, device=''):
 
 def log_handoff(timestamp, data, instance, device=''):
     entry = prepare_log_entry(str(int(timestamp)), data, instance, device)
-    track['current_row'].append(entry)
+    append_to_current_row(entry)
     track['line_count'] += 1
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
+    if track['current_row_size'] >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 100 == 0:
-        logger.debug('Current data object size: ' + str(get_json_size_bytes(track['current_row'])) + ' bytes')
+        logger.debug('Current data object size: ' + str(track['current_row_size']) + ' bytes')
 
 
 def prepare_log_entry(timestamp, data, instance, device=''):
@@ -992,10 +1112,10 @@ def prepare_log_entry(timestamp, data, instance, device=''):
 def metric_handoff(timestamp, field_name, data, instance, device=''):
     append_metric_data_to_entry(timestamp, field_name, data, instance, device)
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_dict']) >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
+    if track['current_dict_size'] >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 500 == 0:
-        logger.debug('Current data object size: ' + str(get_json_size_bytes(track['current_dict'])) + ' bytes')
+        logger.debug('Current data object size: ' + str(track['current_dict_size']) + ' bytes')
 
 
 def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''):
@@ -1004,15 +1124,22 @@ def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''
     ts_str = str(timestamp)
     if ts_str not in track['current_dict']:
         track['current_dict'][ts_str] = dict()
+        # '"<ts>": {}'
+        track['current_dict_size'] += get_json_size_bytes(ts_str) + 4 + get_json_separator_size(track['current_dict'])
     current_obj = track['current_dict'][ts_str]
 
     # use the next non-null value to overwrite the prev value
     # for the same metric in the same timestamp
-    if key in current_obj.keys():
+    if key in current_obj:
         if data is not None and len(str(data)) > 0:
+            prev_size = get_json_size_bytes(current_obj[key])
             current_obj[key] += '|' + str(data)
+            track['current_dict_size'] += get_json_size_bytes(current_obj[key]) - prev_size
     else:
         current_obj[key] = str(data)
+        # '"<key>": "<value>"'
+        track['current_dict_size'] += get_json_size_bytes(key) + 2 + get_json_size_bytes(current_obj[key]) + \
+            get_json_separator_size(current_obj)
     track['current_dict'][ts_str] = current_obj
 
 
@@ -1027,7 +1154,7 @@ def transpose_metrics():
             if '|' in value:
                 value = statistics.median(map(lambda v: float(v), value.split('|')))
             new_row[key] = str(value)
-        track['current_row'].append(new_row)
+        append_to_current_row(new_row)
 
 
 ################################
@@ -1064,22 +1191,51 @@ def send_data_to_if(chunk_metric_data):
 
     # send the data
     post_url = urlparse.urljoin(if_config_vars['if_url'], get_api_from_project_type())
+    post_data = data_to_post
+    post_headers = None
+    if if_config_vars['if_compress']:
+        post_data = gzip_compress(urllib.urlencode(data_to_post))
+        post_headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'}
     send_request(post_url, 'POST', 'Could not send request to IF',
                  str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
-                 data=data_to_post, proxies=if_config_vars['if_proxies'])
+                 data=post_data, headers=post_headers, proxies=if_config_vars['if_proxies'])
     logger.debug('--- Send data time: %s seconds ---' % round(time.time() - send_data_time, 2))
 
 
+def get_request_session():
+    """ get this thread's pooled session, so connections are reused between requests """
+    # requests.Session is not thread-safe, so each thread gets its own
+    pid = (os.getpid(), threading.current_thread().ident)
+    if pid not in SESSIONS:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=if_config_vars['if_pool_size'],
+                                                pool_maxsize=if_config_vars['if_pool_size'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        SESSIONS[pid] = session
+    return SESSIONS[pid]
+
+
+def gzip_compress(data):
+    """ gzip a request body """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
 def send_request(url, mode='GET', failure_message='Failure!', success_message='Success!', **request_passthrough):
     """ sends a request to the given url """
     # determine if post or get (default)
-    req = requests.get
+    session = get_request_session()
+    req = session.get
     if mode.upper() == 'POST':
-        req = requests.post
+        req = session.post
 
     for i in xrange(ATTEMPTS):
         try:
+            request_time = time.time()
             response = req(url, **request_passthrough)
+            logger.debug('Request took {} seconds, {} bytes sent, {} bytes received'.format(
+                round(time.time() - request_time, 3), len(response.request.body or ''), len(response.content)))
             if response.status_code == httplib.OK:
                 logger.info(success_message)
                 return response
@@ -1198,6 +1354,9 @@ if __name__ == "__main__":
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = ','
     ATTEMPTS = 3
+    SESSIONS = dict()
+    LOG_READ_SIZE = 65536
+    LOG_QUEUE_SIZE = 1000
     track = dict()
 
     # get config
@@ -0,0 +1,191 @@
+"""
+Benchmark for getmessages_kafka2.py.
+
+Replays a synthetic topic through the agent's message parser, with the agent posting to a local
+HTTP server instead of InsightFinder, and reports the time taken and the number and size of the
+requests made.
+
+In metric mode each message carries one metric of one instance, as many agents publish them, and
+goes through the metric buffer that reassembles them into rows. In log mode each message is a
+Kafka/file_replay-style JSON log line with nested host/kubernetes/fields objects.
+
+    python benchmark.py --mode metric --messages 1000000 --instances 2000
+    python benchmark.py --mode metric --messages 1000000 --instances 2000 --all-metrics
+    python benchmark.py --mode log --messages 200000 --data-fields message,fields.status,fields.latency_ms
+
+--agent runs the same benchmark against another copy of the script, to compare before and after a change.
+"""
+
+import imp
+import json
+import logging
+import os
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import OrderedDict
+from optparse import OptionParser
+
+import pytz
+import regex
+
+requests_received = []
+
+
+class CountingHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        requests_received.append(len(body))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CountingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Message(object):
+    """ what the agent reads from a KafkaConsumer record """
+    def __init__(self, value):
+        self.value = value
+
+
+def load_agent(path, options, port):
+    """ load the agent and set the globals it declares under __main__ """
+    agent = imp.load_source('agent', path)
+    agent.logger = logging.getLogger('benchmark')
+    agent.logger.addHandler(logging.NullHandler())
+    agent.UNDERSCORE = regex.compile(r"\_+")
+    agent.COLONS = regex.compile(r"\:+")
+    agent.LEFT_BRACE = regex.compile(r"\[")
+    agent.RIGHT_BRACE = regex.compile(r"\]")
+    agent.PERIOD = regex.compile(r"\.")
+    agent.COMMA = regex.compile(r"\,")
+    agent.NON_ALNUM = regex.compile(r"[^a-zA-Z0-9]")
+    agent.FORMAT_STR = regex.compile(r"{(.*?)}")
+    agent.SUBSECOND = regex.compile(r"(?<=:\d\d)[.,]\d+")
+    agent.HOSTNAME = 'benchmark'
+    agent.TIMESTAMP_CACHE_SIZE = 4096
+    agent.ISO8601_FAST_FORMATS = {'YYYY-MM-DDTHH:mm:ss', 'YYYY-MM-DD HH:mm:ss'}
+    agent.JSON_LEVEL_DELIM = '.'
+    agent.ATTEMPTS = 1
+    agent.SESSIONS = dict()
+    agent.track = dict()
+    agent.timestamp_cache = OrderedDict()
+    agent.upload = dict()
+    agent.metric_buffer = dict()
+    agent.cli_config_vars = {'testing': False}
+    all_metrics = ['metric_{}'.format(i) for i in xrange(options.metrics)] if options.all_metrics else ''
+    agent.agent_config_vars = {
+        'data_format': 'JSON',
+        'filters_include': '',
+        'filters_exclude': '',
+        'json_top_level': '',
+        'timestamp_format': ['epoch'] if options.mode == 'metric' else ['YYYY-MM-DDTHH:mm:ss.SSSZ'],
+        'timezone': pytz.utc,
+        'timestamp_field': ['timestamp'],
+        'instance_field': ['host'] if options.mode == 'metric' else ['kubernetes.pod_name'],
+        'device_field': [''],
+        'data_fields': options.data_fields.split(',') if options.data_fields else '',
+        'all_metrics': set(all_metrics),
+        'metric_buffer_size': options.buffer_mb * 1024 * 1024,
+    }
+    agent.if_config_vars = {
+        'user_name': 'benchmark',
+        'license_key': 'benchmark',
+        'project_name': 'benchmark',
+        'project_type': options.mode.upper(),
+        'is_replay': False,
+        'sampling_interval': 60,
+        'run_interval': 3600,
+        'chunk_size': options.chunk_kb * 1024,
+        'if_url': 'http://127.0.0.1:{}'.format(port),
+        'if_proxies': dict(),
+        'if_pool_size': 1,
+        'if_compress': False,
+        'upload_workers': 1,
+        'upload_queue_size': 4,
+    }
+    # scripts from before the extraction plan read the settings on every message
+    if hasattr(agent, 'build_extraction_plan'):
+        agent.extraction_plan = agent.build_extraction_plan()
+    return agent
+
+
+def metric_messages(options):
+    """ one message per metric per instance per timestamp, timestamps in order """
+    start = int(time.time()) * 1000
+    per_timestamp = options.instances * options.metrics
+    for i in xrange(options.messages):
+        yield Message(json.dumps({
+            'timestamp': str(start + 60000 * (i // per_timestamp)),
+            'host': 'host-{}'.format((i // options.metrics) % options.instances),
+            'metric_{}'.format(i % options.metrics): '{}.{}'.format(i, i % 1000),
+        }))
+
+
+def log_messages(options):
+    """ log lines of a few hundred bytes, about 100 a second, spread over the instances """
+    start = int(time.time()) * 1000
+    for i in xrange(options.messages):
+        timestamp = start + 10 * i
+        yield Message(json.dumps({
+            'timestamp': '{}.{:03d}Z'.format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp // 1000)),
+                                             timestamp % 1000),
+            'message': 'GET /api/v1/items/{} 200 {} ms user-agent=benchmark'.format(i, i % 1000),
+            'host': {'name': 'node-{}'.format(i % 50), 'ip': '10.0.{}.{}'.format(i % 50, i % 250)},
+            'kubernetes': {'namespace': 'default', 'pod_name': 'pod-{}'.format(i % options.instances),
+                           'labels': {'app': 'items', 'tier': 'backend'}},
+            'fields': {'status': 200, 'latency_ms': i % 1000, 'env': 'production'},
+        }))
+
+
+def main():
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--mode', default='metric', help='metric or log. Default is metric')
+    parser.add_option('--messages', type='int', default=1000000, help='Number of messages in the topic')
+    parser.add_option('--instances', type='int', default=2000, help='Number of instances')
+    parser.add_option('--metrics', type='int', default=5, help='Number of metrics per instance')
+    parser.add_option('--all-metrics', action='store_true', default=False, dest='all_metrics',
+                      help='Set all_metrics to the generated metrics, so complete rows are sent right away')
+    parser.add_option('--data-fields', default='', dest='data_fields', help='data_fields given to the agent')
+    parser.add_option('--chunk-kb', type='int', default=2048, dest='chunk_kb', help='chunk_size_kb given to the agent')
+    parser.add_option('--buffer-mb', type='int', default=10, dest='buffer_mb',
+                      help='metric_buffer_size_mb given to the agent')
+    parser.add_option('--agent', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                      'getmessages_kafka2.py'), help='Agent script to load')
+    (options, args) = parser.parse_args()
+
+    server = CountingServer(('127.0.0.1', 0), CountingHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    agent = load_agent(options.agent, options, server.server_port)
+    topic = list(metric_messages(options) if options.mode == 'metric' else log_messages(options))
+    agent.start_data_processing = lambda thread_number: agent.parse_messages_kafka(topic)
+    start_time = time.time()
+    agent.initialize_data_gathering(0)
+    elapsed = time.time() - start_time
+    for session in agent.SESSIONS.values():
+        session.close()
+    server.shutdown()
+    server.server_close()
+
+    print 'messages:       %d' % options.messages
+    print 'time:           %.1f s (%d messages/s, %d us/message)' % (
+        elapsed, options.messages / elapsed, elapsed * 1000000 / options.messages)
+    print 'entries:        %d' % agent.track['entry_count']
+    print 'requests:       %d' % len(requests_received)
+    print 'largest POST:   %d KB' % (max(requests_received or [0]) / 1024)
+
+
+if __name__ == '__main__':
+    main()
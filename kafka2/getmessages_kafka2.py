@@ -1,17 +1,24 @@
 #!/usr/bin/env python
 import ConfigParser
+import calendar
+import heapq
+import Queue
 import json
+import zlib
 import logging
 import os
 import regex
 import socket
 import sys
+import threading
 import time
 import pytz
 import arrow
 from optparse import OptionParser
 from multiprocessing import Process
 from datetime import datetime
+from collections import OrderedDict
+import urllib
 import urlparse
 import httplib
 import requests
@@ -241,7 +248,7 @@ def get_agent_config_vars():
 
         # defaults
         if all_metrics:
-            all_metrics = all_metrics.split(',')
+            all_metrics = set(filter(lambda x: x.strip(), all_metrics.split(',')))
 
         # add parsed variables to a global
         config_vars = {
@@ -291,6 +298,14 @@ def get_if_config_vars():
             if_url = config_parser.get('insightfinder', 'if_url')
             if_http_proxy = config_parser.get('insightfinder', 'if_http_proxy')
             if_https_proxy = config_parser.get('insightfinder', 'if_https_proxy')
+            if_pool_size = config_parser.get('insightfinder', 'if_pool_size') if config_parser.has_option(
+                'insightfinder', 'if_pool_size') else ''
+            if_compress = config_parser.get('insightfinder', 'if_compress') if config_parser.has_option(
+                'insightfinder', 'if_compress') else ''
+            upload_workers = config_parser.get('insightfinder', 'upload_workers') if config_parser.has_option(
+                'insightfinder', 'upload_workers') else ''
+            upload_queue_size = config_parser.get('insightfinder', 'upload_queue_size') if config_parser.has_option(
+                'insightfinder', 'upload_queue_size') else ''
         except ConfigParser.NoOptionError as cp_noe:
             logger.error(cp_noe)
             config_error()
@@ -362,7 +377,11 @@ def get_if_config_vars():
             'run_interval': int(run_interval),  # as seconds
             'chunk_size': int(chunk_size_kb) * 1024,  # as bytes
             'if_url': if_url,
-            'if_proxies': if_proxies
+            'if_proxies': if_proxies,
+            'if_pool_size': int(if_pool_size or 10),
+            'if_compress': if_compress.upper() == 'TRUE',
+            'upload_workers': int(upload_workers or 1),
+            'upload_queue_size': int(upload_queue_size or 4)
         }
 
         return config_vars
@@ -581,6 +600,17 @@ def get_json_size_bytes(json_data):
     return len(bytearray(json.dumps(json_data)))
 
 
+def get_json_separator_size(json_data):
+    """ size of the ', ' that json.dumps puts before every item but the first """
+    return 2 if len(json_data) > 1 else 0
+
+
+def append_to_current_row(entry):
+    """ add an entry to the current chunk, keeping a running count of its size in bytes """
+    track['current_row'].append(entry)
+    track['current_row_size'] += get_json_size_bytes(entry) + get_json_separator_size(track['current_row'])
+
+
 def get_all_files(files, file_regex_c):
     return [i for j in
             map(lambda k:
@@ -672,13 +702,66 @@ def parse_formatted(message, setting_value, default='', allow_list=False, remove
     return setting_value.format(**fields)
 
 
+def build_extraction_plan():
+    """ pre-split the field settings once, so each message only has to be walked """
+    return {
+        'json_top_level': agent_config_vars['json_top_level'].split(JSON_LEVEL_DELIM),
+        'filters_include': [compile_filter(x) for x in agent_config_vars['filters_include']],
+        'filters_exclude': [compile_filter(x) for x in agent_config_vars['filters_exclude']],
+        'instance_field': compile_setting(agent_config_vars['instance_field']),
+        'device_field': compile_setting(agent_config_vars['device_field']),
+        'timestamp_field': compile_setting(agent_config_vars['timestamp_field']),
+        # reverse list so it's in priority order, as shared fields names will get overwritten
+        'data_fields': [compile_data_field(x) for x in reversed(agent_config_vars['data_fields'] or [])],
+    }
+
+
+def compile_filter(_filter):
+    filter_field = _filter.split(':')[0]
+    filter_vals = _filter.split(':')[1].split(',')
+    return filter_field.split(JSON_LEVEL_DELIM), [x.upper() for x in filter_vals]
+
+
+def compile_setting(setting_value):
+    if is_formatted(setting_value[0]):
+        return {'formatted': setting_value[0], 'paths': []}
+    return {'formatted': None, 'paths': [x.split(JSON_LEVEL_DELIM) for x in setting_value if x]}
+
+
+def compile_data_field(setting_value):
+    if is_named_data_field(setting_value):
+        return setting_value, None
+    return setting_value, setting_value.split(JSON_LEVEL_DELIM)
+
+
+def get_plan_value(message, setting_plan, default='', allow_list=False, remove=False):
+    if setting_plan['formatted']:
+        return parse_formatted(message,
+                               setting_plan['formatted'],
+                               default=default,
+                               allow_list=False,
+                               remove=remove)
+    value = ''
+    for path in setting_plan['paths']:
+        value = get_json_path(message,
+                              path,
+                              allow_list=allow_list,
+                              remove=remove)
+        if value != '':
+            break
+    return value or default
+
+
 def get_data_values(timestamp, message):
-    setting_values = agent_config_vars['data_fields'] or message.keys()
-    # reverse list so it's in priority order, as shared fields names will get overwritten
-    setting_values.reverse()
     data = {x: dict() for x in timestamp}
-    for setting_value in setting_values:
-        name, value = get_data_value(message, setting_value)
+    # plan is in priority order, as shared fields names will get overwritten
+    data_fields = extraction_plan['data_fields'] or [(x, None) for x in reversed(message.keys())]
+    for setting_value, path in data_fields:
+        if path is None:
+            name, value = get_data_value(message, setting_value)
+        else:
+            name = setting_value
+            value = get_json_path(message, path, allow_list=True)
         if isinstance(value, (set, tuple, list)):
             for i in range(minlen(timestamp, value)):
                 merge_data(name, value[i], data[timestamp[i]])
@@ -753,10 +836,18 @@ def get_json_field_by_pri(message, pri_list, default='', allow_list=False, remov
 
 
 def get_json_field(message, setting_value, default='', allow_list=False, remove=False):
+    return get_json_path(message,
+                         setting_value.split(JSON_LEVEL_DELIM),
+                         default=default,
+                         allow_list=allow_list,
+                         remove=remove)
+
+
+def get_json_path(message, path, default='', allow_list=False, remove=False):
     field_val = json_format_field_value(
         _get_json_field_helper(
             message,
-            setting_value.split(JSON_LEVEL_DELIM),
+            list(path),
             allow_list=allow_list,
             remove=remove))
     if len(field_val) == 0:
@@ -783,7 +874,7 @@ def _get_json_field_helper(nested_value, next_fields, allow_list=False, remove=F
 
     # get the next value
     next_field = next_fields.pop(0)
-    next_value = json.loads(json.dumps(nested_value.get(next_field)))
+    next_value = nested_value.get(next_field)
     if len(next_fields) == 0 and remove:
         # last field to grab, so remove it
         nested_value.pop(next_field)
@@ -797,14 +888,15 @@ def _get_json_field_helper(nested_value, next_fields, allow_list=False, remove=F
         return ''
 
     # sometimes payloads come in formatted
-    try:
-        next_value = json.loads(next_value)
-    except Exception as ex:
-        next_value = json.loads(json.dumps(next_value))
+    if isinstance(next_value, basestring):
+        try:
+            next_value = json.loads(next_value)
+        except Exception as ex:
+            pass
 
     # handle simple lists
     while isinstance(next_value, (list, set, tuple)) and len(next_value) == 1:
-        next_value = next_value.pop()
+        next_value = list(next_value)[0]
 
     # continue traversing?
     if next_fields is None:
@@ -818,17 +910,15 @@ def _get_json_field_helper(nested_value, next_fields, allow_list=False, remove=F
         if allow_list:
             return json_gather_list_values(
                 next_value,
-                next_fields,
-                remove=remove)
+                next_fields)
         else:
             raise ListNotAllowedError('encountered list or set in json when not allowed')
     elif isinstance(next_value, dict):
-        # there's more tree to walk down
+        # there's more tree to walk down; only top-level fields are removed
         return _get_json_field_helper(
-            json.loads(json.dumps(next_value)),
+            next_value,
             next_fields,
-            allow_list=allow_list,
-            remove=remove)
+            allow_list=allow_list)
     else:
         # catch-all
         return ''
@@ -872,7 +962,7 @@ def parse_json_message(messages):
         else:
             top_level = _get_json_field_helper(
                 messages,
-                agent_config_vars['json_top_level'].split(JSON_LEVEL_DELIM),
+                list(extraction_plan['json_top_level']),
                 allow_list=True)
             if isinstance(top_level, (list, set, tuple)):
                 for message in top_level:
@@ -887,21 +977,19 @@ def parse_json_message(messages):
 
 
 def parse_json_message_single(message):
-    # message = json.loads(json.dumps(message))
     # filter
-    if len(agent_config_vars['filters_include']) != 0:
+    if len(extraction_plan['filters_include']) != 0:
         # for each provided filter
         is_valid = False
-        for _filter in agent_config_vars['filters_include']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = get_json_field(
+        for filter_path, filter_vals in extraction_plan['filters_include']:
+            filter_check = get_json_path(
                 message,
-                filter_field.split(JSON_LEVEL_DELIM),
+                filter_path,
                 allow_list=True)
             # check if a valid value
+            filter_check_upper = filter_check.upper()
             for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
+                if filter_val in filter_check_upper:
                     is_valid = True
                     break
             if is_valid:
@@ -913,41 +1001,40 @@ def parse_json_message_single(message):
         else:
             logger.debug('passed filter (inclusion)')
 
-    if len(agent_config_vars['filters_exclude']) != 0:
+    if len(extraction_plan['filters_exclude']) != 0:
         # for each provided filter
-        for _filter in agent_config_vars['filters_exclude']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = get_json_field(
+        for filter_path, filter_vals in extraction_plan['filters_exclude']:
+            filter_check = get_json_path(
                 message,
-                filter_field.split(JSON_LEVEL_DELIM),
+                filter_path,
                 allow_list=True)
             # check if a valid value
+            filter_check_upper = filter_check.upper()
             for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
+                if filter_val in filter_check_upper:
                     logger.debug('filtered message (exclusion): {} in {}'.format(
                         filter_val, filter_check))
                     return
         logger.debug('passed filter (exclusion)')
 
-    instance = get_single_value(message,
-                                'instance_field',
-                                default=HOSTNAME,
-                                remove=True)
-    device = get_single_value(message,
-                              'device_field',
+    instance = get_plan_value(message,
+                              extraction_plan['instance_field'],
+                              default=HOSTNAME,
                               remove=True)
+    device = get_plan_value(message,
+                            extraction_plan['device_field'],
+                            remove=True)
     # get timestamp
     try:
-        timestamp = get_single_value(message,
-                                     'timestamp_field',
-                                     remove=True)
+        timestamp = get_plan_value(message,
+                                   extraction_plan['timestamp_field'],
+                                   remove=True)
         timestamp = [timestamp]
     except ListNotAllowedError as lnae:
-        timestamp = get_single_value(message,
-                                     'timestamp_field',
-                                     remove=True,
-                                     allow_list=True)
+        timestamp = get_plan_value(message,
+                                   extraction_plan['timestamp_field'],
+                                   remove=True,
+                                   allow_list=True)
     except Exception as e:
         logger.warn(e)
         return
@@ -1078,46 +1165,93 @@ def parse_csv_row(row, field_names, instance, device=''):
 
 def get_timestamp_from_date_string(date_string):
     """ parse a date string into unix epoch (ms) """
-    datetime_obj = None
-    epoch = None
-    if 'timestamp_format' in agent_config_vars:
-        for timestamp_format in agent_config_vars['timestamp_format']:
+    if 'timestamp_format' not in agent_config_vars:
+        return get_timestamp_from_any_date_string(date_string)
+
+    timestamp_formats = agent_config_vars['timestamp_format']
+    if timestamp_formats[0] == 'epoch':
+        # cheap enough to not be worth caching
+        try:
+            return get_timestamp_from_format(date_string, 'epoch')
+        except Exception:
+            pass
+
+    # most messages share their second with a message seen shortly before, so the cache is
+    # keyed on the date string without its fraction of a second, and the fraction's width,
+    # as strings with and without a fraction may match different formats
+    subsecond = SUBSECOND.search(date_string)
+    if subsecond:
+        cache_key = (date_string[:subsecond.start()] + date_string[subsecond.end():], len(subsecond.group(0)))
+        milliseconds = int(subsecond.group(0)[1:4].ljust(3, '0'))
+    else:
+        cache_key = (date_string, 0)
+        milliseconds = 0
+    cached = timestamp_cache.pop(cache_key, None)
+    if cached is None:
+        epoch = None
+        for i, timestamp_format in enumerate(timestamp_formats):
             try:
-                if timestamp_format == 'epoch':
-                    if 13 <= len(date_string) < 15:
-                        timestamp = int(date_string) / 1000
-                        datetime_obj = arrow.get(timestamp)
-                    elif 9 <= len(date_string) < 13:
-                        timestamp = int(date_string)
-                        datetime_obj = arrow.get(timestamp)
-                    else:
-                        raise
-                else:
-                    if agent_config_vars['timezone']:
-                        datetime_obj = arrow.get(date_string, timestamp_format,
-                                                 tzinfo=agent_config_vars['timezone'].zone)
-                    else:
-                        datetime_obj = arrow.get(date_string, timestamp_format)
-                break
+                epoch = get_timestamp_from_format(date_string, timestamp_format)
             except Exception as e:
                 logger.debug(e)
                 logger.debug('timestamp {} does not match {}'.format(date_string, timestamp_format))
                 continue
+            # try the format that matched first from now on. epoch stays in place,
+            # as digit-only formats would otherwise be read as epochs
+            if i != 0 and timestamp_format != 'epoch':
+                timestamp_formats.insert(0, timestamp_formats.pop(i))
+            break
+        if epoch is None:
+            return None
+        # arrow's fraction tokens are S, SS, SSS, ...; formats without one ignore the fraction
+        if subsecond and 'S' in timestamp_format:
+            cached = (epoch // 1000 * 1000, True)
+        else:
+            cached = (epoch, False)
+    if len(timestamp_cache) >= TIMESTAMP_CACHE_SIZE:
+        timestamp_cache.popitem(last=False)
+    timestamp_cache[cache_key] = cached
+    epoch, add_milliseconds = cached
+    return epoch + milliseconds if add_milliseconds else epoch
+
+
+def get_timestamp_from_format(date_string, timestamp_format):
+    if timestamp_format == 'epoch':
+        # whole seconds, without going through a datetime
+        if 13 <= len(date_string) < 15:
+            return int(date_string) / 1000 * 1000
+        elif 9 <= len(date_string) < 13:
+            return int(date_string) * 1000
+        else:
+            raise ValueError('not an epoch timestamp')
+    # arrow is slow, so read the common ISO8601 layouts in UTC directly
+    if timestamp_format in ISO8601_FAST_FORMATS and len(date_string) == 19 \
+            and agent_config_vars['timezone'] in ('', pytz.utc) \
+            and date_string[4] == '-' and date_string[7] == '-' and date_string[10] == timestamp_format[10] \
+            and date_string[13] == ':' and date_string[16] == ':':
+        fields = (date_string[0:4], date_string[5:7], date_string[8:10],
+                  date_string[11:13], date_string[14:16], date_string[17:19])
+        if all(x.isdigit() for x in fields):
+            return calendar.timegm(datetime(*[int(x) for x in fields]).timetuple()) * 1000
+    if agent_config_vars['timezone']:
+        datetime_obj = arrow.get(date_string, timestamp_format,
+                                 tzinfo=agent_config_vars['timezone'].zone)
     else:
-        try:
-            if agent_config_vars['timezone']:
-                datetime_obj = arrow.get(date_string, tzinfo=agent_config_vars['timezone'].zone)
-            else:
-                datetime_obj = arrow.get(date_string)
-        except Exception as e:
-            logger.debug(e)
-            logger.error('timestamp {} can not parse'.format(date_string))
+        datetime_obj = arrow.get(date_string, timestamp_format)
+    return int(datetime_obj.float_timestamp * 1000)
 
-    # get epoch (misc)
-    if datetime_obj:
-        epoch = int(datetime_obj.float_timestamp * 1000)
 
-    return epoch
+def get_timestamp_from_any_date_string(date_string):
+    try:
+        if agent_config_vars['timezone']:
+            datetime_obj = arrow.get(date_string, tzinfo=agent_config_vars['timezone'].zone)
+        else:
+            datetime_obj = arrow.get(date_string)
+        return int(datetime_obj.float_timestamp * 1000)
+    except Exception as e:
+        logger.debug(e)
+        logger.error('timestamp {} can not parse'.format(date_string))
+        return None
 
 
 def make_safe_instance_string(instance, device=''):
@@ -1239,20 +1373,25 @@ def initialize_data_gathering(thread_number):
     track['chunk_count'] = 0
     track['entry_count'] = 0
 
-    start_data_processing(thread_number)
+    start_upload_workers()
 
-    # move all buffer data to current data, and send
-    while metric_buffer['buffer_ts_list']:
-        (ts, key) = metric_buffer['buffer_ts_list'].pop()
-        transpose_metrics(ts, key)
-        if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size']:
-            logger.debug('Sending buffer chunk')
-            send_data_wrapper()
+    try:
+        start_data_processing(thread_number)
 
-    # last chunk
-    if len(track['current_row']) > 0:
-        logger.debug('Sending last chunk')
-        send_data_wrapper()
+        # move all buffer data to current data, and send
+        while metric_buffer['buffer_dict']:
+            transpose_oldest_metrics()
+            if track['current_row_size'] >= if_config_vars['chunk_size']:
+                logger.debug('Sending buffer chunk')
+                send_data_wrapper()
+
+        # last chunk
+        if len(track['current_row']) > 0:
+            logger.debug('Sending last chunk')
+            send_data_wrapper()
+    finally:
+        # send what was already queued, even if reading stopped on an error
+        stop_upload_workers()
 
     logger.debug('Total chunks created: ' + str(track['chunk_count']))
     logger.debug('Total {} entries: {}'.format(
@@ -1260,12 +1399,17 @@ def initialize_data_gathering(thread_number):
 
 
 def reset_metric_buffer():
-    metric_buffer['buffer_key_list'] = []
-    metric_buffer['buffer_ts_list'] = []
+    # (timestamp, instance) -> {metric_key: value}
     metric_buffer['buffer_dict'] = {}
+    # heap of (timestamp, key), oldest first. keys already sent are skipped lazily
+    metric_buffer['buffer_ts_heap'] = []
+    # (timestamp, instance) -> serialized size of its row, and the sum over all rows
+    metric_buffer['buffer_size_dict'] = {}
+    metric_buffer['buffer_size'] = 0
 
-    metric_buffer['buffer_collected_list'] = []
+    # (timestamp, instance) -> set of the configured all_metrics collected so far
     metric_buffer['buffer_collected_dict'] = {}
+    metric_buffer['buffer_collected_list'] = []
 
 
 def reset_track():
@@ -1273,6 +1417,7 @@ def reset_track():
     track['start_time'] = time.time()
     track['line_count'] = 0
     track['current_row'] = []
+    track['current_row_size'] = 2  # '[]'
 
 
 #########################################
@@ -1296,15 +1441,15 @@ def log_handoff(timestamp, data, instance, device=''):
 
 def send_log(timestamp, data, instance, device=''):
     entry = prepare_log_entry(str(int(timestamp)), data, instance, device)
-    track['current_row'].append(entry)
+    append_to_current_row(entry)
     track['line_count'] += 1
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (
+    if track['current_row_size'] >= if_config_vars['chunk_size'] or (
             time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 100 == 0:
         logger.debug('Current data object size: {} bytes'.format(
-            get_json_size_bytes(track['current_row'])))
+            track['current_row_size']))
 
 
 def prepare_log_entry(timestamp, data, instance, device=''):
@@ -1342,63 +1487,88 @@ def send_metric(timestamp, field_name, data, instance, device=''):
 
         # send data if all metrics of instance is collected
         while metric_buffer['buffer_collected_list']:
-            (ts, key, index) = metric_buffer['buffer_collected_list'].pop()
-            del metric_buffer['buffer_ts_list'][index]
-            metric_buffer['buffer_collected_dict'].pop(key)
-            transpose_metrics(ts, key)
-            if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size']:
+            key = metric_buffer['buffer_collected_list'].pop()
+            if key in metric_buffer['buffer_dict']:
+                transpose_metrics(key)
+            if track['current_row_size'] >= if_config_vars['chunk_size']:
                 logger.debug('Sending buffer chunk')
                 send_data_wrapper()
 
         # send data if buffer size is bigger than threshold
-        while get_json_size_bytes(metric_buffer['buffer_dict']) >= agent_config_vars['metric_buffer_size'] and \
-                metric_buffer['buffer_ts_list']:
-            (ts, key) = metric_buffer['buffer_ts_list'].pop()
-            transpose_metrics(ts, key)
-            if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size']:
+        while metric_buffer['buffer_size'] >= agent_config_vars['metric_buffer_size'] and \
+                metric_buffer['buffer_dict']:
+            transpose_oldest_metrics()
+            if track['current_row_size'] >= if_config_vars['chunk_size']:
                 logger.debug('Sending buffer chunk')
                 send_data_wrapper()
 
         # send data
-        if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (
+        if track['current_row_size'] >= if_config_vars['chunk_size'] or (
                 time.time() - track['start_time']) >= if_config_vars['run_interval']:
             send_data_wrapper()
         elif track['entry_count'] % 500 == 0:
             logger.debug('Buffer data object size: {} bytes'.format(
-                get_json_size_bytes(metric_buffer['buffer_dict'])))
+                metric_buffer['buffer_size']))
 
 
 def append_metric_data_to_buffer(timestamp, field_name, data, instance, device=''):
     """ creates the metric entry """
-    ts_str = str(timestamp)
     instance_str = make_safe_instance_string(instance, device)
-    key = '{}-{}'.format(ts_str, instance_str)
+    key = (timestamp, instance_str)
     metric_str = make_safe_metric_key(field_name)
     metric_key = '{}[{}]'.format(metric_str, instance_str)
+    value = str(data)
 
-    if key not in metric_buffer['buffer_key_list']:
-        # add timestamp in buffer_ts_list and buffer_dict
-        metric_buffer['buffer_key_list'].append(key)
-        metric_buffer['buffer_ts_list'].append((timestamp, key))
-        metric_buffer['buffer_ts_list'].sort(key=lambda elem: elem[0], reverse=True)
+    if key not in metric_buffer['buffer_dict']:
+        # add timestamp in buffer_ts_heap and buffer_dict
+        heapq.heappush(metric_buffer['buffer_ts_heap'], key)
         metric_buffer['buffer_dict'][key] = dict()
-        metric_buffer['buffer_collected_dict'][key] = []
-    metric_buffer['buffer_dict'][key][metric_key] = str(data)
-    metric_buffer['buffer_collected_dict'][key].append(metric_str)
+        metric_buffer['buffer_size_dict'][key] = 0
+        metric_buffer['buffer_collected_dict'][key] = set()
+    row = metric_buffer['buffer_dict'][key]
+
+    # '"<metric_key>": "<value>", '
+    size = get_json_size_bytes(value)
+    if metric_key in row:
+        size -= get_json_size_bytes(row[metric_key])
+    else:
+        size += get_json_size_bytes(metric_key) + 4
+    row[metric_key] = value
+    metric_buffer['buffer_size_dict'][key] += size
+    metric_buffer['buffer_size'] += size
 
     # if all metrics of ts_instance is collected, then send these data
-    if agent_config_vars['all_metrics'] and set(agent_config_vars['all_metrics']) <= set(
-            metric_buffer['buffer_collected_dict'][key]):
-        metric_buffer['buffer_collected_list'].append(
-            (timestamp, key, metric_buffer['buffer_ts_list'].index((timestamp, key))))
+    if agent_config_vars['all_metrics'] and metric_str in agent_config_vars['all_metrics']:
+        collected = metric_buffer['buffer_collected_dict'][key]
+        if metric_str not in collected:
+            collected.add(metric_str)
+            if len(collected) == len(agent_config_vars['all_metrics']):
+                metric_buffer['buffer_collected_list'].append(key)
+
+
+def transpose_oldest_metrics():
+    """ send the oldest buffered timestamp/instance """
+    while metric_buffer['buffer_ts_heap']:
+        key = heapq.heappop(metric_buffer['buffer_ts_heap'])
+        # skip keys that were already sent once all their metrics were collected
+        if key in metric_buffer['buffer_dict']:
+            transpose_metrics(key)
+            return
 
 
-def transpose_metrics(ts, key):
-    metric_buffer['buffer_key_list'].remove(key)
-    track['current_row'].append(
-        dict({'timestamp': str(ts)}, **metric_buffer['buffer_dict'].pop(key))
+def transpose_metrics(key):
+    metric_buffer['buffer_collected_dict'].pop(key)
+    metric_buffer['buffer_size'] -= metric_buffer['buffer_size_dict'].pop(key)
+    append_to_current_row(
+        dict({'timestamp': str(key[0])}, **metric_buffer['buffer_dict'].pop(key))
     )
 
+    # drop heap entries for keys that were already sent
+    heap = metric_buffer['buffer_ts_heap']
+    if len(heap) > 2 * len(metric_buffer['buffer_dict']) + 1024:
+        metric_buffer['buffer_ts_heap'] = [k for k in heap if k in metric_buffer['buffer_dict']]
+        heapq.heapify(metric_buffer['buffer_ts_heap'])
+
 
 def build_metric_name_map():
     '''
@@ -1510,12 +1680,62 @@ def send_data_wrapper():
     """ wrapper to send data """
     logger.debug('--- Chunk creation time: {} seconds ---'.format(
         round(time.time() - track['start_time'], 2)))
-    send_data_to_if(track['current_row'])
+    if upload['workers']:
+        # blocks while the queue is full, so parsing can't run too far ahead of sending
+        upload['queue'].put((track['current_row'], track['line_count']))
+        upload['max_depth'] = max(upload['max_depth'], upload['queue'].qsize())
+        logger.debug('Upload queue depth: {}, in flight: {}'.format(
+            upload['queue'].qsize(), upload['in_flight']))
+    else:
+        send_data_to_if(track['current_row'], track['line_count'])
     track['chunk_count'] += 1
     reset_track()
 
 
-def send_data_to_if(chunk_metric_data):
+def start_upload_workers():
+    """ start the threads that send chunks to IF in the background """
+    upload['queue'] = Queue.Queue(maxsize=if_config_vars['upload_queue_size'])
+    upload['lock'] = threading.Lock()
+    upload['in_flight'] = 0
+    upload['max_depth'] = 0
+    upload['workers'] = []
+    for i in range(if_config_vars['upload_workers']):
+        worker = threading.Thread(target=upload_worker, name='upload-{}'.format(i))
+        worker.daemon = True
+        worker.start()
+        upload['workers'].append(worker)
+
+
+def stop_upload_workers():
+    """ wait for all queued chunks to be sent, then stop the upload threads """
+    logger.debug('Draining upload queue: {} queued, {} in flight'.format(
+        upload['queue'].qsize(), upload['in_flight']))
+    for _ in upload['workers']:
+        upload['queue'].put(None)
+    for worker in upload['workers']:
+        worker.join()
+    upload['workers'] = []
+    logger.debug('Max upload queue depth: {}'.format(upload['max_depth']))
+
+
+def upload_worker():
+    while True:
+        chunk = upload['queue'].get()
+        if chunk is None:
+            return
+        with upload['lock']:
+            upload['in_flight'] += 1
+        try:
+            send_data_to_if(*chunk)
+        except Exception as e:
+            logger.warning('Error when sending chunk')
+            logger.warning(e)
+        finally:
+            with upload['lock']:
+                upload['in_flight'] -= 1
+
+
+def send_data_to_if(chunk_metric_data, line_count):
     send_data_time = time.time()
 
     # prepare data for metric streaming agent
@@ -1528,7 +1748,7 @@ def send_data_to_if(chunk_metric_data):
     logger.debug('First:\n' + str(chunk_metric_data[0]))
     logger.debug('Last:\n' + str(chunk_metric_data[-1]))
     logger.debug('Total Data (bytes): ' + str(get_json_size_bytes(data_to_post)))
-    logger.debug('Total Lines: ' + str(track['line_count']))
+    logger.debug('Total Lines: ' + str(line_count))
 
     # do not send if only testing
     if cli_config_vars['testing']:
@@ -1536,22 +1756,51 @@ def send_data_to_if(chunk_metric_data):
 
     # send the data
     post_url = urlparse.urljoin(if_config_vars['if_url'], get_api_from_project_type())
+    post_data = data_to_post
+    post_headers = None
+    if if_config_vars['if_compress']:
+        post_data = gzip_compress(urllib.urlencode(data_to_post))
+        post_headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'}
     send_request(post_url, 'POST', 'Could not send request to IF',
                  str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
-                 data=data_to_post, proxies=if_config_vars['if_proxies'])
+                 data=post_data, headers=post_headers, proxies=if_config_vars['if_proxies'])
     logger.debug('--- Send data time: %s seconds ---' % round(time.time() - send_data_time, 2))
 
 
+def get_request_session():
+    """ get this thread's pooled session, so connections are reused between requests """
+    # requests.Session is not thread-safe, so each upload thread gets its own
+    pid = (os.getpid(), threading.current_thread().ident)
+    if pid not in SESSIONS:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=if_config_vars['if_pool_size'],
+                                                pool_maxsize=if_config_vars['if_pool_size'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        SESSIONS[pid] = session
+    return SESSIONS[pid]
+
+
+def gzip_compress(data):
+    """ gzip a request body """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
 def send_request(url, mode='GET', failure_message='Failure!', success_message='Success!', **request_passthrough):
     """ sends a request to the given url """
     # determine if post or get (default)
-    req = requests.get
+    session = get_request_session()
+    req = session.get
     if mode.upper() == 'POST':
-        req = requests.post
+        req = session.post
 
     for i in range(ATTEMPTS):
         try:
+            request_time = time.time()
             response = req(url, **request_passthrough)
+            logger.debug('Request took {} seconds, {} bytes sent, {} bytes received'.format(
+                round(time.time() - request_time, 3), len(response.request.body or ''), len(response.content)))
             if response.status_code == httplib.OK:
                 logger.info(success_message)
                 return response
@@ -1675,10 +1924,16 @@ if __name__ == "__main__":
     FORMAT_STR = regex.compile(r"{(.*?)}")
     HOSTNAME = socket.gethostname().partition('.')[0]
     ISO8601 = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y%m%dT%H%M%SZ', 'epoch']
+    TIMESTAMP_CACHE_SIZE = 4096
+    ISO8601_FAST_FORMATS = {'YYYY-MM-DDTHH:mm:ss', 'YYYY-MM-DD HH:mm:ss'}
+    SUBSECOND = regex.compile(r"(?<=:\d\d)[.,]\d+")
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = ','
     ATTEMPTS = 3
+    SESSIONS = dict()
     track = dict()
+    timestamp_cache = OrderedDict()
+    upload = dict()
     metric_buffer = dict()
 
     # get config
@@ -1686,6 +1941,7 @@ if __name__ == "__main__":
     logger = set_logger_config(cli_config_vars['log_level'])
     if_config_vars = get_if_config_vars()
     agent_config_vars = get_agent_config_vars()
+    extraction_plan = build_extraction_plan()
     print_summary_info()
 
     # start data processing
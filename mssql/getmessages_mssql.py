@@ -1,14 +1,17 @@
 #!/usr/bin/env python
 import ConfigParser
 import json
+import zlib
 import logging
 import os
 import regex
 import socket
 import sys
+import threading
 import time
 import pytz
 import arrow
+import urllib
 import urlparse
 import httplib
 import requests
@@ -17,11 +20,14 @@ import subprocess
 import shlex
 import traceback
 import pymssql
+import resource
+import Queue
 
 from pymssql import ProgrammingError
 from datetime import datetime
 from decimal import Decimal
 from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
 
 """
 This script gathers data to send to Insightfinder
@@ -113,35 +119,45 @@ def start_data_processing(thread_number):
     sql = agent_config_vars['sql']
     sql = sql.replace('\n', ' ').replace('"""', '')
 
+    # one connection per worker, the first one reused from above
+    conn_pool = Queue.Queue()
+    conn_pool.put(conn)
+    for _ in range(agent_config_vars['query_workers'] - 1):
+        conn_pool.put(pymssql.connect(**agent_config_vars['mssql_kwargs']))
+    pool_map = ThreadPool(agent_config_vars['query_workers'])
+
+    def query_messages(sql_str_list):
+        pool_map.map(lambda x: query_messages_mssql(conn_pool, x), sql_str_list)
+
     # parse sql string by params
     logger.debug('sql config: {}'.format(agent_config_vars['sql_config']))
     if agent_config_vars['sql_config']:
         logger.debug('Using time range for replay data')
-        for timestamp in range(agent_config_vars['sql_config']['sql_time_range'][0],
-                               agent_config_vars['sql_config']['sql_time_range'][1],
-                               agent_config_vars['sql_config']['sql_time_interval']):
-            for table in table_list:
-                sql_str = sql
+        sql_time_interval = agent_config_vars['sql_config']['sql_time_interval']
+        timestamps = range(agent_config_vars['sql_config']['sql_time_range'][0],
+                           agent_config_vars['sql_config']['sql_time_range'][1],
+                           sql_time_interval)
+        # query enough time windows at once to keep the workers busy
+        windows_per_batch = max(1, agent_config_vars['query_workers'] // len(table_list))
+        for i in range(0, len(timestamps), windows_per_batch):
+            sql_str_list = []
+            for timestamp in timestamps[i:i + windows_per_batch]:
                 start_time = arrow.get(timestamp).format(agent_config_vars['sql_time_format'])
-                end_time = arrow.get(timestamp + agent_config_vars['sql_config']['sql_time_interval']).format(
-                    agent_config_vars['sql_time_format'])
+                end_time = arrow.get(timestamp + sql_time_interval).format(agent_config_vars['sql_time_format'])
                 extract_time = arrow.get(
-                    timestamp + agent_config_vars['sql_config']['sql_time_interval'] + agent_config_vars[
-                        'sql_extract_time_offset']).format(agent_config_vars['sql_extract_time_format'])
-
-                sql_str = sql_str.replace('{{table}}', table)
-                sql_str = sql_str.replace('{{extract_time}}', extract_time)
-                sql_str = sql_str.replace('{{start_time}}', start_time)
-                sql_str = sql_str.replace('{{end_time}}', end_time)
+                    timestamp + sql_time_interval + agent_config_vars['sql_extract_time_offset']).format(
+                    agent_config_vars['sql_extract_time_format'])
+                for table in table_list:
+                    sql_str_list.append(build_sql_str(sql, table, extract_time, start_time, end_time))
 
-                query_messages_mssql(cursor, sql_str)
+            query_messages(sql_str_list)
 
             # clear metric buffer when piece of time range end
             clear_metric_buffer()
     else:
         logger.debug('Using current time for streaming data')
+        sql_str_list = []
         for table in table_list:
-            sql_str = sql
             start_time_multiple = agent_config_vars['start_time_multiple'] or 1
             start_time = arrow.get(
                 arrow.utcnow().float_timestamp - start_time_multiple * if_config_vars['sampling_interval'],
@@ -153,38 +169,65 @@ def start_data_processing(thread_number):
                 arrow.utcnow().float_timestamp + agent_config_vars['sql_extract_time_offset'],
                 tzinfo=agent_config_vars['timezone'].zone).format(
                 agent_config_vars['sql_extract_time_format'])
+            sql_str_list.append(build_sql_str(sql, table, extract_time, start_time, end_time))
 
-            sql_str = sql_str.replace('{{table}}', table)
-            sql_str = sql_str.replace('{{extract_time}}', extract_time)
-            sql_str = sql_str.replace('{{start_time}}', start_time)
-            sql_str = sql_str.replace('{{end_time}}', end_time)
-
-            query_messages_mssql(cursor, sql_str)
+        query_messages(sql_str_list)
 
+    pool_map.close()
     cursor.close()
-    conn.close()
+    while not conn_pool.empty():
+        conn_pool.get().close()
     logger.info('Closed connection number ' + str(thread_number))
 
 
-def query_messages_mssql(cursor, sql_str):
+def build_sql_str(sql, table, extract_time, start_time, end_time):
+    sql_str = sql
+    sql_str = sql_str.replace('{{table}}', table)
+    sql_str = sql_str.replace('{{extract_time}}', extract_time)
+    sql_str = sql_str.replace('{{start_time}}', start_time)
+    sql_str = sql_str.replace('{{end_time}}', end_time)
+    return sql_str
+
+
+def query_messages_mssql(conn_pool, sql_str):
+    conn = conn_pool.get()
     try:
         logger.info('Starting execute SQL')
         logger.info(sql_str)
 
         # execute sql string
+        cursor = conn.cursor()
         cursor.execute(sql_str)
 
         parse_messages_mssql(cursor)
-    except ProgrammingError as e:
+        cursor.close()
+    except Exception as e:
+        # keep the other queries of the batch going
         logger.error(e)
-        logger.error('SQL execute error: '.format(sql_str))
+        logger.error('SQL execute error: {}'.format(sql_str))
+    finally:
+        conn_pool.put(conn)
 
 
 def parse_messages_mssql(cursor):
     count = 0
-    message_list = cursor.fetchall()
-    logger.info('Reading {} messages'.format(len(message_list)))
-
+    logger.info('Reading messages')
+
+    # read in batches so only fetch_size rows are held in memory at once
+    message_list = cursor.fetchmany(agent_config_vars['fetch_size'])
+    while message_list:
+        # workers share the metric buffer
+        with metric_buffer['lock']:
+            count += parse_message_list_mssql(message_list)
+            # send what has been merged so far, rather than holding the whole batch in memory
+            if len(metric_buffer['buffer_dict']) >= agent_config_vars['fetch_size']:
+                clear_metric_buffer(send_last_chunk=False)
+        logger.info('Parse {0} messages'.format(count))
+        message_list = cursor.fetchmany(agent_config_vars['fetch_size'])
+
+
+def parse_message_list_mssql(message_list):
+    count = 0
     for message in message_list:
         try:
             logger.debug('Message received')
@@ -235,9 +278,7 @@ def parse_messages_mssql(cursor):
 
         track['entry_count'] += 1
         count += 1
-        if count % 1000 == 0:
-            logger.info('Parse {0} messages'.format(count))
-    logger.info('Parse {0} messages'.format(count))
+    return count
 
 
 def get_agent_config_vars():
@@ -387,6 +428,10 @@ def get_agent_config_vars():
             timezone = config_parser.get('mssql', 'timezone') or 'UTC'
             data_fields = config_parser.get('mssql', 'data_fields', raw=True)
             start_time_multiple = config_parser.get('mssql', 'start_time_multiple', raw=True)
+            fetch_size = config_parser.get('mssql', 'fetch_size') if config_parser.has_option(
+                'mssql', 'fetch_size') else ''
+            query_workers = config_parser.get('mssql', 'query_workers') if config_parser.has_option(
+                'mssql', 'query_workers') else ''
 
         except ConfigParser.NoOptionError as cp_noe:
             logger.error(cp_noe)
@@ -395,6 +440,9 @@ def get_agent_config_vars():
         if len(start_time_multiple) != 0:
             start_time_multiple = int(start_time_multiple)
 
+        fetch_size = int(fetch_size or 1000)
+        query_workers = max(1, int(query_workers or 1))
+
         # timestamp format
         if len(timestamp_format) != 0:
             timestamp_format = filter(lambda x: x.strip(), timestamp_format.split(','))
@@ -467,6 +515,8 @@ def get_agent_config_vars():
             'device_field': device_fields,
             'data_fields': data_fields,
             'start_time_multiple': start_time_multiple,
+            'fetch_size': fetch_size,
+            'query_workers': query_workers,
             'timestamp_field': timestamp_fields,
             'target_timestamp_timezone': target_timestamp_timezone,
             'timezone': timezone,
@@ -499,6 +549,14 @@ def get_if_config_vars():
             if_url = config_parser.get('insightfinder', 'if_url')
             if_http_proxy = config_parser.get('insightfinder', 'if_http_proxy')
             if_https_proxy = config_parser.get('insightfinder', 'if_https_proxy')
+            if_pool_size = config_parser.get('insightfinder', 'if_pool_size') if config_parser.has_option(
+                'insightfinder', 'if_pool_size') else ''
+            if_compress = config_parser.get('insightfinder', 'if_compress') if config_parser.has_option(
+                'insightfinder', 'if_compress') else ''
+            spool_dir = config_parser.get('insightfinder', 'spool_dir') if config_parser.has_option(
+                'insightfinder', 'spool_dir') else ''
+            spool_size_mb = config_parser.get('insightfinder', 'spool_size_mb') if config_parser.has_option(
+                'insightfinder', 'spool_size_mb') else ''
         except ConfigParser.NoOptionError as cp_noe:
             logger.error(cp_noe)
             config_error()
@@ -572,6 +630,10 @@ def get_if_config_vars():
             'chunk_size': int(chunk_size_kb) * 1024,  # as bytes
             'if_url': if_url,
             'if_proxies': if_proxies,
+            'if_pool_size': int(if_pool_size or 10),
+            'if_compress': if_compress.upper() == 'TRUE',
+            'spool_dir': abs_path_from_cur(spool_dir or 'spool'),
+            'spool_size': int(spool_size_mb or 100) * 1024 * 1024,  # as bytes
             'is_replay': is_replay
         }
 
@@ -738,22 +800,32 @@ def print_summary_info():
 
 
 def initialize_data_gathering(thread_number):
+    metric_buffer['lock'] = threading.Lock()
     reset_metric_buffer()
     reset_track()
     track['chunk_count'] = 0
     track['entry_count'] = 0
+    processing_start_time = time.time()
+
+    start_spool_replayer()
 
     start_data_processing(thread_number)
 
     # clear metric buffer when data processing end
     clear_metric_buffer()
 
+    stop_spool_replayer()
+
     logger.info('Total chunks created: ' + str(track['chunk_count']))
     logger.info('Total {} entries: {}'.format(
         if_config_vars['project_type'].lower(), track['entry_count']))
+    processing_time = max(time.time() - processing_start_time, 0.001)
+    logger.info('Processed {} entries in {} seconds ({} entries/s), peak RSS {} MB'.format(
+        track['entry_count'], round(processing_time, 2), int(track['entry_count'] / processing_time),
+        round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)))
 
 
-def clear_metric_buffer():
+def clear_metric_buffer(send_last_chunk=True):
     # move all buffer data to current data, and send
     buffer_values = metric_buffer['buffer_dict'].values()
 
@@ -766,7 +838,7 @@ def clear_metric_buffer():
             send_data_wrapper()
 
     # last chunk
-    if len(track['current_row']) > 0:
+    if send_last_chunk and len(track['current_row']) > 0:
         logger.debug('Sending last chunk')
         send_data_wrapper()
 
@@ -822,19 +894,228 @@ def send_data_to_if(chunk_metric_data):
 
     # send the data
     post_url = urlparse.urljoin(if_config_vars['if_url'], get_api_from_project_type())
-    send_request(post_url, 'POST', 'Could not send request to IF',
-                 str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
-                 data=data_to_post, verify=False, proxies=if_config_vars['if_proxies'])
+    post_data, post_headers = get_post_body(data_to_post)
+    response = send_request(post_url, 'POST', 'Could not send request to IF',
+                            str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
+                            data=post_data, headers=post_headers, verify=False, proxies=if_config_vars['if_proxies'])
+    if response == -1:
+        spool_chunk(post_url, data_to_post)
     logger.info('--- Send data time: %s seconds ---' % round(time.time() - send_data_time, 2))
 
 
+def start_spool_replayer():
+    """ start the thread that re-sends spooled chunks once IF is reachable again """
+    spool['lock'] = threading.Lock()
+    spool['stop'] = threading.Event()
+    spool['segment'] = None
+    spool['thread'] = None
+    if if_config_vars['spool_size'] == 0 or cli_config_vars['testing']:
+        return
+    if not os.path.isdir(if_config_vars['spool_dir']):
+        os.makedirs(if_config_vars['spool_dir'])
+    recover_spool_segments()
+    spool['thread'] = threading.Thread(target=replay_spool, name='spool-replay')
+    spool['thread'].daemon = True
+    spool['thread'].start()
+
+
+def stop_spool_replayer():
+    """ stop replaying. anything left in the spool is replayed on the next run """
+    if not spool['thread']:
+        return
+    spool['stop'].set()
+    spool['thread'].join()
+    with spool['lock']:
+        close_spool_segment()
+
+
+def recover_spool_segments():
+    """ release segments left open or half-replayed by agent runs that have exited """
+    for name in os.listdir(if_config_vars['spool_dir']):
+        if name.endswith('.open'):
+            # <ts>-<writer pid>.open
+            owner = name[:-len('.open')].split('-')[-1]
+            closed = name[:-len('.open')] + '.spool'
+        elif name.endswith('.replay'):
+            # <ts>-<writer pid>.spool.<replayer pid>.replay
+            closed, owner, _ = name.rsplit('.', 2)
+        elif name.endswith('.replay.tmp'):
+            # left over from writing back a half-replayed segment
+            owner = name.rsplit('.', 3)[1]
+            if not is_pid_running(int(owner)):
+                os.remove(os.path.join(if_config_vars['spool_dir'], name))
+            continue
+        else:
+            continue
+        if not is_pid_running(int(owner)):
+            os.rename(os.path.join(if_config_vars['spool_dir'], name),
+                      os.path.join(if_config_vars['spool_dir'], closed))
+
+
+def is_pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def get_spool_segments(suffix='.spool'):
+    """ spool segment files, oldest first """
+    return [os.path.join(if_config_vars['spool_dir'], name)
+            for name in sorted(os.listdir(if_config_vars['spool_dir']))
+            if name.endswith(suffix)]
+
+
+def close_spool_segment():
+    """ close the segment this process appends to, making it available for replay """
+    if spool['segment'] and os.path.exists(spool['segment']):
+        os.rename(spool['segment'], spool['segment'][:-len('.open')] + '.spool')
+    spool['segment'] = None
+
+
+def spool_chunk(post_url, data_to_post):
+    """ append a chunk that could not be sent to the spool, dropping the oldest segments over the size cap """
+    if not spool['thread']:
+        return
+    with spool['lock']:
+        if spool['segment'] and os.path.getsize(spool['segment']) >= SPOOL_SEGMENT_SIZE:
+            close_spool_segment()
+        if not spool['segment']:
+            spool['segment'] = os.path.join(if_config_vars['spool_dir'], '{:015d}-{}.open'.format(
+                int(time.time() * 1000), os.getpid()))
+        # only the payload is spooled, the account fields are filled in again on replay
+        account_fields = initialize_api_post_data()
+        payload = dict((key, value) for key, value in data_to_post.items() if key not in account_fields)
+        with open(spool['segment'], 'a') as spool_file:
+            spool_file.write(json.dumps({'url': post_url, 'data': payload}) + '\n')
+        logger.warning('Spooled chunk to {}'.format(spool['segment']))
+
+        # evict oldest first
+        segments = get_spool_segments()
+        spool_size = sum(os.path.getsize(segment) for segment in segments + get_spool_segments('.open'))
+        while spool_size > if_config_vars['spool_size'] and segments:
+            segment = segments.pop(0)
+            spool_size -= os.path.getsize(segment)
+            os.remove(segment)
+            logger.warning('Spool is full, dropped {}'.format(segment))
+
+
+def replay_spool():
+    """ re-send spooled chunks oldest first, backing off exponentially while IF is unreachable """
+    backoff = SPOOL_MIN_BACKOFF
+    while not spool['stop'].is_set():
+        if replay_spool_segment():
+            backoff = SPOOL_MIN_BACKOFF
+        else:
+            spool['stop'].wait(backoff)
+            backoff = min(backoff * 2, SPOOL_MAX_BACKOFF)
+
+
+def replay_spool_segment():
+    """ claim and re-send the oldest spooled segment. returns True if all of it was sent """
+    with spool['lock']:
+        segments = get_spool_segments()
+        if not segments and spool['segment']:
+            close_spool_segment()
+            segments = get_spool_segments()
+        if not segments:
+            return False
+        segment = segments[0]
+        # renaming is atomic, so only one process can claim a segment
+        claimed = '{}.{}.replay'.format(segment, os.getpid())
+        try:
+            os.rename(segment, claimed)
+        except OSError:
+            return False
+
+    with open(claimed) as spool_file:
+        lines = spool_file.readlines()
+    for i, line in enumerate(lines):
+        try:
+            chunk = json.loads(line)
+        except ValueError:
+            logger.warning('Skipping corrupt line in {}'.format(segment))
+            continue
+        if spool['stop'].is_set() or not send_spooled_chunk(chunk):
+            # put back what wasn't sent
+            try:
+                with open(claimed + '.tmp', 'w') as spool_file:
+                    spool_file.writelines(lines[i:])
+                os.rename(claimed + '.tmp', segment)
+            except (IOError, OSError) as e:
+                logger.warning('Could not write back {}, it is replayed in full on the next run'.format(segment))
+                logger.warning(e)
+                if os.path.exists(claimed + '.tmp'):
+                    os.remove(claimed + '.tmp')
+                return False
+            os.remove(claimed)
+            return False
+    os.remove(claimed)
+    logger.info('Replayed {} spooled chunks from {}'.format(len(lines), segment))
+    return True
+
+
+def send_spooled_chunk(chunk):
+    """ re-send a spooled chunk. returns False if it should be tried again later """
+    data_to_post = initialize_api_post_data()
+    data_to_post.update(chunk['data'])
+    post_data, post_headers = get_post_body(data_to_post)
+    # the replayer backs off between attempts, so post once rather than through send_request
+    try:
+        response = get_request_session().post(chunk['url'], data=post_data, headers=post_headers, verify=False,
+                                              proxies=if_config_vars['if_proxies'])
+    except requests.exceptions.RequestException as e:
+        logger.warning('Could not re-send spooled chunk to IF')
+        logger.warning(e)
+        return False
+    if response.status_code == httplib.OK:
+        logger.info('Re-sent a spooled chunk.')
+        return True
+    if 400 <= response.status_code < 500 and response.status_code not in SPOOL_RETRYABLE_STATUS:
+        # IF will never accept this chunk, so drop it rather than hold up the rest of the spool
+        logger.warning('IF rejected a spooled chunk, dropping it. Response Code: {}\nTEXT: {}'.format(
+            response.status_code, response.text))
+        return True
+    logger.warning('Could not re-send spooled chunk to IF. Response Code: {}'.format(response.status_code))
+    return False
+
+
+def get_post_body(data_to_post):
+    """ get the body and headers to post data_to_post with, gzipped if configured """
+    if not if_config_vars['if_compress']:
+        return data_to_post, None
+    return gzip_compress(urllib.urlencode(data_to_post)), {'Content-Type': 'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'}
+
+
+def get_request_session():
+    """ get this thread's pooled session, so connections are reused between requests """
+    # requests.Session is not thread-safe, so each thread gets its own
+    pid = (os.getpid(), threading.current_thread().ident)
+    if pid not in SESSIONS:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=if_config_vars['if_pool_size'],
+                                                pool_maxsize=if_config_vars['if_pool_size'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        SESSIONS[pid] = session
+    return SESSIONS[pid]
+
+
+def gzip_compress(data):
+    """ gzip a request body """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
 def send_request(url, mode='GET', failure_message='Failure!', success_message='Success!', **request_passthrough):
     """ sends a request to the given url """
     # determine if post or get (default)
     requests.packages.urllib3.disable_warnings()
-    req = requests.get
+    session = get_request_session()
+    req = session.get
     if mode.upper() == 'POST':
-        req = requests.post
+        req = session.post
 
     global REQUESTS
     REQUESTS.update(request_passthrough)
@@ -843,7 +1124,10 @@ def send_request(url, mode='GET', failure_message='Failure!', success_message='S
     req_num = 0
     for req_num in range(ATTEMPTS):
         try:
+            request_time = time.time()
             response = req(url, **request_passthrough)
+            logger.debug('Request took {} seconds, {} bytes sent, {} bytes received'.format(
+                round(time.time() - request_time, 3), len(response.request.body or ''), len(response.content)))
             if response.status_code == httplib.OK:
                 logger.info(success_message)
                 return response
@@ -966,8 +1250,14 @@ if __name__ == "__main__":
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = r",|\t"
     ATTEMPTS = 3
+    SESSIONS = dict()
+    SPOOL_SEGMENT_SIZE = 8 * 1024 * 1024
+    SPOOL_MIN_BACKOFF = 1
+    SPOOL_MAX_BACKOFF = 300
+    SPOOL_RETRYABLE_STATUS = (408, 429)
     REQUESTS = dict()
     track = dict()
+    spool = dict()
     metric_buffer = dict()
 
     # get config
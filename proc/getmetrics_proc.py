@@ -1,13 +1,11 @@
 #!/usr/bin/python
 
-import linecache
+import collections
 import json
-import csv
 import subprocess
 import time
 import os
 from optparse import OptionParser
-import multiprocessing
 import socket
 
 '''
@@ -27,6 +25,7 @@ else:
     homepath = options.homepath
 datadir = 'data/'
 hostname = socket.gethostname().partition(".")[0]
+CPU_FIELDS = ["user","nice","system","idle","iowait","irq","softirq"]
 
 def listtocsv(lists):
     log = ''
@@ -68,181 +67,176 @@ def update_results(lists):
     with open(os.path.join(homepath,datadir+"previous_results.json"),'w') as f:
         json.dump(lists,f)
 
-def init_previous_results():
-    first_result = {}
-    for eachfile in filenames:
-        if(eachfile == "cpumetrics.txt"):
-            get_cpuusage(eachfile, tokens, first_result)
-        else:
-            txt_file = open(os.path.join(homepath,datadir,eachfile))
-            lines = txt_file.read().split("\n")
-            for eachline in lines:
-                tokens = eachline.split("=")
-                if(len(tokens) == 1):
-                    continue
-                if(tokens[1].isdigit() is False):
-                    continue
-                if(eachfile == "diskmetrics.txt"):
-                    tokens[1] = float(float(tokens[1])*512/(1024*1024))
-                elif(eachfile == "diskusedmetrics.txt" or eachfile == "memmetrics.txt"):
-                    tokens[1] = float(float(tokens[1])/1024)
-                elif eachfile == "diskpercent.txt":
-                    tokens[1] = float(tokens[1])
-                elif(eachfile == "networkmetrics.txt" or eachfile == "networkinterfacemetrics.txt"):#Change
-                    tokens[1] = float(float(tokens[1])/(1024*1024))
-                first_result[tokens[0]] = float(tokens[1])
-    update_results(first_result)
-    time.sleep(1)
-    proc = subprocess.Popen([os.path.join(homepath,"proc","getmetrics.sh")], cwd=homepath, stdout=subprocess.PIPE, shell=True)
-    (out,err) = proc.communicate()
-
 def get_previous_results():
     with open(os.path.join(homepath,datadir+"previous_results.json"),'r') as f:
         return json.load(f)
 
-def check_delta(field):
-#     print field
+def get_delta_fields():
     with open(os.path.join(homepath,"reporting_config.json"),'r') as f:
         config_lists = json.load(f)
-    deltaFields = config_lists['delta_fields']
-    for eachfield in deltaFields:
-        print eachfield
-        if(eachfield == field):
-#             print field + " " +eachfield
-            return True
-        elif(eachfield in field):
-            print field + " " +eachfield
+    return config_lists['delta_fields']
+
+def check_delta(field, delta_fields):
+    for eachfield in delta_fields:
+        if(eachfield == field or eachfield in field):
             return True
     return False
 
-def calculate_delta(fieldname,value):
-#     print fieldname
-    previous_result = get_previous_results()
-    if fieldname in previous_result.keys():
-        delta = float(value) - previous_result[fieldname]
-    else:
-        delta = float(value)
-    delta = abs(delta)
-    return round(delta,4)
+def read_proc_file(filename):
+    with open(os.path.join("/proc",filename)) as f:
+        return f.read().split("\n")
 
+def get_cpu_metrics(metrics):
+    # per-core counters from /proc/stat, the usage is worked out in calculate_values
+    cpu_usage = {}
+    for eachline in read_proc_file("stat"):
+        tokens = eachline.split()
+        if len(tokens) < 8 or not tokens[0].startswith("cpu") or not tokens[0][3:].isdigit():
+            continue
+        cpu_usage[tokens[0]] = dict(zip(CPU_FIELDS, [float(token) for token in tokens[1:8]]))
+    metrics["cpu_usage"] = cpu_usage
+    metrics["CPU"] = None
 
-def calculate_cpudelta(current_result):
-    previous_result = get_previous_results()
-    prev_cpu_usage = previous_result["cpu_usage"]
-    totalresult = 0
-    for eachcpu in prev_cpu_usage:
-        prev_total = 0
-        curr_total = 0
-        for eachmetric in prev_cpu_usage[eachcpu]:
-            prev_total += prev_cpu_usage[eachcpu][eachmetric]
-        for eachmetric in current_result[eachcpu]:
-            curr_total += current_result[eachcpu][eachmetric]
-        prev_idle = prev_cpu_usage[eachcpu]["idle"] + prev_cpu_usage[eachcpu]["iowait"]
-        curr_idle = current_result[eachcpu]["idle"] + current_result[eachcpu]["iowait"]
-        if((curr_total - prev_total) == 0):
-            result = 0
-        else:
-            result = (1-round((curr_idle - prev_idle)/(curr_total - prev_total),4))*100
-        result = abs(result)
-        totalresult += float(result)
-    return totalresult
+def get_disk_metrics(metrics):
+    # sectors read & written by whole disks (not partitions), as MB
+    read_sectors = 0
+    write_sectors = 0
+    for eachline in read_proc_file("diskstats"):
+        tokens = eachline.split()
+        if len(tokens) < 10 or any(c.isdigit() for c in tokens[2]):
+            continue
+        read_sectors += int(tokens[5])
+        write_sectors += int(tokens[9])
+    metrics["DiskRead"] = float(read_sectors)*512/(1024*1024)
+    metrics["DiskWrite"] = float(write_sectors)*512/(1024*1024)
+
+def get_diskused_metrics(metrics):
+    # df is the only metric not read from /proc, and runs once for every filesystem
+    proc = subprocess.Popen(["df","-kP"], stdout=subprocess.PIPE)
+    (out,err) = proc.communicate()
+    disk_percent = 0
+    for eachline in out.split("\n")[1:]:
+        tokens = eachline.split()
+        if len(tokens) < 6 or not tokens[1].isdigit() or not tokens[2].isdigit():
+            continue
+        metrics["DiskUsed"+tokens[5]] = float(tokens[2])/1024
+        if tokens[5] == "/" and int(tokens[1]) != 0:
+            disk_percent = float(tokens[2])*100/int(tokens[1])
+    metrics["DiskUsed"] = disk_percent
 
-def get_cpuusage(filename,field_values,which_dict):
-    cpuusage_file = open(os.path.join(homepath,datadir,filename))
-    lines = cpuusage_file.read().split("\n")
-    cpu_dict={}
-    if len(lines) == 1:
-        return
-    cpu_count = multiprocessing.cpu_count()
-    for i in range(0,cpu_count):
-        cpucore = "cpu"+str(i)
-        cpu_dict[cpucore] = {}
-    for eachline in lines:
-        tokens_split = eachline.split("=")
-        if(len(tokens_split) == 1):
+def get_network_metrics(metrics):
+    # totals first, then each interface, all as MB
+    interfaces = []
+    for eachline in read_proc_file("net/dev"):
+        if ":" not in eachline:
             continue
-        cpucoresplit = tokens_split[0].split("$")
-        cpu_dict[cpucoresplit[0]][cpucoresplit[1]] = float(tokens_split[1])
-    totalresult = 0
-    for i in range(0,cpu_count):
-        cpucore = "cpu"+str(i)
-        which_dict["cpu_usage"] = cpu_dict
-        Total = cpu_dict[cpucore]["user"] + cpu_dict[cpucore]["nice"] + cpu_dict[cpucore]["system"] + cpu_dict[cpucore]["idle"] + cpu_dict[cpucore]["iowait"] + cpu_dict[cpucore]["irq"] + cpu_dict[cpucore]["softirq"]
-        idle = cpu_dict[cpucore]["idle"] + cpu_dict[cpucore]["iowait"]
-        field_values[0] = "CPU"
-        result = 1 - round(float(idle/Total),4)
-        totalresult += float(result)
-    field_values.append(totalresult*100)
+        name, counters = eachline.split(":",1)
+        interfaces.append((name.strip(), [float(counter)/(1024*1024) for counter in counters.split()]))
+    metrics["NetworkIn"] = sum(counters[0] for name, counters in interfaces)
+    metrics["NetworkOut"] = sum(counters[8] for name, counters in interfaces)
+    for name, counters in interfaces:
+        metrics["InOctets-"+name] = counters[0]
+        metrics["OutOctets-"+name] = counters[8]
+        metrics["InErrors-"+name] = counters[2]
+        metrics["OutErrors-"+name] = counters[10]
+        metrics["InDiscards-"+name] = counters[3]
+        metrics["OutDiscards-"+name] = counters[11]
+
+def get_mem_metrics(metrics):
+    # as MB
+    meminfo = {}
+    for eachline in read_proc_file("meminfo"):
+        tokens = eachline.replace(":"," ").split()
+        if len(tokens) >= 2:
+            meminfo[tokens[0]] = float(tokens[1])/1024
+    metrics["MemUsed"] = meminfo.get("MemTotal",0) - meminfo.get("MemFree",0)
+    metrics["MemTotal"] = meminfo.get("MemTotal",0)
+    metrics["SharedMem"] = meminfo.get("Shmem",0)
+    metrics["SwapUsed"] = meminfo.get("SwapTotal",0) - meminfo.get("SwapFree",0)
+    metrics["SwapTotal"] = meminfo.get("SwapTotal",0)
+
+def get_loadavg_metrics(metrics):
+    tokens = read_proc_file("loadavg")[0].split()
+    metrics["LoadAvg1"] = float(tokens[0])
+    metrics["LoadAvg5"] = float(tokens[1])
+    metrics["LoadAvg15"] = float(tokens[2])
+
+def get_metrics():
+    """ sample everything once, in the order of the csv columns """
+    metrics = collections.OrderedDict()
+    metrics["timestamp"] = str(int(time.time()*1000))
+    get_cpu_metrics(metrics)
+    get_disk_metrics(metrics)
+    get_diskused_metrics(metrics)
+    get_network_metrics(metrics)
+    get_mem_metrics(metrics)
+    get_loadavg_metrics(metrics)
+    return metrics
 
-def is_number(s):
-    try:
-        float(s)
-        return True
-    except ValueError:
-        return False
+def get_cpu_percent(cpu):
+    total = sum(cpu[eachmetric] for eachmetric in CPU_FIELDS)
+    idle = cpu["idle"] + cpu["iowait"]
+    return (1 - round(idle/total,4))*100
+
+def get_cpudelta_percent(prev_cpu, curr_cpu):
+    total = sum(curr_cpu[eachmetric] for eachmetric in CPU_FIELDS) - sum(prev_cpu.values())
+    idle = (curr_cpu["idle"] + curr_cpu["iowait"]) - (prev_cpu["idle"] + prev_cpu["iowait"])
+    if total == 0:
+        return 0
+    return abs((1-round(idle/total,4))*100)
+
+def calculate_values(metrics, previous_result, delta_fields):
+    """ work out every csv value and the counters to save for the next run, in one pass """
+    current_result = {"cpu_usage": metrics["cpu_usage"]}
+    values = []
+    for field, value in metrics.items():
+        if field == "cpu_usage":
+            continue
+        if field == "timestamp":
+            values.append(value)
+            current_result[field] = float(value)
+        elif field == "CPU":
+            if check_delta(field, delta_fields):
+                prev_cpu_usage = previous_result["cpu_usage"]
+                values.append(sum(get_cpudelta_percent(prev_cpu_usage[eachcpu], metrics["cpu_usage"][eachcpu])
+                                  for eachcpu in prev_cpu_usage if eachcpu in metrics["cpu_usage"]))
+            else:
+                value = sum(get_cpu_percent(cpu) for cpu in metrics["cpu_usage"].values())
+                values.append(value)
+                current_result[field] = value
+        elif check_delta(field, delta_fields):
+            # actual values are saved, not deltas
+            values.append(round(abs(value - previous_result.get(field,0)),4))
+            current_result[field] = value
+        else:
+            values.append(round(value,4))
+            current_result[field] = value
+    return values, current_result
 
-filenames = ["timestamp.txt", "cpumetrics.txt","diskmetrics.txt","diskusedmetrics.txt","diskpercent.txt","networkmetrics.txt","networkinterfacemetrics.txt","memmetrics.txt","loadavg.txt"]
-fields = []
 try:
     date = time.strftime("%Y%m%d")
     resource_usage_file = open(os.path.join(homepath,datadir+date+".csv"),'a+')
     csvContent = resource_usage_file.readlines()
     numlines = len(csvContent)
-    values = []
-    dict = {}
-    proc = subprocess.Popen([os.path.join(homepath,"proc","getmetrics.sh")], cwd=homepath, stdout=subprocess.PIPE, shell=True)
-    (out,err) = proc.communicate()
+    delta_fields = get_delta_fields()
+    metrics = get_metrics()
 
     if(os.path.isfile(homepath+"/"+datadir+"previous_results.json") == False):
-        init_previous_results()
-
-    tokens = []
-    for eachfile in filenames:
-        if(eachfile == "cpumetrics.txt"):
-            get_cpuusage(eachfile, tokens,dict)
-            groupid = getindex(tokens[0])
-            field = tokens[0]+"["+hostname+"]:"+str(groupid)
-            fields.append(field)
-            if(check_delta(tokens[0]) is True):
-                deltaValue = calculate_cpudelta(dict["cpu_usage"])
-                values.append(deltaValue)
-            else:
-               values.append(tokens[1])
-               dict[tokens[0]] = float(tokens[1])
-        else:
-            txt_file = open(os.path.join(homepath,datadir,eachfile))
-            lines = txt_file.read().split("\n")
-            for eachline in lines:
-                tokens = eachline.split("=")
-                if(len(tokens) == 1):
-                    continue
-                if(tokens[0] != "timestamp"):
-                    groupid = getindex(tokens[0])
-                    field = tokens[0]+"["+hostname+"]:"+str(groupid)
-                else:
-                    field = tokens[0]
+        # first run: deltas are against a sample taken a second earlier
+        previous_result = calculate_values(metrics, {}, [])[1]
+        time.sleep(1)
+        metrics = get_metrics()
+    else:
+        previous_result = get_previous_results()
 
-                if not is_number(tokens[1]):
-                    continue
-                fields.append(field)
-                if(eachfile == "diskmetrics.txt"):
-                    tokens[1] = float(float(tokens[1])*512/(1024*1024))
-                elif(eachfile == "diskusedmetrics.txt" or eachfile == "memmetrics.txt"):
-                    tokens[1] = float(float(tokens[1])/1024)
-                elif eachfile == "diskpercent.txt":
-                    tokens[1] = float(tokens[1])
-                elif(eachfile == "networkmetrics.txt" or eachfile == "networkinterfacemetrics.txt"):#Change
-                    tokens[1] = float(float(tokens[1])/(1024*1024))
-                if check_delta(tokens[0]) is True:
-                    deltaValue = calculate_delta(tokens[0],tokens[1])
-                    values.append(deltaValue)
-                    dict[tokens[0]] = float(tokens[1]) # Actual values need to be stored in dict and not delta values
-                else:
-                    if(tokens[0] == "timestamp"):
-                        values.append(tokens[1])
-                    else:
-                        values.append(round(float(tokens[1]),4))
-                    dict[tokens[0]] = float(tokens[1])
+    values, current_result = calculate_values(metrics, previous_result, delta_fields)
+    fields = []
+    for field in metrics:
+        if field == "cpu_usage":
+            continue
+        if field != "timestamp":
+            field = field+"["+hostname+"]:"+str(getindex(field))
+        fields.append(field)
 
     if(numlines < 1):
         listtocsv(fields)
@@ -260,8 +254,6 @@ try:
     listtocsv(values)
     resource_usage_file.flush()
     resource_usage_file.close()
-    update_results(dict)
+    update_results(current_result)
 except KeyboardInterrupt:
     print "Interrupt from keyboard"
-
-
@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 import configparser
 import json
+import zlib
 import logging
 import os
 import regex
 import socket
 import sys
+import threading
 import time
 import pytz
 import arrow
@@ -17,6 +19,7 @@ import traceback
 import sqlite3
 from sys import getsizeof
 from itertools import chain
+from collections import OrderedDict
 from optparse import OptionParser
 from multiprocessing.pool import ThreadPool
 
@@ -28,13 +31,12 @@ This script gathers data to send to Insightfinder
 def initialize_cache_connection():
     # connect to local cache
     cache_loc = abs_path_from_cur(CACHE_NAME)
-    if os.path.exists(cache_loc):
-        cache_con = sqlite3.connect(cache_loc)
-        cache_cur = cache_con.cursor()
-    else:
-        cache_con = sqlite3.connect(cache_loc)
-        cache_cur = cache_con.cursor()
-        cache_cur.execute('CREATE TABLE "cache" ( "instance"	TEXT NOT NULL UNIQUE, "alias"	TEXT NOT NULL)')
+    cache_con = sqlite3.connect(cache_loc)
+    cache_cur = cache_con.cursor()
+    # let other agent processes read the cache while one writes to it
+    cache_cur.execute('PRAGMA journal_mode=WAL')
+    cache_cur.execute(
+        'CREATE TABLE IF NOT EXISTS "cache" ( "instance"	TEXT NOT NULL UNIQUE, "alias"	TEXT NOT NULL)')
 
     return cache_con, cache_cur
 
@@ -87,7 +89,39 @@ def start_data_processing():
     # parse sql string by params
     pool_map = ThreadPool(agent_config_vars['thread_pool'])
     logger.debug('history range config: {}'.format(agent_config_vars['his_time_range']))
-    if agent_config_vars['his_time_range']:
+    if agent_config_vars['his_time_range'] and agent_config_vars['his_query_window']:
+        logger.debug('Using range queries for replay data')
+        windows = get_query_windows(agent_config_vars['his_time_range'][0],
+                                    agent_config_vars['his_time_range'][1],
+                                    agent_config_vars['his_query_window'],
+                                    if_config_vars['sampling_interval'])
+        # fetch enough windows at once to keep the pool busy, then flush them
+        windows_per_batch = max(1, agent_config_vars['thread_pool'] // len(metrics))
+        for i in range(0, len(windows), windows_per_batch):
+            batch = windows[i:i + windows_per_batch]
+            logger.info('Querying range {} to {}'.format(
+                arrow.get(batch[0][0]).format(), arrow.get(batch[-1][1]).format()))
+            params = [(m, {
+                'query': get_query_uri(m),
+                'start': start,
+                'end': end,
+                'step': if_config_vars['sampling_interval'],
+            }) for (start, end) in batch for m in metrics]
+
+            # parse each matrix as it arrives instead of waiting for the whole batch. a batch
+            # holds a window of every series, so send what was parsed once the buffer is full
+            count = 0
+            for result in pool_map.imap_unordered(query_messages_prometheus, params):
+                for message in result:
+                    count += parse_message_prometheus(message)
+                if metric_buffer['buffer_size'] >= agent_config_vars['metric_buffer_size']:
+                    logger.debug('Metric buffer is full, sending it')
+                    clear_metric_buffer()
+            logger.info('Parse {0} messages'.format(count))
+
+            # clear metric buffer when piece of time range end
+            clear_metric_buffer()
+    elif agent_config_vars['his_time_range']:
         logger.debug('Using time range for replay data')
         for timestamp in range(agent_config_vars['his_time_range'][0],
                                agent_config_vars['his_time_range'][1],
@@ -116,11 +150,23 @@ def start_data_processing():
         result_list = list(chain(*results))
         parse_messages_prometheus(result_list)
 
+    pool_map.close()
+    write_new_aliases()
     cache_con.close()
 
     logger.info('Closed......')
 
 
+def get_query_windows(start_time, end_time, window, step):
+    """ split [start_time, end_time) into windows of whole steps, as (start, end) pairs """
+    # prometheus rejects range queries returning more than 11000 points per series
+    points = max(1, min(window // step, 11000))
+    window = points * step
+
+    # end is inclusive for prometheus, so stop just short of the next window
+    return [(start, min(start + window, end_time) - 1) for start in range(start_time, end_time, window)]
+
+
 def query_messages_prometheus(args):
     metric, params = args
     logger.info('Starting query metric: ' + metric)
@@ -128,7 +174,8 @@ def query_messages_prometheus(args):
     data = []
     try:
         # execute sql string
-        url = urllib.parse.urljoin(agent_config_vars['api_url'], 'query')
+        endpoint = 'query_range' if 'step' in params else 'query'
+        url = urllib.parse.urljoin(agent_config_vars['api_url'], endpoint)
         response = send_request(url, params=params, proxies=agent_config_vars['proxies'])
         if response == -1:
             logger.error('Query metric error: ' + metric)
@@ -154,48 +201,61 @@ def parse_messages_prometheus(result):
     logger.info('Reading {} messages'.format(len(result)))
 
     for message in result:
-        try:
-            logger.debug(message)
-
-            # date_field = message.get('metric').get('__name__')
-            date_field = message.get('metric_name')
-
-            # get metric name from `metrics_name_field`
-            if agent_config_vars['metrics_name_field']:
-                name_fields = [message.get('metric').get(f) for f in agent_config_vars['metrics_name_field'] or []]
-                name_fields = [f for f in name_fields if f]
-                if len(name_fields) > 0:
-                    date_field = '_'.join(name_fields)
-
-            instance = message.get('metric').get(
-                agent_config_vars['instance_field'][0] if agent_config_vars['instance_field'] and len(
-                    agent_config_vars['instance_field']) > 0 else 'instance')
-
-            # filter by instance whitelist
-            if agent_config_vars['instance_whitelist_regex'] \
-                    and not agent_config_vars['instance_whitelist_regex'].match(instance):
-                continue
-
-            # add device info if has
-            device = None
-            device_field = agent_config_vars['device_field']
-            if device_field and len(device_field) > 0:
-                devices = [message.get('metric').get(d) for d in device_field]
-                devices = [d for d in devices if d]
-                device = devices[0] if len(devices) > 0 else None
-            full_instance = make_safe_instance_string(instance, device)
-
-            # check cache for alias
-            full_instance = get_alias_from_cache(full_instance)
-
-            # get component, and build component instance map info
-            component_map = None
-            if agent_config_vars['component_field']:
-                component = message.get('metric').get(agent_config_vars['component_field'])
-                if component:
-                    component_map = {"instanceName": full_instance, "componentName": component}
-
-            vector_value = message.get('value')
+        parsed = parse_message_prometheus(message)
+        count += parsed
+        if parsed and count % 1000 == 0:
+            logger.info('Parse {0} messages'.format(count))
+    logger.info('Parse {0} messages'.format(count))
+
+
+def parse_message_prometheus(message):
+    """ parse a vector or matrix result into the metric buffer, returning the number of values parsed """
+    try:
+        logger.debug(message)
+
+        # date_field = message.get('metric').get('__name__')
+        date_field = message.get('metric_name')
+
+        # get metric name from `metrics_name_field`
+        if agent_config_vars['metrics_name_field']:
+            name_fields = [message.get('metric').get(f) for f in agent_config_vars['metrics_name_field'] or []]
+            name_fields = [f for f in name_fields if f]
+            if len(name_fields) > 0:
+                date_field = '_'.join(name_fields)
+
+        instance = message.get('metric').get(
+            agent_config_vars['instance_field'][0] if agent_config_vars['instance_field'] and len(
+                agent_config_vars['instance_field']) > 0 else 'instance')
+
+        # filter by instance whitelist
+        if agent_config_vars['instance_whitelist_regex'] \
+                and not agent_config_vars['instance_whitelist_regex'].match(instance):
+            return 0
+
+        # add device info if has
+        device = None
+        device_field = agent_config_vars['device_field']
+        if device_field and len(device_field) > 0:
+            devices = [message.get('metric').get(d) for d in device_field]
+            devices = [d for d in devices if d]
+            device = devices[0] if len(devices) > 0 else None
+        full_instance = make_safe_instance_string(instance, device)
+
+        # check cache for alias
+        full_instance = get_alias_from_cache(full_instance)
+
+        # get component, and build component instance map info
+        component_map = None
+        if agent_config_vars['component_field']:
+            component = message.get('metric').get(agent_config_vars['component_field'])
+            if component:
+                component_map = {"instanceName": full_instance, "componentName": component}
+
+        metric_key = '{}[{}]'.format(date_field, full_instance)
+
+        # instant queries return one value, range queries a list of them
+        values = message.get('values') or [message.get('value')]
+        for vector_value in values:
             timestamp = int(vector_value[0]) * 1000
             data_value = vector_value[1]
 
@@ -206,34 +266,57 @@ def parse_messages_prometheus(result):
             key = '{}-{}'.format(timestamp, full_instance)
             if key not in metric_buffer['buffer_dict']:
                 metric_buffer['buffer_dict'][key] = {"timestamp": timestamp, "component_map": component_map}
+                # '{"timestamp": "<timestamp>"}'
+                metric_buffer['buffer_size'] += len(timestamp) + 17
+            row = metric_buffer['buffer_dict'][key]
+
+            # ', "<metric_key>": "<value>"'
+            value = str(data_value)
+            if metric_key in row:
+                metric_buffer['buffer_size'] -= len(row[metric_key])
+            else:
+                metric_buffer['buffer_size'] += len(metric_key) + 6
+            metric_buffer['buffer_size'] += len(value)
+            row[metric_key] = value
 
-            metric_key = '{}[{}]'.format(date_field, full_instance)
-            metric_buffer['buffer_dict'][key][metric_key] = str(data_value)
+    except Exception as e:
+        logger.warn('Error when parsing message')
+        logger.warn(e)
+        logger.debug(traceback.format_exc())
+        return 0
 
-        except Exception as e:
-            logger.warn('Error when parsing message')
-            logger.warn(e)
-            logger.debug(traceback.format_exc())
-            continue
-
-        track['entry_count'] += 1
-        count += 1
-        if count % 1000 == 0:
-            logger.info('Parse {0} messages'.format(count))
-    logger.info('Parse {0} messages'.format(count))
+    track['entry_count'] += len(values)
+    return len(values)
 
 
 def get_alias_from_cache(alias):
     if cache_cur:
-        cache_cur.execute('select alias from cache where instance="%s"' % alias)
+        # recently used aliases are kept in memory
+        if alias in alias_cache:
+            alias_cache.move_to_end(alias)
+            return alias_cache[alias]
+
+        cache_cur.execute('select alias from cache where instance = ?', (alias,))
         instance = cache_cur.fetchone()
         if instance:
-            return instance[0]
+            instance = instance[0]
         else:
-            # Hard coded if alias hasn't been added to cache, add it 
-            cache_cur.execute('insert into cache (instance, alias) values ("%s", "%s")' % (alias, alias))
-            cache_con.commit()
-            return alias
+            # Hard coded if alias hasn't been added to cache, add it with the next chunk
+            new_aliases.append((alias, alias))
+            instance = alias
+
+        alias_cache[alias] = instance
+        if len(alias_cache) > ALIAS_CACHE_SIZE:
+            alias_cache.popitem(last=False)
+        return instance
+
+
+def write_new_aliases():
+    """ add the aliases seen since the last chunk to the cache, in one transaction """
+    if new_aliases:
+        cache_cur.executemany('insert or ignore into cache (instance, alias) values (?, ?)', new_aliases)
+        cache_con.commit()
+        del new_aliases[:]
 
 
 def get_agent_config_vars():
@@ -255,6 +338,7 @@ def get_agent_config_vars():
         instance_whitelist = ''
         instance_whitelist_regex = None
         his_time_range = None
+        his_query_window = None
         try:
             # prometheus settings
             prometheus_config = {}
@@ -281,6 +365,10 @@ def get_agent_config_vars():
 
             # time range
             his_time_range = config_parser.get('prometheus', 'his_time_range')
+            his_query_window = config_parser.get('prometheus', 'his_query_window') if config_parser.has_option(
+                'prometheus', 'his_query_window') else ''
+            metric_buffer_size_mb = config_parser.get('prometheus', 'metric_buffer_size_mb') if \
+                config_parser.has_option('prometheus', 'metric_buffer_size_mb') else ''
 
             # proxies
             agent_http_proxy = config_parser.get('prometheus', 'agent_http_proxy')
@@ -325,6 +413,13 @@ def get_agent_config_vars():
             his_time_range = [x for x in his_time_range.split(',') if x.strip()]
             his_time_range = [int(arrow.get(x).float_timestamp) for x in his_time_range]
 
+        if len(his_query_window) == 0:
+            his_query_window = 360 * 60
+        elif his_query_window.endswith('s'):
+            his_query_window = int(his_query_window[:-1])
+        else:
+            his_query_window = int(his_query_window) * 60
+
         if len(target_timestamp_timezone) != 0:
             target_timestamp_timezone = int(arrow.now(target_timestamp_timezone).utcoffset().total_seconds())
         else:
@@ -389,6 +484,8 @@ def get_agent_config_vars():
             'metrics_whitelist_with_function': metrics_whitelist_with_function,
             'metrics_name_field': metrics_name_field,
             'his_time_range': his_time_range,
+            'his_query_window': his_query_window,
+            'metric_buffer_size': int(metric_buffer_size_mb or 10) * 1024 * 1024,  # as bytes
 
             'proxies': agent_proxies,
             'data_format': data_format,
@@ -431,6 +528,14 @@ def get_if_config_vars():
             if_url = config_parser.get('insightfinder', 'if_url')
             if_http_proxy = config_parser.get('insightfinder', 'if_http_proxy')
             if_https_proxy = config_parser.get('insightfinder', 'if_https_proxy')
+            if_pool_size = config_parser.get('insightfinder', 'if_pool_size') if config_parser.has_option(
+                'insightfinder', 'if_pool_size') else ''
+            if_compress = config_parser.get('insightfinder', 'if_compress') if config_parser.has_option(
+                'insightfinder', 'if_compress') else ''
+            spool_dir = config_parser.get('insightfinder', 'spool_dir') if config_parser.has_option(
+                'insightfinder', 'spool_dir') else ''
+            spool_size_mb = config_parser.get('insightfinder', 'spool_size_mb') if config_parser.has_option(
+                'insightfinder', 'spool_size_mb') else ''
         except configparser.NoOptionError as cp_noe:
             logger.error(cp_noe)
             config_error()
@@ -504,6 +609,10 @@ def get_if_config_vars():
             'chunk_size': int(chunk_size_kb) * 1024,  # as bytes
             'if_url': if_url,
             'if_proxies': if_proxies,
+            'if_pool_size': int(if_pool_size or 10),
+            'if_compress': if_compress.upper() == 'TRUE',
+            'spool_dir': abs_path_from_cur(spool_dir or 'spool'),
+            'spool_size': int(spool_size_mb or 100) * 1024 * 1024,  # as bytes
             'is_replay': is_replay
         }
 
@@ -676,11 +785,15 @@ def initialize_data_gathering():
     track['chunk_count'] = 0
     track['entry_count'] = 0
 
+    start_spool_replayer()
+
     start_data_processing()
 
     # clear metric buffer when data processing end
     clear_metric_buffer()
 
+    stop_spool_replayer()
+
     logger.info('Total chunks created: ' + str(track['chunk_count']))
     logger.info('Total {} entries: {}'.format(
         if_config_vars['project_type'].lower(), track['entry_count']))
@@ -715,6 +828,8 @@ def reset_metric_buffer():
     metric_buffer['buffer_key_list'] = []
     metric_buffer['buffer_ts_list'] = []
     metric_buffer['buffer_dict'] = {}
+    # roughly the serialized size of buffer_dict
+    metric_buffer['buffer_size'] = 0
 
     metric_buffer['buffer_collected_list'] = []
     metric_buffer['buffer_collected_dict'] = {}
@@ -738,6 +853,7 @@ def send_data_wrapper():
     send_data_to_if(track['current_row'])
     track['chunk_count'] += 1
     reset_track()
+    write_new_aliases()
 
 
 def send_data_to_if(chunk_metric_data):
@@ -765,24 +881,236 @@ def send_data_to_if(chunk_metric_data):
 
     # send the data
     post_url = urllib.parse.urljoin(if_config_vars['if_url'], get_api_from_project_type())
-    send_request(post_url, 'POST', 'Could not send request to IF',
-                 str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
-                 data=data_to_post, verify=False, proxies=if_config_vars['if_proxies'])
+    post_data, post_headers = get_post_body(data_to_post)
+    response = send_request(post_url, 'POST', 'Could not send request to IF',
+                            str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
+                            data=post_data, headers=post_headers, verify=False, proxies=if_config_vars['if_proxies'])
+    if response == -1:
+        spool_chunk(post_url, data_to_post)
     logger.info('--- Send data time: %s seconds ---' % round(time.time() - send_data_time, 2))
 
 
+def start_spool_replayer():
+    """ start the thread that re-sends spooled chunks once IF is reachable again """
+    spool['lock'] = threading.Lock()
+    spool['stop'] = threading.Event()
+    spool['segment'] = None
+    spool['thread'] = None
+    if if_config_vars['spool_size'] == 0 or cli_config_vars['testing']:
+        return
+    if not os.path.isdir(if_config_vars['spool_dir']):
+        os.makedirs(if_config_vars['spool_dir'])
+    recover_spool_segments()
+    spool['thread'] = threading.Thread(target=replay_spool, name='spool-replay')
+    spool['thread'].daemon = True
+    spool['thread'].start()
+
+
+def stop_spool_replayer():
+    """ stop replaying. anything left in the spool is replayed on the next run """
+    if not spool['thread']:
+        return
+    spool['stop'].set()
+    spool['thread'].join()
+    with spool['lock']:
+        close_spool_segment()
+
+
+def recover_spool_segments():
+    """ release segments left open or half-replayed by agent runs that have exited """
+    for name in os.listdir(if_config_vars['spool_dir']):
+        if name.endswith('.open'):
+            # <ts>-<writer pid>.open
+            owner = name[:-len('.open')].split('-')[-1]
+            closed = name[:-len('.open')] + '.spool'
+        elif name.endswith('.replay'):
+            # <ts>-<writer pid>.spool.<replayer pid>.replay
+            closed, owner, _ = name.rsplit('.', 2)
+        elif name.endswith('.replay.tmp'):
+            # left over from writing back a half-replayed segment
+            owner = name.rsplit('.', 3)[1]
+            if not is_pid_running(int(owner)):
+                os.remove(os.path.join(if_config_vars['spool_dir'], name))
+            continue
+        else:
+            continue
+        if not is_pid_running(int(owner)):
+            os.rename(os.path.join(if_config_vars['spool_dir'], name),
+                      os.path.join(if_config_vars['spool_dir'], closed))
+
+
+def is_pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def get_spool_segments(suffix='.spool'):
+    """ spool segment files, oldest first """
+    return [os.path.join(if_config_vars['spool_dir'], name)
+            for name in sorted(os.listdir(if_config_vars['spool_dir']))
+            if name.endswith(suffix)]
+
+
+def close_spool_segment():
+    """ close the segment this process appends to, making it available for replay """
+    if spool['segment'] and os.path.exists(spool['segment']):
+        os.rename(spool['segment'], spool['segment'][:-len('.open')] + '.spool')
+    spool['segment'] = None
+
+
+def spool_chunk(post_url, data_to_post):
+    """ append a chunk that could not be sent to the spool, dropping the oldest segments over the size cap """
+    if not spool['thread']:
+        return
+    with spool['lock']:
+        if spool['segment'] and os.path.getsize(spool['segment']) >= SPOOL_SEGMENT_SIZE:
+            close_spool_segment()
+        if not spool['segment']:
+            spool['segment'] = os.path.join(if_config_vars['spool_dir'], '{:015d}-{}.open'.format(
+                int(time.time() * 1000), os.getpid()))
+        # only the payload is spooled, the account fields are filled in again on replay
+        account_fields = initialize_api_post_data()
+        payload = dict((key, value) for key, value in data_to_post.items() if key not in account_fields)
+        with open(spool['segment'], 'a') as spool_file:
+            spool_file.write(json.dumps({'url': post_url, 'data': payload}) + '\n')
+        logger.warning('Spooled chunk to {}'.format(spool['segment']))
+
+        # evict oldest first
+        segments = get_spool_segments()
+        spool_size = sum(os.path.getsize(segment) for segment in segments + get_spool_segments('.open'))
+        while spool_size > if_config_vars['spool_size'] and segments:
+            segment = segments.pop(0)
+            spool_size -= os.path.getsize(segment)
+            os.remove(segment)
+            logger.warning('Spool is full, dropped {}'.format(segment))
+
+
+def replay_spool():
+    """ re-send spooled chunks oldest first, backing off exponentially while IF is unreachable """
+    backoff = SPOOL_MIN_BACKOFF
+    while not spool['stop'].is_set():
+        if replay_spool_segment():
+            backoff = SPOOL_MIN_BACKOFF
+        else:
+            spool['stop'].wait(backoff)
+            backoff = min(backoff * 2, SPOOL_MAX_BACKOFF)
+
+
+def replay_spool_segment():
+    """ claim and re-send the oldest spooled segment. returns True if all of it was sent """
+    with spool['lock']:
+        segments = get_spool_segments()
+        if not segments and spool['segment']:
+            close_spool_segment()
+            segments = get_spool_segments()
+        if not segments:
+            return False
+        segment = segments[0]
+        # renaming is atomic, so only one process can claim a segment
+        claimed = '{}.{}.replay'.format(segment, os.getpid())
+        try:
+            os.rename(segment, claimed)
+        except OSError:
+            return False
+
+    with open(claimed) as spool_file:
+        lines = spool_file.readlines()
+    for i, line in enumerate(lines):
+        try:
+            chunk = json.loads(line)
+        except ValueError:
+            logger.warning('Skipping corrupt line in {}'.format(segment))
+            continue
+        if spool['stop'].is_set() or not send_spooled_chunk(chunk):
+            # put back what wasn't sent
+            try:
+                with open(claimed + '.tmp', 'w') as spool_file:
+                    spool_file.writelines(lines[i:])
+                os.rename(claimed + '.tmp', segment)
+            except (IOError, OSError) as e:
+                logger.warning('Could not write back {}, it is replayed in full on the next run'.format(segment))
+                logger.warning(e)
+                if os.path.exists(claimed + '.tmp'):
+                    os.remove(claimed + '.tmp')
+                return False
+            os.remove(claimed)
+            return False
+    os.remove(claimed)
+    logger.info('Replayed {} spooled chunks from {}'.format(len(lines), segment))
+    return True
+
+
+def send_spooled_chunk(chunk):
+    """ re-send a spooled chunk. returns False if it should be tried again later """
+    data_to_post = initialize_api_post_data()
+    data_to_post.update(chunk['data'])
+    post_data, post_headers = get_post_body(data_to_post)
+    # the replayer backs off between attempts, so post once rather than through send_request
+    try:
+        response = get_request_session().post(chunk['url'], data=post_data, headers=post_headers, verify=False,
+                                              proxies=if_config_vars['if_proxies'])
+    except requests.exceptions.RequestException as e:
+        logger.warning('Could not re-send spooled chunk to IF')
+        logger.warning(e)
+        return False
+    if response.status_code == http.client.OK:
+        logger.info('Re-sent a spooled chunk.')
+        return True
+    if 400 <= response.status_code < 500 and response.status_code not in SPOOL_RETRYABLE_STATUS:
+        # IF will never accept this chunk, so drop it rather than hold up the rest of the spool
+        logger.warning('IF rejected a spooled chunk, dropping it. Response Code: {}\nTEXT: {}'.format(
+            response.status_code, response.text))
+        return True
+    logger.warning('Could not re-send spooled chunk to IF. Response Code: {}'.format(response.status_code))
+    return False
+
+
+def get_post_body(data_to_post):
+    """ get the body and headers to post data_to_post with, gzipped if configured """
+    if not if_config_vars['if_compress']:
+        return data_to_post, None
+    return gzip_compress(urllib.parse.urlencode(data_to_post).encode('utf-8')), {'Content-Type': 'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'}
+
+
+def get_request_session():
+    """ get this thread's pooled session, so connections are reused between requests """
+    # requests.Session is not thread-safe, so each thread gets its own
+    pid = (os.getpid(), threading.current_thread().ident)
+    if pid not in SESSIONS:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=if_config_vars['if_pool_size'],
+                                                pool_maxsize=if_config_vars['if_pool_size'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        SESSIONS[pid] = session
+    return SESSIONS[pid]
+
+
+def gzip_compress(data):
+    """ gzip a request body """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
 def send_request(url, mode='GET', failure_message='Failure!', success_message='Success!', **request_passthrough):
     """ sends a request to the given url """
     # determine if post or get (default)
     requests.packages.urllib3.disable_warnings()
-    req = requests.get
+    session = get_request_session()
+    req = session.get
     if mode.upper() == 'POST':
-        req = requests.post
+        req = session.post
 
     req_num = 0
     for req_num in range(ATTEMPTS):
         try:
+            request_time = time.time()
             response = req(url, **request_passthrough)
+            logger.debug('Request took {} seconds, {} bytes sent, {} bytes received'.format(
+                round(time.time() - request_time, 3), len(response.request.body or ''), len(response.content)))
             if response.status_code == http.client.OK:
                 return response
             else:
@@ -904,8 +1232,17 @@ if __name__ == "__main__":
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = r",|\t"
     ATTEMPTS = 3
+    SESSIONS = dict()
+    SPOOL_SEGMENT_SIZE = 8 * 1024 * 1024
+    SPOOL_MIN_BACKOFF = 1
+    SPOOL_MAX_BACKOFF = 300
+    SPOOL_RETRYABLE_STATUS = (408, 429)
     CACHE_NAME = 'cache.db'
+    ALIAS_CACHE_SIZE = 100000
     track = dict()
+    alias_cache = OrderedDict()
+    new_aliases = []
+    spool = dict()
     metric_buffer = dict()
 
     # get config
@@ -0,0 +1,185 @@
+"""
+Tests for the history replay in getmessages_prometheus-new.py, against a local HTTP server standing in for
+both Prometheus and InsightFinder.
+
+    python3 test_prometheus.py
+"""
+
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+import urllib.parse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import regex
+
+spec = importlib.util.spec_from_file_location('agent', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                    'getmessages_prometheus-new.py'))
+agent = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(agent)
+
+START = 1600000000
+STEP = 60
+WINDOW = 3600
+WINDOWS = 6
+METRICS = ['cpu', 'mem', 'disk', 'net']
+SERIES = 20
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ answers range queries with a value per series per step, and records the rows posted to IF """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+        start, end, step = int(params['start']), int(params['end']), int(params['step'])
+        result = [{'metric': {'instance': 'host-{}'.format(series)},
+                   'values': [[timestamp, str(series)] for timestamp in range(start, end + 1, step)]}
+                  for series in range(SERIES)]
+        self.reply(200, json.dumps({'status': 'success', 'data': {'resultType': 'matrix', 'result': result}}))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        post = dict(urllib.parse.parse_qsl(body.decode()))
+        with self.server.lock:
+            self.server.rows.extend(json.loads(post['metricData']))
+        self.reply(200, '')
+
+    def reply(self, status, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class RangeReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.server.lock = threading.Lock()
+        self.server.rows = []
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        self.work_dir = tempfile.mkdtemp()
+        url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        agent.logger = logging.getLogger('test_prometheus')
+        agent.logger.addHandler(logging.NullHandler())
+        agent.UNDERSCORE = regex.compile(r"\_+")
+        agent.COLONS = regex.compile(r"\:+")
+        agent.LEFT_BRACE = regex.compile(r"\[")
+        agent.RIGHT_BRACE = regex.compile(r"\]")
+        agent.PERIOD = regex.compile(r"\.")
+        agent.HOSTNAME = 'test-host'
+        agent.ATTEMPTS = 1
+        agent.SESSIONS = dict()
+        agent.ALIAS_CACHE_SIZE = 100000
+        agent.track = dict()
+        agent.alias_cache = OrderedDict()
+        agent.new_aliases = []
+        agent.spool = dict()
+        agent.metric_buffer = dict()
+        agent.cache_con = sqlite3.connect(':memory:')
+        agent.cache_cur = agent.cache_con.cursor()
+        agent.cache_cur.execute('CREATE TABLE "cache" ("instance" TEXT NOT NULL UNIQUE, "alias" TEXT NOT NULL)')
+        agent.cli_config_vars = {'testing': False}
+        agent.if_config_vars = {
+            'user_name': 'user',
+            'license_key': 'key',
+            'project_name': 'project',
+            'project_type': 'METRICREPLAY',
+            'is_replay': True,
+            'sampling_interval': STEP,
+            'chunk_size': 2 * 1024 * 1024,
+            'if_url': url,
+            'if_proxies': dict(),
+            'if_pool_size': 4,
+            'if_compress': False,
+            'spool_dir': os.path.join(self.work_dir, 'spool'),
+            'spool_size': 0,
+        }
+        agent.agent_config_vars = {
+            'api_url': url + '/api/v1/',
+            'proxies': dict(),
+            'metrics': list(METRICS),
+            'metrics_whitelist': '',
+            'metrics_whitelist_with_function': '',
+            'metrics_to_ignore': [],
+            'metrics_name_field': [],
+            'query_label_selector': '',
+            'query_with_function': '',
+            'instance_field': ['instance'],
+            'instance_whitelist_regex': None,
+            'device_field': [],
+            'component_field': '',
+            'target_timestamp_timezone': 0,
+            'his_time_range': [START, START + WINDOWS * WINDOW],
+            'his_query_window': WINDOW,
+            'metric_buffer_size': 16 * 1024,
+            'thread_pool': 8,
+        }
+
+        # the largest the buffer gets after each matrix is parsed
+        self.max_rows = 0
+        parse_message_prometheus = agent.parse_message_prometheus
+
+        def measured_parse(message):
+            parsed = parse_message_prometheus(message)
+            self.max_rows = max(self.max_rows, len(agent.metric_buffer['buffer_dict']))
+            return parsed
+        agent.parse_message_prometheus = measured_parse
+        self.addCleanup(setattr, agent, 'parse_message_prometheus', parse_message_prometheus)
+
+    def tearDown(self):
+        for session in agent.SESSIONS.values():
+            session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def posted_values(self):
+        values = set()
+        for row in self.server.rows:
+            for metric_key, value in row.items():
+                if metric_key != 'timestamp':
+                    values.add((row['timestamp'], metric_key, value))
+        return values
+
+    def expected_values(self):
+        return {(str(timestamp * 1000), '{}[host-{}]'.format(metric, series), str(series))
+                for timestamp in range(START, START + WINDOWS * WINDOW, STEP)
+                for metric in METRICS for series in range(SERIES)}
+
+    def test_buffer_stays_bounded_over_the_range(self):
+        agent.initialize_data_gathering()
+        # a query returns a window of one metric, and the buffer is sent once it is full, so it
+        # never holds more than a window's rows, while a batch covers two windows of every metric
+        self.assertLessEqual(self.max_rows, SERIES * WINDOW // STEP)
+        self.assertEqual(self.posted_values(), self.expected_values())
+
+    def test_large_buffer_sends_once_per_batch(self):
+        agent.agent_config_vars['metric_buffer_size'] = 100 * 1024 * 1024
+        agent.initialize_data_gathering()
+        self.assertEqual(self.max_rows, 2 * SERIES * WINDOW // STEP)
+        self.assertEqual(self.posted_values(), self.expected_values())
+
+
+if __name__ == '__main__':
+    unittest.main()
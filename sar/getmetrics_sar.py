@@ -10,7 +10,7 @@ import sys
 import time
 import pytz
 from optparse import OptionParser
-from multiprocessing import Process
+from multiprocessing import Process, Pool
 from itertools import islice
 from datetime import datetime
 import dateutil
@@ -31,98 +31,129 @@ def start_data_processing(thread_number):
     start_epoch = now_epoch - if_config_vars['run_interval'] - if_config_vars['sampling_interval']
     get_metrics_to_collect()
     if 'REPLAY' in if_config_vars['project_type']:
-        for replay_file in agent_config_vars['replay_sa_files']:
-            # break into 1h segments
-            for h in range(0, 24):
-                get_sar_data(
-                        '{:02d}:00:00'.format(h),
-                        '{:02d}:59:59'.format(h),
-                        replay_file)
-                # send each chunk to keep mem usage low
-                send_data_wrapper()
+        if cli_config_vars['threads'] > 1:
+            replay_in_parallel(cli_config_vars['threads'])
+        else:
+            for replay_file in agent_config_vars['replay_sa_files']:
+                replay_sa_file(replay_file)
     else:
         get_sar_data(
                 datetime.fromtimestamp(start_epoch).strftime('%H:%M:%S'),
                 datetime.fromtimestamp(now_epoch).strftime('%H:%M:%S'))
 
 
-def get_sar_data(start_time, end_time, replay_file=''):
+def replay_in_parallel(processes):
+    """ split the sa files to replay between worker processes, each with its own chunk buffer """
+    start_time = time.time()
+    totals = {'entries': 0, 'chunks': 0}
+    pool = Pool(processes)
+    for replay_file, stats in pool.imap_unordered(replay_sa_file, agent_config_vars['replay_sa_files']):
+        logger.debug('Replayed {}'.format(replay_file))
+        for stat in totals:
+            totals[stat] += stats[stat]
+    pool.close()
+    pool.join()
+    logger.info('Replayed {} sa files, {} entries in {} chunks in {} seconds with {} processes'.format(
+        len(agent_config_vars['replay_sa_files']), totals['entries'], totals['chunks'],
+        round(time.time() - start_time, 1), processes))
+
+
+def replay_sa_file(replay_file):
+    """ send all of an sa file. returns the file and what was sent """
+    entry_count = track.get('entry_count', 0)
+    chunk_count = track.get('chunk_count', 0)
+    get_sar_data(replay_file=replay_file)
+    # don't mix files in a chunk
+    if len(track['current_dict']) > 0:
+        send_data_wrapper()
+    return replay_file, {
+        'entries': track['entry_count'] - entry_count,
+        'chunks': track['chunk_count'] - chunk_count
+    }
+
+
+def get_sar_data(start_time='', end_time='', replay_file=''):
     # the csv data is always host,interval,timestamp[,device],data...
     # collect all data from this time period
+    if not agent_config_vars['flags']:
+        return
     freeze_send()
 
-    for key in agent_config_vars['flags']:
-        if key == 'dev':
-            # if these are device-level metrics
-            agent_config_vars['device_field'] = 3
-            data_start_col = 4
+    # every activity comes from one sadf call, each after its own header
+    for line in get_sar_data_sadf(agent_config_vars['flags'], start_time, end_time, replay_file):
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        if line.startswith('#'):
+            # new header
+            field_names = SLASHES.sub('_per_', line.strip('# '))
+            field_names = field_names.split(CSV_DELIM)
+            # device-level activities name the device in upper case after the timestamp, ie CPU or IFACE
+            if len(field_names) > 3 and field_names[3].isupper():
+                agent_config_vars['device_field'] = 3
+                data_start_col = 4
+            else:
+                agent_config_vars['device_field'] = ''
+                data_start_col = 3
+            agent_config_vars['csv_field_names'] = field_names
+            agent_config_vars['data_fields'] = range(data_start_col, len(field_names))
         else:
-            agent_config_vars['device_field'] = ''
-            data_start_col = 3
-
-        for metric_class in agent_config_vars['flags'][key]:
-            sar_flags = agent_config_vars['flags'][key][metric_class]
-
-            sar_data = get_sar_data_sadf(
-                            sar_flags,
-                            start_time, end_time,
-                            replay_file
-                            ).split('\n')
-
-            for line in sar_data:
-                if line:
-                    if line.startswith('#'):
-                        # new header
-                        field_names = SLASHES.sub('_per_', line.strip('# '))
-                        field_names = field_names.split(CSV_DELIM)
-                        ## prepend each field name with the metric class
-                        # agent_config_vars['csv_field_names'] = map(lambda x: '{}/{}'.format(metric_class, x), field_names)
-                        agent_config_vars['csv_field_names'] = field_names
-                        agent_config_vars['data_fields'] = range(data_start_col, len(field_names))
-                    else:
-                        line = line.split(CSV_DELIM)
-
-                        # check device
-                        if agent_config_vars['device_field']:
-                            device = line[agent_config_vars['device_field']]
-                            # if the name is a numbered label, prepend with the device name
-                            try:
-                                device = int(device)
-                                if device == -1: # alias for ALL
-                                    device = 'ALL'
-                                line[agent_config_vars['device_field']] = '{}.{}'.format(
-                                    agent_config_vars['csv_field_names'][agent_config_vars['device_field']].split('/')[-1],
-                                    device)
-                            except ValueError as ve:
-                                pass
-
-                        parse_csv_message(line)
+            line = line.split(CSV_DELIM)
+
+            # check device
+            if agent_config_vars['device_field']:
+                device = line[agent_config_vars['device_field']]
+                # if the name is a numbered label, prepend with the device name
+                try:
+                    device = int(device)
+                    if device == -1: # alias for ALL
+                        device = 'ALL'
+                    line[agent_config_vars['device_field']] = '{}.{}'.format(
+                        agent_config_vars['csv_field_names'][agent_config_vars['device_field']].split('/')[-1],
+                        device)
+                except ValueError as ve:
+                    pass
+
+            parse_csv_message(line)
 
     resume_send()
 
 
-def get_sar_data_sadf(flags, start_time, end_time, filename=''):
-    cmd = 'sadf -dU {filename} -s {start_time} -e {end_time} -- {flags} {interval}'.format(
-            filename=filename,
-            start_time=start_time,
-            end_time=end_time,
-            flags=flags,
-            interval=if_config_vars['sampling_interval'])
+def get_sar_data_sadf(flags, start_time='', end_time='', filename=''):
+    """ yield each line of sadf's output for all of the given sar flags as it's read """
+    cmd = ['sadf', '-dU']
+    if filename:
+        cmd.append(filename)
+    if start_time:
+        cmd.extend(['-s', start_time])
+    if end_time:
+        cmd.extend(['-e', end_time])
+    cmd.append('--')
+    cmd.extend(flags)
+    cmd.append(str(if_config_vars['sampling_interval']))
     return get_sar_data_cmd(cmd)
 
 
 def get_sar_data_cmd(call):
-    logger.debug(call)
+    logger.debug(' '.join(call))
     try:
-        return subprocess.check_output(call, shell=True)
-    except Exception as e:
+        proc = subprocess.Popen(call, stdout=subprocess.PIPE)
+    except OSError as e:
         logger.warning(e)
-        return ''
+        return
+    try:
+        for line in proc.stdout:
+            yield line
+    finally:
+        proc.stdout.close()
+        if proc.wait() != 0:
+            logger.warning('{} exited with {}'.format(call[0], proc.returncode))
 
 
 def get_metrics_to_collect():
+    """ list the sar flags for every metric to collect, so that one sadf call reads them all """
     metrics = agent_config_vars['metrics']
-    agent_config_vars['flags'] = dict()
+    flags = []
     # deviceless
     metrics_nodev = [ {'paging': ' -BSW'},
                       {'io': ' -bHq'},
@@ -130,14 +161,13 @@ def get_metrics_to_collect():
                       {'os': ' -vw'},
                       {'network': ' -n NFS -n NFSD -n SOCK -n IP -n EIP -n ICMP -n EICMP -n TCP -n ETCP -n UDP' },
                       {'network6': ' -n SOCK6 -n IP6 -n EIP6 -n ICMP6 -n EICMP6 -n UDP6'} ]
-    agent_config_vars['flags']['nodev'] = dict()
     for metric_nodev in metrics_nodev:
         metric_name = metric_nodev.keys()[0]
         if metric_name in metrics:
-            #agent_config_vars['flags']['nodev'] += metric_nodev[metric_name]
-            agent_config_vars['flags']['nodev'][metric_name] = metric_nodev[metric_name]
+            flags.extend(metric_nodev[metric_name].split())
 
     if agent_config_vars['exclude_devices']:
+        agent_config_vars['flags'] = flags
         return
 
     # has device
@@ -146,12 +176,11 @@ def get_metrics_to_collect():
                      {'io': ' -y'},
                      {'power': ' -m FAN -m IN -m TEMP -m USB'},
                      {'cpu': ' -m CPU -m FREQ -u ALL -P ALL'} ]
-    agent_config_vars['flags']['dev'] = dict()
     for metric_dev in metrics_dev:
         metric_name = metric_dev.keys()[0]
         if metric_name in metrics:
-            #agent_config_vars['flags']['dev'] += metric_dev[metric_name]
-            agent_config_vars['flags']['dev'][metric_name] = metric_dev[metric_name]
+            flags.extend(metric_dev[metric_name].split())
+    agent_config_vars['flags'] = flags
 
 
 def get_agent_config_vars():
@@ -347,11 +376,8 @@ def get_cli_config_vars():
     """ get CLI options. use of these options should be rare """
     usage = 'Usage: %prog [options]'
     parser = OptionParser(usage=usage)
-    """
-    ## not ready.
-    parser.add_option('--threads', default=1,
-                      action='store', dest='threads', help='Number of threads to run')
-    """
+    parser.add_option('--threads', default=1, action='store', dest='threads',
+                      help='Number of processes to replay sa files with')
     parser.add_option('--tz', default='UTC', action='store', dest='time_zone',
                       help='Timezone of the data. See pytz.all_timezones')
     parser.add_option('-q', '--quiet', action='store_true', dest='quiet',
@@ -363,16 +389,13 @@ def get_cli_config_vars():
                            ' Automatically turns on verbose logging')
     (options, args) = parser.parse_args()
 
-    """
-    # not ready
     try:
-        threads = int(options.threads)
+        threads = max(int(options.threads), 1)
     except ValueError:
         threads = 1
-    """
 
     config_vars = {
-        'threads': 1,
+        'threads': threads,
         'testing': False,
         'log_level': logging.INFO,
         'time_zone': pytz.utc
@@ -518,6 +541,11 @@ def get_json_size_bytes(json_data):
     return len(bytearray(json.dumps(json_data)))
 
 
+def get_json_separator_size(json_data):
+    """ size of the ', ' that json.dumps puts before every item but the first """
+    return 2 if len(json_data) > 1 else 0
+
+
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for index in xrange(0, len(l), n):
@@ -913,6 +941,7 @@ def reset_track():
     track['line_count'] = 0
     track['current_row'] = []
     track['current_dict'] = dict()
+    track['current_dict_size'] = 2  # '{}'
 
 
 #########################################
@@ -967,10 +996,10 @@ def metric_handoff(timestamp, field_name, data, instance, device=''):
 
     append_metric_data_to_entry(timestamp, field_name, data, instance, device)
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_dict']) >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
+    if track['current_dict_size'] >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 500 == 0:
-        logger.debug('Current data object size: ' + str(get_json_size_bytes(track['current_dict'])) + ' bytes')
+        logger.debug('Current data object size: ' + str(track['current_dict_size']) + ' bytes')
 
 
 def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''):
@@ -982,13 +1011,20 @@ def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''
     ts_str = str(timestamp)
     if ts_str not in track['current_dict']:
         track['current_dict'][ts_str] = dict()
+        # '"<ts>": {}'
+        track['current_dict_size'] += get_json_size_bytes(ts_str) + 4 + get_json_separator_size(track['current_dict'])
 
     # add to dict or running list of values for this timestamp
     current_obj = track['current_dict'][ts_str]
-    if key in current_obj.keys():
+    if key in current_obj:
+        prev_size = get_json_size_bytes(current_obj[key])
         current_obj[key] += '|' + str(data)
+        track['current_dict_size'] += get_json_size_bytes(current_obj[key]) - prev_size
     else:
         current_obj[key] = str(data)
+        # '"<key>": "<value>"'
+        track['current_dict_size'] += get_json_size_bytes(key) + 2 + get_json_size_bytes(current_obj[key]) + \
+            get_json_separator_size(current_obj)
 
 
 def transpose_metrics():
@@ -1197,8 +1233,7 @@ if __name__ == "__main__":
     agent_config_vars = get_agent_config_vars()
     print_summary_info()
 
-    # start data processing
-    for i in range(0, cli_config_vars['threads']):
-        Process(target=initialize_data_gathering,
-                args=(i,)
-                ).start()
+    # start data processing. replays are split between cli_config_vars['threads'] processes from there
+    Process(target=initialize_data_gathering,
+            args=(0,)
+            ).start()
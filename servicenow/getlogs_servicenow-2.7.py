@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 import ConfigParser
 import json
+import zlib
 import logging
 import os
 import regex
 import socket
 import sys
+import threading
 import time
 import pytz
 from optparse import OptionParser
@@ -13,6 +15,7 @@ from multiprocessing import Process
 from datetime import datetime
 import dateutil
 import tzlocal
+import urllib
 import urlparse
 import httplib
 import requests
@@ -22,6 +25,11 @@ import shlex
 import ifobfuscate
 import re
 import distutils
+import email.utils
+# imported up front, as strptime's lazy import of it is not thread-safe
+import _strptime
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
 
 '''
 This script gathers data to send to Insightfinder
@@ -36,12 +44,11 @@ NAME_KEY = "name"
 
 
 def start_data_processing(thread_number):
-    # set sysparm limi/offset
-    passthru = {'sysparm_limit': 100,
-                'sysparm_exclude_reference_link': 'true',
+    passthru = {'sysparm_exclude_reference_link': 'true',
                 'sysparm_display_value': 'true',
-                'sysparm_offset': agent_config_vars['state']['sysparm_offset'],
                 'sysparm_query': ''}
+    # kept, as the data timezone may be swapped out below
+    data_timezone = agent_config_vars['timezone']
 
     ## add timestamp query
     # get utc earliest datetime
@@ -67,34 +74,38 @@ def start_data_processing(thread_number):
         passthru['sysparm_query'] = '{}^OR{}'.format(passthru['sysparm_query'], statement) if len(
             passthru['sysparm_query']) != 0 else statement
     elif agent_config_vars['is_historical'] == False:
-        if agent_config_vars['cron_start_time']:
-            utc_cron_epoch = agent_config_vars['cron_start_time']
-            # get localized earliest datetime
-            local_cron_datetime = tzlocal.get_localzone().localize(
-                datetime.fromtimestamp(float(utc_cron_epoch)))
-            # convert earliest datetime to the data timezone
-            data_cron_datetime = local_cron_datetime.astimezone(
-                agent_config_vars['timezone'])
-            # do not apply timezone conversion later
-            agent_config_vars['timezone'] = pytz.utc
-            # convert to string for Glide
-            cron_date_and_time = data_cron_datetime.strftime(
-                agent_config_vars['timestamp_format'][0]).split(' ')
-            earliest_date = cron_date_and_time[0]
-            earliest_time = cron_date_and_time[1]
+        if agent_config_vars['state']['last_updated_on']:
+            # pick up where the last run stopped
+            passthru['sysparm_query'] = get_glide_date_statement(
+                UPDATED_FIELD, '>=', datetime.strptime(agent_config_vars['state']['last_updated_on'], STATE_TIME_FORMAT))
         else:
-            earliest_date = earliest_date_and_time[0]
-            earliest_time = '00:00:00'
-        for timestamp_field in agent_config_vars['timestamp_field']:
-            if not is_formatted(timestamp_field):
-                statement = '{}>=javascript:gs.dateGenerate(\'{}\',\'{}\')'.format(
-                    timestamp_field,
-                    earliest_date,
-                    earliest_time)
-                # OR between fields
-                passthru['sysparm_query'] = '{}^OR{}'.format(passthru['sysparm_query'], statement) if len(
-                    passthru['sysparm_query']) != 0 else statement
-        passthru['sysparm_offset'] = 0
+            if agent_config_vars['cron_start_time']:
+                utc_cron_epoch = agent_config_vars['cron_start_time']
+                # get localized earliest datetime
+                local_cron_datetime = tzlocal.get_localzone().localize(
+                    datetime.fromtimestamp(float(utc_cron_epoch)))
+                # convert earliest datetime to the data timezone
+                data_cron_datetime = local_cron_datetime.astimezone(
+                    agent_config_vars['timezone'])
+                # do not apply timezone conversion later
+                agent_config_vars['timezone'] = pytz.utc
+                # convert to string for Glide
+                cron_date_and_time = data_cron_datetime.strftime(
+                    agent_config_vars['timestamp_format'][0]).split(' ')
+                earliest_date = cron_date_and_time[0]
+                earliest_time = cron_date_and_time[1]
+            else:
+                earliest_date = earliest_date_and_time[0]
+                earliest_time = '00:00:00'
+            for timestamp_field in agent_config_vars['timestamp_field']:
+                if not is_formatted(timestamp_field):
+                    statement = '{}>=javascript:gs.dateGenerate(\'{}\',\'{}\')'.format(
+                        timestamp_field,
+                        earliest_date,
+                        earliest_time)
+                    # OR between fields
+                    passthru['sysparm_query'] = '{}^OR{}'.format(passthru['sysparm_query'], statement) if len(
+                        passthru['sysparm_query']) != 0 else statement
     # add applicable keyword filtering
     for in_filter in agent_config_vars['filters_include']:
         filter_keyword, filter_values = in_filter.split(':')
@@ -126,39 +137,119 @@ def start_data_processing(thread_number):
         agent_config_vars['addl_query']) != 0 else passthru['sysparm_query']
     # build auth
     auth = (agent_config_vars['username'], ifobfuscate.decode(agent_config_vars['password']))
-    # logger.debug(ifobfuscate.decode(agent_config_vars['password']))
-    # call API
-    logger.info(
-        'Trying to get next {} records, starting at {}'.format(passthru['sysparm_limit'], passthru['sysparm_offset']))
-    logger.debug(passthru)
-    api_response = send_request(agent_config_vars['api_url'], auth=auth, params=passthru)
-    count = 0
-    if api_response != -1 and api_response.text.find('hibernating') == -1:
-        count = int(api_response.headers['X-Total-Count'])
-    logger.debug('Processing {} records'.format(count))
-    while api_response != -1 and passthru['sysparm_offset'] < count:
-        # parse messages
+
+    # stop at the instance's current time, so records updated during this run are left for the next one
+    run_end_time = None
+    if agent_config_vars['is_historical'] == False:
+        run_end_time = get_servicenow_time(auth, passthru, data_timezone)
+        if run_end_time is None:
+            return
+        statement = get_glide_date_statement(UPDATED_FIELD, '<', run_end_time)
+        passthru['sysparm_query'] = '{}^{}'.format(passthru['sysparm_query'], statement) if len(
+            passthru['sysparm_query']) != 0 else statement
+
+    if not get_records_concurrently(passthru, auth):
+        logger.warning('Not all records could be fetched, they will be fetched again on the next run')
+        return
+
+    if run_end_time and not cli_config_vars['testing']:
+        # send what's left before moving the high-water mark past it
+        if len(track['current_row']) > 0:
+            send_data_wrapper()
+        update_state('last_updated_on', run_end_time.strftime(STATE_TIME_FORMAT), write=True)
+
+    if agent_config_vars['is_historical'] == False:
+        update_status('cron_start_time', utc_earliest_epoch, write=True)
+
+
+def get_glide_date_statement(field, operator, date_time):
+    """ build a query statement comparing field to a datetime in the data timezone """
+    return '{}{}javascript:gs.dateGenerate(\'{}\',\'{}\')'.format(
+        field, operator, date_time.strftime('%Y-%m-%d'), date_time.strftime('%H:%M:%S'))
+
+
+def get_servicenow_time(auth, passthru, timezone):
+    """ get the instance's current time in the data timezone, from the Date header of a one-record request """
+    params = dict(passthru, sysparm_limit=1, sysparm_fields=ID_FIELD)
+    api_response = send_request(agent_config_vars['api_url'], auth=auth, params=params)
+    if api_response == -1 or api_response.text.find('hibernating') != -1:
+        logger.warning('Could not reach ServiceNow')
+        return None
+    server_date = api_response.headers.get('Date')
+    server_epoch = email.utils.mktime_tz(email.utils.parsedate_tz(server_date)) if server_date else time.time()
+    return datetime.fromtimestamp(server_epoch, pytz.utc).astimezone(timezone).replace(tzinfo=None)
+
+
+def get_records_concurrently(passthru, auth):
+    """ page through each sys_id shard in a pool of threads, parsing pages here as they come in """
+    page_queue = Queue(PAGE_QUEUE_SIZE)
+    pool = ThreadPool(agent_config_vars['thread_pool'])
+    pool.map_async(lambda shard: get_shard_records(page_queue, passthru, auth, shard), SYS_ID_SHARDS)
+    pool.close()
+
+    complete = True
+    shards_done = 0
+    while shards_done < len(SYS_ID_SHARDS):
+        api_json, shard_complete = page_queue.get()
+        # end of a shard
+        if api_json is None:
+            shards_done += 1
+            complete = complete and shard_complete
+            continue
         try:
-            api_json = json.loads(api_response.content)
             parse_json_message(api_json)
         except Exception as e:
             logger.warning(e)
-            pass
-        # set limit and offset
-        passthru['sysparm_offset'] = passthru['sysparm_offset'] + passthru['sysparm_limit']
-        passthru['sysparm_limit'] = min(100, count - passthru['sysparm_offset'])
-        if passthru['sysparm_offset'] >= count or passthru['sysparm_limit'] <= 0:
-            break
-        # update_state('sysparm_offset', passthru['sysparm_offset'], write=True)
-        # call API for next cycle
-        logger.info('Trying to get next {} records, starting at {}'.format(passthru['sysparm_limit'],
-                                                                           passthru['sysparm_offset']))
-        api_response = send_request(agent_config_vars['api_url'], auth=auth, params=passthru)
+    pool.join()
+    return complete
 
-    # update_state('sysparm_offset', count, write=True)
 
-    if agent_config_vars['is_historical'] == False:
-        update_status('cron_start_time', utc_earliest_epoch, write=True)
+def get_shard_records(page_queue, passthru, auth, shard):
+    """
+    page through the records whose sys_id starts with shard, ordered by sys_updated_on then sys_id.
+    each page starts after the last record of the one before, rather than at an offset
+    """
+    shard_complete = False
+    try:
+        page_size = agent_config_vars['page_size']
+        last_updated_on = None
+        last_sys_id = None
+        same_second = False
+        while True:
+            query = [passthru['sysparm_query']] if passthru['sysparm_query'] else []
+            query.append('{}STARTSWITH{}'.format(ID_FIELD, shard))
+            if same_second:
+                # a full page may end part-way through a second, so finish that second by sys_id first
+                query.append(get_glide_date_statement(UPDATED_FIELD, '=', last_updated_on))
+                query.append('{}>{}'.format(ID_FIELD, last_sys_id))
+                query.append('ORDERBY{}'.format(ID_FIELD))
+            else:
+                if last_updated_on:
+                    query.append(get_glide_date_statement(UPDATED_FIELD, '>', last_updated_on))
+                query.append('ORDERBY{}^ORDERBY{}'.format(UPDATED_FIELD, ID_FIELD))
+            params = dict(passthru, sysparm_limit=page_size, sysparm_query='^'.join(query))
+            logger.debug(params)
+            api_response = send_request(agent_config_vars['api_url'], auth=auth, params=params)
+            if api_response == -1 or api_response.text.find('hibernating') != -1:
+                return
+            api_json = json.loads(api_response.content)
+            records = api_json.get(RESULT_KEY) or []
+            if records:
+                page_queue.put((api_json, True))
+                # display values of sys_updated_on are in the instance's Glide format, not timestamp_format
+                last_updated_on = datetime.strptime(records[-1][UPDATED_FIELD], GLIDE_TIME_FORMAT)
+                last_sys_id = records[-1][ID_FIELD]
+            if len(records) == page_size:
+                same_second = True
+            elif same_second:
+                same_second = False
+            else:
+                break
+        shard_complete = True
+    except Exception as e:
+        logger.warning(e)
+    finally:
+        page_queue.put((None, shard_complete))
 
 
 def get_agent_config_vars():
@@ -169,7 +260,8 @@ def get_agent_config_vars():
         config_parser.read(config_ini)
         try:
             # state
-            sysparm_offset = config_parser.get('state', 'sysparm_offset')
+            last_updated_on = config_parser.get('state', 'last_updated_on') if config_parser.has_option(
+                'state', 'last_updated_on') else ''
 
             # api
             base_url = config_parser.get('agent', 'base_url')
@@ -177,6 +269,10 @@ def get_agent_config_vars():
             username = config_parser.get('agent', 'username')
             password = config_parser.get('agent', 'password_encrypted')
             addl_query = config_parser.get('agent', 'sysparm_query')
+            page_size = config_parser.get('agent', 'page_size') if config_parser.has_option(
+                'agent', 'page_size') else ''
+            thread_pool = config_parser.get('agent', 'thread_pool') if config_parser.has_option(
+                'agent', 'thread_pool') else ''
 
             # proxies
             agent_http_proxy = config_parser.get('agent', 'agent_http_proxy')
@@ -276,9 +372,13 @@ def get_agent_config_vars():
             timezone = pytz.timezone(timezone)
 
         try:
-            sysparm_offset = int(sysparm_offset)
-        except Exception:
-            sysparm_offset = 0
+            page_size = int(page_size or 1000)
+        except ValueError:
+            config_error('page_size')
+        try:
+            thread_pool = int(thread_pool or 4)
+        except ValueError:
+            config_error('thread_pool')
 
         if os.path.exists("status"):
             with open("status", 'r+') as status_file:
@@ -297,11 +397,13 @@ def get_agent_config_vars():
 
         # add parsed variables to a global
         config_vars = {
-            'state': {'sysparm_offset': sysparm_offset},
+            'state': {'last_updated_on': last_updated_on},
             'api_url': api_url,
             'username': username,
             'password': password,
             'addl_query': addl_query,
+            'page_size': page_size,
+            'thread_pool': thread_pool,
             'proxies': agent_proxies,
             'filters_include': filters_include,
             'filters_exclude': filters_exclude,
@@ -352,6 +454,10 @@ def get_if_config_vars():
             if_url = config_parser.get('insightfinder', 'if_url')
             if_http_proxy = config_parser.get('insightfinder', 'if_http_proxy')
             if_https_proxy = config_parser.get('insightfinder', 'if_https_proxy')
+            if_pool_size = config_parser.get('insightfinder', 'if_pool_size') if config_parser.has_option(
+                'insightfinder', 'if_pool_size') else ''
+            if_compress = config_parser.get('insightfinder', 'if_compress') if config_parser.has_option(
+                'insightfinder', 'if_compress') else ''
         except ConfigParser.NoOptionError as cp_noe:
             logger.error(cp_noe)
             config_error()
@@ -423,7 +529,9 @@ def get_if_config_vars():
             'run_interval': int(run_interval),  # as seconds
             'chunk_size': int(chunk_size_kb) * 1024,  # as bytes
             'if_url': if_url,
-            'if_proxies': if_proxies
+            'if_proxies': if_proxies,
+            'if_pool_size': int(if_pool_size or 10),
+            'if_compress': if_compress.upper() == 'TRUE'
         }
 
         return config_vars
@@ -548,6 +656,17 @@ def get_json_size_bytes(json_data):
     return len(bytearray(json.dumps(json_data)))
 
 
+def get_json_separator_size(json_data):
+    """ size of the ', ' that json.dumps puts before every item but the first """
+    return 2 if len(json_data) > 1 else 0
+
+
+def append_to_current_row(entry):
+    """ add an entry to the current chunk, keeping a running count of its size in bytes """
+    track['current_row'].append(entry)
+    track['current_row_size'] += get_json_size_bytes(entry) + get_json_separator_size(track['current_row'])
+
+
 def is_formatted(setting_value):
     """ returns True if the setting is a format string """
     return len(FORMAT_STR.findall(setting_value)) != 0
@@ -1288,7 +1407,9 @@ def reset_track():
     track['start_time'] = time.time()
     track['line_count'] = 0
     track['current_row'] = []
+    track['current_row_size'] = 2  # '[]'
     track['current_dict'] = dict()
+    track['current_dict_size'] = 2  # '{}'
 
 
 #########################################
@@ -1312,15 +1433,15 @@ def log_handoff(timestamp, data, instance, device=''):
 
 def send_log(timestamp, data, instance, device=''):
     entry = prepare_log_entry(str(int(timestamp)), data, instance, device)
-    track['current_row'].append(entry)
+    append_to_current_row(entry)
     track['line_count'] += 1
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (
+    if track['current_row_size'] >= if_config_vars['chunk_size'] or (
             time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 100 == 0:
         logger.debug('Current data object size: {} bytes'.format(
-            get_json_size_bytes(track['current_row'])))
+            track['current_row_size']))
 
 
 def prepare_log_entry(timestamp, data, instance, device=''):
@@ -1359,12 +1480,12 @@ def add_and_send_metric(timestamp, field_name, data, instance, device=''):
 
 def send_metric():
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_dict']) >= if_config_vars['chunk_size'] or (
+    if track['current_dict_size'] >= if_config_vars['chunk_size'] or (
             time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 500 == 0:
         logger.debug('Current data object size: {} bytes'.format(
-            get_json_size_bytes(track['current_dict'])))
+            track['current_dict_size']))
 
 
 def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''):
@@ -1374,15 +1495,22 @@ def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''
     ts_str = str(timestamp)
     if ts_str not in track['current_dict']:
         track['current_dict'][ts_str] = dict()
+        # '"<ts>": {}'
+        track['current_dict_size'] += get_json_size_bytes(ts_str) + 4 + get_json_separator_size(track['current_dict'])
     current_obj = track['current_dict'][ts_str]
 
     # use the next non-null value to overwrite the prev value
     # for the same metric in the same timestamp
-    if key in current_obj.keys():
+    if key in current_obj:
         if data is not None and len(str(data)) > 0:
+            prev_size = get_json_size_bytes(current_obj[key])
             current_obj[key] += '|' + str(data)
+            track['current_dict_size'] += get_json_size_bytes(current_obj[key]) - prev_size
     else:
         current_obj[key] = str(data)
+        # '"<key>": "<value>"'
+        track['current_dict_size'] += get_json_size_bytes(key) + 2 + get_json_size_bytes(current_obj[key]) + \
+            get_json_separator_size(current_obj)
     track['current_dict'][ts_str] = current_obj
 
 
@@ -1397,7 +1525,7 @@ def transpose_metrics():
                 value = statistics.median(
                     map(lambda v: float(v), value.split('|')))
             new_row[key] = str(value)
-        track['current_row'].append(new_row)
+        append_to_current_row(new_row)
 
 
 def fold_up(tree, sentence_tree=False, value_tree=False):
@@ -1494,18 +1622,44 @@ def send_data_to_if(chunk_metric_data):
 
     # send the data
     post_url = urlparse.urljoin(if_config_vars['if_url'], get_api_from_project_type())
+    post_data = data_to_post
+    post_headers = None
+    if if_config_vars['if_compress']:
+        post_data = gzip_compress(urllib.urlencode(data_to_post))
+        post_headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'}
     send_request(post_url, 'POST', 'Could not send request to IF',
                  str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
-                 data=data_to_post, proxies=if_config_vars['if_proxies'])
+                 data=post_data, headers=post_headers, proxies=if_config_vars['if_proxies'])
     logger.debug('--- Send data time: %s seconds ---' % round(time.time() - send_data_time, 2))
 
 
+def get_request_session():
+    """ get this thread's pooled session, so connections are reused between requests """
+    # requests.Session is not thread-safe, so each thread gets its own
+    pid = (os.getpid(), threading.current_thread().ident)
+    if pid not in SESSIONS:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=if_config_vars['if_pool_size'],
+                                                pool_maxsize=if_config_vars['if_pool_size'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        SESSIONS[pid] = session
+    return SESSIONS[pid]
+
+
+def gzip_compress(data):
+    """ gzip a request body """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
 def send_request(url, mode='GET', failure_message='No message', success_message='Success!', **request_passthrough):
     """ sends a request to the given url """
     # determine if post or get (default)
-    req = requests.get
+    session = get_request_session()
+    req = session.get
     if mode.upper() == 'POST':
-        req = requests.post
+        req = session.post
 
     global REQUESTS
     REQUESTS.update(request_passthrough)
@@ -1513,7 +1667,10 @@ def send_request(url, mode='GET', failure_message='No message', success_message=
 
     for i in range(ATTEMPTS):
         try:
+            request_time = time.time()
             response = req(url, **request_passthrough)
+            logger.debug('Request took {} seconds, {} bytes sent, {} bytes received'.format(
+                round(time.time() - request_time, 3), len(response.request.body or ''), len(response.content)))
             if response.status_code == httplib.OK:
                 logger.info(success_message)
                 return response
@@ -1612,8 +1769,15 @@ if __name__ == "__main__":
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = r",|\t"
     ATTEMPTS = 3
+    SESSIONS = dict()
     REQUESTS = dict()
     track = dict()
+    UPDATED_FIELD = 'sys_updated_on'
+    ID_FIELD = 'sys_id'
+    SYS_ID_SHARDS = '0123456789abcdef'
+    PAGE_QUEUE_SIZE = 32
+    STATE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+    GLIDE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
     # get config
     cli_config_vars = get_cli_config_vars()
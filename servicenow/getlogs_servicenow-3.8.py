@@ -1,16 +1,19 @@
 #!/usr/bin/env python
 import configparser
 import json
+import zlib
 import logging
 import os
 import regex
 import socket
 import sys
+import threading
 import time
 import pytz
 from optparse import OptionParser
 from multiprocessing import Process
 from datetime import datetime
+from collections import OrderedDict
 import dateutil
 import urllib.parse
 import http.client
@@ -22,6 +25,9 @@ import ifobfuscate
 import re
 import sqlite3
 import urllib3
+import email.utils
+from queue import Queue
+from multiprocessing.pool import ThreadPool
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 '''
@@ -37,11 +43,8 @@ NAME_KEY = "name"
 
 
 def start_data_processing(thread_number):
-    # set sysparm limi/offset
-    passthru = {'sysparm_limit': 100,
-                'sysparm_exclude_reference_link': 'true',
+    passthru = {'sysparm_exclude_reference_link': 'true',
                 'sysparm_display_value': 'true',
-                'sysparm_offset': agent_config_vars['state']['sysparm_offset'],
                 'sysparm_query': ''}
 
     # add timestamp filter
@@ -55,66 +58,154 @@ def start_data_processing(thread_number):
             passthru['sysparm_query']) != 0 else statement
     elif agent_config_vars['is_historical'] == False:
         update_status('cron_start_time', time.time())
-        if agent_config_vars['cron_start_time']:
-            utc_cron_epoch = float(agent_config_vars['cron_start_time'])
+        if agent_config_vars['state']['last_updated_on']:
+            # pick up where the last run stopped
+            passthru['sysparm_query'] = get_glide_date_statement(
+                UPDATED_FIELD, '>=', datetime.strptime(agent_config_vars['state']['last_updated_on'], STATE_TIME_FORMAT))
         else:
-            utc_cron_epoch = time.time()
-        # get localized earliest datetime
-        local_cron_datetime = datetime.fromtimestamp(utc_cron_epoch)
-        # convert earliest datetime to the data timezone
-        data_cron_datetime = local_cron_datetime.astimezone(
-            agent_config_vars['timezone'])
-        # convert to string for Glide
-        cron_date_and_time = data_cron_datetime.strftime(
-            agent_config_vars['timestamp_format'][0]).split(' ')
-        earliest_date = cron_date_and_time[0]
-        if agent_config_vars['cron_start_time']:
-            earliest_time = cron_date_and_time[1]
-        else:
-            earliest_time = '00:00:00'
-        for timestamp_field in agent_config_vars['timestamp_field']:
-            if not is_formatted(timestamp_field):
-                statement = '{}>=javascript:gs.dateGenerate(\'{}\',\'{}\')'.format(
-                    timestamp_field,
-                    earliest_date,
-                    earliest_time)
-                # OR between fields
-                passthru['sysparm_query'] = '{}^OR{}'.format(passthru['sysparm_query'], statement) if len(
-                    passthru['sysparm_query']) != 0 else statement
-        passthru['sysparm_offset'] = 0
+            if agent_config_vars['cron_start_time']:
+                utc_cron_epoch = float(agent_config_vars['cron_start_time'])
+            else:
+                utc_cron_epoch = time.time()
+            # get localized earliest datetime
+            local_cron_datetime = datetime.fromtimestamp(utc_cron_epoch)
+            # convert earliest datetime to the data timezone
+            data_cron_datetime = local_cron_datetime.astimezone(
+                agent_config_vars['timezone'])
+            # convert to string for Glide
+            cron_date_and_time = data_cron_datetime.strftime(
+                agent_config_vars['timestamp_format'][0]).split(' ')
+            earliest_date = cron_date_and_time[0]
+            if agent_config_vars['cron_start_time']:
+                earliest_time = cron_date_and_time[1]
+            else:
+                earliest_time = '00:00:00'
+            for timestamp_field in agent_config_vars['timestamp_field']:
+                if not is_formatted(timestamp_field):
+                    statement = '{}>=javascript:gs.dateGenerate(\'{}\',\'{}\')'.format(
+                        timestamp_field,
+                        earliest_date,
+                        earliest_time)
+                    # OR between fields
+                    passthru['sysparm_query'] = '{}^OR{}'.format(passthru['sysparm_query'], statement) if len(
+                        passthru['sysparm_query']) != 0 else statement
 
     passthru['sysparm_query'] = '{}^{}'.format(passthru['sysparm_query'], agent_config_vars['addl_query']) if len(
         agent_config_vars['addl_query']) != 0 else passthru['sysparm_query']
     # build auth
     auth = (agent_config_vars['username'], ifobfuscate.decode(agent_config_vars['password']))
-    # call API
-    logger.info(
-        'Trying to get next {} records, starting at {}'.format(passthru['sysparm_limit'], passthru['sysparm_offset']))
-    logger.debug(passthru)
+
+    # stop at the instance's current time, so records updated during this run are left for the next one
+    run_end_time = None
+    if agent_config_vars['is_historical'] == False:
+        run_end_time = get_servicenow_time(auth, passthru, agent_config_vars['timezone'])
+        if run_end_time is None:
+            return
+        statement = get_glide_date_statement(UPDATED_FIELD, '<', run_end_time)
+        passthru['sysparm_query'] = '{}^{}'.format(passthru['sysparm_query'], statement) if len(
+            passthru['sysparm_query']) != 0 else statement
+
+    if not get_records_concurrently(passthru, auth):
+        logger.warning('Not all records could be fetched, they will be fetched again on the next run')
+        return
+
+    if run_end_time and not cli_config_vars['testing']:
+        # send what's left before moving the high-water mark past it
+        if len(track['current_row']) > 0:
+            send_data_wrapper()
+        update_state('last_updated_on', run_end_time.strftime(STATE_TIME_FORMAT), write=True)
+
+
+def get_glide_date_statement(field, operator, date_time):
+    """ build a query statement comparing field to a datetime in the data timezone """
+    return '{}{}javascript:gs.dateGenerate(\'{}\',\'{}\')'.format(
+        field, operator, date_time.strftime('%Y-%m-%d'), date_time.strftime('%H:%M:%S'))
+
+
+def get_servicenow_time(auth, passthru, timezone):
+    """ get the instance's current time in the data timezone, from the Date header of a one-record request """
+    params = dict(passthru, sysparm_limit=1, sysparm_fields=ID_FIELD)
     api_response = send_request(agent_config_vars['api_url'], auth=auth, proxies=agent_config_vars['proxies'],
-                                params=passthru)
-    count = 0
-    if api_response != -1 and api_response.text.find('hibernating') == -1:
-        count = int(api_response.headers['X-Total-Count'])
-    logger.debug('Processing {} records'.format(count))
-    while api_response != -1 and passthru['sysparm_offset'] < count:
-        # parse messages
+                                params=params)
+    if api_response == -1 or api_response.text.find('hibernating') != -1:
+        logger.warning('Could not reach ServiceNow')
+        return None
+    server_date = api_response.headers.get('Date')
+    server_epoch = email.utils.mktime_tz(email.utils.parsedate_tz(server_date)) if server_date else time.time()
+    return datetime.fromtimestamp(server_epoch, pytz.utc).astimezone(timezone).replace(tzinfo=None)
+
+
+def get_records_concurrently(passthru, auth):
+    """ page through each sys_id shard in a pool of threads, parsing pages here as they come in """
+    page_queue = Queue(PAGE_QUEUE_SIZE)
+    pool = ThreadPool(agent_config_vars['thread_pool'])
+    pool.map_async(lambda shard: get_shard_records(page_queue, passthru, auth, shard), SYS_ID_SHARDS)
+    pool.close()
+
+    complete = True
+    shards_done = 0
+    while shards_done < len(SYS_ID_SHARDS):
+        api_json, shard_complete = page_queue.get()
+        # end of a shard
+        if api_json is None:
+            shards_done += 1
+            complete = complete and shard_complete
+            continue
         try:
-            api_json = json.loads(api_response.content)
             parse_json_message(api_json)
         except Exception as e:
             logger.warning(e)
-            pass
-        # set limit and offset
-        passthru['sysparm_offset'] = passthru['sysparm_offset'] + passthru['sysparm_limit']
-        passthru['sysparm_limit'] = min(100, count - passthru['sysparm_offset'])
-        if passthru['sysparm_offset'] >= count or passthru['sysparm_limit'] <= 0:
-            break
-        # call API for next cycle
-        logger.info('Trying to get next {} records, starting at {}'.format(passthru['sysparm_limit'],
-                                                                           passthru['sysparm_offset']))
-        api_response = send_request(agent_config_vars['api_url'], auth=auth, proxies=agent_config_vars['proxies'],
-                                    params=passthru)
+    pool.join()
+    return complete
+
+
+def get_shard_records(page_queue, passthru, auth, shard):
+    """
+    page through the records whose sys_id starts with shard, ordered by sys_updated_on then sys_id.
+    each page starts after the last record of the one before, rather than at an offset
+    """
+    shard_complete = False
+    try:
+        page_size = agent_config_vars['page_size']
+        last_updated_on = None
+        last_sys_id = None
+        same_second = False
+        while True:
+            query = [passthru['sysparm_query']] if passthru['sysparm_query'] else []
+            query.append('{}STARTSWITH{}'.format(ID_FIELD, shard))
+            if same_second:
+                # a full page may end part-way through a second, so finish that second by sys_id first
+                query.append(get_glide_date_statement(UPDATED_FIELD, '=', last_updated_on))
+                query.append('{}>{}'.format(ID_FIELD, last_sys_id))
+                query.append('ORDERBY{}'.format(ID_FIELD))
+            else:
+                if last_updated_on:
+                    query.append(get_glide_date_statement(UPDATED_FIELD, '>', last_updated_on))
+                query.append('ORDERBY{}^ORDERBY{}'.format(UPDATED_FIELD, ID_FIELD))
+            params = dict(passthru, sysparm_limit=page_size, sysparm_query='^'.join(query))
+            logger.debug(params)
+            api_response = send_request(agent_config_vars['api_url'], auth=auth, proxies=agent_config_vars['proxies'],
+                                        params=params)
+            if api_response == -1 or api_response.text.find('hibernating') != -1:
+                return
+            api_json = json.loads(api_response.content)
+            records = api_json.get(RESULT_KEY) or []
+            if records:
+                page_queue.put((api_json, True))
+                # display values of sys_updated_on are in the instance's Glide format, not timestamp_format
+                last_updated_on = datetime.strptime(records[-1][UPDATED_FIELD], GLIDE_TIME_FORMAT)
+                last_sys_id = records[-1][ID_FIELD]
+            if len(records) == page_size:
+                same_second = True
+            elif same_second:
+                same_second = False
+            else:
+                break
+        shard_complete = True
+    except Exception as e:
+        logger.warning(e)
+    finally:
+        page_queue.put((None, shard_complete))
 
 
 def get_agent_config_vars():
@@ -125,7 +216,8 @@ def get_agent_config_vars():
         config_parser.read(config_ini)
         try:
             # state
-            sysparm_offset = config_parser.get('state', 'sysparm_offset')
+            last_updated_on = config_parser.get('state', 'last_updated_on') if config_parser.has_option(
+                'state', 'last_updated_on') else ''
 
             # api
             base_url = config_parser.get('agent', 'base_url')
@@ -133,6 +225,10 @@ def get_agent_config_vars():
             username = config_parser.get('agent', 'username')
             password = config_parser.get('agent', 'password_encrypted')
             addl_query = config_parser.get('agent', 'filter_query')
+            page_size = config_parser.get('agent', 'page_size') if config_parser.has_option(
+                'agent', 'page_size') else ''
+            thread_pool = config_parser.get('agent', 'thread_pool') if config_parser.has_option(
+                'agent', 'thread_pool') else ''
 
             # proxies
             agent_http_proxy = config_parser.get('agent', 'agent_http_proxy')
@@ -206,9 +302,14 @@ def get_agent_config_vars():
             timezone = pytz.timezone(timezone)
 
         try:
-            sysparm_offset = int(sysparm_offset)
-        except Exception:
-            sysparm_offset = 0
+            page_size = int(page_size or 1000)
+        except ValueError:
+            config_error('page_size')
+        try:
+            thread_pool = int(thread_pool or 4)
+        except ValueError:
+            config_error('thread_pool')
+
         if os.path.exists("status"):
             with open("status", 'r+') as status_file:
                 content = status_file.readline()
@@ -226,11 +327,13 @@ def get_agent_config_vars():
 
         # add parsed variables to a global
         config_vars = {
-            'state': {'sysparm_offset': sysparm_offset},
+            'state': {'last_updated_on': last_updated_on},
             'api_url': api_url,
             'username': username,
             'password': password,
             'addl_query': addl_query,
+            'page_size': page_size,
+            'thread_pool': thread_pool,
             'proxies': agent_proxies,
             'data_format': 'JSON',
             'json_top_level': json_top_level,
@@ -257,40 +360,58 @@ def get_agent_config_vars():
 #########################
 ### START_BOILERPLATE ###
 #########################
+def get_cache_row(instance):
+    """ get the (alias, component) cached for an instance, keeping recently used ones in memory """
+    if instance in alias_cache:
+        alias_cache.move_to_end(instance)
+        return alias_cache[instance]
+
+    cache_cur.execute('select alias, component from cache where instance = ?', (instance,))
+    row = cache_cur.fetchone() or (None, None)
+    alias_cache[instance] = row
+    if len(alias_cache) > ALIAS_CACHE_SIZE:
+        alias_cache.popitem(last=False)
+    return row
+
+
 def get_alias_from_cache(alias):
     if cache_cur:
-        cache_cur.execute('select alias from cache where instance="%s"' % alias)
-        instance = cache_cur.fetchone()
+        instance = get_cache_row(alias)[0]
         if instance:
-            return instance[0]
+            return instance
         else:
-            # Hard coded if alias hasn't been added to cache, add it
-            cache_cur.execute('insert into cache (instance, alias) values ("%s", "%s")' % (alias, alias))
-            cache_con.commit()
+            # Hard coded if alias hasn't been added to cache, add it with the next chunk
+            new_aliases.append((alias, alias))
+            alias_cache[alias] = (alias, None)
             return alias
 
 
 def get_component_from_cache(instance):
     if cache_cur:
-        cache_cur.execute('select component from cache where instance="%s"' % instance)
-        instance = cache_cur.fetchone()
-        if instance:
-            return instance[0]
+        alias, component = get_cache_row(instance)
+        if alias:
+            return component
         else:
             return ""
 
 
+def write_new_aliases():
+    """ add the aliases seen since the last chunk to the cache, in one transaction """
+    if new_aliases:
+        cache_cur.executemany('insert or ignore into cache (instance, alias) values (?, ?)', new_aliases)
+        cache_con.commit()
+        del new_aliases[:]
+
+
 def initialize_cache_connection():
     # connect to local cache
     cache_loc = abs_path_from_cur(CACHE_NAME)
-    if os.path.exists(cache_loc):
-        cache_con = sqlite3.connect(cache_loc)
-        cache_cur = cache_con.cursor()
-    else:
-        cache_con = sqlite3.connect(cache_loc)
-        cache_cur = cache_con.cursor()
-        cache_cur.execute(
-            'CREATE TABLE "cache" ( "instance"	TEXT NOT NULL UNIQUE, "alias"	TEXT NOT NULL, "component"	TEXT)')
+    cache_con = sqlite3.connect(cache_loc)
+    cache_cur = cache_con.cursor()
+    # let other agent processes read the cache while one writes to it
+    cache_cur.execute('PRAGMA journal_mode=WAL')
+    cache_cur.execute(
+        'CREATE TABLE IF NOT EXISTS "cache" ( "instance"	TEXT NOT NULL UNIQUE, "alias"	TEXT NOT NULL, "component"	TEXT)')
 
     return cache_con, cache_cur
 
@@ -317,6 +438,10 @@ def get_if_config_vars():
             if_url = config_parser.get('insightfinder', 'if_url')
             if_http_proxy = config_parser.get('insightfinder', 'if_http_proxy')
             if_https_proxy = config_parser.get('insightfinder', 'if_https_proxy')
+            if_pool_size = config_parser.get('insightfinder', 'if_pool_size') if config_parser.has_option(
+                'insightfinder', 'if_pool_size') else ''
+            if_compress = config_parser.get('insightfinder', 'if_compress') if config_parser.has_option(
+                'insightfinder', 'if_compress') else ''
         except configparser.NoOptionError as cp_noe:
             logger.error(cp_noe)
             config_error()
@@ -387,7 +512,9 @@ def get_if_config_vars():
             'run_interval': int(run_interval),  # as seconds
             'chunk_size': int(chunk_size_kb) * 1024,  # as bytes
             'if_url': if_url,
-            'if_proxies': if_proxies
+            'if_proxies': if_proxies,
+            'if_pool_size': int(if_pool_size or 10),
+            'if_compress': if_compress.upper() == 'TRUE'
         }
 
         return config_vars
@@ -512,6 +639,17 @@ def get_json_size_bytes(json_data):
     return len(bytearray(json.dumps(json_data), encoding='utf8'))
 
 
+def get_json_separator_size(json_data):
+    """ size of the ', ' that json.dumps puts before every item but the first """
+    return 2 if len(json_data) > 1 else 0
+
+
+def append_to_current_row(entry):
+    """ add an entry to the current chunk, keeping a running count of its size in bytes """
+    track['current_row'].append(entry)
+    track['current_row_size'] += get_json_size_bytes(entry) + get_json_separator_size(track['current_row'])
+
+
 def is_formatted(setting_value):
     """ returns True if the setting is a format string """
     return len(FORMAT_STR.findall(setting_value)) != 0
@@ -1117,6 +1255,7 @@ def initialize_data_gathering(thread_number):
     if len(track['current_row']) > 0 or len(track['current_dict']) > 0:
         logger.debug('Sending last chunk')
         send_data_wrapper()
+    write_new_aliases()
 
     logger.debug('Total chunks created: ' + str(track['chunk_count']))
     logger.debug('Total {} entries: {}'.format(
@@ -1128,7 +1267,9 @@ def reset_track():
     track['start_time'] = time.time()
     track['line_count'] = 0
     track['current_row'] = []
+    track['current_row_size'] = 2  # '[]'
     track['current_dict'] = dict()
+    track['current_dict_size'] = 2  # '{}'
 
 
 #########################################
@@ -1152,15 +1293,15 @@ def log_handoff(timestamp, data, instance, component, device=''):
 
 def send_log(timestamp, data, instance, component, device=''):
     entry = prepare_log_entry(str(int(timestamp)), data, instance, component, device)
-    track['current_row'].append(entry)
+    append_to_current_row(entry)
     track['line_count'] += 1
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (
+    if track['current_row_size'] >= if_config_vars['chunk_size'] or (
             time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 100 == 0:
         logger.debug('Current data object size: {} bytes'.format(
-            get_json_size_bytes(track['current_row'])))
+            track['current_row_size']))
 
 
 def prepare_log_entry(timestamp, data, instance, component, device=''):
@@ -1201,12 +1342,12 @@ def add_and_send_metric(timestamp, field_name, data, instance, device=''):
 
 def send_metric():
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_dict']) >= if_config_vars['chunk_size'] or (
+    if track['current_dict_size'] >= if_config_vars['chunk_size'] or (
             time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 500 == 0:
         logger.debug('Current data object size: {} bytes'.format(
-            get_json_size_bytes(track['current_dict'])))
+            track['current_dict_size']))
 
 
 def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''):
@@ -1216,15 +1357,22 @@ def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''
     ts_str = str(timestamp)
     if ts_str not in track['current_dict']:
         track['current_dict'][ts_str] = dict()
+        # '"<ts>": {}'
+        track['current_dict_size'] += get_json_size_bytes(ts_str) + 4 + get_json_separator_size(track['current_dict'])
     current_obj = track['current_dict'][ts_str]
 
     # use the next non-null value to overwrite the prev value
     # for the same metric in the same timestamp
-    if key in list(current_obj.keys()):
+    if key in current_obj:
         if data is not None and len(str(data)) > 0:
+            prev_size = get_json_size_bytes(current_obj[key])
             current_obj[key] += '|' + str(data)
+            track['current_dict_size'] += get_json_size_bytes(current_obj[key]) - prev_size
     else:
         current_obj[key] = str(data)
+        # '"<key>": "<value>"'
+        track['current_dict_size'] += get_json_size_bytes(key) + 2 + get_json_size_bytes(current_obj[key]) + \
+            get_json_separator_size(current_obj)
     track['current_dict'][ts_str] = current_obj
 
 
@@ -1239,7 +1387,7 @@ def transpose_metrics():
                 value = statistics.median(
                     [float(v) for v in value.split('|')])
             new_row[key] = str(value)
-        track['current_row'].append(new_row)
+        append_to_current_row(new_row)
 
 
 def fold_up(tree, sentence_tree=False, value_tree=False):
@@ -1313,6 +1461,7 @@ def send_data_wrapper():
     send_data_to_if(track['current_row'])
     track['chunk_count'] += 1
     reset_track()
+    write_new_aliases()
 
 
 def send_data_to_if(chunk_metric_data):
@@ -1336,18 +1485,44 @@ def send_data_to_if(chunk_metric_data):
 
     # send the data
     post_url = urllib.parse.urljoin(if_config_vars['if_url'], get_api_from_project_type())
+    post_data = data_to_post
+    post_headers = None
+    if if_config_vars['if_compress']:
+        post_data = gzip_compress(urllib.parse.urlencode(data_to_post).encode('utf-8'))
+        post_headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'}
     send_request(post_url, 'POST', 'Could not send request to IF',
                  str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
-                 verify=False, data=data_to_post, proxies=if_config_vars['if_proxies'])
+                 verify=False, data=post_data, headers=post_headers, proxies=if_config_vars['if_proxies'])
     logger.debug('--- Send data time: %s seconds ---' % round(time.time() - send_data_time, 2))
 
 
+def get_request_session():
+    """ get this thread's pooled session, so connections are reused between requests """
+    # requests.Session is not thread-safe, so each thread gets its own
+    pid = (os.getpid(), threading.current_thread().ident)
+    if pid not in SESSIONS:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=if_config_vars['if_pool_size'],
+                                                pool_maxsize=if_config_vars['if_pool_size'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        SESSIONS[pid] = session
+    return SESSIONS[pid]
+
+
+def gzip_compress(data):
+    """ gzip a request body """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
 def send_request(url, mode='GET', failure_message='No message', success_message='Success!', **request_passthrough):
     """ sends a request to the given url """
     # determine if post or get (default)
-    req = requests.get
+    session = get_request_session()
+    req = session.get
     if mode.upper() == 'POST':
-        req = requests.post
+        req = session.post
 
     global REQUESTS
     REQUESTS.update(request_passthrough)
@@ -1355,7 +1530,10 @@ def send_request(url, mode='GET', failure_message='No message', success_message=
 
     for i in range(ATTEMPTS):
         try:
+            request_time = time.time()
             response = req(url, **request_passthrough)
+            logger.debug('Request took {} seconds, {} bytes sent, {} bytes received'.format(
+                round(time.time() - request_time, 3), len(response.request.body or ''), len(response.content)))
             if response.status_code == http.client.OK:
                 logger.info(success_message)
                 return response
@@ -1454,9 +1632,19 @@ if __name__ == "__main__":
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = r",|\t"
     ATTEMPTS = 3
+    SESSIONS = dict()
     REQUESTS = dict()
     track = dict()
     CACHE_NAME = 'cache.db'
+    ALIAS_CACHE_SIZE = 100000
+    alias_cache = OrderedDict()
+    new_aliases = []
+    UPDATED_FIELD = 'sys_updated_on'
+    ID_FIELD = 'sys_id'
+    SYS_ID_SHARDS = '0123456789abcdef'
+    PAGE_QUEUE_SIZE = 32
+    STATE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+    GLIDE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
     # get config
     cli_config_vars = get_cli_config_vars()
@@ -0,0 +1,186 @@
+"""
+Tests for the paging in getlogs_servicenow-3.8.py, against a local HTTP server standing in for ServiceNow.
+
+    python3 test_servicenow.py
+"""
+
+import email.utils
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytz
+
+spec = importlib.util.spec_from_file_location('agent', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                    'getlogs_servicenow-3.8.py'))
+agent = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(agent)
+
+GLIDE_DATE = re.compile(r"^(\w+?)(>=|>|<|=)javascript:gs\.dateGenerate\('([\d-]+)','([\d:]+)'\)$")
+NOW = 1700000000
+
+
+def glide_time(epoch):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(epoch))
+
+
+def condition(term):
+    """ the subset of encoded query terms the agent sends """
+    match = GLIDE_DATE.match(term)
+    if match:
+        field, operator, date, clock = match.groups()
+        value = '{} {}'.format(date, clock)
+        compare = {'>=': lambda a: a >= value, '>': lambda a: a > value,
+                   '<': lambda a: a < value, '=': lambda a: a == value}[operator]
+        return lambda record: compare(record[field])
+    match = re.match(r'^(\w+)STARTSWITH(.*)$', term)
+    if match:
+        return lambda record: record[match.group(1)].startswith(match.group(2))
+    match = re.match(r'^(\w+)>(.*)$', term)
+    if match:
+        return lambda record: record[match.group(1)] > match.group(2)
+    raise ValueError('unexpected query term {}'.format(term))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ answers table api requests from the server's records, and with 500 for shards in its failing list """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        conditions = []
+        order = []
+        for term in params.get('sysparm_query', [''])[0].split('^'):
+            if term.startswith('ORDERBY'):
+                order.append(term[len('ORDERBY'):])
+            elif term:
+                conditions.append(condition(term))
+        records = [record for record in self.server.records if all(test(record) for test in conditions)]
+        records.sort(key=lambda record: tuple(record[field] for field in order))
+        records = records[:int(params['sysparm_limit'][0])]
+        status = 200
+        if 'sysparm_fields' not in params and records:
+            if records[0]['sys_id'][0] in self.server.failing:
+                status = 500
+            else:
+                with self.server.lock:
+                    self.server.served.extend(record['sys_id'] for record in records)
+        body = json.dumps({'result': records}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def date_time_string(self, timestamp=None):
+        return email.utils.formatdate(NOW, usegmt=True)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class PagingTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.server.lock = threading.Lock()
+        self.server.records = []
+        self.server.served = []
+        self.server.failing = ''
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+        os.chdir(self.work_dir)
+        self.parsed = []
+        agent.logger = logging.getLogger('test_servicenow')
+        agent.logger.addHandler(logging.NullHandler())
+        agent.ATTEMPTS = 1
+        agent.SESSIONS = dict()
+        agent.REQUESTS = dict()
+        agent.track = {'current_row': []}
+        agent.UPDATED_FIELD = 'sys_updated_on'
+        agent.ID_FIELD = 'sys_id'
+        agent.SYS_ID_SHARDS = '0123456789abcdef'
+        agent.PAGE_QUEUE_SIZE = 32
+        agent.STATE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+        agent.GLIDE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+        agent.parse_json_message = lambda api_json: self.parsed.extend(
+            record['sys_id'] for record in api_json['result'])
+        agent.if_config_vars = {'if_pool_size': 4}
+        agent.cli_config_vars = {'testing': False, 'config': os.path.join(self.work_dir, 'config.ini')}
+        agent.agent_config_vars = {
+            'api_url': 'http://127.0.0.1:{}/api/now/table/incident'.format(self.server.server_port),
+            'proxies': dict(),
+            'username': 'user',
+            'password': agent.ifobfuscate.obfuscate('password'),
+            'addl_query': '',
+            'page_size': 5,
+            'thread_pool': 4,
+            'timezone': pytz.utc,
+            # the user's timestamp_format must not matter for paging
+            'timestamp_format': ['%d/%m/%Y %H:%M'],
+            'timestamp_field': ['sys_updated_on'],
+            'is_historical': False,
+            'cron_start_time': None,
+            'start_time': '',
+            'end_time': '',
+            'state': {'last_updated_on': glide_time(NOW - 3600)},
+        }
+
+    def tearDown(self):
+        for session in agent.SESSIONS.values():
+            session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def add_records(self, count, epochs):
+        for number in range(count):
+            self.server.records.append({'sys_id': hashlib.md5(str(number).encode()).hexdigest(),
+                                        'sys_updated_on': glide_time(epochs[number % len(epochs)])})
+
+    def test_every_record_is_fetched_once(self):
+        # many records per second, so pages end part-way through a second
+        self.add_records(400, [NOW - 60, NOW - 59, NOW - 30])
+        agent.start_data_processing(0)
+        expected = sorted(record['sys_id'] for record in self.server.records)
+        self.assertEqual(sorted(self.parsed), expected)
+        self.assertEqual(sorted(self.server.served), expected)
+
+    def test_run_stops_at_the_instance_time_and_moves_the_state(self):
+        self.add_records(20, [NOW - 10])
+        self.server.records.append({'sys_id': 'f' * 32, 'sys_updated_on': glide_time(NOW + 5)})
+        self.server.records.append({'sys_id': 'e' * 32, 'sys_updated_on': glide_time(NOW - 7200)})
+        agent.start_data_processing(0)
+        self.assertEqual(len(self.parsed), 20)
+        self.assertNotIn('f' * 32, self.parsed)
+        self.assertNotIn('e' * 32, self.parsed)
+        self.assertEqual(agent.agent_config_vars['state']['last_updated_on'], glide_time(NOW))
+
+    def test_failed_shard_leaves_the_state_alone(self):
+        self.add_records(100, [NOW - 10, NOW - 20])
+        self.server.failing = '3'
+        agent.start_data_processing(0)
+        self.assertEqual(agent.agent_config_vars['state']['last_updated_on'], glide_time(NOW - 3600))
+        self.assertFalse([sys_id for sys_id in self.parsed if sys_id.startswith('3')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Benchmark for the InsightFinder statsite sink.
+
+Feeds a generated statsite flush through the sink's stdin, with the sink posting to
+a local HTTP server instead of InsightFinder, and reports the time taken, the number
+and size of the requests made and the sink's peak memory.
+
+    python benchmark.py --lines 1000000
+"""
+
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from optparse import OptionParser
+
+requests_received = []
+
+
+class CountingHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        requests_received.append(len(body))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_flush(path, lines, keys, timestamps):
+    """ write a statsite flush of key|value|timestamp lines """
+    start = int(time.time())
+    with open(path, 'w') as f:
+        for i in xrange(lines):
+            f.write('timers.rn_app.all.host-%d.us-east.svc.metric_%d.mean|%d.%d|%d\n' % (
+                i % 100, i % keys, i, i % 1000, start + 10 * (i % timestamps)))
+
+
+def main():
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--lines', type='int', default=1000000, help='Number of lines in the flush')
+    parser.add_option('--keys', type='int', default=0, help='Number of distinct metric keys. Default is one per line')
+    parser.add_option('--timestamps', type='int', default=1, help='Number of distinct timestamps')
+    parser.add_option('--flush-kb', type='int', default=3000, dest='flush_kb', help='flush_kb given to the sink')
+    (options, args) = parser.parse_args()
+
+    sink = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'insightfinder.py')
+    work_dir = tempfile.mkdtemp()
+    try:
+        server = HTTPServer(('127.0.0.1', 0), CountingHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        with open(os.path.join(work_dir, 'insightfinder.ini'), 'w') as f:
+            f.write('[insightfinder]\nusername = benchmark\nproject_name = benchmark\nlicense_key = benchmark\n'
+                    'url = http://127.0.0.1:%d\n' % server.server_port)
+        flush_file = os.path.join(work_dir, 'flush.txt')
+        write_flush(flush_file, options.lines, options.keys or options.lines, options.timestamps)
+
+        start_time = time.time()
+        with open(flush_file) as stdin:
+            subprocess.check_call([sys.executable, sink, 'insightfinder.ini', 'INFO', '1', str(options.flush_kb)],
+                                  stdin=stdin, cwd=work_dir)
+        elapsed = time.time() - start_time
+        server.shutdown()
+    finally:
+        shutil.rmtree(work_dir)
+
+    print 'lines:          %d' % options.lines
+    print 'time:           %.1f s (%d lines/s)' % (elapsed, options.lines / elapsed)
+    print 'requests:       %d' % len(requests_received)
+    print 'largest POST:   %d KB' % (max(requests_received or [0]) / 1024)
+    print 'sink peak RSS:  %d MB' % (resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+if __name__ == '__main__':
+    main()
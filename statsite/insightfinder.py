@@ -51,6 +51,8 @@ SLASHES = re.compile(r"\/+")
 NON_ALNUM = re.compile(r"[^a-zA-Z_\-0-9\.]")
 GROUPING_START = 10000
 GROUPING_END = 11000
+# number of statsite keys whose metric field is remembered
+METRIC_FIELD_CACHE_SIZE = 100000
 
 
 class InsightfinderStore(object):
@@ -87,10 +89,16 @@ class InsightfinderStore(object):
         self.attempts = attempts
         self.metrics_map = {}
         self.to_send_metrics = []
+        # size of metrics_map once sent as JSON, kept as metrics are appended
+        self.chunk_size = 0
+        # metric field for each raw statsite key
+        self.metric_fields = {}
         self.cfg = cfg
         self.load(cfg)
         self.temp_group_id = 10000
         self.flush_kb = int(flush_kb)
+        self.instance_name = socket.gethostname().partition(".")[0]
+        self.session = requests.Session()
         self._load_grouping()
 
     def load(self, cfg):
@@ -137,6 +145,21 @@ class InsightfinderStore(object):
         if ini.has_option(sect, 'filter_string'):
             self.filter_string = ini.get(sect, 'filter_string')
 
+        self.host_slice = self._parse_range(self.host_range)
+        self.metric_name_slice = self._parse_range(self.metric_name_range)
+
+    def _parse_range(self, split_range):
+        """ Parses a 'start,end' or 'start' range setting into a (start, end) tuple, end being None if not set """
+        if not split_range:
+            return None
+        try:
+            spl_list = split_range.split(',')
+            spl_right = int(spl_list[1]) if len(spl_list) == 2 else None
+            return int(spl_list[0]), spl_right
+        except ValueError:
+            self.logger.warning("Unable to parse metric key range " + split_range)
+            return None
+
     
     def _load_grouping(self):
         if (os.path.isfile('grouping.json')):
@@ -194,46 +217,54 @@ class InsightfinderStore(object):
         Parameters:
         - `metric` : A string entry with format key|value|timestamp.
         """
-        if not metric and metric.count("|") != 2:
+        if not metric or metric.count("|") < 2:
             return
-        hostname = socket.gethostname()
 
-        if len(metric) != 0:
-            metric_split = metric.split("|")
-            metric_key = self.normalize_key(metric_split[0])
-            metric_value = metric_split[1]
-            timestamp = int(metric_split[2])
+        metric_split = metric.split("|")
+        metric_value = metric_split[1]
+        timestamp = int(metric_split[2])
 
-            hostname = self._get_detail_from_metric(metric_key, self.host_range).replace("_", "-")
-            metric_name = self._get_detail_from_metric(metric_key, self.metric_name_range)
+        metric_field = self.metric_fields.get(metric_split[0])
+        if metric_field is None:
+            metric_field = self._get_metric_field(metric_split[0])
+            if len(self.metric_fields) >= METRIC_FIELD_CACHE_SIZE:
+                self.metric_fields.clear()
+            self.metric_fields[metric_split[0]] = metric_field
 
-            if timestamp in self.metrics_map:
-                value_map = self.metrics_map[timestamp]
-            else:
-                value_map = {}
-
-            value_map[metric_name + '[' + hostname + ']:' +
-                      str(self._get_grouping_id(metric_name))] = metric_value
-            self.temp_group_id += 1
+        if timestamp in self.metrics_map:
+            value_map = self.metrics_map[timestamp]
+        else:
+            value_map = {}
             self.metrics_map[timestamp] = value_map
-
-
-    def _get_detail_from_metric(self, metric_key, split_range):
-        """ Extracts the details from metric key with provided range """
+            # {"timestamp": "<timestamp>000"}, 
+            self.chunk_size += len(str(timestamp)) + 22
+
+        previous_value = value_map.get(metric_field)
+        value_map[metric_field] = metric_value
+        if previous_value is None:
+            # "<field>": "<value>", 
+            self.chunk_size += len(metric_field) + len(metric_value) + 8
+        else:
+            self.chunk_size += len(metric_value) - len(previous_value)
+        self.temp_group_id += 1
+
+    def _get_metric_field(self, key):
+        """ Builds the InsightFinder metric field for a statsite key """
+        metric_key = self.normalize_key(key)
+        hostname = self._get_detail_from_metric(metric_key, self.host_slice).replace("_", "-")
+        metric_name = self._get_detail_from_metric(metric_key, self.metric_name_slice)
+        return metric_name + '[' + hostname + ']:' + str(self._get_grouping_id(metric_name))
+
+    def _get_detail_from_metric(self, metric_key, split_slice):
+        """ Extracts the details from metric key with provided (start, end) range """
         parsed_metric = metric_key
-        try:
-            if metric_key and split_range:
-                metric_info = metric_key.split('.')
-                spl_list = split_range.split(',')
-                spl_left = int(spl_list[0])
-                if len(spl_list) == 2:
-                    spl_right = int(spl_list[1])
-                    if len(metric_info) > spl_right:
-                        parsed_metric = '.'.join(metric_info[spl_left:spl_right])
-                else:
-                    parsed_metric = '.'.join(metric_info[spl_left:])
-        except:
-            self.logger.warning("Unable to parse metric key")
+        if metric_key and split_slice:
+            metric_info = metric_key.split('.')
+            spl_left, spl_right = split_slice
+            if spl_right is None:
+                parsed_metric = '.'.join(metric_info[spl_left:])
+            elif len(metric_info) > spl_right:
+                parsed_metric = '.'.join(metric_info[spl_left:spl_right])
         return parsed_metric
 
 
@@ -243,6 +274,7 @@ class InsightfinderStore(object):
         self._flush_lines()
         self.metrics_map = {}
         self.to_send_metrics = []
+        self.chunk_size = 0
 
 
     def _flush_lines(self):
@@ -288,21 +320,18 @@ class InsightfinderStore(object):
         to_send_data_dict["licenseKey"] = self.license_key
         to_send_data_dict["projectName"] = self.project_name
         to_send_data_dict["userName"] = self.username
-        to_send_data_dict["instanceName"] = socket.gethostname().partition(".")[
-            0]
+        to_send_data_dict["instanceName"] = self.instance_name
         to_send_data_dict["samplingInterval"] = str(self.sampling_interval)
         to_send_data_dict["agentType"] = "custom"
 
-        to_send_data_json = json.dumps(to_send_data_dict)
-        self.logger.debug(
-            "TotalData: " + str(len(bytearray(to_send_data_json))) + "bytes")
+        data_size = len(bytearray(to_send_data_dict["metricData"]))
+        self.logger.debug("TotalData: " + str(data_size) + "bytes")
 
-        # send the data
+        # send the data, reusing the connection between chunks
         postUrl = self.url + "/customprojectrawdata"
-        response = requests.post(postUrl, data=json.loads(to_send_data_json))
+        response = self.session.post(postUrl, data=to_send_data_dict)
         if response.status_code == 200:
-            self.logger.info(str(len(bytearray(to_send_data_json))
-                                 ) + " bytes of data are reported.")
+            self.logger.info(str(data_size) + " bytes of data are reported.")
         else:
             self.logger.exception("Failed to send data.")
             raise IOError("Failed to send request to " + postUrl)
@@ -323,8 +352,7 @@ def main():
     for line in sys.stdin:
         if insightfinder.filter_string not in line:
             continue
-        map_size = len(bytearray(json.dumps(insightfinder.metrics_map)))
-        if map_size >= insightfinder.flush_kb * 1000:
+        if insightfinder.chunk_size >= insightfinder.flush_kb * 1000:
             insightfinder.logger.debug("Flushing chunk number: " + str(current_chunk))
             insightfinder.send_metrics()
             current_chunk += 1
@@ -1,23 +1,28 @@
 #!/usr/bin/env python
 import ConfigParser
+import array
 import collections
+import Queue
 import json
+import zlib
 import logging
 import os
 import re
 import socket
+import struct
 import sys
+import threading
 import time
 import pytz
 from optparse import OptionParser
-from multiprocessing import Process
+from multiprocessing import Process, Pool
 from itertools import islice
 from datetime import datetime
 import dateutil
+import urllib
 import urlparse
 import httplib
 import requests
-import statistics
 import subprocess
 import shlex
 
@@ -28,16 +33,101 @@ This script gathers data to send to Insightfinder
 
 def start_data_processing(thread_number):
     if is_replay() and len(agent_config_vars['files']) != 0:
-        for pcap_file in agent_config_vars['files']:
-            cur_log = reset_cur_log()
-            for line in read_tcpdump(pcap_file):
-                cur_log = process_tcpdump_line(line, cur_log)
+        if cli_config_vars['threads'] > 1:
+            replay_in_parallel(cli_config_vars['threads'])
+        else:
+            for pcap_file in agent_config_vars['files']:
+                replay_pcap_file(pcap_file)
+    elif agent_config_vars['pcap_reader'] == 'PYTHON':
+        read_pcap_live()
     else:
         cur_log = reset_cur_log()
         for line in read_tcpdump():
             cur_log = process_tcpdump_line(line, cur_log)
 
 
+def replay_pcap_file(pcap_file, start=0, end=None):
+    """ send the packets of a pcap file, or the ones starting in [start, end) of it """
+    if agent_config_vars['pcap_reader'] == 'PYTHON':
+        with open(pcap_file, 'rb') as f:
+            for packet in read_pcap(f, start, end):
+                pcap_packet_handoff(*packet)
+        flush_flows()
+    else:
+        cur_log = reset_cur_log()
+        for line in read_tcpdump(pcap_file):
+            cur_log = process_tcpdump_line(line, cur_log)
+        # the last packet has no next header to send it
+        if cur_log['timestamp']:
+            timestamp = cur_log.pop('timestamp')
+            log_handoff(timestamp, cur_log, HOSTNAME)
+
+
+def replay_in_parallel(processes):
+    """ split the pcap files, or ranges of them, between worker processes, each with its own chunk buffer and senders """
+    start_time = time.time()
+    tasks = get_replay_tasks()
+    logger.info('Replaying {} files as {} tasks with {} processes'.format(
+        len(agent_config_vars['files']), len(tasks), processes))
+
+    totals = {'bytes': 0, 'entries': 0, 'chunks': 0}
+    pool = Pool(processes)
+    for task, stats in pool.imap_unordered(replay_task, tasks):
+        for stat in totals:
+            totals[stat] += stats[stat]
+        logger.debug('Replayed {} from {} to {}'.format(task[0], task[2], task[3]))
+    pool.close()
+    pool.join()
+
+    elapsed = max(time.time() - start_time, 0.001)
+    logger.info('Replayed {} MB, {} entries in {} chunks in {} seconds: {} MB/s, {} entries/s'.format(
+        round(totals['bytes'] / 1048576.0, 1), totals['entries'], totals['chunks'], round(elapsed, 1),
+        round(totals['bytes'] / 1048576.0 / elapsed, 1), int(totals['entries'] / elapsed)))
+
+
+def get_replay_tasks():
+    """ list (filename, size, start, end) for each file, or each range of a large file that's decoded here """
+    # flows in an interval would be split between ranges
+    splittable = agent_config_vars['pcap_reader'] == 'PYTHON' and 'METRIC' not in if_config_vars['project_type']
+    split_size = agent_config_vars['replay_split_size']
+    tasks = []
+    for pcap_file in agent_config_vars['files']:
+        try:
+            size = os.path.getsize(pcap_file)
+        except OSError:
+            continue
+        if not splittable or size <= split_size:
+            tasks.append((pcap_file, size, 0, None))
+            continue
+        for start in range(0, size, split_size):
+            tasks.append((pcap_file, size, start, min(start + split_size, size)))
+    return tasks
+
+
+def replay_task(task):
+    """ send one file or range of a file from a worker process. returns the task and what was sent """
+    pcap_file, size, start, end = task
+    reset_track()
+    track['chunk_count'] = 0
+    track['entry_count'] = 0
+    start_upload_workers()
+    try:
+        replay_pcap_file(pcap_file, start, end)
+        # last chunk
+        if len(track['current_row']) > 0 or len(track['current_dict']) > 0:
+            send_data_wrapper()
+    except Exception as e:
+        logger.warning('Error when replaying {}'.format(pcap_file))
+        logger.warning(e)
+    finally:
+        stop_upload_workers()
+    return task, {
+        'bytes': (end if end is not None else size) - start,
+        'entries': track['entry_count'],
+        'chunks': track['chunk_count']
+    }
+
+
 def reset_cur_log():
     return {'header': dict(), 'packet': dict(), 'timestamp': ''}
 
@@ -171,6 +261,446 @@ def read_tcpdump(pcap_file=''):
             yield line
 
 
+def read_pcap_live():
+    """ decode a live capture, which tcpdump writes out as pcap data instead of text """
+    cmd = 'tcpdump -U -w - {flags} {expression}'.format(
+        flags=agent_config_vars['tcpdump_flags'],
+        expression=agent_config_vars['tcpdump_expression'])
+    logger.debug(cmd)
+    proc = subprocess.Popen(format_command(cmd), stdout=subprocess.PIPE)
+    try:
+        for packet in read_pcap(proc.stdout):
+            pcap_packet_handoff(*packet)
+    finally:
+        # make sure process exits
+        proc.terminate()
+        proc.wait()
+    flush_flows()
+
+
+def pcap_packet_handoff(timestamp, linktype, frame, length):
+    cur_log = decode_frame(linktype, frame)
+    if cur_log is None:
+        return
+    if 'METRIC' in if_config_vars['project_type']:
+        add_flow_sample(timestamp, cur_log, length)
+    else:
+        filter_pcap_fields(cur_log)
+        log_handoff(timestamp, cur_log, HOSTNAME)
+
+
+def read_pcap(f, start=0, end=None):
+    """ yield (timestamp in ms, link type, frame, length on the wire) for each packet of a pcap or pcapng file,
+        or for each one starting in [start, end) of it """
+    magic = f.read(4)
+    if magic == PCAPNG_MAGIC:
+        packets = read_pcapng_blocks(f, start, end)
+    elif magic in PCAP_MAGICS:
+        packets = read_pcap_records(f, magic, start, end)
+    else:
+        logger.warning('Not a pcap or pcapng file')
+        return
+    for packet in packets:
+        yield packet
+
+
+def read_pcap_records(f, magic, start, end):
+    endian, frac_per_ms = PCAP_MAGICS[magic]
+    header = f.read(20)
+    if len(header) < 20:
+        return
+    snaplen, linktype = struct.unpack(endian + 'II', header[12:])
+    # the upper bits can hold FCS info
+    linktype &= 0xFFFF
+    record = struct.Struct(endian + 'IIII')
+    offset = 24
+    if start > offset:
+        # a record from a day before the first one is most likely bytes of another record
+        first = f.read(16)
+        if len(first) < 16:
+            return
+        min_ts = record.unpack(first)[0] - 86400
+        offset = find_pcap_record(f, start, end, record, frac_per_ms, snaplen, min_ts)
+        if offset is None:
+            return
+        f.seek(offset)
+    while end is None or offset < end:
+        header = f.read(16)
+        if len(header) < 16:
+            return
+        ts_sec, ts_frac, incl_len, orig_len = record.unpack(header)
+        frame = f.read(incl_len)
+        if len(frame) < incl_len:
+            logger.warning('Truncated pcap record at {}'.format(offset))
+            return
+        offset += 16 + incl_len
+        yield ts_sec * 1000 + ts_frac // frac_per_ms, linktype, frame, orig_len
+
+
+def find_pcap_record(f, start, end, record, frac_per_ms, snaplen, min_ts):
+    """ offset of the first record at or after start, or None if none start before end """
+    f.seek(start)
+    buf = f.read(PCAP_RESYNC_BYTES)
+    at_eof = len(buf) < PCAP_RESYNC_BYTES
+    for i in range(len(buf)):
+        if end is not None and start + i >= end:
+            return None
+        if is_pcap_record(buf, i, record, frac_per_ms * 1000, snaplen or 262144, min_ts, at_eof):
+            return start + i
+    return None
+
+
+def is_pcap_record(buf, i, record, max_frac, max_len, min_ts, at_eof):
+    """ whether a record header starts at buf[i], checked against the ones following it """
+    ts_prev = None
+    for _ in range(PCAP_RESYNC_RECORDS):
+        if i + 16 > len(buf):
+            # only fine if the file ends right after a record
+            return at_eof and i == len(buf) and ts_prev is not None
+        ts_sec, ts_frac, incl_len, orig_len = record.unpack_from(buf, i)
+        if ts_sec < min_ts or ts_frac >= max_frac or not 0 < incl_len <= min(orig_len, max_len):
+            return False
+        if ts_prev is not None and abs(ts_sec - ts_prev) > 86400:
+            return False
+        ts_prev = ts_sec
+        i += 16 + incl_len
+    return True
+
+
+def read_pcapng_blocks(f, start, end):
+    # (link type, timestamp units per second) for each interface of the section
+    interfaces = []
+    endian = '<'
+    offset = 0
+    resynced = start == 0
+    block_head = PCAPNG_MAGIC + f.read(4)
+    while end is None or offset < end:
+        if len(block_head) < 8:
+            return
+        if block_head[:4] == PCAPNG_MAGIC:
+            # a new section, which sets the byte order
+            byte_order = f.read(4)
+            endian = '<' if byte_order == '\x4d\x3c\x2b\x1a' else '>'
+            block_type, length = struct.unpack(endian + 'II', block_head)
+            body = byte_order + f.read(length - 12)
+            interfaces = []
+        else:
+            block_type, length = struct.unpack(endian + 'II', block_head)
+            if not resynced and block_type in PCAPNG_PACKET_BLOCKS:
+                resynced = True
+                if start > offset:
+                    offset = find_pcapng_block(f, start, end, endian)
+                    if offset is None:
+                        return
+                    f.seek(offset)
+                    block_head = f.read(8)
+                    continue
+            body = f.read(length - 8)
+        if length < 12 or length % 4 or len(body) < length - 8:
+            logger.warning('Bad pcapng block at {}'.format(offset))
+            return
+        offset += length
+        block_head = f.read(8)
+
+        if block_type == 1:
+            # interface description
+            linktype = struct.unpack(endian + 'H', body[:2])[0]
+            interfaces.append((linktype, get_pcapng_tsresol(body[8:-4], endian)))
+            continue
+        if block_type == 6:
+            interface_id, ts_high, ts_low, caplen, orig_len = struct.unpack(endian + 'IIIII', body[:20])
+        elif block_type == 2:
+            interface_id, _, ts_high, ts_low, caplen, orig_len = struct.unpack(endian + 'HHIIII', body[:20])
+        else:
+            # simple packet blocks have no timestamp
+            continue
+        if interface_id >= len(interfaces):
+            continue
+        linktype, units = interfaces[interface_id]
+        yield ((ts_high << 32) | ts_low) * 1000 // units, linktype, body[20:20 + caplen], orig_len
+
+
+def get_pcapng_tsresol(options, endian):
+    """ timestamp units per second of an interface, from its if_tsresol option """
+    i = 0
+    while i + 4 <= len(options):
+        code, length = struct.unpack(endian + 'HH', options[i:i + 4])
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            resol = ord(options[i + 4])
+            return 2 ** (resol & 0x7F) if resol & 0x80 else 10 ** resol
+        i += 4 + length + (-length % 4)
+    return 1000000
+
+
+def find_pcapng_block(f, start, end, endian):
+    """ offset of the first block at or after start, or None if none start before end """
+    # blocks are 32-bit aligned
+    start += -start % 4
+    f.seek(start)
+    buf = f.read(PCAP_RESYNC_BYTES)
+    at_eof = len(buf) < PCAP_RESYNC_BYTES
+    for i in range(0, len(buf), 4):
+        if end is not None and start + i >= end:
+            return None
+        if is_pcapng_block(buf, i, endian, at_eof):
+            return start + i
+    return None
+
+
+def is_pcapng_block(buf, i, endian, at_eof):
+    """ whether a block starts at buf[i]: its length is repeated at its end, as for the ones following it """
+    checked = 0
+    for _ in range(PCAP_RESYNC_RECORDS):
+        if i + 12 > len(buf):
+            # only fine if the file ends right after a block
+            return at_eof and i == len(buf) and checked > 0
+        block_type, length = struct.unpack(endian + 'II', buf[i:i + 8])
+        if block_type not in PCAPNG_BLOCK_TYPES or length < 12 or length % 4 or i + length > len(buf):
+            return False
+        if struct.unpack(endian + 'I', buf[i + length - 4:i + length])[0] != length:
+            return False
+        i += length
+        checked += 1
+    return True
+
+
+def decode_frame(linktype, frame):
+    """ decode a captured frame into the header/packet/source/target shape that parsing tcpdump's output gives.
+        returns None for link types that aren't handled """
+    cur_log = {'header': dict(), 'packet': dict()}
+    try:
+        if linktype == 1:
+            # Ethernet, maybe with VLAN tags
+            ethertype, i = struct.unpack('>H', frame[12:14])[0], 14
+            while ethertype in (0x8100, 0x88A8):
+                ethertype, i = struct.unpack('>H', frame[i + 2:i + 4])[0], i + 4
+        elif linktype == 113:
+            # Linux cooked capture
+            ethertype, i = struct.unpack('>H', frame[14:16])[0], 16
+        elif linktype == 276:
+            # Linux cooked capture v2
+            ethertype, i = struct.unpack('>H', frame[0:2])[0], 20
+        elif linktype in (12, 14, 101):
+            # raw IP
+            ethertype, i = 0x86DD if ord(frame[0]) >> 4 == 6 else 0x0800, 0
+        elif linktype == 0:
+            # BSD loopback, with the address family in the capturing host's byte order
+            family = struct.unpack('<I', frame[:4])[0]
+            if family > 0xFFFF:
+                family = struct.unpack('>I', frame[:4])[0]
+            ethertype, i = 0x0800 if family == 2 else 0x86DD, 4
+        else:
+            return None
+
+        if ethertype == 0x0800:
+            decode_ipv4(frame[i:], cur_log)
+        elif ethertype == 0x86DD:
+            decode_ipv6(frame[i:], cur_log)
+        elif ethertype == 0x0806:
+            decode_arp(frame[i:], cur_log)
+        else:
+            cur_log['header']['packet_type'] = 'ethertype 0x{:04x}'.format(ethertype)
+            cur_log['packet']['length'] = str(len(frame) - i)
+    except (struct.error, IndexError):
+        # truncated by the snaplen. keep what was decoded
+        pass
+    return cur_log
+
+
+def decode_ipv4(ip, cur_log):
+    ver_ihl, tos, total_length, ip_id, flags_offset, ttl, proto = struct.unpack('>BBHHHBB', ip[:10])
+    header_length = (ver_ihl & 0x0F) * 4
+    flags = [name for bit, name in IP_FLAGS if flags_offset & bit]
+    cur_log['header'].update({
+        'packet_type': 'IP',
+        'tos': '0x{:x}'.format(tos),
+        'ttl': str(ttl),
+        'id': str(ip_id),
+        'offset': str((flags_offset & 0x1FFF) * 8),
+        'flags': '[{}]'.format(', '.join(flags) or 'none'),
+        'proto': '{} ({})'.format(IP_PROTOCOLS.get(proto, 'unknown'), proto),
+        'length': str(total_length)
+    })
+    source = socket.inet_ntoa(ip[12:16])
+    target = socket.inet_ntoa(ip[16:20])
+    if flags_offset & 0x1FFF:
+        # only the first fragment has the transport header
+        cur_log['source'] = source
+        cur_log['target'] = target
+        return
+    decode_transport(proto, ip[header_length:total_length], total_length - header_length, source, target, cur_log)
+
+
+def decode_ipv6(ip, cur_log):
+    version_class_flow, payload_length, next_header, hlim = struct.unpack('>IHBB', ip[:8])
+    header = cur_log['header']
+    header['packet_type'] = 'IP6'
+    if version_class_flow & 0x0FF00000:
+        header['class'] = '0x{:x}'.format((version_class_flow >> 20) & 0xFF)
+    if version_class_flow & 0xFFFFF:
+        header['flowlabel'] = '0x{:05x}'.format(version_class_flow & 0xFFFFF)
+    header['hlim'] = str(hlim)
+    header['next-header'] = '{} ({})'.format(IP_PROTOCOLS.get(next_header, 'unknown'), next_header)
+    header['payload length'] = str(payload_length)
+    source = socket.inet_ntop(socket.AF_INET6, ip[8:24])
+    target = socket.inet_ntop(socket.AF_INET6, ip[24:40])
+    cur_log['source'] = source
+    cur_log['target'] = target
+
+    # skip the extension headers
+    i = 40
+    while next_header in IPV6_EXTENSION_HEADERS:
+        if next_header == 44:
+            # only the first fragment has the transport header
+            if struct.unpack('>H', ip[i + 2:i + 4])[0] & 0xFFF8:
+                return
+            next_header, i = ord(ip[i]), i + 8
+        else:
+            next_header, i = ord(ip[i]), i + (ord(ip[i + 1]) + 1) * 8
+    decode_transport(next_header, ip[i:40 + payload_length], 40 + payload_length - i, source, target, cur_log)
+
+
+def decode_transport(proto, segment, length, source, target, cur_log):
+    packet = cur_log['packet']
+    cur_log['source'] = source
+    cur_log['target'] = target
+    if proto == 6:
+        sport, dport, seq, ack, offset_flags, win, cksum, urp = struct.unpack('>HHIIHHHH', segment[:20])
+        data_offset = (offset_flags >> 12) * 4
+        flags = offset_flags & 0xFF
+        payload_length = length - data_offset
+        cur_log['source'] = '{}.{}'.format(source, sport)
+        cur_log['target'] = '{}.{}'.format(target, dport)
+        packet['Flags'] = '[{}]'.format(''.join(name for bit, name in TCP_FLAGS if flags & bit) or 'none')
+        packet['cksum'] = '0x{:04x}'.format(cksum)
+        # as tcpdump prints them, with absolute sequence numbers
+        if payload_length > 0:
+            packet['seq'] = '{}:{}'.format(seq, (seq + payload_length) & 0xFFFFFFFF)
+        elif flags & 0x07:
+            packet['seq'] = str(seq)
+        if flags & 0x10:
+            packet['ack'] = str(ack)
+        packet['win'] = str(win)
+        if flags & 0x20:
+            packet['urg'] = str(urp)
+        options = decode_tcp_options(segment[20:data_offset])
+        if options:
+            packet['options'] = options
+        packet['length'] = str(payload_length)
+    elif proto == 17:
+        sport, dport, udp_length, cksum = struct.unpack('>HHHH', segment[:8])
+        cur_log['source'] = '{}.{}'.format(source, sport)
+        cur_log['target'] = '{}.{}'.format(target, dport)
+        packet['cksum'] = '0x{:04x}'.format(cksum)
+        packet['length'] = str(udp_length - 8)
+    elif proto in (1, 58):
+        icmp_type, code, cksum = struct.unpack('>BBH', segment[:4])
+        packet['type'] = str(icmp_type)
+        packet['code'] = str(code)
+        packet['cksum'] = '0x{:04x}'.format(cksum)
+        packet['length'] = str(length)
+    else:
+        packet['length'] = str(length)
+
+
+def decode_tcp_options(options):
+    """ TCP options, as process_csv_kvs reads them from tcpdump's `options [...]` """
+    values = dict()
+    i = 0
+    while i < len(options):
+        kind = ord(options[i])
+        if kind == 0:
+            values['eol'] = ''
+            break
+        if kind == 1:
+            values['nop'] = ''
+            i += 1
+            continue
+        length = ord(options[i + 1]) if i + 1 < len(options) else 0
+        if length < 2:
+            break
+        value = options[i + 2:i + length]
+        if kind == 2 and len(value) == 2:
+            values['mss'] = str(struct.unpack('>H', value)[0])
+        elif kind == 3 and len(value) == 1:
+            values['wscale'] = str(ord(value))
+        elif kind == 4:
+            values['sackOK'] = ''
+        elif kind == 5:
+            blocks = ['{{{}:{}}}'.format(*struct.unpack('>II', value[j:j + 8])) for j in range(0, len(value) - 7, 8)]
+            values['sack'] = '{} {}'.format(len(blocks), ' '.join(blocks))
+        elif kind == 8 and len(value) == 8:
+            ts_val, ts_ecr = struct.unpack('>II', value)
+            values['TS'] = {'val': str(ts_val), 'ecr': str(ts_ecr)}
+        else:
+            values['unknown-{}'.format(kind)] = '0x{}'.format(value.encode('hex'))
+        i += length
+    return values
+
+
+def decode_arp(arp, cur_log):
+    htype, ptype, hlen, plen, oper = struct.unpack('>HHBBH', arp[:8])
+    sha = arp[8:8 + hlen]
+    spa = arp[8 + hlen:8 + hlen + plen]
+    tpa = arp[8 + 2 * hlen + plen:8 + 2 * (hlen + plen)]
+    if len(tpa) < plen:
+        raise IndexError('truncated ARP')
+    header = cur_log['header']
+    header['packet_type'] = 'ARP'
+    header['Ethernet' if htype == 1 else 'hardware {}'.format(htype)] = '(len {})'.format(hlen)
+    header['IPv4' if ptype == 0x0800 else 'protocol 0x{:04x}'.format(ptype)] = '(len {})'.format(plen)
+    spa = socket.inet_ntoa(spa) if plen == 4 else spa.encode('hex')
+    tpa = socket.inet_ntoa(tpa) if plen == 4 else tpa.encode('hex')
+    if oper == 1:
+        header['Request'] = 'who-has {} tell {}'.format(tpa, spa)
+    elif oper == 2:
+        header['Reply'] = '{} is-at {}'.format(spa, ':'.join('{:02x}'.format(ord(c)) for c in sha))
+    else:
+        header['op'] = str(oper)
+    header['length'] = str(8 + 2 * (hlen + plen))
+
+
+def filter_pcap_fields(cur_log):
+    """ keep only the data_fields, as process_csv_kvs does for tcpdump's output """
+    data_fields = agent_config_vars['data_fields']
+    if len(data_fields) == 0:
+        return
+    for part in ('header', 'packet'):
+        cur_log[part] = dict((key, value) for key, value in cur_log[part].items()
+                             if key in data_fields or key == 'packet_type')
+
+
+def add_flow_sample(timestamp, cur_log, length):
+    """ count a packet towards its flow's packets and bytes in its sampling interval.
+        intervals before it are sent, as captures are read in time order """
+    interval = if_config_vars['sampling_interval'] * 1000
+    timestamp -= timestamp % interval
+    if timestamp > flows['latest']:
+        flush_flows(timestamp)
+        flows['latest'] = timestamp
+
+    header = cur_log['header']
+    proto = header.get('proto') or header.get('next-header') or header.get('packet_type', 'unknown')
+    instance = '{}>{}'.format(cur_log['source'], cur_log['target']) if 'source' in cur_log else HOSTNAME
+    key = (timestamp, instance, proto.partition(' ')[0])
+    counts = flows['counts'].get(key)
+    if counts is None:
+        counts = flows['counts'][key] = [0, 0]
+    counts[0] += 1
+    counts[1] += length
+
+
+def flush_flows(before=None):
+    """ send each flow's packets and bytes for the intervals before the given one, or all of them """
+    for key in sorted(key for key in flows['counts'] if before is None or key[0] < before):
+        timestamp, instance, proto = key
+        packets, length = flows['counts'].pop(key)
+        metric_handoff(timestamp, 'packets', packets, instance, proto)
+        metric_handoff(timestamp, 'bytes', length, instance, proto)
+
+
 def get_agent_config_vars():
     """ Read and parse config.ini """
     if os.path.exists(os.path.abspath(os.path.join(__file__, os.pardir, 'config.ini'))):
@@ -187,17 +717,27 @@ def get_agent_config_vars():
 
             data_fields = config_parser.get('agent', 'data_fields')
 
+            pcap_reader = config_parser.get('agent', 'pcap_reader').upper() if config_parser.has_option(
+                'agent', 'pcap_reader') else ''
+            replay_split_size_mb = config_parser.get('agent', 'replay_split_size_mb') if config_parser.has_option(
+                'agent', 'replay_split_size_mb') else ''
+
         except ConfigParser.NoOptionError:
             logger.error('Agent not correctly configured. Check config file.')
             sys.exit(1)
 
         if len(file_path) != 0:
-            file_regex = re.compile(r".*\.pcap$")
+            file_regex = re.compile(r".*\.pcap(ng)?$")
             files = file_path.split(',')
             files = get_all_files(files, file_regex)
         else:
             files = ''
 
+        pcap_reader = pcap_reader or 'TCPDUMP'
+        if pcap_reader not in {'TCPDUMP', 'PYTHON'}:
+            logger.warning('Agent not correctly configured (pcap_reader). Check config file.')
+            sys.exit(1)
+
         # default flag(s)
         tcpdump_flags = '--immediate-mode '
 
@@ -243,6 +783,8 @@ def get_agent_config_vars():
             'files': files,
             'tcpdump_flags': tcpdump_flags,
             'tcpdump_expression': expression,
+            'pcap_reader': pcap_reader,
+            'replay_split_size': int(replay_split_size_mb or 64) * 1024 * 1024,
             'data_format': 'RAW',
             'data_fields': data_fields,
             'timestamp_field': 'timestamp',
@@ -277,6 +819,16 @@ def get_if_config_vars():
             if_url = config_parser.get('insightfinder', 'if_url')
             if_http_proxy = config_parser.get('insightfinder', 'if_http_proxy')
             if_https_proxy = config_parser.get('insightfinder', 'if_https_proxy')
+            if_pool_size = config_parser.get('insightfinder', 'if_pool_size') if config_parser.has_option(
+                'insightfinder', 'if_pool_size') else ''
+            if_compress = config_parser.get('insightfinder', 'if_compress') if config_parser.has_option(
+                'insightfinder', 'if_compress') else ''
+            upload_workers = config_parser.get('insightfinder', 'upload_workers') if config_parser.has_option(
+                'insightfinder', 'upload_workers') else ''
+            upload_queue_size = config_parser.get('insightfinder', 'upload_queue_size') if config_parser.has_option(
+                'insightfinder', 'upload_queue_size') else ''
+            metric_aggregation = config_parser.get('insightfinder', 'metric_aggregation') if config_parser.has_option(
+                'insightfinder', 'metric_aggregation') else ''
         except ConfigParser.NoOptionError as cp_noe:
             logger.error('Agent not correctly configured. Check config file.')
             logger.error(cp_noe)
@@ -338,6 +890,10 @@ def get_if_config_vars():
             chunk_size_kb = 2048  # 2MB chunks by default
         if len(if_url) == 0:
             if_url = 'https://app.insightfinder.com'
+        metric_aggregation = metric_aggregation.lower() or 'median'
+        if metric_aggregation not in METRIC_AGGREGATIONS:
+            logger.warning('Agent not correctly configured (metric_aggregation). Check config file.')
+            sys.exit(1)
 
         # set IF proxies
         if_proxies = dict()
@@ -356,7 +912,12 @@ def get_if_config_vars():
             'run_interval': int(run_interval),              # as seconds
             'chunk_size': int(chunk_size_kb) * 1024,        # as bytes
             'if_url': if_url,
-            'if_proxies': if_proxies
+            'if_proxies': if_proxies,
+            'if_pool_size': int(if_pool_size or 10),
+            'if_compress': if_compress.upper() == 'TRUE',
+            'upload_workers': int(upload_workers or 1),
+            'upload_queue_size': int(upload_queue_size or 4),
+            'metric_aggregation': metric_aggregation
         }
 
         return config_vars
@@ -369,11 +930,8 @@ def get_cli_config_vars():
     """ get CLI options. use of these options should be rare """
     usage = 'Usage: %prog [options]'
     parser = OptionParser(usage=usage)
-    """
-    ## not ready.
     parser.add_option('--threads', default=1, action='store', dest='threads',
-                      help='Number of threads to run')
-    """
+                      help='Number of processes to replay pcap files with')
     parser.add_option('--tz', default='UTC', action='store', dest='time_zone',
                       help='Timezone of the data. See pytz.all_timezones')
     parser.add_option('-q', '--quiet', action='store_true', dest='quiet',
@@ -385,16 +943,13 @@ def get_cli_config_vars():
                            ' Automatically turns on verbose logging')
     (options, args) = parser.parse_args()
 
-    """
-    # not ready
     try:
-        threads = int(options.threads)
+        threads = max(int(options.threads), 1)
     except ValueError:
         threads = 1
-    """
 
     config_vars = {
-        'threads': 1,
+        'threads': threads,
         'testing': False,
         'log_level': logging.INFO,
         'time_zone': pytz.utc
@@ -576,6 +1131,17 @@ def get_json_size_bytes(json_data):
     return len(bytearray(json.dumps(json_data)))
 
 
+def get_json_separator_size(json_data):
+    """ size of the ', ' that json.dumps puts before every item but the first """
+    return 2 if len(json_data) > 1 else 0
+
+
+def append_to_current_row(entry):
+    """ add an entry to the current chunk, keeping a running count of its size in bytes """
+    track['current_row'].append(entry)
+    track['current_row_size'] += get_json_size_bytes(entry) + get_json_separator_size(track['current_row'])
+
+
 def get_all_files(files, file_regex_c):
     return [ i for j in
                 map(lambda k:
@@ -1089,12 +1655,18 @@ def initialize_data_gathering(thread_number):
     track['chunk_count'] = 0
     track['entry_count'] = 0
 
-    start_data_processing(thread_number)
+    start_upload_workers()
 
-    # last chunk
-    if len(track['current_row']) > 0 or len(track['current_dict']) > 0:
-        logger.debug('Sending last chunk')
-        send_data_wrapper()
+    try:
+        start_data_processing(thread_number)
+
+        # last chunk
+        if len(track['current_row']) > 0 or len(track['current_dict']) > 0:
+            logger.debug('Sending last chunk')
+            send_data_wrapper()
+    finally:
+        # send what was already queued, even if reading stopped on an error
+        stop_upload_workers()
 
     logger.debug('Total chunks created: ' + str(track['chunk_count']))
     logger.debug('Total {} entries: {}'.format(
@@ -1106,7 +1678,10 @@ def reset_track():
     track['start_time'] = time.time()
     track['line_count'] = 0
     track['current_row'] = []
+    track['current_row_size'] = 2  # '[]'
     track['current_dict'] = dict()
+    track['current_dict_size'] = 2  # '{}'
+    track['metric_samples'] = []
 
 
 #########################################
@@ -1130,14 +1705,14 @@ def log_handoff(timestamp, data, instance, device=''):
 
 def send_log(timestamp, data, instance, device=''):
     entry = prepare_log_entry(str(int(timestamp)), data, instance, device)
-    track['current_row'].append(entry)
+    append_to_current_row(entry)
     track['line_count'] += 1
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
+    if track['current_row_size'] >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 100 == 0:
         logger.debug('Current data object size: {} bytes'.format(
-            get_json_size_bytes(track['current_row'])))
+            track['current_row_size']))
 
 
 def prepare_log_entry(timestamp, data, instance, device=''):
@@ -1163,11 +1738,11 @@ def metric_handoff(timestamp, field_name, data, instance, device=''):
 def send_metric(timestamp, field_name, data, instance, device=''):
     append_metric_data_to_entry(timestamp, field_name, data, instance, device)
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_dict']) >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
+    if track['current_dict_size'] >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 500 == 0:
         logger.debug('Current data object size: {} bytes'.format(
-            get_json_size_bytes(track['current_dict'])))
+            track['current_dict_size']))
 
 
 def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''):
@@ -1177,30 +1752,53 @@ def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''
     ts_str = str(timestamp)
     if ts_str not in track['current_dict']:
         track['current_dict'][ts_str] = dict()
+        # '"<ts>": {}'
+        track['current_dict_size'] += get_json_size_bytes(ts_str) + 4 + get_json_separator_size(track['current_dict'])
     current_obj = track['current_dict'][ts_str]
 
-    # use the next non-null value to overwrite the prev value
-    # for the same metric in the same timestamp
-    if key in current_obj.keys():
+    # keep each non-null value for the same metric in the same timestamp,
+    # to be aggregated when the chunk is sent
+    if key in current_obj:
         if data is not None and len(str(data)) > 0:
-            current_obj[key] += '|' + str(data)
+            add_metric_sample(current_obj, key, data)
     else:
         current_obj[key] = str(data)
+        # '"<key>": "<value>"'
+        track['current_dict_size'] += get_json_size_bytes(key) + 2 + get_json_size_bytes(current_obj[key]) + \
+            get_json_separator_size(current_obj)
     track['current_dict'][ts_str] = current_obj
 
 
+def add_metric_sample(current_obj, key, data):
+    """ add another value to a metric at a timestamp, keeping them as doubles until they're aggregated """
+    samples = current_obj[key]
+    if not isinstance(samples, array.array):
+        # the aggregate can be as long as any float
+        track['current_dict_size'] += max(METRIC_VALUE_SIZE - len(samples), 0)
+        samples = current_obj[key] = array.array('d', [float(samples)])
+        track['metric_samples'].append((current_obj, key))
+    samples.append(float(data))
+
+
 def transpose_metrics():
     """ flatten data up to the timestamp"""
-    for timestamp, kvs in track['current_dict'].itemss():
+    # aggregate every metric with more than one value in one pass
+    aggregate = METRIC_AGGREGATIONS[if_config_vars['metric_aggregation']]
+    for current_obj, key in track['metric_samples']:
+        current_obj[key] = str(aggregate(current_obj[key]))
+    for timestamp, kvs in track['current_dict'].items():
         track['line_count'] += 1
-        new_row = dict()
-        new_row['timestamp'] = timestamp
-        for key, value in kvs.items():
-            if '|' in value:
-                value = statistics.median(
-                    map(lambda v: float(v), value.split('|')))
-            new_row[key] = str(value)
-        track['current_row'].append(new_row)
+        kvs['timestamp'] = timestamp
+        track['current_row'].append(kvs)
+
+
+def get_median(values):
+    """ median of a list of numbers, as statistics.median """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
 
 
 def build_metric_name_map():
@@ -1315,12 +1913,62 @@ def send_data_wrapper():
         transpose_metrics()
     logger.debug('--- Chunk creation time: {} seconds ---'.format(
         round(time.time() - track['start_time'], 2)))
-    send_data_to_if(track['current_row'])
+    if upload['workers']:
+        # blocks while the queue is full, so parsing can't run too far ahead of sending
+        upload['queue'].put((track['current_row'], track['line_count']))
+        upload['max_depth'] = max(upload['max_depth'], upload['queue'].qsize())
+        logger.debug('Upload queue depth: {}, in flight: {}'.format(
+            upload['queue'].qsize(), upload['in_flight']))
+    else:
+        send_data_to_if(track['current_row'], track['line_count'])
     track['chunk_count'] += 1
     reset_track()
 
 
-def send_data_to_if(chunk_metric_data):
+def start_upload_workers():
+    """ start the threads that send chunks to IF in the background """
+    upload['queue'] = Queue.Queue(maxsize=if_config_vars['upload_queue_size'])
+    upload['lock'] = threading.Lock()
+    upload['in_flight'] = 0
+    upload['max_depth'] = 0
+    upload['workers'] = []
+    for i in range(if_config_vars['upload_workers']):
+        worker = threading.Thread(target=upload_worker, name='upload-{}'.format(i))
+        worker.daemon = True
+        worker.start()
+        upload['workers'].append(worker)
+
+
+def stop_upload_workers():
+    """ wait for all queued chunks to be sent, then stop the upload threads """
+    logger.debug('Draining upload queue: {} queued, {} in flight'.format(
+        upload['queue'].qsize(), upload['in_flight']))
+    for _ in upload['workers']:
+        upload['queue'].put(None)
+    for worker in upload['workers']:
+        worker.join()
+    upload['workers'] = []
+    logger.debug('Max upload queue depth: {}'.format(upload['max_depth']))
+
+
+def upload_worker():
+    while True:
+        chunk = upload['queue'].get()
+        if chunk is None:
+            return
+        with upload['lock']:
+            upload['in_flight'] += 1
+        try:
+            send_data_to_if(*chunk)
+        except Exception as e:
+            logger.warning('Error when sending chunk')
+            logger.warning(e)
+        finally:
+            with upload['lock']:
+                upload['in_flight'] -= 1
+
+
+def send_data_to_if(chunk_metric_data, line_count):
     send_data_time = time.time()
 
     # prepare data for metric streaming agent
@@ -1333,7 +1981,7 @@ def send_data_to_if(chunk_metric_data):
     logger.debug('First:\n' + str(chunk_metric_data[0]))
     logger.debug('Last:\n' + str(chunk_metric_data[-1]))
     logger.debug('Total Data (bytes): ' + str(get_json_size_bytes(data_to_post)))
-    logger.debug('Total Lines: ' + str(track['line_count']))
+    logger.debug('Total Lines: ' + str(line_count))
 
     # do not send if only testing
     if cli_config_vars['testing']:
@@ -1341,22 +1989,51 @@ def send_data_to_if(chunk_metric_data):
 
     # send the data
     post_url = urlparse.urljoin(if_config_vars['if_url'], get_api_from_project_type())
+    post_data = data_to_post
+    post_headers = None
+    if if_config_vars['if_compress']:
+        post_data = gzip_compress(urllib.urlencode(data_to_post))
+        post_headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'}
     send_request(post_url, 'POST', 'Could not send request to IF',
                  str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
-                 data=data_to_post, proxies=if_config_vars['if_proxies'])
+                 data=post_data, headers=post_headers, proxies=if_config_vars['if_proxies'])
     logger.debug('--- Send data time: %s seconds ---' % round(time.time() - send_data_time, 2))
 
 
+def get_request_session():
+    """ get this thread's pooled session, so connections are reused between requests """
+    # requests.Session is not thread-safe, so each upload thread gets its own
+    pid = (os.getpid(), threading.current_thread().ident)
+    if pid not in SESSIONS:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=if_config_vars['if_pool_size'],
+                                                pool_maxsize=if_config_vars['if_pool_size'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        SESSIONS[pid] = session
+    return SESSIONS[pid]
+
+
+def gzip_compress(data):
+    """ gzip a request body """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
 def send_request(url, mode='GET', failure_message='Failure!', success_message='Success!', **request_passthrough):
     """ sends a request to the given url """
     # determine if post or get (default)
-    req = requests.get
+    session = get_request_session()
+    req = session.get
     if mode.upper() == 'POST':
-        req = requests.post
+        req = session.post
 
     for i in range(ATTEMPTS):
         try:
+            request_time = time.time()
             response = req(url, **request_passthrough)
+            logger.debug('Request took {} seconds, {} bytes sent, {} bytes received'.format(
+                round(time.time() - request_time, 3), len(response.request.body or ''), len(response.content)))
             if response.status_code == httplib.OK:
                 logger.info(success_message)
                 return response
@@ -1484,7 +2161,35 @@ if __name__ == "__main__":
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = ','
     ATTEMPTS = 3
+    METRIC_AGGREGATIONS = {
+        'median': get_median,
+        'mean': lambda values: sum(values) / len(values),
+        'min': min,
+        'max': max,
+        'last': lambda values: values[-1]
+    }
+    METRIC_VALUE_SIZE = 19  # longest str() of a float
+    PCAPNG_MAGIC = '\x0a\x0d\x0d\x0a'
+    # (byte order, timestamp fractions per ms) for micro- and nanosecond pcap files
+    PCAP_MAGICS = {
+        '\xd4\xc3\xb2\xa1': ('<', 1000),
+        '\x4d\x3c\xb2\xa1': ('<', 1000000),
+        '\xa1\xb2\xc3\xd4': ('>', 1000),
+        '\xa1\xb2\x3c\x4d': ('>', 1000000)
+    }
+    PCAPNG_BLOCK_TYPES = {1, 2, 3, 4, 5, 6, 0x0A0D0D0A}
+    PCAPNG_PACKET_BLOCKS = {2, 3, 6}
+    PCAP_RESYNC_BYTES = 4 * 1024 * 1024
+    PCAP_RESYNC_RECORDS = 3
+    IP_PROTOCOLS = {0: 'Options', 1: 'ICMP', 2: 'IGMP', 4: 'IPIP', 6: 'TCP', 17: 'UDP', 41: 'IPv6', 43: 'Routing',
+                    44: 'Frag', 47: 'GRE', 50: 'ESP', 51: 'AH', 58: 'ICMPv6', 60: 'DSTOPTS', 132: 'SCTP'}
+    IPV6_EXTENSION_HEADERS = {0, 43, 44, 60}
+    IP_FLAGS = ((0x2000, '+'), (0x4000, 'DF'))
+    TCP_FLAGS = ((0x01, 'F'), (0x02, 'S'), (0x04, 'R'), (0x08, 'P'), (0x10, '.'), (0x20, 'U'), (0x40, 'E'), (0x80, 'W'))
+    SESSIONS = dict()
     track = dict()
+    upload = dict()
+    flows = {'latest': 0, 'counts': dict()}
 
     # get config
     cli_config_vars = get_cli_config_vars()
@@ -1493,8 +2198,7 @@ if __name__ == "__main__":
     agent_config_vars = get_agent_config_vars()
     print_summary_info()
 
-    # start data processing
-    for i in range(0, cli_config_vars['threads']):
-        Process(target=initialize_data_gathering,
-                args=(i,)
-                ).start()
+    # start data processing. replays are split between cli_config_vars['threads'] processes from there
+    Process(target=initialize_data_gathering,
+            args=(0,)
+            ).start()
@@ -0,0 +1,169 @@
+"""
+Benchmark for insightagent-boilerplate.py.
+
+Feeds generated metric or log entries through the agent's handoff functions, with the agent
+posting to a local HTTP server instead of InsightFinder, and reports the time taken and the
+number and size of the requests made. In timestamp mode the log entries' millisecond date
+strings are parsed by the agent first.
+
+    python benchmark.py --mode metric --entries 1000000
+    python benchmark.py --mode log --entries 200000 --chunk-kb 5120
+    python benchmark.py --mode timestamp --entries 200000
+
+--agent runs the same benchmark against another copy of the script, to compare before and after a change.
+"""
+
+import imp
+import logging
+import os
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import OrderedDict
+from optparse import OptionParser
+
+import pytz
+import regex
+
+requests_received = []
+
+
+class CountingHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        requests_received.append(len(body))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CountingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def load_agent(path, options, port):
+    """ load the agent and set the globals it declares under __main__ """
+    agent = imp.load_source('agent', path)
+    agent.logger = logging.getLogger('benchmark')
+    agent.logger.addHandler(logging.NullHandler())
+    agent.UNDERSCORE = regex.compile(r"\_+")
+    agent.COLONS = regex.compile(r"\:+")
+    agent.LEFT_BRACE = regex.compile(r"\[")
+    agent.RIGHT_BRACE = regex.compile(r"\]")
+    agent.PERIOD = regex.compile(r"\.")
+    agent.SUBSECOND = regex.compile(r"(?<=:\d\d)[.,]\d+")
+    agent.HOSTNAME = 'benchmark'
+    agent.TIMESTAMP_CACHE_SIZE = 4096
+    agent.ISO8601_FAST_FORMATS = {'YYYY-MM-DDTHH:mm:ss', 'YYYY-MM-DD HH:mm:ss'}
+    agent.ATTEMPTS = 1
+    agent.SESSIONS = dict()
+    agent.REQUESTS = dict()
+    agent.track = dict()
+    agent.timestamp_cache = OrderedDict()
+    agent.spool = dict()
+    agent.upload = dict()
+    agent.metric_buffer = dict()
+    agent.cli_config_vars = {'testing': False}
+    agent.agent_config_vars = {
+        'all_metrics': [],
+        'timestamp_format': ['YYYY-MM-DD HH:mm:ss.SSS'],
+        'timezone': pytz.utc,
+        'metric_buffer_size': options.buffer_mb * 1024 * 1024,
+    }
+    agent.if_config_vars = {
+        'user_name': 'benchmark',
+        'license_key': 'benchmark',
+        'project_name': 'benchmark',
+        'project_type': 'METRIC' if options.mode == 'metric' else 'LOG',
+        'is_replay': False,
+        'sampling_interval': 60,
+        'run_interval': 3600,
+        'chunk_size': options.chunk_kb * 1024,
+        'if_url': 'http://127.0.0.1:{}'.format(port),
+        'if_proxies': dict(),
+        'if_pool_size': 1,
+        'if_compress': False,
+        'upload_workers': 1,
+        'upload_queue_size': 4,
+        'spool_size': 0,
+        'spool_dir': '',
+    }
+    return agent
+
+
+def feed_metrics(agent, options):
+    """ one value per metric per instance per timestamp, timestamps in order """
+    start = int(time.time()) * 1000
+    per_timestamp = options.instances * options.metrics
+    for i in xrange(options.entries):
+        timestamp = start + 60000 * (i // per_timestamp)
+        agent.metric_handoff(timestamp, 'metric_{}'.format(i % options.metrics),
+                             '{}.{}'.format(i, i % 1000), 'host-{}'.format((i // options.metrics) % options.instances))
+
+
+def feed_logs(agent, options):
+    """ log lines of about 200 bytes spread over the instances """
+    start = int(time.time()) * 1000
+    for i in xrange(options.entries):
+        agent.log_handoff(start + i, 'GET /api/v1/items/{} 200 {} ms user-agent=benchmark {}'.format(
+            i, i % 1000, 'x' * 120), 'host-{}'.format(i % options.instances))
+
+
+def feed_timestamps(agent, options, date_strings):
+    """ log lines as in log mode, about 100 a second, with the timestamp parsed from a date string """
+    for i in xrange(options.entries):
+        agent.log_handoff(agent.get_timestamp_from_date_string(date_strings[i]),
+                          'GET /api/v1/items/{} 200 {} ms user-agent=benchmark {}'.format(i, i % 1000, 'x' * 120),
+                          'host-{}'.format(i % options.instances))
+
+
+def main():
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--mode', default='metric', help='metric, log or timestamp. Default is metric')
+    parser.add_option('--entries', type='int', default=1000000, help='Number of entries to send')
+    parser.add_option('--instances', type='int', default=100, help='Number of instances')
+    parser.add_option('--metrics', type='int', default=20, help='Number of metrics per instance')
+    parser.add_option('--chunk-kb', type='int', default=2048, dest='chunk_kb', help='chunk_size_kb given to the agent')
+    parser.add_option('--buffer-mb', type='int', default=10, dest='buffer_mb',
+                      help='metric_buffer_size_mb given to the agent')
+    parser.add_option('--agent', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                      'insightagent-boilerplate.py'), help='Agent script to load')
+    (options, args) = parser.parse_args()
+
+    server = CountingServer(('127.0.0.1', 0), CountingHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    agent = load_agent(options.agent, options, server.server_port)
+    if options.mode == 'timestamp':
+        start = int(time.time()) * 1000
+        date_strings = ['{}.{:03d}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp // 1000)),
+                                           timestamp % 1000)
+                        for timestamp in xrange(start, start + 10 * options.entries, 10)]
+        agent.start_data_processing = lambda thread_number: feed_timestamps(agent, options, date_strings)
+    else:
+        feed = feed_metrics if options.mode == 'metric' else feed_logs
+        agent.start_data_processing = lambda thread_number: feed(agent, options)
+    start_time = time.time()
+    agent.initialize_data_gathering(0)
+    elapsed = time.time() - start_time
+    for session in agent.SESSIONS.values():
+        session.close()
+    server.shutdown()
+    server.server_close()
+
+    print 'entries:        %d' % options.entries
+    print 'time:           %.1f s (%d entries/s)' % (elapsed, options.entries / elapsed)
+    print 'requests:       %d' % len(requests_received)
+    print 'largest POST:   %d KB' % (max(requests_received or [0]) / 1024)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,19 @@
 #!/usr/bin/env python
 import ConfigParser
+import calendar
+import Queue
 import json
+import zlib
 import logging
 import os
 import regex
 import socket
 import sys
+import threading
 import time
 import pytz
 import arrow
+import urllib
 import urlparse
 import httplib
 import requests
@@ -17,6 +22,7 @@ import subprocess
 import shlex
 
 from datetime import datetime
+from collections import OrderedDict
 from decimal import Decimal
 from optparse import OptionParser
 from multiprocessing import Process
@@ -222,6 +228,18 @@ def get_if_config_vars():
             if_url = config_parser.get('insightfinder', 'if_url')
             if_http_proxy = config_parser.get('insightfinder', 'if_http_proxy')
             if_https_proxy = config_parser.get('insightfinder', 'if_https_proxy')
+            if_pool_size = config_parser.get('insightfinder', 'if_pool_size') if config_parser.has_option(
+                'insightfinder', 'if_pool_size') else ''
+            if_compress = config_parser.get('insightfinder', 'if_compress') if config_parser.has_option(
+                'insightfinder', 'if_compress') else ''
+            spool_dir = config_parser.get('insightfinder', 'spool_dir') if config_parser.has_option(
+                'insightfinder', 'spool_dir') else ''
+            spool_size_mb = config_parser.get('insightfinder', 'spool_size_mb') if config_parser.has_option(
+                'insightfinder', 'spool_size_mb') else ''
+            upload_workers = config_parser.get('insightfinder', 'upload_workers') if config_parser.has_option(
+                'insightfinder', 'upload_workers') else ''
+            upload_queue_size = config_parser.get('insightfinder', 'upload_queue_size') if config_parser.has_option(
+                'insightfinder', 'upload_queue_size') else ''
         except ConfigParser.NoOptionError as cp_noe:
             logger.error(cp_noe)
             config_error()
@@ -295,6 +313,12 @@ def get_if_config_vars():
             'chunk_size': int(chunk_size_kb) * 1024,  # as bytes
             'if_url': if_url,
             'if_proxies': if_proxies,
+            'if_pool_size': int(if_pool_size or 10),
+            'if_compress': if_compress.upper() == 'TRUE',
+            'spool_dir': abs_path_from_cur(spool_dir or 'spool'),
+            'spool_size': int(spool_size_mb or 100) * 1024 * 1024,  # as bytes
+            'upload_workers': int(upload_workers or 1),
+            'upload_queue_size': int(upload_queue_size or 4),
             'is_replay': is_replay
         }
 
@@ -495,6 +519,17 @@ def get_json_size_bytes(json_data):
     return len(bytearray(json.dumps(json_data)))
 
 
+def get_json_separator_size(json_data):
+    """ size of the ', ' that json.dumps puts before every item but the first """
+    return 2 if len(json_data) > 1 else 0
+
+
+def append_to_current_row(entry):
+    """ add an entry to the current chunk, keeping a running count of its size in bytes """
+    track['current_row'].append(entry)
+    track['current_row_size'] += get_json_size_bytes(entry) + get_json_separator_size(track['current_row'])
+
+
 def get_all_files(files, file_regex_c):
     return [i for j in
             map(lambda k:
@@ -594,13 +629,67 @@ def parse_formatted(message, setting_value, default='', allow_list=False, remove
     return setting_value.format(**fields)
 
 
+def build_extraction_plan():
+    """ pre-split the field settings once, so each message only has to be walked """
+    return {
+        'json_top_level': agent_config_vars['json_top_level'].split(JSON_LEVEL_DELIM),
+        'filters_include': [compile_filter(x) for x in agent_config_vars['filters_include']],
+        'filters_exclude': [compile_filter(x) for x in agent_config_vars['filters_exclude']],
+        'instance_field': compile_setting(agent_config_vars['instance_field']),
+        'device_field': compile_setting(agent_config_vars['device_field']),
+        'timestamp_field': compile_setting(agent_config_vars['timestamp_field']),
+        # reverse list so it's in priority order, as shared fields names will get overwritten
+        'data_fields': [compile_data_field(x) for x in reversed(agent_config_vars['data_fields'] or [])],
+    }
+
+
+def compile_filter(_filter):
+    filter_field = _filter.split(':')[0]
+    filter_vals = _filter.split(':')[1].split(',')
+    return filter_field.split(JSON_LEVEL_DELIM), [x.upper() for x in filter_vals]
+
+
+def compile_setting(setting_value):
+    # complex and formatted settings are still resolved per message
+    if is_complex(setting_value[0]) or is_formatted(setting_value[0]):
+        return {'formatted': setting_value[0], 'paths': []}
+    return {'formatted': None, 'paths': [x.split(JSON_LEVEL_DELIM) for x in setting_value if x]}
+
+
+def compile_data_field(setting_value):
+    if is_named_data_field(setting_value) or is_complex(setting_value) or is_formatted(setting_value):
+        return setting_value, None
+    return setting_value, setting_value.split(JSON_LEVEL_DELIM)
+
+
+def get_plan_value(message, setting_plan, default='', allow_list=False, remove=False):
+    if setting_plan['formatted']:
+        return get_single_value(message,
+                                setting_plan['formatted'],
+                                default=default,
+                                allow_list=allow_list,
+                                remove=remove)
+    value = ''
+    for path in setting_plan['paths']:
+        value = get_json_path(message,
+                              path,
+                              allow_list=allow_list,
+                              remove=remove)
+        if value != '':
+            break
+    return value or default
+
+
 def get_data_values(timestamp, message):
-    setting_values = agent_config_vars['data_fields'] or message.keys()
-    # reverse list so it's in priority order, as shared fields names will get overwritten
-    setting_values.reverse()
     data = {x: dict() for x in timestamp}
-    for setting_value in setting_values:
-        name, value = get_data_value(message, setting_value)
+    # plan is in priority order, as shared fields names will get overwritten
+    data_fields = extraction_plan['data_fields'] or [(x, None) for x in reversed(message.keys())]
+    for setting_value, path in data_fields:
+        if path is None:
+            name, value = get_data_value(message, setting_value)
+        else:
+            name = setting_value
+            value = get_json_path(message, path, allow_list=True)
         if isinstance(value, (set, tuple, list)):
             for i in range(minlen(timestamp, value)):
                 merge_data(name, value[i], data[timestamp[i]])
@@ -749,10 +838,18 @@ def get_json_field_by_pri(message, pri_list, default='', allow_list=False, remov
 
 
 def get_json_field(message, setting_value, default='', allow_list=False, remove=False):
+    return get_json_path(message,
+                         setting_value.split(JSON_LEVEL_DELIM),
+                         default=default,
+                         allow_list=allow_list,
+                         remove=remove)
+
+
+def get_json_path(message, path, default='', allow_list=False, remove=False):
     field_val = json_format_field_value(
         _get_json_field_helper(
             message,
-            setting_value.split(JSON_LEVEL_DELIM),
+            list(path),
             allow_list=allow_list,
             remove=remove))
     if len(field_val) == 0:
@@ -798,14 +895,15 @@ def _get_json_field_helper(nested_value, next_fields, allow_list=False, remove=F
         return ''
 
     # sometimes payloads come in formatted
-    try:
-        next_value = json.loads(next_value)
-    except:
-        pass
+    if isinstance(next_value, basestring):
+        try:
+            next_value = json.loads(next_value)
+        except:
+            pass
 
     # handle simple lists
     while isinstance(next_value, (list, set, tuple)) and len(next_value) == 1:
-        next_value = next_value.pop()
+        next_value = list(next_value)[0]
 
     # continue traversing?
     if next_fields is None:
@@ -819,17 +917,15 @@ def _get_json_field_helper(nested_value, next_fields, allow_list=False, remove=F
         if allow_list:
             return json_gather_list_values(
                 next_value,
-                next_fields,
-                remove=remove)
+                next_fields)
         else:
             raise ListNotAllowedError('encountered list or set in json when not allowed')
     elif isinstance(next_value, dict):
-        # there's more tree to walk down
+        # there's more tree to walk down; only top-level fields are removed
         return _get_json_field_helper(
-            json.loads(json.dumps(next_value)),
+            next_value,
             next_fields,
-            allow_list=allow_list,
-            remove=remove)
+            allow_list=allow_list)
     else:
         # catch-all
         return ''
@@ -879,7 +975,7 @@ def parse_json_message(messages):
         else:
             top_level = _get_json_field_helper(
                 messages,
-                agent_config_vars['json_top_level'].split(JSON_LEVEL_DELIM),
+                list(extraction_plan['json_top_level']),
                 allow_list=True)
             if isinstance(top_level, (list, set, tuple)):
                 for message in top_level:
@@ -889,21 +985,19 @@ def parse_json_message(messages):
 
 
 def parse_json_message_single(message):
-    # message = json.loads(json.dumps(message))
     # filter
-    if len(agent_config_vars['filters_include']) != 0:
+    if len(extraction_plan['filters_include']) != 0:
         # for each provided filter
         is_valid = False
-        for _filter in agent_config_vars['filters_include']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = get_json_field(
+        for filter_path, filter_vals in extraction_plan['filters_include']:
+            filter_check = get_json_path(
                 message,
-                filter_field,
+                filter_path,
                 allow_list=True)
             # check if a valid value
+            filter_check_upper = filter_check.upper()
             for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
+                if filter_val in filter_check_upper:
                     is_valid = True
                     break
             if is_valid:
@@ -915,18 +1009,17 @@ def parse_json_message_single(message):
         else:
             logger.debug('passed filter (inclusion)')
 
-    if len(agent_config_vars['filters_exclude']) != 0:
+    if len(extraction_plan['filters_exclude']) != 0:
         # for each provided filter
-        for _filter in agent_config_vars['filters_exclude']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = get_json_field(
+        for filter_path, filter_vals in extraction_plan['filters_exclude']:
+            filter_check = get_json_path(
                 message,
-                filter_field,
+                filter_path,
                 allow_list=True)
             # check if a valid value
+            filter_check_upper = filter_check.upper()
             for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
+                if filter_val in filter_check_upper:
                     logger.debug('filtered message (exclusion): {} in {}'.format(
                         filter_val, filter_check))
                     return
@@ -937,26 +1030,26 @@ def parse_json_message_single(message):
     #                                'project_field',
     #                                default=if_config_vars['project_name']),
     #                                remove=True)
-    instance = get_setting_value(message,
-                                 'instance_field',
-                                 default=HOSTNAME,
-                                 remove=True)
+    instance = get_plan_value(message,
+                              extraction_plan['instance_field'],
+                              default=HOSTNAME,
+                              remove=True)
     logger.debug(instance)
-    device = get_setting_value(message,
-                               'device_field',
-                               remove=True)
+    device = get_plan_value(message,
+                            extraction_plan['device_field'],
+                            remove=True)
     # get timestamp
     try:
-        timestamp = get_setting_value(message,
-                                      'timestamp_field',
-                                      remove=True)
+        timestamp = get_plan_value(message,
+                                   extraction_plan['timestamp_field'],
+                                   remove=True)
         timestamp = [timestamp]
     except ListNotAllowedError as e:
         logger.debug(e)
-        timestamp = get_setting_value(message,
-                                      'timestamp_field',
-                                      remove=True,
-                                      allow_list=True)
+        timestamp = get_plan_value(message,
+                                   extraction_plan['timestamp_field'],
+                                   remove=True,
+                                   allow_list=True)
     except Exception as e:
         logger.warn(e)
         sys.exit(1)
@@ -1096,46 +1189,93 @@ def parse_csv_row(row, field_names, instance, device=''):
 
 def get_timestamp_from_date_string(date_string):
     """ parse a date string into unix epoch (ms) """
-    datetime_obj = None
-    epoch = None
-    if 'timestamp_format' in agent_config_vars:
-        for timestamp_format in agent_config_vars['timestamp_format']:
+    if 'timestamp_format' not in agent_config_vars:
+        return get_timestamp_from_any_date_string(date_string)
+
+    timestamp_formats = agent_config_vars['timestamp_format']
+    if timestamp_formats[0] == 'epoch':
+        # cheap enough to not be worth caching
+        try:
+            return get_timestamp_from_format(date_string, 'epoch')
+        except Exception:
+            pass
+
+    # most messages share their second with a message seen shortly before, so the cache is
+    # keyed on the date string without its fraction of a second, and the fraction's width,
+    # as strings with and without a fraction may match different formats
+    subsecond = SUBSECOND.search(date_string)
+    if subsecond:
+        cache_key = (date_string[:subsecond.start()] + date_string[subsecond.end():], len(subsecond.group(0)))
+        milliseconds = int(subsecond.group(0)[1:4].ljust(3, '0'))
+    else:
+        cache_key = (date_string, 0)
+        milliseconds = 0
+    cached = timestamp_cache.pop(cache_key, None)
+    if cached is None:
+        epoch = None
+        for i, timestamp_format in enumerate(timestamp_formats):
             try:
-                if timestamp_format == 'epoch':
-                    if 13 <= len(date_string) < 15:
-                        timestamp = int(date_string) / 1000
-                        datetime_obj = arrow.get(time.gmtime(timestamp))
-                    elif 9 <= len(date_string) < 13:
-                        timestamp = int(date_string)
-                        datetime_obj = arrow.get(time.gmtime(timestamp))
-                    else:
-                        raise
-                else:
-                    if agent_config_vars['timezone']:
-                        datetime_obj = arrow.get(date_string, timestamp_format,
-                                                 tzinfo=agent_config_vars['timezone'].zone)
-                    else:
-                        datetime_obj = arrow.get(date_string, timestamp_format)
-                break
+                epoch = get_timestamp_from_format(date_string, timestamp_format)
             except Exception as e:
                 logger.debug(e)
                 logger.debug('timestamp {} does not match {}'.format(date_string, timestamp_format))
                 continue
+            # try the format that matched first from now on. epoch stays in place,
+            # as digit-only formats would otherwise be read as epochs
+            if i != 0 and timestamp_format != 'epoch':
+                timestamp_formats.insert(0, timestamp_formats.pop(i))
+            break
+        if epoch is None:
+            return None
+        # arrow's fraction tokens are S, SS, SSS, ...; formats without one ignore the fraction
+        if subsecond and 'S' in timestamp_format:
+            cached = (epoch // 1000 * 1000, True)
+        else:
+            cached = (epoch, False)
+    if len(timestamp_cache) >= TIMESTAMP_CACHE_SIZE:
+        timestamp_cache.popitem(last=False)
+    timestamp_cache[cache_key] = cached
+    epoch, add_milliseconds = cached
+    return epoch + milliseconds if add_milliseconds else epoch
+
+
+def get_timestamp_from_format(date_string, timestamp_format):
+    if timestamp_format == 'epoch':
+        # whole seconds, without going through a datetime
+        if 13 <= len(date_string) < 15:
+            return int(date_string) / 1000 * 1000
+        elif 9 <= len(date_string) < 13:
+            return int(date_string) * 1000
+        else:
+            raise ValueError('not an epoch timestamp')
+    # arrow is slow, so read the common ISO8601 layouts in UTC directly
+    if timestamp_format in ISO8601_FAST_FORMATS and len(date_string) == 19 \
+            and agent_config_vars['timezone'] in ('', pytz.utc) \
+            and date_string[4] == '-' and date_string[7] == '-' and date_string[10] == timestamp_format[10] \
+            and date_string[13] == ':' and date_string[16] == ':':
+        fields = (date_string[0:4], date_string[5:7], date_string[8:10],
+                  date_string[11:13], date_string[14:16], date_string[17:19])
+        if all(x.isdigit() for x in fields):
+            return calendar.timegm(datetime(*[int(x) for x in fields]).timetuple()) * 1000
+    if agent_config_vars['timezone']:
+        datetime_obj = arrow.get(date_string, timestamp_format,
+                                 tzinfo=agent_config_vars['timezone'].zone)
     else:
-        try:
-            if agent_config_vars['timezone']:
-                datetime_obj = arrow.get(date_string, tzinfo=agent_config_vars['timezone'].zone)
-            else:
-                datetime_obj = arrow.get(date_string)
-        except Exception as e:
-            logger.debug(e)
-            logger.error('timestamp {} can not parse'.format(date_string))
+        datetime_obj = arrow.get(date_string, timestamp_format)
+    return int(datetime_obj.float_timestamp * 1000)
 
-    # get epoch (misc)
-    if datetime_obj:
-        epoch = int(datetime_obj.float_timestamp * 1000)
 
-    return epoch
+def get_timestamp_from_any_date_string(date_string):
+    try:
+        if agent_config_vars['timezone']:
+            datetime_obj = arrow.get(date_string, tzinfo=agent_config_vars['timezone'].zone)
+        else:
+            datetime_obj = arrow.get(date_string)
+        return int(datetime_obj.float_timestamp * 1000)
+    except Exception as e:
+        logger.debug(e)
+        logger.error('timestamp {} can not parse'.format(date_string))
+        return None
 
 
 def make_safe_instance_string(instance, device=''):
@@ -1258,20 +1398,29 @@ def initialize_data_gathering(thread_number):
     track['chunk_count'] = 0
     track['entry_count'] = 0
 
-    start_data_processing(thread_number)
+    start_upload_workers()
 
-    # move all buffer data to current data, and send
-    while metric_buffer['buffer_ts_list']:
-        (ts, key) = metric_buffer['buffer_ts_list'].pop()
-        transpose_metrics(ts, key)
-        if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size']:
-            logger.debug('Sending buffer chunk')
-            send_data_wrapper()
+    start_spool_replayer()
 
-    # last chunk
-    if len(track['current_row']) > 0:
-        logger.debug('Sending last chunk')
-        send_data_wrapper()
+    try:
+        start_data_processing(thread_number)
+
+        # move all buffer data to current data, and send
+        while metric_buffer['buffer_ts_list']:
+            (ts, key) = metric_buffer['buffer_ts_list'].pop()
+            transpose_metrics(ts, key)
+            if track['current_row_size'] >= if_config_vars['chunk_size']:
+                logger.debug('Sending buffer chunk')
+                send_data_wrapper()
+
+        # last chunk
+        if len(track['current_row']) > 0:
+            logger.debug('Sending last chunk')
+            send_data_wrapper()
+    finally:
+        # send what was already queued, even if reading stopped on an error
+        stop_upload_workers()
+        stop_spool_replayer()
 
     logger.debug('Total chunks created: ' + str(track['chunk_count']))
     logger.debug('Total {} entries: {}'.format(
@@ -1282,6 +1431,9 @@ def reset_metric_buffer():
     metric_buffer['buffer_key_list'] = []
     metric_buffer['buffer_ts_list'] = []
     metric_buffer['buffer_dict'] = {}
+    # key -> serialized size of its row, and the sum over all rows
+    metric_buffer['buffer_size_dict'] = {}
+    metric_buffer['buffer_size'] = 0
 
     metric_buffer['buffer_collected_list'] = []
     metric_buffer['buffer_collected_dict'] = {}
@@ -1292,6 +1444,7 @@ def reset_track():
     track['start_time'] = time.time()
     track['line_count'] = 0
     track['current_row'] = []
+    track['current_row_size'] = 2  # '[]'
 
 
 #########################################
@@ -1315,15 +1468,15 @@ def log_handoff(timestamp, data, instance, device=''):
 
 def send_log(timestamp, data, instance, device=''):
     entry = prepare_log_entry(str(int(timestamp)), data, instance, device)
-    track['current_row'].append(entry)
+    append_to_current_row(entry)
     track['line_count'] += 1
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (
+    if track['current_row_size'] >= if_config_vars['chunk_size'] or (
             time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 100 == 0:
         logger.debug('Current data object size: {} bytes'.format(
-            get_json_size_bytes(track['current_row'])))
+            track['current_row_size']))
 
 
 def prepare_log_entry(timestamp, data, instance, device=''):
@@ -1365,26 +1518,26 @@ def send_metric(timestamp, field_name, data, instance, device=''):
             del metric_buffer['buffer_ts_list'][index]
             metric_buffer['buffer_collected_dict'].pop(key)
             transpose_metrics(ts, key)
-            if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size']:
+            if track['current_row_size'] >= if_config_vars['chunk_size']:
                 logger.debug('Sending buffer chunk')
                 send_data_wrapper()
 
         # send data if buffer size is bigger than threshold
-        while get_json_size_bytes(metric_buffer['buffer_dict']) >= agent_config_vars['metric_buffer_size'] and \
+        while metric_buffer['buffer_size'] >= agent_config_vars['metric_buffer_size'] and \
                 metric_buffer['buffer_ts_list']:
             (ts, key) = metric_buffer['buffer_ts_list'].pop()
             transpose_metrics(ts, key)
-            if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size']:
+            if track['current_row_size'] >= if_config_vars['chunk_size']:
                 logger.debug('Sending buffer chunk')
                 send_data_wrapper()
 
         # send data
-        if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (
+        if track['current_row_size'] >= if_config_vars['chunk_size'] or (
                 time.time() - track['start_time']) >= if_config_vars['run_interval']:
             send_data_wrapper()
         elif track['entry_count'] % 500 == 0:
             logger.debug('Buffer data object size: {} bytes'.format(
-                get_json_size_bytes(metric_buffer['buffer_dict'])))
+                metric_buffer['buffer_size']))
 
 
 def append_metric_data_to_buffer(timestamp, field_name, data, instance, device=''):
@@ -1395,14 +1548,26 @@ def append_metric_data_to_buffer(timestamp, field_name, data, instance, device='
     metric_str = make_safe_metric_key(field_name)
     metric_key = '{}[{}]'.format(metric_str, instance_str)
 
-    if key not in metric_buffer['buffer_key_list']:
+    if key not in metric_buffer['buffer_dict']:
         # add timestamp in buffer_ts_list and buffer_dict
         metric_buffer['buffer_key_list'].append(key)
         metric_buffer['buffer_ts_list'].append((timestamp, key))
         metric_buffer['buffer_ts_list'].sort(key=lambda elem: elem[0], reverse=True)
         metric_buffer['buffer_dict'][key] = dict()
+        metric_buffer['buffer_size_dict'][key] = 0
         metric_buffer['buffer_collected_dict'][key] = []
-    metric_buffer['buffer_dict'][key][metric_key] = str(data)
+    row = metric_buffer['buffer_dict'][key]
+    value = str(data)
+
+    # '"<metric_key>": "<value>", '
+    size = get_json_size_bytes(value)
+    if metric_key in row:
+        size -= get_json_size_bytes(row[metric_key])
+    else:
+        size += get_json_size_bytes(metric_key) + 4
+    row[metric_key] = value
+    metric_buffer['buffer_size_dict'][key] += size
+    metric_buffer['buffer_size'] += size
     metric_buffer['buffer_collected_dict'][key].append(metric_str)
 
     # if all metrics of ts_instance is collected, then send these data
@@ -1414,7 +1579,8 @@ def append_metric_data_to_buffer(timestamp, field_name, data, instance, device='
 
 def transpose_metrics(ts, key):
     metric_buffer['buffer_key_list'].remove(key)
-    track['current_row'].append(
+    metric_buffer['buffer_size'] -= metric_buffer['buffer_size_dict'].pop(key)
+    append_to_current_row(
         dict({'timestamp': str(ts)}, **metric_buffer['buffer_dict'].pop(key))
     )
 
@@ -1529,12 +1695,62 @@ def send_data_wrapper():
     """ wrapper to send data """
     logger.debug('--- Chunk creation time: {} seconds ---'.format(
         round(time.time() - track['start_time'], 2)))
-    send_data_to_if(track['current_row'])
+    if upload['workers']:
+        # blocks while the queue is full, so parsing can't run too far ahead of sending
+        upload['queue'].put((track['current_row'], track['line_count']))
+        upload['max_depth'] = max(upload['max_depth'], upload['queue'].qsize())
+        logger.debug('Upload queue depth: {}, in flight: {}'.format(
+            upload['queue'].qsize(), upload['in_flight']))
+    else:
+        send_data_to_if(track['current_row'], track['line_count'])
     track['chunk_count'] += 1
     reset_track()
 
 
-def send_data_to_if(chunk_metric_data):
+def start_upload_workers():
+    """ start the threads that send chunks to IF in the background """
+    upload['queue'] = Queue.Queue(maxsize=if_config_vars['upload_queue_size'])
+    upload['lock'] = threading.Lock()
+    upload['in_flight'] = 0
+    upload['max_depth'] = 0
+    upload['workers'] = []
+    for i in range(if_config_vars['upload_workers']):
+        worker = threading.Thread(target=upload_worker, name='upload-{}'.format(i))
+        worker.daemon = True
+        worker.start()
+        upload['workers'].append(worker)
+
+
+def stop_upload_workers():
+    """ wait for all queued chunks to be sent, then stop the upload threads """
+    logger.debug('Draining upload queue: {} queued, {} in flight'.format(
+        upload['queue'].qsize(), upload['in_flight']))
+    for _ in upload['workers']:
+        upload['queue'].put(None)
+    for worker in upload['workers']:
+        worker.join()
+    upload['workers'] = []
+    logger.debug('Max upload queue depth: {}'.format(upload['max_depth']))
+
+
+def upload_worker():
+    while True:
+        chunk = upload['queue'].get()
+        if chunk is None:
+            return
+        with upload['lock']:
+            upload['in_flight'] += 1
+        try:
+            send_data_to_if(*chunk)
+        except Exception as e:
+            logger.warning('Error when sending chunk')
+            logger.warning(e)
+        finally:
+            with upload['lock']:
+                upload['in_flight'] -= 1
+
+
+def send_data_to_if(chunk_metric_data, line_count):
     send_data_time = time.time()
 
     # prepare data for metric streaming agent
@@ -1547,7 +1763,7 @@ def send_data_to_if(chunk_metric_data):
     logger.debug('First:\n' + str(chunk_metric_data[0] if len(chunk_metric_data) > 0 else ''))
     logger.debug('Last:\n' + str(chunk_metric_data[-1] if len(chunk_metric_data) > 0 else ''))
     logger.debug('Total Data (bytes): ' + str(get_json_size_bytes(data_to_post)))
-    logger.debug('Total Lines: ' + str(track['line_count']))
+    logger.debug('Total Lines: ' + str(line_count))
 
     # do not send if only testing or empty chunk
     if cli_config_vars['testing'] or len(chunk_metric_data) == 0:
@@ -1556,18 +1772,227 @@ def send_data_to_if(chunk_metric_data):
 
     # send the data
     post_url = urlparse.urljoin(if_config_vars['if_url'], get_api_from_project_type())
-    send_request(post_url, 'POST', 'Could not send request to IF',
-                 str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
-                 data=data_to_post, verify=False, proxies=if_config_vars['if_proxies'])
+    post_data, post_headers = get_post_body(data_to_post)
+    response = send_request(post_url, 'POST', 'Could not send request to IF',
+                            str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
+                            data=post_data, headers=post_headers, verify=False, proxies=if_config_vars['if_proxies'])
+    if response == -1:
+        spool_chunk(post_url, data_to_post)
     logger.debug('--- Send data time: %s seconds ---' % round(time.time() - send_data_time, 2))
 
 
+def start_spool_replayer():
+    """ start the thread that re-sends spooled chunks once IF is reachable again """
+    spool['lock'] = threading.Lock()
+    spool['stop'] = threading.Event()
+    spool['segment'] = None
+    spool['thread'] = None
+    if if_config_vars['spool_size'] == 0 or cli_config_vars['testing']:
+        return
+    if not os.path.isdir(if_config_vars['spool_dir']):
+        os.makedirs(if_config_vars['spool_dir'])
+    recover_spool_segments()
+    spool['thread'] = threading.Thread(target=replay_spool, name='spool-replay')
+    spool['thread'].daemon = True
+    spool['thread'].start()
+
+
+def stop_spool_replayer():
+    """ stop replaying. anything left in the spool is replayed on the next run """
+    if not spool['thread']:
+        return
+    spool['stop'].set()
+    spool['thread'].join()
+    with spool['lock']:
+        close_spool_segment()
+
+
+def recover_spool_segments():
+    """ release segments left open or half-replayed by agent runs that have exited """
+    for name in os.listdir(if_config_vars['spool_dir']):
+        if name.endswith('.open'):
+            # <ts>-<writer pid>.open
+            owner = name[:-len('.open')].split('-')[-1]
+            closed = name[:-len('.open')] + '.spool'
+        elif name.endswith('.replay'):
+            # <ts>-<writer pid>.spool.<replayer pid>.replay
+            closed, owner, _ = name.rsplit('.', 2)
+        elif name.endswith('.replay.tmp'):
+            # left over from writing back a half-replayed segment
+            owner = name.rsplit('.', 3)[1]
+            if not is_pid_running(int(owner)):
+                os.remove(os.path.join(if_config_vars['spool_dir'], name))
+            continue
+        else:
+            continue
+        if not is_pid_running(int(owner)):
+            os.rename(os.path.join(if_config_vars['spool_dir'], name),
+                      os.path.join(if_config_vars['spool_dir'], closed))
+
+
+def is_pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def get_spool_segments(suffix='.spool'):
+    """ spool segment files, oldest first """
+    return [os.path.join(if_config_vars['spool_dir'], name)
+            for name in sorted(os.listdir(if_config_vars['spool_dir']))
+            if name.endswith(suffix)]
+
+
+def close_spool_segment():
+    """ close the segment this process appends to, making it available for replay """
+    if spool['segment'] and os.path.exists(spool['segment']):
+        os.rename(spool['segment'], spool['segment'][:-len('.open')] + '.spool')
+    spool['segment'] = None
+
+
+def spool_chunk(post_url, data_to_post):
+    """ append a chunk that could not be sent to the spool, dropping the oldest segments over the size cap """
+    if not spool['thread']:
+        return
+    with spool['lock']:
+        if spool['segment'] and os.path.getsize(spool['segment']) >= SPOOL_SEGMENT_SIZE:
+            close_spool_segment()
+        if not spool['segment']:
+            spool['segment'] = os.path.join(if_config_vars['spool_dir'], '{:015d}-{}.open'.format(
+                int(time.time() * 1000), os.getpid()))
+        # only the payload is spooled, the account fields are filled in again on replay
+        account_fields = initialize_api_post_data()
+        payload = dict((key, value) for key, value in data_to_post.items() if key not in account_fields)
+        with open(spool['segment'], 'a') as spool_file:
+            spool_file.write(json.dumps({'url': post_url, 'data': payload}) + '\n')
+        logger.warning('Spooled chunk to {}'.format(spool['segment']))
+
+        # evict oldest first
+        segments = get_spool_segments()
+        spool_size = sum(os.path.getsize(segment) for segment in segments + get_spool_segments('.open'))
+        while spool_size > if_config_vars['spool_size'] and segments:
+            segment = segments.pop(0)
+            spool_size -= os.path.getsize(segment)
+            os.remove(segment)
+            logger.warning('Spool is full, dropped {}'.format(segment))
+
+
+def replay_spool():
+    """ re-send spooled chunks oldest first, backing off exponentially while IF is unreachable """
+    backoff = SPOOL_MIN_BACKOFF
+    while not spool['stop'].is_set():
+        if replay_spool_segment():
+            backoff = SPOOL_MIN_BACKOFF
+        else:
+            spool['stop'].wait(backoff)
+            backoff = min(backoff * 2, SPOOL_MAX_BACKOFF)
+
+
+def replay_spool_segment():
+    """ claim and re-send the oldest spooled segment. returns True if all of it was sent """
+    with spool['lock']:
+        segments = get_spool_segments()
+        if not segments and spool['segment']:
+            close_spool_segment()
+            segments = get_spool_segments()
+        if not segments:
+            return False
+        segment = segments[0]
+        # renaming is atomic, so only one process can claim a segment
+        claimed = '{}.{}.replay'.format(segment, os.getpid())
+        try:
+            os.rename(segment, claimed)
+        except OSError:
+            return False
+
+    with open(claimed) as spool_file:
+        lines = spool_file.readlines()
+    for i, line in enumerate(lines):
+        try:
+            chunk = json.loads(line)
+        except ValueError:
+            logger.warning('Skipping corrupt line in {}'.format(segment))
+            continue
+        if spool['stop'].is_set() or not send_spooled_chunk(chunk):
+            # put back what wasn't sent
+            try:
+                with open(claimed + '.tmp', 'w') as spool_file:
+                    spool_file.writelines(lines[i:])
+                os.rename(claimed + '.tmp', segment)
+            except (IOError, OSError) as e:
+                logger.warning('Could not write back {}, it is replayed in full on the next run'.format(segment))
+                logger.warning(e)
+                if os.path.exists(claimed + '.tmp'):
+                    os.remove(claimed + '.tmp')
+                return False
+            os.remove(claimed)
+            return False
+    os.remove(claimed)
+    logger.info('Replayed {} spooled chunks from {}'.format(len(lines), segment))
+    return True
+
+
+def send_spooled_chunk(chunk):
+    """ re-send a spooled chunk. returns False if it should be tried again later """
+    data_to_post = initialize_api_post_data()
+    data_to_post.update(chunk['data'])
+    post_data, post_headers = get_post_body(data_to_post)
+    # the replayer backs off between attempts, so post once rather than through send_request
+    try:
+        response = get_request_session().post(chunk['url'], data=post_data, headers=post_headers, verify=False,
+                                              proxies=if_config_vars['if_proxies'])
+    except requests.exceptions.RequestException as e:
+        logger.warning('Could not re-send spooled chunk to IF')
+        logger.warning(e)
+        return False
+    if response.status_code == httplib.OK:
+        logger.info('Re-sent a spooled chunk.')
+        return True
+    if 400 <= response.status_code < 500 and response.status_code not in SPOOL_RETRYABLE_STATUS:
+        # IF will never accept this chunk, so drop it rather than hold up the rest of the spool
+        logger.warning('IF rejected a spooled chunk, dropping it. Response Code: {}\nTEXT: {}'.format(
+            response.status_code, response.text))
+        return True
+    logger.warning('Could not re-send spooled chunk to IF. Response Code: {}'.format(response.status_code))
+    return False
+
+
+def get_post_body(data_to_post):
+    """ get the body and headers to post data_to_post with, gzipped if configured """
+    if not if_config_vars['if_compress']:
+        return data_to_post, None
+    return gzip_compress(urllib.urlencode(data_to_post)), {'Content-Type': 'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'}
+
+
+def get_request_session():
+    """ get this thread's pooled session, so connections are reused between requests """
+    # requests.Session is not thread-safe, so each upload thread gets its own
+    pid = (os.getpid(), threading.current_thread().ident)
+    if pid not in SESSIONS:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=if_config_vars['if_pool_size'],
+                                                pool_maxsize=if_config_vars['if_pool_size'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        SESSIONS[pid] = session
+    return SESSIONS[pid]
+
+
+def gzip_compress(data):
+    """ gzip a request body """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
 def send_request(url, mode='GET', failure_message='Failure!', success_message='Success!', **request_passthrough):
     """ sends a request to the given url """
     # determine if post or get (default)
-    req = requests.get
+    session = get_request_session()
+    req = session.get
     if mode.upper() == 'POST':
-        req = requests.post
+        req = session.post
 
     global REQUESTS
     REQUESTS.update(request_passthrough)
@@ -1576,7 +2001,10 @@ def send_request(url, mode='GET', failure_message='Failure!', success_message='S
     req_num = 0
     for req_num in range(ATTEMPTS):
         try:
+            request_time = time.time()
             response = req(url, **request_passthrough)
+            logger.debug('Request took {} seconds, {} bytes sent, {} bytes received'.format(
+                round(time.time() - request_time, 3), len(response.request.body or ''), len(response.content)))
             if response.status_code == httplib.OK:
                 logger.info(success_message)
                 return response
@@ -1696,11 +2124,22 @@ if __name__ == "__main__":
     FORMAT_STR = regex.compile(r"{(.*?)}")
     HOSTNAME = socket.gethostname().partition('.')[0]
     ISO8601 = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y%m%dT%H%M%SZ', 'epoch']
+    TIMESTAMP_CACHE_SIZE = 4096
+    ISO8601_FAST_FORMATS = {'YYYY-MM-DDTHH:mm:ss', 'YYYY-MM-DD HH:mm:ss'}
+    SUBSECOND = regex.compile(r"(?<=:\d\d)[.,]\d+")
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = r",|\t"
     ATTEMPTS = 3
+    SESSIONS = dict()
+    SPOOL_SEGMENT_SIZE = 8 * 1024 * 1024
+    SPOOL_MIN_BACKOFF = 1
+    SPOOL_MAX_BACKOFF = 300
+    SPOOL_RETRYABLE_STATUS = (408, 429)
     REQUESTS = dict()
     track = dict()
+    timestamp_cache = OrderedDict()
+    spool = dict()
+    upload = dict()
     metric_buffer = dict()
 
     # get config
@@ -1709,6 +2148,7 @@ if __name__ == "__main__":
     logger.debug(cli_config_vars)
     if_config_vars = get_if_config_vars()
     agent_config_vars = get_agent_config_vars()
+    extraction_plan = build_extraction_plan()
     print_summary_info()
 
     # start data processing
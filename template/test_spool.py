@@ -0,0 +1,191 @@
+"""
+Tests for the spool in insightagent-boilerplate.py, against a local HTTP server standing in for InsightFinder.
+
+    python test_spool.py
+"""
+
+import imp
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+agent = imp.load_source('agent', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                              'insightagent-boilerplate.py'))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ answers each post with the next status in the server's list, 200 once the list runs out """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        if status == 200:
+            self.server.received.append(dict(urlparse.parse_qsl(body)))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.server.statuses = []
+        self.server.received = []
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        self.spool_dir = tempfile.mkdtemp()
+        agent.logger = logging.getLogger('test_spool')
+        agent.logger.addHandler(logging.NullHandler())
+        agent.HOSTNAME = 'test-host'
+        agent.ATTEMPTS = 1
+        agent.SESSIONS = dict()
+        agent.REQUESTS = dict()
+        agent.SPOOL_SEGMENT_SIZE = 8 * 1024 * 1024
+        agent.SPOOL_MIN_BACKOFF = 1
+        agent.SPOOL_MAX_BACKOFF = 300
+        agent.SPOOL_RETRYABLE_STATUS = (408, 429)
+        agent.spool = dict()
+        agent.cli_config_vars = {'testing': False}
+        agent.if_config_vars = {
+            'user_name': 'user',
+            'license_key': 'secret-license-key',
+            'project_name': 'project',
+            'project_type': 'METRIC',
+            'is_replay': False,
+            'sampling_interval': 60,
+            'if_url': 'http://127.0.0.1:{}'.format(self.server.server_port),
+            'if_proxies': dict(),
+            'if_pool_size': 1,
+            'if_compress': False,
+            'spool_dir': self.spool_dir,
+            'spool_size': 1024 * 1024,
+        }
+        agent.start_spool_replayer()
+        # replay by hand rather than from the background thread
+        agent.spool['stop'].set()
+        agent.spool['thread'].join()
+
+    def tearDown(self):
+        for session in agent.SESSIONS.values():
+            session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.spool_dir)
+
+    def send(self, value):
+        agent.send_data_to_if([{'timestamp': '1000', 'metric[host]': str(value)}], 1)
+
+    def spool_files(self):
+        return sorted(os.listdir(self.spool_dir))
+
+    def replay(self):
+        agent.spool['stop'].clear()
+        while agent.replay_spool_segment():
+            pass
+
+    def received_values(self):
+        return [json.loads(post['metricData'])[0]['metric[host]'] for post in self.server.received]
+
+    def test_failed_chunks_are_spooled_without_the_license_key(self):
+        self.server.statuses = [503, 503]
+        self.send(1)
+        self.send(2)
+        self.assertEqual(self.server.received, [])
+        with open(os.path.join(self.spool_dir, self.spool_files()[0])) as spool_file:
+            lines = spool_file.readlines()
+        self.assertEqual(len(lines), 2)
+        self.assertNotIn('secret-license-key', ''.join(lines))
+
+    def test_replay_sends_spooled_chunks_in_order_with_account_fields(self):
+        self.server.statuses = [503, 503]
+        self.send(1)
+        self.send(2)
+        self.replay()
+        self.assertEqual(self.received_values(), ['1', '2'])
+        self.assertEqual(self.server.received[0]['licenseKey'], 'secret-license-key')
+        self.assertEqual(self.server.received[0]['userName'], 'user')
+        self.assertEqual(self.spool_files(), [])
+
+    def test_replay_keeps_unsent_chunks_while_unreachable(self):
+        self.server.statuses = [503, 503, 200, 503]
+        self.send(1)
+        self.send(2)
+        self.replay()
+        self.assertEqual(self.received_values(), ['1'])
+        self.assertEqual(len(self.spool_files()), 1)
+        self.assertTrue(self.spool_files()[0].endswith('.spool'))
+        self.replay()
+        self.assertEqual(self.received_values(), ['1', '2'])
+        self.assertEqual(self.spool_files(), [])
+
+    def test_rejected_chunk_does_not_hold_up_the_rest(self):
+        self.server.statuses = [503, 503, 503, 200, 400, 200]
+        self.send(1)
+        self.send(2)
+        self.send(3)
+        self.replay()
+        self.assertEqual(self.received_values(), ['1', '3'])
+        self.assertEqual(self.spool_files(), [])
+
+    def test_oldest_segments_are_evicted_over_the_cap(self):
+        agent.SPOOL_SEGMENT_SIZE = 1
+        agent.if_config_vars['spool_size'] = 1000
+        self.server.statuses = [503] * 10
+        for value in range(10):
+            self.send(value)
+        agent.close_spool_segment()
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(self.spool_dir, name))
+                                 for name in self.spool_files()), 1000)
+        self.replay()
+        values = self.received_values()
+        self.assertTrue(0 < len(values) < 10)
+        self.assertEqual(values, [str(value) for value in range(10 - len(values), 10)])
+
+    def test_failed_write_back_leaves_no_tmp_file(self):
+        self.server.statuses = [503, 503, 503]
+        self.send(1)
+        self.send(2)
+        rename = agent.os.rename
+
+        def failing_rename(src, dst):
+            if src.endswith('.tmp'):
+                raise OSError('no space left on device')
+            return rename(src, dst)
+        agent.os.rename = failing_rename
+        try:
+            self.replay()
+        finally:
+            agent.os.rename = rename
+        self.assertFalse([name for name in self.spool_files() if name.endswith('.tmp')])
+
+    def test_leftovers_from_dead_processes_are_released(self):
+        dead_pid = 2 ** 22 + 1
+        with open(os.path.join(self.spool_dir, '000000000000001-{}.open'.format(dead_pid)), 'w') as spool_file:
+            spool_file.write(json.dumps({'url': agent.if_config_vars['if_url'] + '/customprojectrawdata',
+                                         'data': {'metricData': json.dumps([{'metric[host]': '7'}])}}) + '\n')
+        open(os.path.join(self.spool_dir, '000000000000002-1.spool.{}.replay.tmp'.format(dead_pid)), 'w').close()
+        agent.recover_spool_segments()
+        self.assertEqual(self.spool_files(), ['000000000000001-{}.spool'.format(dead_pid)])
+        self.replay()
+        self.assertEqual(self.received_values(), ['7'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""
+Tests for the timestamp parsing and its cache in insightagent-boilerplate.py.
+
+    python test_timestamp.py
+"""
+
+import imp
+import logging
+import os
+import unittest
+from collections import OrderedDict
+
+import pytz
+import regex
+
+agent = imp.load_source('agent', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                              'insightagent-boilerplate.py'))
+
+
+class TimestampTest(unittest.TestCase):
+    def setUp(self):
+        agent.logger = logging.getLogger('test_timestamp')
+        agent.logger.addHandler(logging.NullHandler())
+        agent.SUBSECOND = regex.compile(r"(?<=:\d\d)[.,]\d+")
+        agent.TIMESTAMP_CACHE_SIZE = 4096
+        agent.ISO8601_FAST_FORMATS = {'YYYY-MM-DDTHH:mm:ss', 'YYYY-MM-DD HH:mm:ss'}
+        agent.timestamp_cache = OrderedDict()
+        agent.agent_config_vars = {'timezone': pytz.utc}
+
+    def parse(self, timestamp_formats, date_strings):
+        agent.agent_config_vars['timestamp_format'] = list(timestamp_formats)
+        return [agent.get_timestamp_from_date_string(date_string) for date_string in date_strings]
+
+    def test_fraction_is_kept_after_the_same_second_without_one(self):
+        self.assertEqual(self.parse(['YYYY-MM-DD HH:mm:ss', 'YYYY-MM-DD HH:mm:ss.SSS'],
+                                    ['2020-01-01 00:00:00', '2020-01-01 00:00:00.123', '2020-01-01 00:00:00.456']),
+                         [1577836800000, 1577836800123, 1577836800456])
+
+    def test_same_second_with_and_without_a_fraction_in_either_order(self):
+        date_strings = ['2020-01-01 00:00:00.123', '2020-01-01 00:00:00', '2020-01-01 00:00:00.5',
+                        '2020-01-01 00:00:00.456', '2020-01-01 00:00:00']
+        expected = [1577836800123, 1577836800000, 1577836800500, 1577836800456, 1577836800000]
+        self.assertEqual(self.parse(['YYYY-MM-DD HH:mm:ss.SSS', 'YYYY-MM-DD HH:mm:ss', 'YYYY-MM-DD HH:mm:ss.S'],
+                                    date_strings), expected)
+
+    def test_cached_second_keeps_each_fraction(self):
+        self.assertEqual(self.parse(['YYYY-MM-DDTHH:mm:ss.SSSZZ'],
+                                    ['2020-01-01T00:00:01.001+00:00', '2020-01-01T00:00:01.999+00:00']),
+                         [1577836801001, 1577836801999])
+
+    def test_iso8601_fast_path_matches_arrow(self):
+        date_strings = ['2020-02-29T23:59:59', '1999-12-31T00:00:00']
+        fast = self.parse(['YYYY-MM-DDTHH:mm:ss'], date_strings)
+        agent.ISO8601_FAST_FORMATS = set()
+        agent.timestamp_cache = OrderedDict()
+        self.assertEqual(fast, self.parse(['YYYY-MM-DDTHH:mm:ss'], date_strings))
+        self.assertEqual(fast, [1583020799000, 946598400000])
+
+    def test_iso8601_fast_path_is_not_used_outside_utc(self):
+        agent.agent_config_vars['timezone'] = pytz.timezone('US/Eastern')
+        self.assertEqual(self.parse(['YYYY-MM-DD HH:mm:ss'], ['2020-01-01 00:00:00']), [1577854800000])
+
+    def test_invalid_date_falls_through_to_the_next_format(self):
+        self.assertEqual(self.parse(['YYYY-MM-DD HH:mm:ss', 'YYYY-DD-MM HH:mm:ss'], ['2020-13-01 00:00:00']),
+                         [1578873600000])
+
+
+if __name__ == '__main__':
+    unittest.main()